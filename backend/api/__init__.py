@@ -5,6 +5,7 @@ from .models import router as models_router
 from .tools.image import router as image_router
 from .tools.prompts import router as prompts_router
 from .tools.doc_format import router as doc_format_router
+from .tools.doc_stream import router as doc_stream_router
 from .tools.tavily_search import router as tavily_search_router
 from .tools.language import router as language_router
 from .tools.theme import router as theme_router
@@ -22,6 +23,7 @@ api_router.include_router(auth_router, prefix="/auth", tags=["auth"])
 api_router.include_router(chat_router, prefix="/chat", tags=["chat"])
 api_router.include_router(models_router, tags=["models"])
 api_router.include_router(doc_format_router, prefix="/doc", tags=["document"])
+api_router.include_router(doc_stream_router, prefix="/doc", tags=["document"])
 api_router.include_router(image_router, tags=["images"])
 api_router.include_router(prompts_router, tags=["prompts"])
 api_router.include_router(notes_router, prefix="/notes", tags=["notes"])
@@ -17,6 +17,7 @@ from pathlib import Path
 # 添加父目录到Python路径
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 from config import ERROR_MESSAGES, SECURITY_CONFIG
+from tracing import span
 from data_path import get_avatars_dir
 
 logger = logging.getLogger(__name__)
@@ -226,14 +227,15 @@ async def get_current_user(
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECURITY_CONFIG["SECRET_KEY"], algorithms=[SECURITY_CONFIG["ALGORITHM"]])
-        username: str = payload.get("sub")
-        if username is None:
+    with span("auth"):
+        try:
+            payload = jwt.decode(token, SECURITY_CONFIG["SECRET_KEY"], algorithms=[SECURITY_CONFIG["ALGORITHM"]])
+            username: str = payload.get("sub")
+            if username is None:
+                raise credentials_exception
+        except jwt.PyJWTError:
             raise credentials_exception
-    except jwt.PyJWTError:
-        raise credentials_exception
-    user = await get_user(db, username)
+        user = await get_user(db, username)
     if user is None:
         raise credentials_exception
     return user
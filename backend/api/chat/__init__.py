@@ -36,10 +36,13 @@ from .client_pool import get_available_client
 from .message_processor import process_chat_messages, get_limited_history
 from .db_operations import save_message, verify_conversation_ownership
 from .websocket_handler import handle_websocket_connection, active_connections
+from .generation_registry import generation_registry
+from .session_handler import handle_chat_session
 
 # 导入功能模块
 from .conversation import router as conversation_router
-from .message import router as message_router, websocket_endpoint, chat, abort_generation
+from .message import router as message_router, websocket_endpoint, session_websocket_endpoint, chat, abort_generation
+from .batch import router as batch_router
 
 # 包含会话管理路由
 router.include_router(conversation_router)
@@ -47,9 +50,15 @@ router.include_router(conversation_router)
 # 包含消息处理路由
 router.include_router(message_router)
 
+# 包含批量推理任务路由
+router.include_router(batch_router)
+
 # WebSocket聊天接口
 router.websocket("/conversations/{conversation_id}/ws")(websocket_endpoint)
 
+# 长连接多路复用聊天会话
+router.websocket("/ws")(session_websocket_endpoint)
+
 # HTTP聊天接口
 @router.post("/conversations/{conversation_id}/chat")
 async def chat_endpoint(
@@ -0,0 +1,238 @@
+import asyncio
+import json
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Any, List, Optional
+
+from database import Database, db
+from config import ANALYTICS_CONFIG
+
+# 汇总表和时间桶格式
+ROLLUP_TABLES = {
+    "hour": ("stats_hourly", "%Y-%m-%dT%H"),
+    "day": ("stats_daily", "%Y-%m-%d")
+}
+
+# 直方图字段及对应的分桶
+HISTOGRAMS = {
+    "ttft_hist": "TTFT_BUCKETS_MS",
+    "latency_hist": "LATENCY_BUCKETS_MS",
+    "tps_hist": "TPS_BUCKETS"
+}
+
+SUM_COLUMNS = ("requests", "prompt_tokens", "eval_tokens", "prompt_eval_ms", "eval_ms",
+               "total_ms", "load_ms", "queue_ms", "ttft_ms")
+
+def bucket_index(buckets: List[float], value: float) -> int:
+    """值所在的分桶下标，超过最大分桶时落在最后的溢出桶"""
+    for i, bound in enumerate(buckets):
+        if value <= bound:
+            return i
+    return len(buckets)
+
+def histogram_percentile(buckets: List[float], counts: List[int], q: float) -> Optional[float]:
+    """从分桶计数估算分位数，桶内按线性插值"""
+    total = sum(counts)
+    if not total:
+        return None
+    rank = q * total
+    cumulative = 0
+    for i, count in enumerate(counts):
+        if count and cumulative + count >= rank:
+            if i >= len(buckets):
+                return float(buckets[-1])
+            lower = buckets[i - 1] if i > 0 else 0.0
+            return round(lower + (buckets[i] - lower) * (rank - cumulative) / count, 2)
+        cumulative += count
+    return float(buckets[-1])
+
+def _ms(nanoseconds: Optional[int]) -> int:
+    return int((nanoseconds or 0) / 1e6)
+
+class GenerationStats:
+    """生成统计
+
+    保存每条助手回复的 Ollama 生成统计（总耗时、加载、提示词评估、生成）以及服务端的排队时间
+    和首 token 延迟，并按小时、按天汇总到 stats_hourly / stats_daily 表（按模型和用户），
+    汇总表保存各项总和与直方图，用于计算生成速度和延迟分位数。
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        # 汇总表的直方图需要读取后再写入，串行化避免并发更新丢失
+        self._lock = asyncio.Lock()
+        self._last_prune = 0.0
+        self.records_total = 0
+        self.failures_total = 0
+
+    async def record(
+        self,
+        username: str,
+        model: str,
+        stats: Optional[Dict[str, Any]],
+        message_id: Optional[int] = None,
+        conversation_id: Optional[str] = None
+    ) -> None:
+        """记录一次生成的统计，message_id 为空时（如批量任务）只计入汇总"""
+        if not ANALYTICS_CONFIG["ENABLED"] or not stats or "eval_count" not in stats:
+            return
+        row = {
+            "total_ms": _ms(stats.get("total_duration")),
+            "load_ms": _ms(stats.get("load_duration")),
+            "queue_ms": _ms(stats.get("queue_duration")),
+            "ttft_ms": _ms(stats.get("first_token_duration")),
+            "prompt_tokens": stats.get("prompt_eval_count") or 0,
+            "prompt_eval_ms": _ms(stats.get("prompt_eval_duration")),
+            "eval_tokens": stats.get("eval_count") or 0,
+            "eval_ms": _ms(stats.get("eval_duration"))
+        }
+        try:
+            async with self._lock:
+                if message_id is not None:
+                    await self.db.execute(
+                        f"""
+                        INSERT OR REPLACE INTO message_stats
+                            (message_id, conversation_id, user_id, model, {", ".join(row)})
+                        VALUES (?, ?, ?, ?, {", ".join("?" for _ in row)})
+                        """,
+                        (message_id, conversation_id, username, model, *row.values())
+                    )
+                now = datetime.now()
+                for period, (table, fmt) in ROLLUP_TABLES.items():
+                    await self._rollup(table, now.strftime(fmt), username, model, row)
+                await self.db.commit()
+            self.records_total += 1
+        except Exception as e:
+            self.failures_total += 1
+            logging.error(f"记录生成统计失败: {e}")
+            return
+
+        if time.monotonic() - self._last_prune > 3600:
+            await self.prune()
+
+    async def _rollup(self, table: str, bucket: str, username: str, model: str, row: Dict[str, int]) -> None:
+        current = await self.db.fetch_one(
+            f"SELECT * FROM {table} WHERE bucket = ? AND user_id = ? AND model = ?",
+            (bucket, username, model)
+        )
+        values = {column: (current[column] if current else 0) for column in SUM_COLUMNS}
+        values["requests"] += 1
+        for column, value in row.items():
+            values[column] += value
+
+        tokens_per_second = row["eval_tokens"] / (row["eval_ms"] / 1000) if row["eval_ms"] else None
+        observed = {
+            "ttft_hist": row["ttft_ms"],
+            "latency_hist": row["total_ms"],
+            "tps_hist": tokens_per_second
+        }
+        for column, config_key in HISTOGRAMS.items():
+            buckets = ANALYTICS_CONFIG[config_key]
+            counts = json.loads(current[column]) if current and current[column] else [0] * (len(buckets) + 1)
+            if observed[column] is not None:
+                counts[bucket_index(buckets, observed[column])] += 1
+            values[column] = json.dumps(counts)
+
+        columns = list(values)
+        await self.db.execute(
+            f"""
+            INSERT OR REPLACE INTO {table} (bucket, user_id, model, {", ".join(columns)})
+            VALUES (?, ?, ?, {", ".join("?" for _ in columns)})
+            """,
+            (bucket, username, model, *values.values())
+        )
+
+    async def prune(self) -> None:
+        """删除超过保留期的按小时汇总数据"""
+        self._last_prune = time.monotonic()
+        cutoff = (datetime.now() - timedelta(days=ANALYTICS_CONFIG["HOURLY_RETENTION_DAYS"])).strftime("%Y-%m-%dT%H")
+        try:
+            await self.db.execute("DELETE FROM stats_hourly WHERE bucket < ?", (cutoff,))
+            await self.db.commit()
+        except Exception as e:
+            logging.warning(f"清理按小时汇总的生成统计失败: {e}")
+
+    async def query(
+        self,
+        username: str,
+        period: str = "day",
+        days: int = 7,
+        model: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """查询汇总统计
+
+        Returns:
+            按模型合并的总体统计（生成速度、首 token 延迟和总耗时的分位数），以及按时间桶的序列
+        """
+        table, fmt = ROLLUP_TABLES[period]
+        since = (datetime.now() - timedelta(days=days)).strftime(fmt)
+        query = f"SELECT * FROM {table} WHERE user_id = ? AND bucket >= ?"
+        params: tuple = (username, since)
+        if model:
+            query += " AND model = ?"
+            params += (model,)
+        rows = await self.db.fetch_all(query + " ORDER BY bucket ASC, model ASC", params)
+
+        merged: Dict[str, Dict[str, Any]] = {}
+        series = []
+        for row in rows:
+            series.append({"bucket": row["bucket"], **self._summarize(row)})
+            total = merged.setdefault(row["model"], {
+                **{column: 0 for column in SUM_COLUMNS},
+                **{column: [0] * (len(ANALYTICS_CONFIG[key]) + 1) for column, key in HISTOGRAMS.items()},
+                "model": row["model"]
+            })
+            for column in SUM_COLUMNS:
+                total[column] += row[column]
+            for column in HISTOGRAMS:
+                if row[column]:
+                    total[column] = [a + b for a, b in zip(total[column], json.loads(row[column]))]
+
+        return {
+            "period": period,
+            "since": since,
+            "models": [self._summarize(total) for total in merged.values()],
+            "series": series
+        }
+
+    def _summarize(self, row: Dict[str, Any]) -> Dict[str, Any]:
+        requests = row["requests"] or 0
+        histograms = {
+            column: json.loads(row[column]) if isinstance(row[column], str) else row[column]
+            for column in HISTOGRAMS
+        }
+        summary = {
+            "model": row["model"],
+            "requests": requests,
+            "prompt_tokens": row["prompt_tokens"],
+            "eval_tokens": row["eval_tokens"],
+            # 整体速度按总 token 数除以总耗时计算，不受单次请求长短的影响
+            "tokens_per_second": round(row["eval_tokens"] / (row["eval_ms"] / 1000), 2) if row["eval_ms"] else None,
+            "prompt_tokens_per_second": round(row["prompt_tokens"] / (row["prompt_eval_ms"] / 1000), 2) if row["prompt_eval_ms"] else None,
+            "avg_ttft_ms": round(row["ttft_ms"] / requests) if requests else None,
+            "avg_queue_ms": round(row["queue_ms"] / requests) if requests else None,
+            "avg_load_ms": round(row["load_ms"] / requests) if requests else None,
+            "avg_total_ms": round(row["total_ms"] / requests) if requests else None
+        }
+        for name, column, config_key in (
+            ("ttft_ms", "ttft_hist", "TTFT_BUCKETS_MS"),
+            ("total_ms", "latency_hist", "LATENCY_BUCKETS_MS"),
+            ("tokens_per_second", "tps_hist", "TPS_BUCKETS")
+        ):
+            counts = histograms[column]
+            if not counts:
+                continue
+            for q in (0.5, 0.9, 0.99):
+                summary[f"{name}_p{int(q * 100)}"] = histogram_percentile(ANALYTICS_CONFIG[config_key], counts, q)
+        return summary
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": ANALYTICS_CONFIG["ENABLED"],
+            "records_total": self.records_total,
+            "failures_total": self.failures_total
+        }
+
+# 全局生成统计
+generation_stats = GenerationStats(db)
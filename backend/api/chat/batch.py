@@ -0,0 +1,456 @@
+import asyncio
+import json
+import logging
+import time
+import uuid
+from collections import deque
+from contextlib import aclosing
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Set
+
+from fastapi import APIRouter, Depends, HTTPException
+from fastapi.responses import StreamingResponse
+from pydantic import ValidationError
+
+from ollama.types import ChatMessage, ChatRequest, Options
+from database import Database, db, get_db
+from api.auth import get_current_user
+from api.sse import format_sse, sse_response
+from config import BATCH_CONFIG
+from .schemas import BatchJobCreate
+from .client_pool import get_available_client
+from .residency import residency_manager
+from .scheduler import Priority, QueueFullError, get_scheduler
+from .analytics import generation_stats
+
+router = APIRouter(prefix="/batch")
+
+# 已结束的任务状态
+FINISHED_STATUSES = ("completed", "cancelled", "failed")
+
+class BatchManager:
+    """批量推理任务
+
+    任务和每条提示词保存在 batch_jobs / batch_items 表中，由后台 worker 以 BACKGROUND 优先级
+    逐条生成：调度器总是先满足交互式聊天，批量任务只使用空闲的槽位。
+    worker 总数默认比调度器槽位少一个，始终为交互式请求保留余量。
+    每条结果生成后立即写入数据库，后端重启后从未完成的条目继续。
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = {}
+        self._workers: Optional[asyncio.Semaphore] = None
+        self.items_total = 0
+        self.items_failed = 0
+
+    @property
+    def max_workers(self) -> int:
+        return BATCH_CONFIG["MAX_WORKERS"] or max(1, get_scheduler().capacity - 1)
+
+    async def start(self) -> None:
+        """恢复重启前未完成的任务"""
+        try:
+            await self.db.ensure_connected()
+            # 重启前正在处理的条目重新排队
+            await self.db.execute("UPDATE batch_items SET status = 'pending' WHERE status = 'running'")
+            await self.db.commit()
+            jobs = await self.db.fetch_all(
+                "SELECT id FROM batch_jobs WHERE status IN ('queued', 'running') ORDER BY created_at ASC"
+            )
+        except Exception as e:
+            logging.error(f"恢复批量任务失败: {e}")
+            return
+        for job in jobs:
+            self._spawn(job["id"])
+        if jobs:
+            logging.info(f"已恢复 {len(jobs)} 个未完成的批量任务")
+
+    async def stop(self) -> None:
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    async def submit(self, username: str, request: BatchJobCreate) -> Dict[str, Any]:
+        """创建任务并开始处理"""
+        job_id = str(uuid.uuid4())
+        now = datetime.now().isoformat()
+        await self.db.execute(
+            """
+            INSERT INTO batch_jobs (id, user_id, model, system_prompt, options, status, total, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?, 'queued', ?, ?, ?)
+            """,
+            (job_id, username, request.model, request.system,
+             json.dumps(request.options) if request.options else None, len(request.prompts), now, now)
+        )
+        await self.db.executemany(
+            "INSERT INTO batch_items (job_id, idx, prompt) VALUES (?, ?, ?)",
+            [(job_id, idx, prompt) for idx, prompt in enumerate(request.prompts)]
+        )
+        await self.db.commit()
+        logging.info(f"用户 {username} 创建了批量任务 {job_id}，模型 {request.model}，共 {len(request.prompts)} 条")
+        self._spawn(job_id)
+        return await self.get_job(job_id)
+
+    async def get_job(self, job_id: str, username: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """获取任务信息，指定用户时只返回该用户的任务"""
+        query = """
+            SELECT id, user_id, model, status, error, total, completed, failed, created_at, updated_at, finished_at
+            FROM batch_jobs WHERE id = ?
+        """
+        params: tuple = (job_id,)
+        if username is not None:
+            query += " AND user_id = ?"
+            params += (username,)
+        job = await self.db.fetch_one(query, params)
+        if job:
+            job["pending"] = job["total"] - job["completed"] - job["failed"]
+        return job
+
+    async def list_jobs(self, username: str) -> List[Dict[str, Any]]:
+        jobs = await self.db.fetch_all(
+            """
+            SELECT id, user_id, model, status, error, total, completed, failed, created_at, updated_at, finished_at
+            FROM batch_jobs WHERE user_id = ?
+            ORDER BY created_at DESC
+            """,
+            (username,)
+        )
+        for job in jobs:
+            job["pending"] = job["total"] - job["completed"] - job["failed"]
+        return jobs
+
+    async def cancel(self, job_id: str) -> None:
+        """取消任务，已生成的结果保留"""
+        task = self._tasks.pop(job_id, None)
+        if task is not None:
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await self.db.execute("UPDATE batch_items SET status = 'pending' WHERE job_id = ? AND status = 'running'", (job_id,))
+        await self._finish(job_id, "cancelled")
+
+    async def delete(self, job_id: str) -> None:
+        """删除任务及其结果"""
+        await self.cancel(job_id)
+        await self.db.execute("DELETE FROM batch_items WHERE job_id = ?", (job_id,))
+        await self.db.execute("DELETE FROM batch_jobs WHERE id = ?", (job_id,))
+        await self.db.commit()
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+        self._subscribers.setdefault(job_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue) -> None:
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[job_id]
+
+    def _publish(self, job_id: str, event: str, data: Dict[str, Any]) -> None:
+        for queue in self._subscribers.get(job_id, ()):
+            if queue.full():
+                # 读取过慢的订阅者丢弃最早的事件，进度事件本身带有完整计数
+                queue.get_nowait()
+            queue.put_nowait({"event": event, "data": data})
+
+    def _spawn(self, job_id: str) -> None:
+        if self._workers is None:
+            self._workers = asyncio.Semaphore(self.max_workers)
+        task = self._tasks.get(job_id)
+        if task is not None and not task.done():
+            return
+        self._tasks[job_id] = asyncio.create_task(self._run(job_id))
+
+    async def _run(self, job_id: str) -> None:
+        try:
+            job = await self.db.fetch_one(
+                "SELECT id, user_id, model, system_prompt, options, status FROM batch_jobs WHERE id = ?",
+                (job_id,)
+            )
+            if not job or job["status"] in FINISHED_STATUSES:
+                return
+            items = await self.db.fetch_all(
+                "SELECT idx, prompt, attempts FROM batch_items WHERE job_id = ? AND status = 'pending' ORDER BY idx ASC",
+                (job_id,)
+            )
+            await self.db.execute(
+                "UPDATE batch_jobs SET status = 'running', updated_at = ? WHERE id = ?",
+                (datetime.now().isoformat(), job_id)
+            )
+            await self.db.commit()
+
+            options = Options(**json.loads(job["options"])) if job["options"] else None
+            pending = deque(items)
+            workers = min(self.max_workers, len(pending))
+            await asyncio.gather(*(self._worker(job, options, pending) for _ in range(workers)))
+            await self._finish(job_id, "completed")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 意外异常（例如数据库错误）不会自行恢复，标记为失败并记录原因，避免任务一直停留在 running
+            logging.error(f"批量任务 {job_id} 异常中止: {e}")
+            logging.exception(e)
+            try:
+                await self.db.execute("UPDATE batch_items SET status = 'pending' WHERE job_id = ? AND status = 'running'", (job_id,))
+                await self._finish(job_id, "failed", error=str(e) or type(e).__name__)
+            except Exception as finish_error:
+                logging.error(f"标记批量任务 {job_id} 失败时出错: {finish_error}")
+        finally:
+            if self._tasks.get(job_id) is asyncio.current_task():
+                del self._tasks[job_id]
+
+    async def _worker(self, job: Dict[str, Any], options: Optional[Options], pending: deque) -> None:
+        """逐条取出待处理的条目生成，直到队列为空"""
+        while pending:
+            item = pending.popleft()
+            async with self._workers:
+                await self._process(job, options, item)
+
+    async def _process(self, job: Dict[str, Any], options: Optional[Options], item: Dict[str, Any]) -> None:
+        job_id = job["id"]
+        await self.db.execute(
+            "UPDATE batch_items SET status = 'running', updated_at = ? WHERE job_id = ? AND idx = ?",
+            (datetime.now().isoformat(), job_id, item["idx"])
+        )
+        await self.db.commit()
+
+        attempts = item["attempts"]
+        error = None
+        while attempts < BATCH_CONFIG["MAX_ATTEMPTS"]:
+            attempts += 1
+            started = time.monotonic()
+            try:
+                content, stats = await self._generate(job, options, item["prompt"])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = str(e)
+                logging.warning(f"批量任务 {job_id} 第 {item['idx']} 条第 {attempts} 次生成失败: {error}")
+                continue
+
+            duration = round(time.monotonic() - started, 3)
+            await self.db.execute(
+                """
+                UPDATE batch_items
+                SET status = 'done', response = ?, error = NULL, attempts = ?,
+                    prompt_eval_count = ?, eval_count = ?, duration = ?, updated_at = ?
+                WHERE job_id = ? AND idx = ?
+                """,
+                (content, attempts, stats.get("prompt_eval_count"), stats.get("eval_count"), duration,
+                 datetime.now().isoformat(), job_id, item["idx"])
+            )
+            await self._increment(job_id, "completed")
+            await generation_stats.record(job["user_id"], job["model"], stats)
+            self.items_total += 1
+            self._publish(job_id, "item", {"index": item["idx"], "status": "done", "duration": duration,
+                                           "eval_count": stats.get("eval_count")})
+            await self._publish_progress(job_id)
+            return
+
+        await self.db.execute(
+            "UPDATE batch_items SET status = 'error', error = ?, attempts = ?, updated_at = ? WHERE job_id = ? AND idx = ?",
+            (error, attempts, datetime.now().isoformat(), job_id, item["idx"])
+        )
+        await self._increment(job_id, "failed")
+        self.items_total += 1
+        self.items_failed += 1
+        self._publish(job_id, "item", {"index": item["idx"], "status": "error", "error": error})
+        await self._publish_progress(job_id)
+
+    async def _generate(self, job: Dict[str, Any], options: Optional[Options], prompt: str):
+        """以后台优先级生成一条回复，返回 (内容, 统计信息)"""
+        model = job["model"]
+        messages = []
+        if job["system_prompt"]:
+            messages.append(ChatMessage(role="system", content=job["system_prompt"]))
+        messages.append(ChatMessage(role="user", content=prompt))
+        request = ChatRequest(
+            model=model,
+            messages=messages,
+            options=options,
+            keep_alive=residency_manager.keep_alive_for(model)
+        )
+
+        while True:
+            client, _, slot = await get_available_client(model=model, username=job["user_id"], priority=Priority.BACKGROUND)
+            content = ""
+            stats: Dict[str, Any] = {}
+            try:
+                async with slot:
+                    async with aclosing(client.chat_lazy(request)) as chunks:
+                        async for chunk in chunks:
+                            if chunk.error:
+                                raise RuntimeError(chunk.error)
+                            content += chunk.content
+                            if chunk.done:
+                                stats = chunk.stats
+                return content, stats
+            except QueueFullError:
+                # 队列已满时等待后重新排队，而不是把条目记为失败（进入槽位前被拒绝，尚未生成任何内容）
+                await asyncio.sleep(BATCH_CONFIG["QUEUE_RETRY_DELAY"])
+
+    async def _increment(self, job_id: str, column: str) -> None:
+        await self.db.execute(
+            f"UPDATE batch_jobs SET {column} = {column} + 1, updated_at = ? WHERE id = ?",
+            (datetime.now().isoformat(), job_id)
+        )
+        await self.db.commit()
+
+    async def _publish_progress(self, job_id: str) -> None:
+        if not self._subscribers.get(job_id):
+            return
+        job = await self.get_job(job_id)
+        if job:
+            self._publish(job_id, "progress", job)
+
+    async def _finish(self, job_id: str, status: str, error: Optional[str] = None) -> None:
+        now = datetime.now().isoformat()
+        await self.db.execute(
+            f"UPDATE batch_jobs SET status = ?, error = ?, finished_at = ?, updated_at = ? "
+            f"WHERE id = ? AND status NOT IN ({', '.join('?' * len(FINISHED_STATUSES))})",
+            (status, error, now, now, job_id, *FINISHED_STATUSES)
+        )
+        await self.db.commit()
+        job = await self.get_job(job_id)
+        if job:
+            logging.info(f"批量任务 {job_id} 已结束: {job['status']}，成功 {job['completed']} 条，失败 {job['failed']} 条")
+            self._publish(job_id, "finished", job)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "max_workers": self.max_workers,
+            "running_jobs": len(self._tasks),
+            "items_total": self.items_total,
+            "items_failed": self.items_failed
+        }
+
+# 全局批量任务管理器
+batch_manager = BatchManager(db)
+
+async def get_owned_job(job_id: str, username: str) -> Dict[str, Any]:
+    job = await batch_manager.get_job(job_id, username)
+    if not job:
+        raise HTTPException(status_code=404, detail="批量任务不存在或您无权访问")
+    return job
+
+@router.post("/jobs")
+async def create_batch_job(
+    request: BatchJobCreate,
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    db: Database = Depends(get_db)
+):
+    """提交批量推理任务，立即返回任务信息，生成在后台进行"""
+    prompts = [prompt for prompt in request.prompts if prompt and prompt.strip()]
+    if not prompts:
+        raise HTTPException(status_code=400, detail="提示词列表不能为空")
+    if len(prompts) > BATCH_CONFIG["MAX_PROMPTS"]:
+        raise HTTPException(status_code=400, detail=f"单个任务最多 {BATCH_CONFIG['MAX_PROMPTS']} 条提示词")
+    if request.options:
+        try:
+            Options(**request.options)
+        except ValidationError as e:
+            raise HTTPException(status_code=400, detail=f"生成参数无效: {e}")
+    request.prompts = prompts
+    return await batch_manager.submit(current_user["username"], request)
+
+@router.get("/jobs")
+async def list_batch_jobs(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取当前用户的批量任务列表"""
+    return await batch_manager.list_jobs(current_user["username"])
+
+@router.get("/metrics")
+async def get_batch_metrics(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取批量任务 worker 的状态"""
+    return batch_manager.snapshot()
+
+@router.get("/jobs/{job_id}")
+async def get_batch_job(job_id: str, current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取批量任务的进度"""
+    return await get_owned_job(job_id, current_user["username"])
+
+@router.get("/jobs/{job_id}/events")
+async def stream_batch_job_events(job_id: str, current_user: Dict[str, Any] = Depends(get_current_user)):
+    """以 SSE 推送任务进度：先发送一次当前进度，之后每条完成时推送 item 和 progress 事件，结束时推送 finished"""
+    await get_owned_job(job_id, current_user["username"])
+
+    async def events():
+        queue = batch_manager.subscribe(job_id)
+        try:
+            job = await batch_manager.get_job(job_id)
+            if job is None:
+                return
+            if job["status"] in FINISHED_STATUSES:
+                yield format_sse("finished", job)
+                return
+            yield format_sse("progress", job)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), BATCH_CONFIG["SSE_KEEPALIVE"])
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                yield format_sse(event["event"], event["data"])
+                if event["event"] == "finished":
+                    return
+        finally:
+            batch_manager.unsubscribe(job_id, queue)
+
+    return sse_response(events())
+
+@router.get("/jobs/{job_id}/results")
+async def download_batch_results(
+    job_id: str,
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    db: Database = Depends(get_db)
+):
+    """以 NDJSON 下载任务结果，每行一条，按提交顺序排列（未完成的条目 status 为 pending）"""
+    await get_owned_job(job_id, current_user["username"])
+
+    async def lines():
+        last_idx = -1
+        while True:
+            rows = await db.fetch_all(
+                """
+                SELECT idx, prompt, status, response, error, attempts, prompt_eval_count, eval_count, duration
+                FROM batch_items
+                WHERE job_id = ? AND idx > ?
+                ORDER BY idx ASC
+                LIMIT ?
+                """,
+                (job_id, last_idx, BATCH_CONFIG["RESULTS_PAGE_SIZE"])
+            )
+            if not rows:
+                return
+            chunk = ""
+            for row in rows:
+                last_idx = row.pop("idx")
+                chunk += json.dumps({"index": last_idx, **row}, ensure_ascii=False) + "\n"
+            yield chunk
+
+    return StreamingResponse(
+        lines(),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="batch-{job_id}.ndjson"'}
+    )
+
+@router.post("/jobs/{job_id}/cancel")
+async def cancel_batch_job(job_id: str, current_user: Dict[str, Any] = Depends(get_current_user)):
+    """取消批量任务，已生成的结果仍可下载"""
+    job = await get_owned_job(job_id, current_user["username"])
+    if job["status"] in FINISHED_STATUSES:
+        return job
+    await batch_manager.cancel(job_id)
+    return await batch_manager.get_job(job_id)
+
+@router.delete("/jobs/{job_id}")
+async def delete_batch_job(job_id: str, current_user: Dict[str, Any] = Depends(get_current_user)):
+    """删除批量任务及其结果"""
+    await get_owned_job(job_id, current_user["username"])
+    await batch_manager.delete(job_id)
+    return {"status": "success", "message": "批量任务已删除"}
@@ -1,79 +1,82 @@
 import asyncio
 import logging
-import os
-from typing import Dict, Tuple
+import time
+from typing import Dict, List, Tuple
 
 from fastapi import WebSocket
 from ollama.client import OllamaClient
-from ollama.types import ChatMessage, ChatRequest
+from metrics import model_load_seconds
 
-from config import API_CONFIG
 from .schemas import ModelLoadingStatus
+from .scheduler import FairScheduler, Priority, SchedulerSlot, get_scheduler
+from .residency import residency_manager
+from .node_registry import NodeRegistry, node_registry, normalize_model
 
 # 全局客户端池
 client_pool = None
 
 # 定义ClientPool类
 class ClientPool:
-    """Ollama客户端池，用于管理多个并发请求和模型加载"""
+    """Ollama客户端池，用于管理多个并发请求和模型加载
     
-    def __init__(self, max_clients: int, semaphore: asyncio.Semaphore):
+    每个 Ollama 节点对应一个客户端，由节点注册表按模型亲和和负载选择节点
+    """
+    
+    def __init__(self, registry: NodeRegistry, scheduler: FairScheduler):
         """初始化客户端池
         Args:
-            max_clients: 最大客户端数量
-            semaphore: 用于限制并发请求的信号量
+            registry: Ollama 节点注册表
+            scheduler: 用于限制并发请求的公平调度器
         """
-        self.max_clients = max_clients
-        self.semaphore = semaphore
-        self.clients = [OllamaClient(API_CONFIG["OLLAMA_BASE_URL"]) for _ in range(max_clients)]
-        self.model_locks = {}  # 模型加载锁
-        self.model_client_map = {}  # 模型到客户端的映射
-        self.client_model_map = {i: None for i in range(max_clients)}  # 客户端到模型的映射
-        logging.info(f"已创建客户端池，包含 {max_clients} 个客户端")
+        self.registry = registry
+        self.scheduler = scheduler
+        self.model_locks = {}  # 模型加载锁，按 (节点, 模型) 区分
+        logging.info(f"已创建客户端池，包含 {len(registry.nodes)} 个 Ollama 节点")
+    
+    @property
+    def clients(self) -> List[OllamaClient]:
+        return [node.client for node in self.registry.nodes]
     
     def get_default_client(self) -> Tuple[OllamaClient, int]:
-        """获取默认客户端"""
-        # 简单循环选择策略
-        client_id = 0
-        return self.clients[client_id], client_id
+        """获取默认客户端（进行中请求最少的节点）"""
+        node = self.registry.select()
+        return node.client, self.registry.nodes.index(node)
     
-    async def get_client_for_model(self, model: str) -> int:
-        """获取指定模型的客户端ID
-        如果模型未加载，会加载模型
+    def select_client(self, model: str) -> int:
+        """选择处理该模型请求的客户端ID，优先选择已加载该模型的节点"""
+        node = self.registry.select(model)
+        return self.registry.nodes.index(node)
+
+    async def prepare_model(self, client_id: int, model: str) -> None:
+        """确保模型已加载到指定客户端
+        本机节点未加载时先在内存预算内腾出空间再加载；在获得调度槽位后调用，
+        淘汰和加载模型同样按公平排队的顺序进行
         Args:
+            client_id: 客户端ID
             model: 模型名称
-        Returns:
-            客户端ID
         """
-        # 如果模型已经分配给某个客户端，直接返回
-        if model in self.model_client_map:
-            return self.model_client_map[model]
+        node = self.registry.nodes[client_id]
+        key = (node.base_url, model)
         
         # 如果尚未为这个模型创建锁，创建一个
-        if model not in self.model_locks:
-            self.model_locks[model] = asyncio.Lock()
+        if key not in self.model_locks:
+            self.model_locks[key] = asyncio.Lock()
         
         # 使用锁确保模型只被加载一次
-        async with self.model_locks[model]:
-            # 双重检查模型是否已经分配
-            if model in self.model_client_map:
-                return self.model_client_map[model]
+        async with self.model_locks[key]:
+            # 内存预算只管理本机的 Ollama，其他节点由各自的 Ollama 管理内存
+            local = node.base_url == residency_manager.client.base_url
+            if local:
+                if await residency_manager.ensure_capacity(model):
+                    return
+            elif node.has_model(model):
+                return
             
-            # 查找空闲客户端
-            for client_id, current_model in self.client_model_map.items():
-                if current_model is None:
-                    logging.info(f"为模型 {model} 分配空闲客户端 {client_id}")
-                    # 分配模型
-                    self.model_client_map[model] = client_id
-                    self.client_model_map[client_id] = model
-                    
-                    # 确保模型已加载
-                    await self._load_model(client_id, model)
-                    return client_id
-            
-            # 如果没有空闲客户端，选择一个替换
-            client_id = await self._select_client_to_replace(model)
-            return client_id
+            # 确保模型已加载
+            await self._load_model(client_id, model)
+            node.models.add(normalize_model(model))
+            if local:
+                residency_manager.mark_loaded(model)
     
     async def _load_model(self, client_id: int, model: str) -> None:
         """在指定客户端上加载模型
@@ -82,131 +85,98 @@ class ClientPool:
             model: 模型名称
         """
         try:
-            logging.info(f"在客户端 {client_id} 上加载模型 {model}")
-            # 这里可以添加调用Ollama API加载模型的代码
-            # 简单示例：发送一个简短的消息来预热模型
+            logging.info(f"在客户端 {client_id}（{self.clients[client_id].base_url}）上加载模型 {model}")
+            # 空提示词的请求只加载模型，不生成内容
             client = self.clients[client_id]
-            request = ChatRequest(
-                model=model,
-                messages=[ChatMessage(role="user", content="Hello")],
-                stream=False
-            )
+            started = time.perf_counter()
+            await client.load_model(model, keep_alive=residency_manager.keep_alive_for(model))
+            model_load_seconds.observe(time.perf_counter() - started, model=model)
             
-            async for _ in client.chat(request):
-                pass  # 忽略响应内容，只是为了加载模型
-                
             logging.info(f"模型 {model} 已成功加载到客户端 {client_id}")
         except Exception as e:
             logging.error(f"加载模型 {model} 到客户端 {client_id} 失败: {e}")
-            # 清除映射关系
-            if model in self.model_client_map:
-                del self.model_client_map[model]
-            self.client_model_map[client_id] = None
             raise e
-    
-    async def _select_client_to_replace(self, model: str) -> int:
-        """选择一个客户端替换其当前模型
-        使用简单的循环策略
-        Args:
-            model: 新模型名称
-        Returns:
-            选中的客户端ID
-        """
-        client_id = 0  # 默认选择第一个客户端
-        
-        # 获取当前加载的模型
-        old_model = self.client_model_map[client_id]
-        logging.info(f"替换客户端 {client_id} 上的模型 {old_model} 为 {model}")
-        
-        # 如果有旧模型，更新映射
-        if old_model and old_model in self.model_client_map:
-            del self.model_client_map[old_model]
-        
-        # 更新新模型的映射
-        self.model_client_map[model] = client_id
-        self.client_model_map[client_id] = model
-        
-        # 加载新模型
-        await self._load_model(client_id, model)
-        return client_id
 
 # 获取可用客户端
-async def get_available_client(model: str = None, websocket: WebSocket = None) -> Tuple[OllamaClient, int, asyncio.Semaphore]:
+async def get_available_client(
+    model: str = None,
+    websocket: WebSocket = None,
+    username: str = None,
+    priority: Priority = Priority.INTERACTIVE
+) -> Tuple[OllamaClient, int, SchedulerSlot]:
     """
     获取可用的Ollama客户端
-    如果指定了WebSocket，在模型加载时会发送加载状态
+    如果指定了WebSocket，在模型加载时会发送加载状态，排队时会推送排队位置
+    
+    返回的调度槽位用法与信号量相同（`async with slot:`），进入时按用户公平排队，
+    获得槽位后才淘汰其他模型并加载所需的模型
     """
     global client_pool
     
     # 初始化客户端池
     if client_pool is None:
         logging.info("初始化Ollama客户端池")
-        
-        # 从配置获取并发请求数
-        max_concurrent = API_CONFIG.get("MAX_CONCURRENT_REQUESTS", 4)
-        
-        # 如果配置不存在，使用合理的默认值
-        if not isinstance(max_concurrent, int) or max_concurrent <= 0:
-            max_concurrent = os.cpu_count() or 4
-            logging.info(f"使用默认并发数: {max_concurrent}")
-        else:
-            logging.info(f"使用配置的并发数: {max_concurrent}")
-        
-        # 初始化信号量
-        request_semaphore = asyncio.Semaphore(max_concurrent)
-        
-        # 初始化客户端池
-        client_pool = ClientPool(max_concurrent, request_semaphore)
+        client_pool = ClientPool(node_registry, get_scheduler())
+    
+    # 如果没有指定模型，返回默认客户端
+    if not model:
+        client, client_id = client_pool.get_default_client()
+        return client, client_id, client_pool.scheduler.slot(username, priority, notifier=websocket)
+    
+    client_id = client_pool.select_client(model)
+    
+    async def prepare():
+        await _prepare_model(client_id, model, websocket)
+    
+    # 从开始排队起标记模型正在使用，排队期间不会因为其他模型的加载而被淘汰
+    slot = client_pool.scheduler.slot(
+        username, priority, notifier=websocket, model=model,
+        prepare=prepare, hold=lambda: residency_manager.in_use(model)
+    )
+    return client_pool.clients[client_id], client_id, slot
+
+async def _prepare_model(client_id: int, model: str, websocket: WebSocket = None) -> None:
+    """获得调度槽位后加载模型，如果有WebSocket连接，发送模型加载状态"""
+    if websocket:
+        try:
+            await websocket.send_json({
+                "type": "model_loading",
+                "status": ModelLoadingStatus.LOADING,
+                "message": f"正在加载模型 {model}...",
+                "progress": 0,
+                "model": model
+            })
+        except Exception as e:
+            logging.error(f"发送模型加载状态失败: {e}")
     
-    # 如果指定了模型，尝试获取对应的客户端
-    if model:
-        # 如果有WebSocket连接，发送模型加载状态
+    try:
+        await client_pool.prepare_model(client_id, model)
+    except Exception as e:
+        logging.error(f"获取模型 {model} 客户端失败: {e}")
+        
+        # 如果有WebSocket连接，发送模型加载失败状态
         if websocket:
             try:
                 await websocket.send_json({
                     "type": "model_loading",
-                    "status": ModelLoadingStatus.LOADING,
-                    "message": f"正在加载模型 {model}...",
-                    "progress": 0,
+                    "status": ModelLoadingStatus.ERROR,
+                    "message": f"模型 {model} 加载失败: {str(e)}",
                     "model": model
                 })
             except Exception as e:
-                logging.error(f"发送模型加载状态失败: {e}")
-        
+                logging.error(f"发送模型加载失败状态失败: {e}")
+                
+        raise e
+    
+    # 如果有WebSocket连接，发送模型加载完成状态
+    if websocket:
         try:
-            client_id = await client_pool.get_client_for_model(model)
-            
-            # 如果有WebSocket连接，发送模型加载完成状态
-            if websocket:
-                try:
-                    await websocket.send_json({
-                        "type": "model_loading",
-                        "status": ModelLoadingStatus.READY,
-                        "message": f"模型 {model} 加载完成",
-                        "progress": 100,
-                        "model": model
-                    })
-                except Exception as e:
-                    logging.error(f"发送模型加载完成状态失败: {e}")
-                    
-            return client_pool.clients[client_id], client_id, client_pool.semaphore
+            await websocket.send_json({
+                "type": "model_loading",
+                "status": ModelLoadingStatus.READY,
+                "message": f"模型 {model} 加载完成",
+                "progress": 100,
+                "model": model
+            })
         except Exception as e:
-            logging.error(f"获取模型 {model} 客户端失败: {e}")
-            
-            # 如果有WebSocket连接，发送模型加载失败状态
-            if websocket:
-                try:
-                    await websocket.send_json({
-                        "type": "model_loading",
-                        "status": ModelLoadingStatus.ERROR,
-                        "message": f"模型 {model} 加载失败: {str(e)}",
-                        "model": model
-                    })
-                except Exception as e:
-                    logging.error(f"发送模型加载失败状态失败: {e}")
-                    
-            raise e
-    
-    # 如果没有指定模型，返回默认客户端
-    client, client_id = client_pool.get_default_client()
-    return client, client_id, client_pool.semaphore 
\ No newline at end of file
+            logging.error(f"发送模型加载完成状态失败: {e}")
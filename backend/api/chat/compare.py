@@ -0,0 +1,217 @@
+import asyncio
+import json
+import logging
+import time
+from contextlib import aclosing
+from typing import Dict, Any, List, Callable, Optional
+
+from database import Database
+from metrics import inter_token_seconds, ttft_seconds
+
+from config import GENERATION_CONFIG
+from .db_operations import save_message
+from .message_processor import process_chat_messages
+from .client_pool import get_available_client
+from .generation_registry import (
+    CancelReason, Generation, GenerationConflictError, generation_registry, stream_generation
+)
+from .analytics import generation_stats
+from .websocket_handler import load_history
+
+class ModelStream:
+    """为发送的每一帧附加模型名称，使多个模型的输出可以在同一连接上区分"""
+
+    def __init__(self, sender, model: str):
+        self.sender = sender
+        self.model = model
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        frame = dict(data)
+        frame.setdefault("model", self.model)
+        await self.sender.send_json(frame)
+
+async def run_compare_turn(
+    sender,
+    db: Database,
+    conversation: Dict[str, Any],
+    current_user: Dict[str, Any],
+    data: Dict[str, Any],
+    on_start: Optional[Callable[[Generation], None]] = None
+) -> bool:
+    """对比模式：把同一份上下文同时发送给多个模型，输出按模型标记后复用同一个连接
+
+    每个模型通过调度器各自占用一个槽位，总耗时接近最慢的模型而不是各模型之和。
+    每个模型的回复单独保存（messages.model 记录模型），并报告首 token 延迟和生成速度。
+    整个对比作为对话当前的生成任务登记在生成注册表中：与普通对话互斥，可以通过中止接口取消。
+    各模型的输出直接发给发起的连接，无法续传，连接断开时对比随之取消。
+
+    客户端消息格式：{"models": [...], "messages": [...], "web_search": ...}
+
+    Returns:
+        本轮是否正常完成（至少一个模型生成成功）
+    """
+    conversation_id = conversation["id"]
+    messages = data.get("messages", [])
+    web_search = data.get("web_search", False)
+    username = current_user["username"]
+
+    models: List[str] = []
+    for model in data.get("models") or []:
+        if isinstance(model, str) and model and model not in models:
+            models.append(model)
+
+    if not messages or not isinstance(messages, list):
+        await sender.send_json({"error": "消息格式不正确"})
+        return False
+    if not models:
+        await sender.send_json({"error": "对比模式需要至少一个模型"})
+        return False
+    if len(models) > GENERATION_CONFIG["MAX_COMPARE_MODELS"]:
+        await sender.send_json({"error": f"对比模式最多支持 {GENERATION_CONFIG['MAX_COMPARE_MODELS']} 个模型"})
+        return False
+
+    # 同一对话同时只允许一个进行中的生成
+    current_generation = generation_registry.get_for_conversation(conversation_id)
+    if current_generation and not current_generation.finished:
+        await sender.send_json({"error": "该对话已有进行中的生成", "generation_id": current_generation.id})
+        return False
+
+    # 所有模型共用同一份上下文
+    history = await load_history(db, conversation_id, models[0])
+    combined_messages = history + messages
+
+    if messages[-1]["role"] == "user":
+        try:
+            await save_message(
+                db,
+                conversation_id,
+                "user",
+                messages[-1]["content"],
+                images=messages[-1].get("image"),
+                document=messages[-1].get("document")
+            )
+        except Exception as e:
+            logging.error(f"保存用户消息失败: {e}")
+
+    results: List[Dict[str, Any]] = []
+
+    async def produce(generation: Generation):
+        await sender.send_json({"type": "compare_start", "models": models})
+        started = time.monotonic()
+        results.extend(await asyncio.gather(*(
+            compare_model(ModelStream(sender, model), db, conversation_id, combined_messages, model, web_search, username)
+            for model in models
+        )))
+        total_seconds = round(time.monotonic() - started, 3)
+        logging.info(f"对话 {conversation_id} 的对比完成，模型: {models}，总耗时 {total_seconds} 秒")
+        await sender.send_json({"type": "compare_complete", "done": True, "results": results, "total_seconds": total_seconds})
+
+    try:
+        generation = generation_registry.start(
+            conversation_id, username, ",".join(models), db, produce,
+            deadline=data.get("deadline")
+        )
+    except GenerationConflictError as e:
+        await sender.send_json({"error": str(e)})
+        return False
+    if on_start is not None:
+        on_start(generation)
+
+    try:
+        # 转发生成任务的开始帧（含 generation_id）和结束帧（完成、取消或错误）
+        completed = await stream_generation(sender, generation)
+    except asyncio.CancelledError:
+        generation.cancel(CancelReason.CLIENT_DISCONNECT)
+        raise
+    return completed and any(result["error"] is None for result in results)
+
+async def compare_model(
+    stream: ModelStream,
+    db: Database,
+    conversation_id: str,
+    messages: List[Dict[str, Any]],
+    model: str,
+    web_search: bool,
+    username: str
+) -> Dict[str, Any]:
+    """在对比模式下用单个模型生成回复，返回该模型的统计信息"""
+    started = time.monotonic()
+    first_token_at = None
+    last_chunk_at = None
+    content = ""
+    stats: Dict[str, Any] = {}
+    error = None
+
+    try:
+        client, client_id, slot = await get_available_client(model=model, websocket=stream, username=username)
+        async with aclosing(process_chat_messages(
+            messages,
+            model,
+            web_search=web_search,
+            username=username,
+            client=client,
+            client_index=client_id,
+            semaphore=slot
+        )) as chunks:
+            async for chunk_json in chunks:
+                chunk_data = json.loads(chunk_json)
+                if "error" in chunk_data:
+                    raise RuntimeError(chunk_data["error"])
+                piece = chunk_data.get("message", {}).get("content") or ""
+                if piece:
+                    now = time.monotonic()
+                    if first_token_at is None:
+                        first_token_at = now
+                    else:
+                        inter_token_seconds.observe(now - last_chunk_at, model=model)
+                    last_chunk_at = now
+                    content += piece
+                    await stream.send_json({"message": {"content": piece}})
+                if chunk_data.get("stats"):
+                    stats = chunk_data["stats"]
+                    if stats.get("first_token_duration"):
+                        ttft_seconds.observe(stats["first_token_duration"] / 1e9, model=model)
+    except asyncio.CancelledError:
+        # 取消（中止、断线）时也保存已生成的部分回复
+        if content:
+            try:
+                await save_message(db, conversation_id, "assistant", content, model=model)
+            except Exception as e:
+                logging.error(f"保存模型 {model} 的部分回复失败: {e}")
+        raise
+    except Exception as e:
+        error = str(e)
+        logging.error(f"对比模式下模型 {model} 生成失败: {error}")
+
+    finished = time.monotonic()
+    message_id = None
+    if content:
+        try:
+            message_id = await save_message(db, conversation_id, "assistant", content, model=model)
+            if error is None:
+                await generation_stats.record(username, model, stats, message_id, conversation_id)
+        except Exception as e:
+            logging.error(f"保存模型 {model} 的回复失败: {e}")
+
+    # 生成速度按 Ollama 报告的 eval_count / eval_duration 计算，不包含排队和提示词评估时间
+    tokens_per_second = None
+    if stats.get("eval_count") and stats.get("eval_duration"):
+        tokens_per_second = stats["eval_count"] / (stats["eval_duration"] / 1e9)
+
+    result = {
+        "model": model,
+        "message_id": message_id,
+        "error": error,
+        "ttft": round(first_token_at - started, 3) if first_token_at is not None else None,
+        "total_seconds": round(finished - started, 3),
+        "tokens_per_second": round(tokens_per_second, 2) if tokens_per_second else None,
+        "eval_count": stats.get("eval_count"),
+        "prompt_eval_count": stats.get("prompt_eval_count"),
+        "chars": len(content)
+    }
+    try:
+        await stream.send_json({"type": "compare_error" if error else "compare_done", **result})
+    except Exception as e:
+        # 连接已断开时仍返回统计结果，不影响其他模型和 compare_complete
+        logging.info(f"发送模型 {model} 的对比结果失败: {e}")
+    return result
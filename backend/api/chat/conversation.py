@@ -10,9 +10,14 @@ import os
 import json
 import logging
 from api.tools.doc_format import get_mime_type_from_filename
+from api.tools.image_store import image_id_from_handle, image_urls
+from api.tools.attachments import attachment_store, parse_attachment_ref
 
 router = APIRouter()
 
+# 历史消息中文档附件的预览长度
+ATTACHMENT_PREVIEW_CHARS = 20000
+
 async def get_conversations_list(
     current_user: Dict[str, Any],
     db: Database
@@ -51,7 +56,7 @@ async def get_conversation_with_messages(
     # 获取对话的消息历史
     messages = await db.fetch_all(
         """
-        SELECT role, content, images, document, created_at
+        SELECT role, content, images, document, model, created_at
         FROM messages
         WHERE conversation_id = ?
         ORDER BY created_at ASC
@@ -67,9 +72,17 @@ async def get_conversation_with_messages(
             "content": msg["content"],
             "timestamp": msg["created_at"]
         }
+        # 生成该回复的模型（对比模式下同一轮有多条回复）
+        if msg["model"]:
+            message_dict["model"] = msg["model"]
         
         # 处理图片数据
-        if msg["images"]:
+        image_id = image_id_from_handle(msg["images"]) if msg["images"] else None
+        if image_id:
+            # 图片保存在图片存储中，页面通过缩略图地址按需加载
+            message_dict["image"] = msg["images"]
+            message_dict["image_url"] = image_urls(image_id)["thumbnail_url"]
+        elif msg["images"]:
             try:
                 # 尝试解析 JSON 字符串
                 images_data = json.loads(msg["images"])
@@ -83,7 +96,18 @@ async def get_conversation_with_messages(
                 message_dict["images"] = msg["images"]
         
         # 处理文档数据
-        if msg["document"]:
+        attachment = parse_attachment_ref(msg["document"]) if msg["document"] else None
+        if attachment:
+            # 文档附件只返回开头部分用于预览，完整内容通过附件接口获取
+            content, status = await attachment_store.read(attachment["attachment_id"], ATTACHMENT_PREVIEW_CHARS)
+            message_dict["document"] = {
+                "name": attachment.get("name") or "document.md",
+                "content": content,
+                "type": attachment.get("type") or "text/markdown",
+                "attachment_id": attachment["attachment_id"],
+                "status": status["status"] if status else None
+            }
+        elif msg["document"]:
             # 文档内容是 Markdown 文本
             document_content = msg["document"]
             
@@ -211,11 +235,15 @@ async def clear_conversation_messages(
     if not conversation:
         raise HTTPException(status_code=404, detail="对话不存在")
     
-    # 只删除消息，保留对话
+    # 只删除消息，保留对话，同时清除对话摘要
     await db.execute(
         "DELETE FROM messages WHERE conversation_id = ?",
         (conversation_id,)
     )
+    await db.execute(
+        "UPDATE conversations SET summary = NULL, summary_upto = 0, summary_updated_at = NULL WHERE id = ?",
+        (conversation_id,)
+    )
     await db.commit()
     
     return {"message": "对话消息已清空"}
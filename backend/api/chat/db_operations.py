@@ -5,6 +5,7 @@ from datetime import datetime
 
 from fastapi import HTTPException
 from database import Database
+from api.tools.attachments import attachment_reference, parse_attachment_ref
 
 async def save_message(
     db: Database,
@@ -12,8 +13,9 @@ async def save_message(
     role: str,
     content: str,
     images: str = None,
-    document: str = None
-):
+    document: str = None,
+    model: str = None
+) -> int:
     """保存消息到数据库
     
     Args:
@@ -23,6 +25,10 @@ async def save_message(
         content: 消息内容
         images: 图片数据，JSON数组格式存储图片路径
         document: 文档数据，Markdown 格式
+        model: 生成该回复的模型（助手消息）
+        
+    Returns:
+        新消息的ID
     """
     timestamp = datetime.utcnow().isoformat()
     
@@ -35,6 +41,10 @@ async def save_message(
             
     if document:
         logging.debug(f"Saving message with document data for conversation {conversation_id}")
+        attachment = parse_attachment_ref(document)
+        if attachment:
+            # 文档附件只保存引用，预览内容在读取历史时从附件存储中获取
+            document = attachment_reference(attachment)
         # 确保 document 是字符串类型
         if not isinstance(document, str):
             try:
@@ -47,13 +57,14 @@ async def save_message(
                   f"content={type(content)}, images={type(images)}, document={type(document)}, "
                   f"timestamp={type(timestamp)}")
     
-    await db.execute(
+    cursor = await db.execute(
         """
-        INSERT INTO messages (conversation_id, role, content, images, document, created_at)
-        VALUES (?, ?, ?, ?, ?, ?)
+        INSERT INTO messages (conversation_id, role, content, images, document, model, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
         """,
-        (conversation_id, role, content, images, document, timestamp)
+        (conversation_id, role, content, images, document, model, timestamp)
     )
+    message_id = cursor.lastrowid
     
     # 更新对话的更新时间
     await db.execute(
@@ -65,6 +76,23 @@ async def save_message(
         (timestamp, conversation_id)
     )
     await db.commit()
+    return message_id
+
+async def update_message_content(
+    db: Database,
+    message_id: int,
+    content: str
+):
+    """更新已保存消息的内容，用于生成过程中的增量保存"""
+    await db.execute(
+        """
+        UPDATE messages
+        SET content = ?
+        WHERE id = ?
+        """,
+        (content, message_id)
+    )
+    await db.commit()
 
 async def get_conversation_messages(
     db: Database,
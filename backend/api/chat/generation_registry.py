@@ -0,0 +1,359 @@
+import asyncio
+import logging
+import time
+import uuid
+from typing import Dict, Any, Optional, Callable, Awaitable, Set
+
+from database import Database
+from config import GENERATION_CONFIG
+from .db_operations import save_message, update_message_content
+from .analytics import generation_stats
+
+class GenerationConflictError(Exception):
+    """对话中已有进行中的生成"""
+    pass
+
+class CancelReason:
+    """生成取消原因"""
+    ABORT = "abort"
+    CLIENT_DISCONNECT = "client_disconnect"
+    HEARTBEAT_TIMEOUT = "heartbeat_timeout"
+    DEADLINE = "deadline"
+
+class GenerationMetrics:
+    """生成任务统计，记录被取消的生成浪费的时间"""
+
+    def __init__(self):
+        self.started_total = 0
+        self.completed_total = 0
+        self.failed_total = 0
+        self.cancelled_total: Dict[str, int] = {}
+        self.wasted_seconds_total: Dict[str, float] = {}
+        self.wasted_chars_total: Dict[str, int] = {}
+
+    def record_cancel(self, reason: str, elapsed: float, chars: int) -> None:
+        self.cancelled_total[reason] = self.cancelled_total.get(reason, 0) + 1
+        self.wasted_seconds_total[reason] = self.wasted_seconds_total.get(reason, 0.0) + elapsed
+        self.wasted_chars_total[reason] = self.wasted_chars_total.get(reason, 0) + chars
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "started_total": self.started_total,
+            "completed_total": self.completed_total,
+            "failed_total": self.failed_total,
+            "cancelled_total": dict(self.cancelled_total),
+            "wasted_seconds_total": {k: round(v, 3) for k, v in self.wasted_seconds_total.items()},
+            "wasted_chars_total": dict(self.wasted_chars_total)
+        }
+
+class GenerationSubscriber:
+    """生成输出的订阅者
+
+    待发送帧的队列有界（SUBSCRIBER_QUEUE_SIZE）。消费过慢的订阅者积压满后，
+    丢弃已排队的帧并标记为需要重新同步，此后的内容帧不再入队，
+    由消费方从生成的完整内容中按自己的偏移一次性补发。
+    """
+
+    RESYNC = {"type": "_resync"}
+
+    def __init__(self):
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=GENERATION_CONFIG["SUBSCRIBER_QUEUE_SIZE"])
+        self.lagging = False
+
+    def put(self, frame: Dict[str, Any]) -> None:
+        if self.lagging and "message" in frame:
+            return
+        try:
+            self.queue.put_nowait(frame)
+            return
+        except asyncio.QueueFull:
+            pass
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.lagging = True
+        self.queue.put_nowait(self.RESYNC)
+        if "message" not in frame:
+            self.queue.put_nowait(frame)
+
+class Generation:
+    """一次进行中的回复生成
+
+    生成过程运行在独立任务中，与 WebSocket 连接解耦：
+    - 部分回复定期写入数据库，断线或中止时不会丢失
+    - 完整的部分回复保存在内存中（长度受生成期限约束，结束后保留 RETENTION_SECONDS），
+      重连的客户端可以从任意字符偏移继续接收
+    - 中止、客户端断开超过宽限期、心跳超时或超过期限时取消任务，
+      取消会关闭到 Ollama 的上游连接并释放并发槽位
+    """
+
+    def __init__(self, conversation_id: str, username: str, model: str, db: Database, metrics: GenerationMetrics):
+        self.id = str(uuid.uuid4())
+        self.conversation_id = conversation_id
+        self.username = username
+        self.model = model
+        self.db = db
+        self.status = "running"
+        self.content = ""
+        self.error: Optional[str] = None
+        self.message_id: Optional[int] = None
+        # Ollama 最后一块中的生成统计
+        self.stats: Optional[Dict[str, Any]] = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.task: Optional[asyncio.Task] = None
+        self.cancel_reason: Optional[str] = None
+        self.metrics = metrics
+        self._detach_handle: Optional[asyncio.TimerHandle] = None
+        self._deadline_handle: Optional[asyncio.TimerHandle] = None
+        self._subscribers: Set[GenerationSubscriber] = set()
+        self._terminal_frame: Optional[Dict[str, Any]] = None
+        self._checkpointed_length = 0
+        self._last_checkpoint = time.monotonic()
+
+    @property
+    def finished(self) -> bool:
+        return self._terminal_frame is not None
+
+    def info(self) -> Dict[str, Any]:
+        """生成任务的状态摘要"""
+        return {
+            "generation_id": self.id,
+            "conversation_id": self.conversation_id,
+            "model": self.model,
+            "status": self.status,
+            "offset": len(self.content),
+            "message_id": self.message_id
+        }
+
+    def _publish(self, frame: Dict[str, Any]) -> None:
+        for subscriber in self._subscribers:
+            subscriber.put(frame)
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        """向所有订阅者转发非内容帧（例如模型加载状态）"""
+        self._publish(data)
+
+    async def append(self, content: str) -> None:
+        """追加生成内容，必要时写入检查点"""
+        if not content:
+            return
+        offset = len(self.content)
+        self.content += content
+        self._publish({"message": {"content": content}, "offset": offset})
+
+        if time.monotonic() - self._last_checkpoint >= GENERATION_CONFIG["CHECKPOINT_INTERVAL"]:
+            await self.checkpoint()
+
+    def fail(self, frame: Dict[str, Any]) -> None:
+        """记录生成错误，错误帧作为结束帧发送"""
+        self.error = frame.get("error") or "生成失败"
+        self._finish("error", frame)
+
+    async def checkpoint(self) -> None:
+        """将当前的部分回复写入数据库"""
+        self._last_checkpoint = time.monotonic()
+        if not self.content or len(self.content) == self._checkpointed_length:
+            return
+        try:
+            if self.message_id is None:
+                self.message_id = await save_message(self.db, self.conversation_id, "assistant", self.content, model=self.model)
+            else:
+                await update_message_content(self.db, self.message_id, self.content)
+            self._checkpointed_length = len(self.content)
+        except Exception as e:
+            logging.error(f"保存生成检查点失败: {e}")
+
+    def replay_frame(self, offset: int) -> Optional[Dict[str, Any]]:
+        """offset 之后的全部内容合并为一个内容帧，没有新内容时返回 None"""
+        if offset >= len(self.content):
+            return None
+        return {"message": {"content": self.content[offset:]}, "offset": offset}
+
+    def subscribe(self, offset: int = 0) -> GenerationSubscriber:
+        """订阅生成输出，先重放 offset 之后的内容"""
+        subscriber = GenerationSubscriber()
+        offset = max(0, min(offset, len(self.content)))
+        subscriber.put({"type": "generation", **self.info(), "offset": offset})
+
+        replay = self.replay_frame(offset)
+        if replay is not None:
+            subscriber.put(replay)
+
+        if self._terminal_frame is not None:
+            subscriber.put(self._terminal_frame)
+        else:
+            self._subscribers.add(subscriber)
+            if self._detach_handle is not None:
+                self._detach_handle.cancel()
+                self._detach_handle = None
+        return subscriber
+
+    def unsubscribe(self, subscriber: GenerationSubscriber) -> None:
+        """取消订阅，最后一个订阅者离开后在宽限期内无人重连则取消生成"""
+        self._subscribers.discard(subscriber)
+        if not self._subscribers and not self.finished and self._detach_handle is None:
+            self._detach_handle = asyncio.get_running_loop().call_later(
+                GENERATION_CONFIG["DETACH_GRACE_SECONDS"], self.cancel, CancelReason.CLIENT_DISCONNECT
+            )
+
+    def set_deadline(self, seconds: float) -> None:
+        """设置生成期限，超时后取消生成"""
+        if self._deadline_handle is not None:
+            self._deadline_handle.cancel()
+        self._deadline_handle = asyncio.get_running_loop().call_later(seconds, self.cancel, CancelReason.DEADLINE)
+
+    def cancel(self, reason: str = CancelReason.ABORT) -> bool:
+        """取消生成任务，上游请求随任务一起被取消"""
+        if self.finished or self.task is None or self.task.done():
+            return False
+        if self.cancel_reason is None:
+            self.cancel_reason = reason
+            logging.info(f"取消对话 {self.conversation_id} 的生成，原因: {reason}")
+        self.task.cancel()
+        return True
+
+    def _finish(self, status: str, frame: Dict[str, Any]) -> None:
+        if self._terminal_frame is not None:
+            return
+        for handle in (self._detach_handle, self._deadline_handle):
+            if handle is not None:
+                handle.cancel()
+        self.status = status
+        self.finished_at = time.time()
+        self._terminal_frame = frame
+        self._publish(frame)
+        self._subscribers.clear()
+
+    async def run(self, producer: Callable[["Generation"], Awaitable[None]]) -> None:
+        """运行生成过程，结束时保存最终内容并通知订阅者"""
+        self.metrics.started_total += 1
+        try:
+            await producer(self)
+            await self.checkpoint()
+            if self.error is None:
+                self.metrics.completed_total += 1
+                if self.message_id is not None:
+                    await generation_stats.record(self.username, self.model, self.stats, self.message_id, self.conversation_id)
+            else:
+                self.metrics.failed_total += 1
+            self._finish("done", {"done": True})
+        except asyncio.CancelledError:
+            reason = self.cancel_reason or CancelReason.ABORT
+            elapsed = time.time() - self.started_at
+            logging.info(f"对话 {self.conversation_id} 的生成已取消（{reason}），已运行 {elapsed:.1f} 秒，生成 {len(self.content)} 个字符")
+            self.metrics.record_cancel(reason, elapsed, len(self.content))
+            await self.checkpoint()
+            self._finish("cancelled", {"type": "cancelled", "generation_id": self.id, "reason": reason})
+        except Exception as e:
+            logging.error(f"对话 {self.conversation_id} 的生成失败: {str(e)}")
+            logging.exception(e)
+            self.metrics.failed_total += 1
+            await self.checkpoint()
+            self._finish("error", {"error": f"生成回复失败: {str(e)}"})
+
+class GenerationRegistry:
+    """进行中生成任务的注册表"""
+
+    def __init__(self):
+        self.generations: Dict[str, Generation] = {}
+        self.by_conversation: Dict[str, str] = {}
+        self.metrics = GenerationMetrics()
+
+    def start(
+        self,
+        conversation_id: str,
+        username: str,
+        model: str,
+        db: Database,
+        producer: Callable[[Generation], Awaitable[None]],
+        deadline: Optional[float] = None
+    ) -> Generation:
+        """启动新的生成任务，同一对话同时只允许一个进行中的生成
+
+        Args:
+            deadline: 生成期限（秒），不超过 GENERATION_CONFIG["DEADLINE_SECONDS"]
+        """
+        current = self.get_for_conversation(conversation_id)
+        if current and not current.finished:
+            raise GenerationConflictError("该对话已有进行中的生成")
+
+        max_deadline = GENERATION_CONFIG["DEADLINE_SECONDS"]
+        try:
+            deadline = min(float(deadline), max_deadline) if deadline else max_deadline
+        except (TypeError, ValueError):
+            deadline = max_deadline
+
+        generation = Generation(conversation_id, username, model, db, self.metrics)
+        self.generations[generation.id] = generation
+        self.by_conversation[conversation_id] = generation.id
+        generation.task = asyncio.create_task(self._run(generation, producer))
+        generation.set_deadline(deadline)
+        return generation
+
+    async def _run(self, generation: Generation, producer: Callable[[Generation], Awaitable[None]]) -> None:
+        try:
+            await generation.run(producer)
+        finally:
+            asyncio.get_running_loop().call_later(
+                GENERATION_CONFIG["RETENTION_SECONDS"], self._remove, generation.id
+            )
+
+    def _remove(self, generation_id: str) -> None:
+        generation = self.generations.pop(generation_id, None)
+        if generation and self.by_conversation.get(generation.conversation_id) == generation_id:
+            del self.by_conversation[generation.conversation_id]
+
+    def get(self, generation_id: str) -> Optional[Generation]:
+        return self.generations.get(generation_id)
+
+    def get_for_conversation(self, conversation_id: str) -> Optional[Generation]:
+        generation_id = self.by_conversation.get(conversation_id)
+        return self.generations.get(generation_id) if generation_id else None
+
+    def cancel_conversation(self, conversation_id: str, reason: str = CancelReason.ABORT) -> bool:
+        """取消对话中进行中的生成"""
+        generation = self.get_for_conversation(conversation_id)
+        if generation is None:
+            return False
+        return generation.cancel(reason)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """生成任务统计快照"""
+        now = time.time()
+        running = [g for g in self.generations.values() if not g.finished]
+        return {
+            "running": len(running),
+            "detached": sum(1 for g in running if not g._subscribers),
+            "oldest_running_seconds": round(max((now - g.started_at for g in running), default=0.0), 3),
+            **self.metrics.snapshot()
+        }
+
+async def stream_generation(sender, generation: Generation, offset: int = 0) -> bool:
+    """将生成输出转发给发送对象，直到生成结束
+
+    发送对象断开时只取消订阅，生成任务继续运行。发送过慢导致积压溢出时，
+    从已发送的偏移处一次性补发缺失的内容。
+
+    Returns:
+        生成是否正常完成
+    """
+    subscriber = generation.subscribe(offset)
+    offset = max(0, min(offset, len(generation.content)))
+    try:
+        while True:
+            frame = await subscriber.queue.get()
+            if frame is GenerationSubscriber.RESYNC:
+                subscriber.lagging = False
+                frame = generation.replay_frame(offset)
+                if frame is None:
+                    continue
+            if "message" in frame:
+                offset = frame["offset"] + len(frame["message"]["content"])
+            await sender.send_json(frame)
+            if frame.get("done") or "error" in frame or frame.get("type") == "cancelled":
+                return frame.get("done", False)
+    finally:
+        generation.unsubscribe(subscriber)
+
+# 全局生成任务注册表
+generation_registry = GenerationRegistry()
@@ -7,13 +7,20 @@ from datetime import datetime
 
 from database import Database, get_db
 from api.auth import get_current_user
-from config import API_CONFIG
+from config import API_CONFIG, PROMPT_CONFIG
 
 from .schemas import ChatCompletionRequest
 from .client_pool import get_available_client
-from .message_processor import process_chat_messages, get_limited_history
+from .message_processor import process_chat_messages, get_limited_history, prompt_metrics
 from .db_operations import save_message, verify_conversation_ownership
 from .websocket_handler import handle_websocket_connection, active_connections
+from .session_handler import handle_chat_session
+from .generation_registry import generation_registry
+from .scheduler import QueueFullError, get_scheduler
+from .residency import residency_manager
+from .node_registry import node_registry
+from .summarizer import conversation_summarizer
+from .analytics import generation_stats, ROLLUP_TABLES
 
 router = APIRouter()
 
@@ -45,8 +52,15 @@ async def abort_generation(
         if not conversation:
             raise HTTPException(status_code=404, detail="对话不存在或您无权访问")
             
+        # 取消生成任务，已生成的部分内容会保存到数据库
+        generation_cancelled = generation_registry.cancel_conversation(conversation_id)
+        if generation_cancelled:
+            logging.info(f"已取消对话 {conversation_id} 的生成任务")
+            
         # 检查用户是否有权限操作该对话
         if conversation_id not in active_connections:
+            if generation_cancelled:
+                return {"status": "success", "message": "已停止生成"}
             return {"status": "success", "message": "没有找到活跃的生成过程"}
             
         # 关闭 WebSocket 连接
@@ -63,6 +77,58 @@ async def abort_generation(
         logging.exception(e)
         raise HTTPException(status_code=500, detail=error_msg)
 
+@router.get("/conversations/{conversation_id}/generation")
+async def get_generation_status(
+    conversation_id: str,
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    db: Database = Depends(get_db)
+):
+    """获取对话当前（或最近）生成任务的状态，供断线重连时确定续传偏移"""
+    await verify_conversation_ownership(db, conversation_id, current_user["username"])
+    generation = generation_registry.get_for_conversation(conversation_id)
+    if generation is None:
+        return {"status": "none"}
+    return generation.info()
+
+@router.get("/generations/metrics")
+async def get_generation_metrics(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取生成任务统计，包括各原因取消的次数和浪费的生成时间"""
+    return generation_registry.snapshot()
+
+@router.get("/scheduler/metrics")
+async def get_scheduler_metrics(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取请求调度器状态，包括各优先级的队列深度和等待时间直方图"""
+    return get_scheduler().snapshot()
+
+@router.get("/prompt/metrics")
+async def get_prompt_metrics(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取提示词评估统计（prompt_eval_count），用于衡量前缀稳定组装节省的评估量"""
+    return prompt_metrics.snapshot()
+
+@router.get("/analytics")
+async def get_generation_analytics(
+    period: str = "day",
+    days: int = 7,
+    model: str = None,
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """获取按模型汇总的生成统计：生成速度（tokens/s）、首 token 延迟和总耗时的分位数，以及按小时或按天的序列"""
+    if period not in ROLLUP_TABLES:
+        raise HTTPException(status_code=400, detail="period 只能是 hour 或 day")
+    if days <= 0:
+        raise HTTPException(status_code=400, detail="days 必须大于 0")
+    return await generation_stats.query(current_user["username"], period, days, model)
+
+@router.get("/residency")
+async def get_model_residency(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取模型驻留状态：内存预算、已加载的模型及其占用"""
+    return residency_manager.snapshot()
+
+@router.get("/nodes")
+async def get_ollama_nodes(current_user: Dict[str, Any] = Depends(get_current_user)):
+    """获取各 Ollama 节点的健康状态、已加载模型和进行中的请求数"""
+    return node_registry.snapshot()
+
 @router.websocket("/conversations/{conversation_id}/ws")
 async def websocket_endpoint(
     websocket: WebSocket,
@@ -73,6 +139,15 @@ async def websocket_endpoint(
     """处理WebSocket连接，支持流式响应和思考状态"""
     await handle_websocket_connection(websocket, conversation_id, token, db)
 
+@router.websocket("/ws")
+async def session_websocket_endpoint(
+    websocket: WebSocket,
+    token: str,
+    db: Database = Depends(get_db)
+):
+    """长连接聊天会话，一次认证后可在同一连接上承载多轮、多对话的流"""
+    await handle_chat_session(websocket, token, db)
+
 @router.post("/conversations/{conversation_id}/chat")
 async def chat(
     conversation_id: str,
@@ -106,7 +181,7 @@ async def chat(
         # 获取历史消息
         history_messages = await db.fetch_all(
             """
-            SELECT role, content, images, document
+            SELECT id, role, content, images, document
             FROM messages
             WHERE conversation_id = ?
             ORDER BY created_at ASC
@@ -114,6 +189,10 @@ async def chat(
             (conversation_id,)
         )
         
+        # 已被滚动摘要覆盖的较早消息由摘要代替
+        summary = await conversation_summarizer.load(conversation_id)
+        history_messages = conversation_summarizer.apply(summary, history_messages)
+        
         # 构建完整的消息列表，包含历史消息
         all_messages = []
         
@@ -217,11 +296,21 @@ async def chat(
             })
         
         # 限制发送给模型的历史消息数量
-        limited_messages = get_limited_history(all_messages)
+        preamble = [conversation_summarizer.as_message(summary)] if summary else []
+        if PROMPT_CONFIG["PREFIX_STABLE"]:
+            # 系统前导（摘要、个人信息等系统消息）固定在最前面，只对对话消息开窗，窗口按块滑动
+            limited_messages = preamble + system_messages + get_limited_history(all_messages[len(system_messages):])
+        else:
+            limited_messages = preamble + get_limited_history(all_messages)
         
         if request.stream:
             # 流式响应 - 预先加载模型
-            client, client_id, semaphore = await get_available_client(model=model)
+            client, client_id, semaphore = await get_available_client(model=model, username=current_user["username"])
+            try:
+                # 响应头发出后无法再返回状态码，排队已满时先返回 503，与非流式请求一致
+                semaphore.check()
+            except QueueFullError as e:
+                raise HTTPException(status_code=503, detail=str(e))
             
             # 将过程封装在异步生成器中
             async def stream_response():
@@ -233,8 +322,10 @@ async def chat(
                         username=current_user["username"],
                         client=client,
                         client_index=client_id,
-                        semaphore=semaphore
+                        semaphore=semaphore,
+                        raw=True
                     ):
+                        # 透传 Ollama 的原始 NDJSON 行，不再逐块解析和重新编码
                         yield chunk
                 except Exception as e:
                     error_msg = f"流式生成回复出错: {str(e)}"
@@ -256,11 +347,12 @@ async def chat(
         else:
             # 完整响应
             full_response = ""
+            stats = None
             error_occurred = False
             
             try:
                 # 预先加载模型
-                client, client_id, semaphore = await get_available_client(model=model)
+                client, client_id, semaphore = await get_available_client(model=model, username=current_user["username"])
                 
                 async for chunk_json in process_chat_messages(
                     limited_messages, 
@@ -287,18 +379,22 @@ async def chat(
                     # 提取内容并累加到响应中
                     if "message" in chunk_data and "content" in chunk_data["message"]:
                         full_response += chunk_data["message"]["content"]
+                    if chunk_data.get("stats"):
+                        stats = chunk_data["stats"]
                 
                 # 只有在没有错误且有响应内容的情况下才保存到数据库
                 if not error_occurred and full_response:
                     # 保存助手回复
-                    await save_message(
+                    message_id = await save_message(
                         db,
                         conversation_id,
                         "assistant",
                         full_response,
                         None,  # AI 回复没有图片
-                        None   # AI 回复没有文档
+                        None,  # AI 回复没有文档
+                        model=model
                     )
+                    await generation_stats.record(current_user["username"], model, stats, message_id, conversation_id)
                 
                 return {
                     "model": model,
@@ -310,6 +406,9 @@ async def chat(
             except HTTPException:
                 # 直接重新抛出HTTP异常
                 raise
+            except QueueFullError as e:
+                # 排队已满时返回 503，客户端可稍后重试
+                raise HTTPException(status_code=503, detail=str(e))
             except Exception as e:
                 # 其他异常转换为HTTP异常
                 error_msg = f"处理对话请求时出错: {str(e)}"
@@ -1,12 +1,87 @@
 import json
 import logging
 import re
-from typing import Dict, Any, List, AsyncGenerator
+import time
+from contextlib import aclosing
+from typing import Dict, Any, List, AsyncGenerator, Optional, Union
 
 from ollama.types import ChatRequest, ChatMessage
+from ollama.ndjson import dumps
 
 from api.tools.doc_format import get_mime_type_from_filename
+from api.tools.vision import vision_preprocessor
+from api.tools.attachments import attachment_store, parse_attachment_ref
+from config import PROMPT_CONFIG
+from tracing import record_span, span
 from .client_pool import get_available_client
+from .residency import residency_manager
+from .node_registry import node_registry
+from .search_context import build_search_context
+from .scheduler import Histogram
+
+# 添加到消息中的文档内容的最大长度
+MAX_DOCUMENT_CHARS = 200000
+
+class PromptMetrics:
+    """提示词评估统计，用于衡量前缀复用（KV 缓存命中）节省的评估量
+
+    Ollama 只对未命中缓存的部分计入 prompt_eval_count，前缀越稳定该值越小。
+    """
+
+    def __init__(self, buckets: List[float]):
+        self.turns_total = 0
+        self.prompt_eval_tokens_total = 0
+        self.prompt_eval_seconds_total = 0.0
+        self.prompt_eval_tokens = Histogram(buckets)
+
+    def record(self, stats: Dict[str, Any]) -> None:
+        if "prompt_eval_count" not in stats:
+            return
+        self.turns_total += 1
+        self.prompt_eval_tokens_total += stats["prompt_eval_count"]
+        self.prompt_eval_seconds_total += stats.get("prompt_eval_duration", 0) / 1e9
+        self.prompt_eval_tokens.observe(stats["prompt_eval_count"])
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "prefix_stable": PROMPT_CONFIG["PREFIX_STABLE"],
+            "history_block": PROMPT_CONFIG["HISTORY_BLOCK"],
+            "turns_total": self.turns_total,
+            "prompt_eval_tokens_total": self.prompt_eval_tokens_total,
+            "prompt_eval_seconds_total": round(self.prompt_eval_seconds_total, 6),
+            "avg_prompt_eval_tokens": round(self.prompt_eval_tokens_total / self.turns_total, 2) if self.turns_total else 0.0,
+            "prompt_eval_tokens": self.prompt_eval_tokens.snapshot()
+        }
+
+# 全局提示词评估统计
+prompt_metrics = PromptMetrics(PROMPT_CONFIG["PROMPT_TOKEN_BUCKETS"])
+
+def insert_context_message(messages: List[Dict[str, Any]], content: str) -> None:
+    """插入易变的系统上下文（搜索结果、搜索状态等）
+
+    前缀稳定模式下放在最后一条用户消息之后，使之前的消息保持为稳定的前缀；
+    否则放在最前面。
+    """
+    message = {"role": "system", "content": content}
+    if PROMPT_CONFIG["PREFIX_STABLE"]:
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i]["role"] == "user":
+                messages.insert(i + 1, message)
+                return
+        messages.append(message)
+    else:
+        messages.insert(0, message)
+
+def record_ollama_spans(stats: Dict[str, Any]) -> None:
+    """把 Ollama 报告的各阶段耗时（纳秒）和服务端首 token 延迟记入当前追踪"""
+    for name, key in (
+        ("ttft", "first_token_duration"),
+        ("load", "load_duration"),
+        ("prompt_eval", "prompt_eval_duration"),
+        ("eval", "eval_duration")
+    ):
+        if stats.get(key):
+            record_span(name, stats[key] / 1e9)
 
 async def process_chat_messages(
     messages: List[Dict[str, Any]],
@@ -15,8 +90,9 @@ async def process_chat_messages(
     username: str = None,
     client=None,
     client_index=None,
-    semaphore=None
-) -> AsyncGenerator[str, None]:
+    semaphore=None,
+    raw: bool = False
+) -> AsyncGenerator[Union[str, bytes], None]:
     """处理聊天消息并生成响应流
     
     Args:
@@ -26,16 +102,22 @@ async def process_chat_messages(
         username: 用户名
         client: 预先获取的客户端对象，如果提供则使用此客户端
         client_index: 客户端索引
-        semaphore: 客户端信号量
+        semaphore: 调度槽位（用法与信号量相同）
+        raw: 透传模式，直接转发 Ollama 返回的原始 NDJSON 行（bytes），不重新编码
     """
     # 如果未提供客户端，则获取可用的客户端实例
     if client is None or semaphore is None:
-        client, client_index, semaphore = await get_available_client(model=model)
+        client, client_index, semaphore = await get_available_client(model=model, username=username)
     
-    # 使用信号量控制对客户端的访问
+    # 服务端首 token 延迟从这里开始计算，包括排队、网页搜索和提示词评估的时间
+    started = time.monotonic()
+    first_token_at = None
+
+    # 通过调度槽位控制对客户端的访问，获得槽位后才加载模型；从排队到处理结束模型都不会被淘汰
     async with semaphore:
+        record_span("queue", getattr(semaphore, "wait_seconds", 0.0))
         try:
-            logging.info(f"开始处理聊天消息，使用模型: {model}, 网页搜索: {web_search}, 客户端索引: {client_index}")
+            logging.debug(f"开始处理聊天消息，使用模型: {model}, 网页搜索: {web_search}, 客户端索引: {client_index}")
             # 转换消息格式，确保图片数据正确传递
             formatted_messages = []
             for msg in messages:
@@ -45,16 +127,25 @@ async def process_chat_messages(
                 }
                 # 如果有图片数据，添加到消息中
                 if "image" in msg and msg["image"]:
-                    formatted_msg["images"] = [msg["image"]]  # Ollama API 需要 images 数组
+                    # 历史中保存的是图片句柄，只在组装本次请求时读取，并缩放到模型的视觉分辨率
+                    image_data = await vision_preprocessor.prepare(msg["image"], model)
+                    if image_data:
+                        formatted_msg["images"] = [image_data]  # Ollama API 需要 images 数组
                 
                 # 如果有文档数据，将文档内容添加到消息中
                 if "document" in msg and msg["document"]:
                     # 获取文档内容
                     doc_content = msg["document"]
                     file_name = "文档"
+                    attachment = parse_attachment_ref(doc_content)
                     
                     # 处理文档内容，确保它是字符串类型
-                    if isinstance(doc_content, dict):
+                    if attachment:
+                        # 渐进式转换的文档附件，读取当前已转换的内容（转换可能仍在进行）
+                        file_name = attachment.get("name") or "文档"
+                        doc_content = await attachment_store.read_for_prompt(
+                            attachment["attachment_id"], MAX_DOCUMENT_CHARS + 1)
+                    elif isinstance(doc_content, dict):
                         # 如果是字典格式，提取内容和文件名
                         if "content" in doc_content:
                             file_name = doc_content.get("name", "文档")
@@ -79,9 +170,8 @@ async def process_chat_messages(
                     
                     # 如果文档内容太长，可能需要截断
                     if isinstance(doc_content, str):
-                        max_doc_length = 200000  # 设置一个合理的最大长度
-                        if len(doc_content) > max_doc_length:
-                            doc_content = doc_content[:max_doc_length] + "...\n[文档内容过长，已截断]"
+                        if len(doc_content) > MAX_DOCUMENT_CHARS:
+                            doc_content = doc_content[:MAX_DOCUMENT_CHARS] + "...\n[文档内容过长，已截断]"
                     
                     # 添加文档内容到消息中
                     formatted_msg["content"] = formatted_msg["content"] + f"\n\n以下是《{file_name}》的内容：\n" + doc_content
@@ -96,72 +186,88 @@ async def process_chat_messages(
                 from api.tools.tavily_search import search_web
                 try:
                     search_query = messages[-1]["content"]
-                    search_results = await search_web(search_query, username=username)
+                    async with span("search"):
+                        search_results = await search_web(search_query, username=username)
                     
                     # 检查搜索结果
                     if search_results and "results" in search_results and search_results["results"]:
-                        # 将搜索结果添加到系统消息中
-                        search_content = "\n\n网页搜索结果:\n"
-                        for idx, result in enumerate(search_results["results"], 1):
-                            search_content += f"{idx}. {result['title']}: {result['url']}\n{result['content']}\n\n"
+                        # 去重、按与问题的相关性排序，并压缩到 token 预算内
+                        search_content, _ = build_search_context(search_query, search_results["results"])
                         
-                        # 添加系统消息，提供搜索结果
-                        formatted_messages.insert(0, {
-                            "role": "system",
-                            "content": "你必须使用以下网页搜索结果来回答用户的问题。如果搜索结果中包含答案，请基于这些结果回答，而不是使用你自己的知识。以下是搜索结果：" + search_content
-                        })
+                        # 在用户最后一条消息后添加一次搜索结果
+                        for i in range(len(formatted_messages) - 1, -1, -1):
+                            if formatted_messages[i]["role"] == "user":
+                                formatted_messages.insert(i + 1, {
+                                    "role": "system",
+                                    "content": "你必须使用以下网页搜索结果来回答用户的问题。如果搜索结果中包含答案，请基于这些结果回答，而不是使用你自己的知识。以下是搜索结果：\n\n" + search_content
+                                })
+                                break
                         logging.info(f"已添加网页搜索结果到消息中")
                     elif search_results and "error" in search_results:
                         # 如果有错误，添加错误信息到系统消息
                         error_message = search_results["error"]
-                        formatted_messages.insert(0, {
-                            "role": "system",
-                            "content": f"用户启用了网页搜索功能，但搜索失败: {error_message}。请在回答中告知用户搜索功能当前不可用，建议检查Tavily API密钥配置。"
-                        })
+                        insert_context_message(
+                            formatted_messages,
+                            f"用户启用了网页搜索功能，但搜索失败: {error_message}。请在回答中告知用户搜索功能当前不可用，建议检查Tavily API密钥配置。"
+                        )
                         logging.warning(f"网页搜索失败: {error_message}")
                     else:
                         # 如果没有结果，添加提示信息
-                        formatted_messages.insert(0, {
-                            "role": "system",
-                            "content": "用户启用了网页搜索功能，但未找到相关搜索结果。请基于您已有的知识回答问题。"
-                        })
+                        insert_context_message(
+                            formatted_messages,
+                            "用户启用了网页搜索功能，但未找到相关搜索结果。请基于您已有的知识回答问题。"
+                        )
                         logging.info("网页搜索未返回结果")
                 except Exception as e:
                     # 捕获搜索过程中的异常
                     error_message = str(e)
-                    formatted_messages.insert(0, {
-                        "role": "system",
-                        "content": f"用户启用了网页搜索功能，但搜索过程中发生错误: {error_message}。请在回答中告知用户搜索功能当前不可用。"
-                    })
+                    insert_context_message(
+                        formatted_messages,
+                        f"用户启用了网页搜索功能，但搜索过程中发生错误: {error_message}。请在回答中告知用户搜索功能当前不可用。"
+                    )
                     logging.error(f"网页搜索异常: {error_message}")
-                    
-            # 在用户最后一条消息后添加搜索结果（仅当启用网页搜索且有搜索结果时）
-            if web_search and 'search_content' in locals() and search_results and "results" in search_results and search_results["results"]:
-                for i in range(len(formatted_messages) - 1, -1, -1):
-                    if formatted_messages[i]["role"] == "user":
-                        formatted_messages.insert(i + 1, {
-                            "role": "system",
-                            "content": f"以下是与用户问题相关的网页搜索结果：{search_content}"
-                        })
-                        break
 
             chat_request = ChatRequest(
                 model=model,
                 messages=[ChatMessage(**msg) for msg in formatted_messages],
-                stream=True
+                stream=True,
+                keep_alive=residency_manager.keep_alive_for(model)
             )
             
             try:
-                # 使用分配的客户端处理请求
-                async for chunk in client.chat(chat_request):
-                    yield json.dumps({
-                        "model": model,
-                        "message": {
-                            "role": "assistant",
-                            "content": chunk.message.content if chunk.message else ""
-                        },
-                        "done": chunk.done
-                    })
+                # 在分配的节点上处理请求（可能对冲到其他节点），提前关闭时同时关闭上游流以释放连接和并发槽位
+                async with aclosing(node_registry.chat(chat_request, client)) as chunks:
+                    async for chunk in chunks:
+                        # 透传模式下也要检查错误，只有可能包含 error 字段的行才会被解析
+                        if chunk.error:
+                            raise RuntimeError(chunk.error)
+                        if first_token_at is None and not chunk.done:
+                            first_token_at = time.monotonic()
+                        # 最后一块包含 Ollama 的生成统计，补充服务端的排队时间和首 token 延迟（纳秒，与 Ollama 一致）
+                        stats = chunk.stats if chunk.done else None
+                        if stats:
+                            stats["queue_duration"] = int(getattr(semaphore, "wait_seconds", 0.0) * 1e9)
+                            stats["first_token_duration"] = int(((first_token_at or time.monotonic()) - started) * 1e9)
+                            prompt_metrics.record(stats)
+                            record_ollama_spans(stats)
+                        if raw:
+                            if stats:
+                                # 最后一行重新编码，补充服务端统计字段，与 Ollama 的统计字段同层
+                                yield (dumps({**chunk.data, **stats}) + "\n").encode()
+                            else:
+                                yield chunk.raw
+                            continue
+                        frame = {
+                            "model": model,
+                            "message": {
+                                "role": "assistant",
+                                "content": chunk.content
+                            },
+                            "done": chunk.done
+                        }
+                        if stats:
+                            frame["stats"] = stats
+                        yield dumps(frame)
             except AttributeError as e:
                 # 特别处理可能的元组或对象属性错误
                 error_msg = f"客户端对象类型错误: {type(client)}, 错误: {str(e)}"
@@ -176,7 +282,7 @@ async def process_chat_messages(
                     }
                 })
                 
-            logging.info(f"完成处理聊天消息，客户端索引: {client_index}")
+            logging.debug(f"完成处理聊天消息，客户端索引: {client_index}")
         except Exception as e:
             error_msg = f"处理消息时出错: {str(e)}"
             logging.error(f"客户端 {client_index} 处理消息时出错: {error_msg}")
@@ -190,13 +296,30 @@ async def process_chat_messages(
                 }
             })
 
+def history_window_start(total: int, max_messages: int, block: Optional[int] = None) -> int:
+    """计算历史窗口的起始位置
+
+    窗口按 block 条消息为单位滑动：起始位置只在累计移出 block 条消息时才变化，
+    期间各轮提示词的开头保持不变，Ollama 可以复用上一轮的 KV 缓存。
+    起始位置向下取整，窗口长度在 max_messages 到 max_messages + block - 1 之间，
+    不会少于关闭前缀稳定模式时发送的消息数。
+    """
+    if total <= max_messages:
+        return 0
+    overflow = total - max_messages
+    if not block or block <= 1:
+        return overflow
+    block = min(block, max_messages)
+    return overflow // block * block
+
 def get_limited_history(messages, max_messages=20):
-    """限制历史消息数量，保留最近的消息"""
+    """限制历史消息数量，保留最近的消息（前缀稳定模式下按块滑动）"""
     if len(messages) <= max_messages:
         return messages
     
-    # 保留最后 max_messages 条消息
-    limited_messages = messages[-max_messages:]
+    # 保留最后 max_messages 条以内的消息
+    block = PROMPT_CONFIG["HISTORY_BLOCK"] if PROMPT_CONFIG["PREFIX_STABLE"] else None
+    limited_messages = messages[history_window_start(len(messages), max_messages, block):]
     
     # 确保每条消息都有正确的格式
     for msg in limited_messages:
@@ -0,0 +1,303 @@
+import asyncio
+import logging
+import time
+from contextlib import aclosing, asynccontextmanager
+from typing import Dict, Any, AsyncGenerator, Iterable, List, Optional
+
+from ollama.client import OllamaClient
+from ollama.ndjson import LazyChunk
+from ollama.types import ChatRequest
+from config import OLLAMA_NODES_CONFIG
+
+def normalize_model(model: str) -> str:
+    return model if ":" in model else f"{model}:latest"
+
+class OllamaNode:
+    """一个 Ollama 服务节点"""
+
+    def __init__(self, base_url: str):
+        self.base_url = base_url.rstrip("/")
+        self.client = OllamaClient(self.base_url)
+        self.healthy = True
+        self.version: Optional[str] = None
+        self.consecutive_failures = 0
+        self.last_check: Optional[float] = None
+        # 节点上已加载的模型（来自 /api/ps）
+        self.models: set = set()
+        self.in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+        # 首个 token 延迟的指数移动平均（秒）
+        self.ttft_ewma: Optional[float] = None
+
+    def has_model(self, model: str) -> bool:
+        return normalize_model(model) in self.models
+
+    def record_ttft(self, seconds: float) -> None:
+        alpha = OLLAMA_NODES_CONFIG["EWMA_ALPHA"]
+        self.ttft_ewma = seconds if self.ttft_ewma is None else alpha * seconds + (1 - alpha) * self.ttft_ewma
+
+    def record_failure(self) -> None:
+        self.errors_total += 1
+        self.consecutive_failures += 1
+        if self.healthy and self.consecutive_failures >= OLLAMA_NODES_CONFIG["FAIL_THRESHOLD"]:
+            logging.warning(f"Ollama 节点 {self.base_url} 连续失败 {self.consecutive_failures} 次，标记为不可用")
+            self.healthy = False
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        if not self.healthy:
+            logging.info(f"Ollama 节点 {self.base_url} 已恢复")
+        self.healthy = True
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "base_url": self.base_url,
+            "healthy": self.healthy,
+            "version": self.version,
+            "models": sorted(self.models),
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "errors_total": self.errors_total,
+            "ttft_ewma": round(self.ttft_ewma, 4) if self.ttft_ewma is not None else None,
+            "last_check": self.last_check
+        }
+
+_END = object()
+
+class _Attempt:
+    """在某个节点上的一次聊天请求，输出写入队列"""
+
+    def __init__(self, registry: "NodeRegistry", node: OllamaNode, request: ChatRequest):
+        self.node = node
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.task = asyncio.create_task(self._run(registry, request))
+
+    async def _run(self, registry: "NodeRegistry", request: ChatRequest) -> None:
+        try:
+            async with aclosing(registry._stream_on(self.node, request)) as chunks:
+                async for chunk in chunks:
+                    await self.queue.put(chunk)
+            await self.queue.put(_END)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.queue.put(e)
+
+    async def cancel(self) -> None:
+        if not self.task.done():
+            self.task.cancel()
+        try:
+            await self.task
+        except (asyncio.CancelledError, Exception):
+            pass
+
+class NodeRegistry:
+    """多个 Ollama 节点的注册表
+
+    - 后台定期检查各节点的健康状态（/api/version）和已加载的模型（/api/ps）
+    - 聊天请求优先路由到已加载该模型的节点，其次选择进行中请求最少的节点
+    - 可选的对冲请求：主节点在 HEDGE_DELAY 秒内没有返回首个 token 时，
+      在另一个节点上同时发起请求，先返回的一方胜出，另一方被取消
+    """
+
+    def __init__(self, base_urls: Iterable[str]):
+        self.nodes: List[OllamaNode] = []
+        self._health_task: Optional[asyncio.Task] = None
+        self.hedges_total = 0
+        self.hedge_wins_total = 0
+        self.configure(base_urls)
+
+    def configure(self, base_urls: Iterable[str]) -> None:
+        """设置节点列表，保留已存在节点的状态"""
+        existing = {node.base_url: node for node in self.nodes}
+        nodes = []
+        for url in base_urls:
+            url = url.strip().rstrip("/")
+            if url and url not in (n.base_url for n in nodes):
+                nodes.append(existing.get(url) or OllamaNode(url))
+        if not nodes:
+            raise ValueError("至少需要配置一个 Ollama 节点")
+        self.nodes = nodes
+
+    def get_node(self, base_url: str) -> Optional[OllamaNode]:
+        for node in self.nodes:
+            if node.base_url == base_url.rstrip("/"):
+                return node
+        return None
+
+    async def start(self) -> None:
+        if self._health_task is None or self._health_task.done():
+            self._health_task = asyncio.create_task(self._health_loop())
+
+    async def stop(self) -> None:
+        if self._health_task is not None:
+            self._health_task.cancel()
+            try:
+                await self._health_task
+            except asyncio.CancelledError:
+                pass
+            self._health_task = None
+
+    async def _health_loop(self) -> None:
+        while True:
+            await self.check_all()
+            await asyncio.sleep(OLLAMA_NODES_CONFIG["HEALTH_INTERVAL"])
+
+    async def check_all(self) -> None:
+        await asyncio.gather(*(self.check(node) for node in self.nodes))
+
+    async def check(self, node: OllamaNode) -> None:
+        """检查节点健康状态并同步已加载的模型"""
+        node.last_check = time.time()
+        try:
+            version = await asyncio.wait_for(node.client.version(), OLLAMA_NODES_CONFIG["HEALTH_TIMEOUT"])
+            node.version = version.get("version")
+            running = await asyncio.wait_for(node.client.list_running(), OLLAMA_NODES_CONFIG["HEALTH_TIMEOUT"])
+            node.models = {
+                normalize_model(item.get("name") or item.get("model"))
+                for item in running.get("models", []) or []
+                if item.get("name") or item.get("model")
+            }
+            node.record_success()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.debug(f"检查 Ollama 节点 {node.base_url} 失败: {e}")
+            node.record_failure()
+
+    def select(self, model: Optional[str] = None, exclude: Iterable[OllamaNode] = ()) -> Optional[OllamaNode]:
+        """选择处理请求的节点：模型亲和优先，其次进行中请求最少"""
+        excluded = set(id(node) for node in exclude)
+        candidates = [n for n in self.nodes if id(n) not in excluded]
+        if not candidates:
+            return None
+        healthy = [n for n in candidates if n.healthy]
+        # 所有节点都不可用时仍然尝试，由请求本身决定成败
+        candidates = healthy or candidates
+        if model:
+            affine = [n for n in candidates if n.has_model(model)]
+            candidates = affine or candidates
+        return min(candidates, key=lambda n: (n.in_flight, n.ttft_ewma or 0.0, self.nodes.index(n)))
+
+    @asynccontextmanager
+    async def track(self, node: OllamaNode):
+        """统计节点上进行中的请求"""
+        node.in_flight += 1
+        node.requests_total += 1
+        try:
+            yield node
+        finally:
+            node.in_flight -= 1
+
+    async def _stream_on(self, node: OllamaNode, request: ChatRequest) -> AsyncGenerator[LazyChunk, None]:
+        started = time.monotonic()
+        first = True
+        async with self.track(node):
+            try:
+                async with aclosing(node.client.chat_lazy(request)) as chunks:
+                    async for chunk in chunks:
+                        if first:
+                            first = False
+                            node.record_ttft(time.monotonic() - started)
+                        yield chunk
+                node.record_success()
+                node.models.add(normalize_model(request.model))
+            except (asyncio.CancelledError, GeneratorExit):
+                raise
+            except Exception:
+                node.record_failure()
+                raise
+
+    async def chat(self, request: ChatRequest, client: Optional[OllamaClient] = None) -> AsyncGenerator[LazyChunk, None]:
+        """在选定的节点上发起流式聊天请求，必要时发起对冲请求
+
+        Args:
+            request: 聊天请求
+            client: 已分配的客户端，对应的节点作为主节点
+        """
+        primary = None
+        if client is not None:
+            primary = self.get_node(client.base_url)
+        primary = primary or self.select(request.model)
+
+        hedge_delay = OLLAMA_NODES_CONFIG["HEDGE_DELAY"]
+        if not OLLAMA_NODES_CONFIG["HEDGE_ENABLED"] or len(self.nodes) < 2:
+            async with aclosing(self._stream_on(primary, request)) as chunks:
+                async for chunk in chunks:
+                    yield chunk
+            return
+
+        attempts: Dict[_Attempt, asyncio.Task] = {}
+        primary_attempt = _Attempt(self, primary, request)
+        attempts[primary_attempt] = asyncio.create_task(primary_attempt.queue.get())
+        winner: Optional[_Attempt] = None
+        first_item: Any = None
+        hedged = False
+        try:
+            while attempts:
+                done, _ = await asyncio.wait(
+                    attempts.values(),
+                    timeout=None if hedged else hedge_delay,
+                    return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    # 主节点迟迟没有首个 token，在另一个节点上发起对冲请求
+                    hedged = True
+                    backup = self.select(request.model, exclude=[a.node for a in attempts])
+                    if backup is not None:
+                        self.hedges_total += 1
+                        logging.info(f"节点 {primary.base_url} 首个 token 超过 {hedge_delay} 秒，对冲到 {backup.base_url}")
+                        attempt = _Attempt(self, backup, request)
+                        attempts[attempt] = asyncio.create_task(attempt.queue.get())
+                    continue
+
+                for attempt, getter in list(attempts.items()):
+                    if getter not in done:
+                        continue
+                    item = getter.result()
+                    del attempts[attempt]
+                    if isinstance(item, Exception):
+                        if attempts:
+                            # 该节点失败，等待其他节点
+                            continue
+                        backup = None if hedged else self.select(request.model, exclude=[attempt.node])
+                        if backup is not None:
+                            # 主节点在返回首个 token 前失败，改到另一个节点重试一次
+                            hedged = True
+                            retry = _Attempt(self, backup, request)
+                            attempts[retry] = asyncio.create_task(retry.queue.get())
+                            continue
+                    winner, first_item = attempt, item
+                    break
+                if winner is not None:
+                    break
+        finally:
+            for attempt, getter in attempts.items():
+                getter.cancel()
+                await attempt.cancel()
+
+        if winner is not primary_attempt:
+            self.hedge_wins_total += 1
+
+        try:
+            item = first_item
+            while item is not _END:
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+                item = await winner.queue.get()
+        finally:
+            await winner.cancel()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "hedge_enabled": OLLAMA_NODES_CONFIG["HEDGE_ENABLED"],
+            "hedge_delay": OLLAMA_NODES_CONFIG["HEDGE_DELAY"],
+            "hedges_total": self.hedges_total,
+            "hedge_wins_total": self.hedge_wins_total,
+            "nodes": [node.info() for node in self.nodes]
+        }
+
+# 全局节点注册表
+node_registry = NodeRegistry(OLLAMA_NODES_CONFIG["BASE_URLS"])
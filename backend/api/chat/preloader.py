@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import math
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+
+from database import Database, db
+from config import PRELOAD_CONFIG
+from .residency import residency_manager
+from .scheduler import Priority, get_scheduler
+
+class ModelPreloader:
+    """模型预加载
+
+    启动时和空闲时，按各用户最近对话使用的模型预测接下来最可能用到的模型，
+    在内存预算内提前加载（只加载不生成），使重启后的首条消息只需等待模型加载。
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._task: Optional[asyncio.Task] = None
+        self._last_run_activity: Optional[float] = None
+
+    async def start(self) -> None:
+        if not PRELOAD_CONFIG["ENABLED"]:
+            return
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _loop(self) -> None:
+        """启动后先预加载一次，之后每次空闲超过阈值时再预加载一次"""
+        scheduler = get_scheduler()
+        try:
+            await asyncio.sleep(PRELOAD_CONFIG["STARTUP_DELAY"])
+            await self.run_once()
+            self._last_run_activity = scheduler.last_activity
+            while True:
+                await asyncio.sleep(PRELOAD_CONFIG["IDLE_CHECK_INTERVAL"])
+                # 同一段空闲期只预加载一次
+                if scheduler.last_activity == self._last_run_activity:
+                    continue
+                if scheduler.idle_seconds < PRELOAD_CONFIG["IDLE_SECONDS"]:
+                    continue
+                await self.run_once()
+                self._last_run_activity = scheduler.last_activity
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"模型预加载任务异常退出: {e}")
+            logging.exception(e)
+
+    async def rank_models(self) -> List[str]:
+        """按最近对话的模型使用情况排序候选模型
+
+        每个用户的最常用模型排在前面，其余模型按所有用户的加权使用量排序，
+        越近的对话权重越高（按 HALF_LIFE_HOURS 指数衰减）。
+        """
+        await self.db.ensure_connected()
+        since = (datetime.utcnow() - timedelta(days=PRELOAD_CONFIG["LOOKBACK_DAYS"])).isoformat()
+        rows = await self.db.fetch_all(
+            """
+            SELECT user_id, model, updated_at
+            FROM conversations
+            WHERE model IS NOT NULL AND model != '' AND datetime(updated_at) >= datetime(?)
+            ORDER BY updated_at DESC
+            LIMIT 1000
+            """,
+            (since,)
+        )
+
+        now = datetime.utcnow()
+        half_life = PRELOAD_CONFIG["HALF_LIFE_HOURS"] * 3600
+        user_scores: Dict[str, Dict[str, float]] = {}
+        for row in rows:
+            try:
+                updated_at = datetime.fromisoformat(str(row["updated_at"]).replace(" ", "T"))
+                age = max(0.0, (now - updated_at).total_seconds())
+            except ValueError:
+                age = half_life
+            weight = math.pow(0.5, age / half_life)
+            scores = user_scores.setdefault(row["user_id"], {})
+            scores[row["model"]] = scores.get(row["model"], 0.0) + weight
+
+        totals: Dict[str, float] = {}
+        favourites: List[str] = []
+        for scores in user_scores.values():
+            favourite = max(scores, key=scores.get)
+            if favourite not in favourites:
+                favourites.append(favourite)
+            for model, score in scores.items():
+                totals[model] = totals.get(model, 0.0) + score
+
+        favourites.sort(key=lambda m: totals[m], reverse=True)
+        others = sorted((m for m in totals if m not in favourites), key=totals.get, reverse=True)
+        return (favourites + others)[:PRELOAD_CONFIG["MAX_MODELS"]]
+
+    async def run_once(self) -> List[str]:
+        """在内存预算内预加载排名靠前的模型，不淘汰已加载的模型
+
+        Returns:
+            本次加载的模型
+        """
+        try:
+            candidates = await self.rank_models()
+        except Exception as e:
+            logging.error(f"统计模型使用情况失败: {e}")
+            return []
+
+        loaded = []
+        scheduler = get_scheduler()
+        for model in candidates:
+            if residency_manager.is_resident(model):
+                continue
+            if not await residency_manager.fits(model):
+                logging.info(f"预加载跳过模型 {model}：超出内存预算")
+                continue
+            # 以最低优先级占用槽位，不与用户请求竞争
+            async with scheduler.slot("preloader", Priority.WARMUP):
+                try:
+                    await residency_manager.client.load_model(model, keep_alive=residency_manager.keep_alive_for(model))
+                    residency_manager.mark_loaded(model)
+                    loaded.append(model)
+                    logging.info(f"已预加载模型 {model}")
+                except Exception as e:
+                    logging.warning(f"预加载模型 {model} 失败: {e}")
+        return loaded
+
+# 全局模型预加载器
+model_preloader = ModelPreloader(db)
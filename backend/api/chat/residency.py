@@ -0,0 +1,289 @@
+import asyncio
+import logging
+import re
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Dict, Any, List, Optional
+
+from ollama.client import OllamaClient
+from ollama.model_schema import calculate_vram_usage, get_quantization_bits
+from config import API_CONFIG, RESIDENCY_CONFIG
+
+GB = 1024 ** 3
+
+def parse_parameter_size(parameter_size: Any) -> float:
+    """将 "8B"、"8.0B"、"135M" 形式的参数量转换为十亿单位"""
+    if isinstance(parameter_size, (int, float)):
+        return float(parameter_size)
+    match = re.match(r"^\s*([\d.]+)\s*([KMBT]?)", str(parameter_size or ""), re.IGNORECASE)
+    if not match:
+        return 0.0
+    scale = {"": 1, "K": 1e-6, "M": 1e-3, "B": 1, "T": 1e3}[match.group(2).upper()]
+    try:
+        return float(match.group(1)) * scale
+    except ValueError:
+        return 0.0
+
+def detect_ram_budget() -> int:
+    """内存预算（字节），未配置时按系统总内存的比例计算"""
+    budget_gb = RESIDENCY_CONFIG.get("RAM_BUDGET_GB")
+    if budget_gb:
+        return int(float(budget_gb) * GB)
+    try:
+        import psutil
+        return int(psutil.virtual_memory().total * RESIDENCY_CONFIG["RAM_BUDGET_RATIO"])
+    except Exception as e:
+        logging.warning(f"无法获取系统内存大小，使用默认内存预算: {e}")
+        return 8 * GB
+
+class ModelUsage:
+    """模型使用记录，卸载后保留，用于 LRU/LFU 淘汰和热点判断"""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.last_used = 0.0
+        self.uses: deque = deque(maxlen=100)
+        self.in_flight = 0
+
+    def touch(self) -> None:
+        self.last_used = time.time()
+        self.uses.append(self.last_used)
+
+    def recent_uses(self, window: float) -> int:
+        since = time.time() - window
+        return sum(1 for t in self.uses if t >= since)
+
+class ResidencyManager:
+    """模型驻留管理
+
+    以 Ollama 的 /api/ps 为准跟踪已加载的模型，在内存预算内决定哪些模型常驻：
+    - 加载新模型前估算其内存占用，超出预算时按 LRU 或 LFU 淘汰空闲模型（keep_alive: 0）
+    - 近期频繁使用的热点模型在请求时使用更长的 keep_alive，避免被 Ollama 自动卸载
+    - 正在处理请求的模型不会被淘汰
+    """
+
+    def __init__(self, base_url: str, budget_bytes: int):
+        self.client = OllamaClient(base_url)
+        self.budget_bytes = budget_bytes
+        self.policy = RESIDENCY_CONFIG["POLICY"]
+        # 模型名 -> /api/ps 返回的记录
+        self.resident: Dict[str, Dict[str, Any]] = {}
+        self.usage: Dict[str, ModelUsage] = {}
+        # 模型名 -> 估算的内存占用（字节），按 /api/tags 的参数量和量化级别计算
+        self._estimates: Dict[str, int] = {}
+        self._last_refresh = 0.0
+        self._lock = asyncio.Lock()
+        self._poll_task: Optional[asyncio.Task] = None
+        self.evictions_total = 0
+
+    def _usage(self, model: str) -> ModelUsage:
+        key = self._normalize(model)
+        if key not in self.usage:
+            self.usage[key] = ModelUsage(key)
+        return self.usage[key]
+
+    async def start(self) -> None:
+        """启动后台轮询"""
+        if self._poll_task is None or self._poll_task.done():
+            self._poll_task = asyncio.create_task(self._poll())
+
+    async def stop(self) -> None:
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            try:
+                await self._poll_task
+            except asyncio.CancelledError:
+                pass
+            self._poll_task = None
+        await self.client.close()
+
+    async def _poll(self) -> None:
+        while True:
+            try:
+                await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.debug(f"获取已加载模型失败: {e}")
+            await asyncio.sleep(RESIDENCY_CONFIG["POLL_INTERVAL"])
+
+    async def refresh(self) -> None:
+        """从 /api/ps 同步已加载的模型"""
+        response = await self.client.list_running()
+        resident = {}
+        for item in response.get("models", []) or []:
+            name = item.get("name") or item.get("model")
+            if name:
+                resident[self._normalize(name)] = item
+        self.resident = resident
+        self._last_refresh = time.monotonic()
+
+    async def _refresh_if_stale(self) -> None:
+        if time.monotonic() - self._last_refresh < RESIDENCY_CONFIG["POLL_INTERVAL"]:
+            return
+        try:
+            await self.refresh()
+        except Exception as e:
+            logging.warning(f"获取已加载模型失败，按上次的状态处理: {e}")
+
+    @staticmethod
+    def _normalize(model: str) -> str:
+        return model if ":" in model else f"{model}:latest"
+
+    def is_resident(self, model: str) -> bool:
+        return self._normalize(model) in self.resident
+
+    def used_bytes(self) -> int:
+        return sum(self.footprint(name) for name in self.resident)
+
+    def footprint(self, model: str) -> int:
+        """模型的内存占用（字节），已加载时以 Ollama 报告的大小为准"""
+        item = self.resident.get(self._normalize(model))
+        if item and item.get("size"):
+            return int(item["size"])
+        return self._estimates.get(self._normalize(model), 0)
+
+    async def estimate(self, model: str) -> int:
+        """估算模型加载后的内存占用（字节）"""
+        key = self._normalize(model)
+        if key in self.resident and self.resident[key].get("size"):
+            return int(self.resident[key]["size"])
+        if key not in self._estimates:
+            try:
+                models = await self.client.list_models()
+                for info in models.models:
+                    details = info.details
+                    if details is None:
+                        continue
+                    parameters = parse_parameter_size(details.parameter_size)
+                    bits = get_quantization_bits(details.quantization_level or "")
+                    estimate = int(calculate_vram_usage(parameters, bits) * GB)
+                    # 无法解析参数量时退回到模型文件大小
+                    self._estimates[self._normalize(info.name)] = estimate or info.size
+            except Exception as e:
+                logging.warning(f"估算模型 {model} 的内存占用失败: {e}")
+        return self._estimates.get(key, 0)
+
+    def is_hot(self, model: str) -> bool:
+        usage = self.usage.get(self._normalize(model))
+        if usage is None:
+            return False
+        return usage.recent_uses(RESIDENCY_CONFIG["HOT_WINDOW_SECONDS"]) >= RESIDENCY_CONFIG["HOT_MIN_USES"]
+
+    def keep_alive_for(self, model: str) -> str:
+        """请求时使用的 keep_alive，热点模型常驻更久"""
+        if self.is_hot(model):
+            return RESIDENCY_CONFIG["PIN_KEEP_ALIVE"]
+        return RESIDENCY_CONFIG["DEFAULT_KEEP_ALIVE"]
+
+    def _eviction_key(self, name: str):
+        usage = self.usage.get(name)
+        last_used = usage.last_used if usage else 0.0
+        if self.policy == "lfu":
+            uses = usage.recent_uses(RESIDENCY_CONFIG["HOT_WINDOW_SECONDS"]) if usage else 0
+            return (uses, last_used)
+        return (last_used,)
+
+    def _in_flight(self, name: str) -> bool:
+        usage = self.usage.get(name)
+        return usage is not None and usage.in_flight > 0
+
+    async def ensure_capacity(self, model: str) -> bool:
+        """确保加载 model 不会超出内存预算，必要时淘汰其他空闲模型
+
+        Returns:
+            模型是否已经驻留
+        """
+        async with self._lock:
+            await self._refresh_if_stale()
+            self._usage(model).touch()
+            if self.is_resident(model):
+                return True
+
+            needed = await self.estimate(model)
+            target = self._normalize(model)
+            # 卸载失败的模型仍然占用内存，本轮不再重试
+            failed = set()
+            while self.used_bytes() + needed > self.budget_bytes:
+                candidates = [
+                    name for name in self.resident
+                    if name != target and name not in failed and not self._in_flight(name)
+                ]
+                if not candidates:
+                    logging.warning(
+                        f"加载模型 {model} 需要约 {needed / GB:.2f} GB，超出内存预算 "
+                        f"{self.budget_bytes / GB:.2f} GB，但没有可淘汰的空闲模型"
+                    )
+                    break
+                victim = min(candidates, key=self._eviction_key)
+                if not await self.evict(victim):
+                    failed.add(victim)
+            return False
+
+    async def fits(self, model: str) -> bool:
+        """不淘汰其他模型的情况下，加载 model 是否在内存预算内"""
+        async with self._lock:
+            await self._refresh_if_stale()
+            if self.is_resident(model):
+                return True
+            needed = await self.estimate(model)
+            return self.used_bytes() + needed <= self.budget_bytes
+
+    async def evict(self, model: str) -> bool:
+        """卸载模型（keep_alive: 0），返回是否卸载成功
+
+        卸载失败时模型可能仍然驻留，保留其内存占用，并在下一次检查时重新查询 /api/ps。
+        """
+        logging.info(f"内存预算不足，卸载模型 {model}（策略: {self.policy}）")
+        try:
+            await self.client.unload_model(model)
+        except Exception as e:
+            logging.error(f"卸载模型 {model} 失败: {e}")
+            self._last_refresh = 0.0
+            return False
+        self.evictions_total += 1
+        self.resident.pop(self._normalize(model), None)
+        return True
+
+    def mark_loaded(self, model: str) -> None:
+        """模型加载完成后立即视为驻留，下一次轮询时以 /api/ps 为准"""
+        key = self._normalize(model)
+        if key not in self.resident:
+            self.resident[key] = {"name": key, "size": self._estimates.get(key, 0)}
+        # 让下一次检查重新同步实际大小
+        self._last_refresh = 0.0
+
+    @asynccontextmanager
+    async def in_use(self, model: str):
+        """标记模型正在处理请求，期间不会被淘汰"""
+        usage = self._usage(model)
+        usage.in_flight += 1
+        try:
+            yield
+        finally:
+            usage.in_flight -= 1
+            usage.last_used = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        resident: List[Dict[str, Any]] = []
+        for name, item in self.resident.items():
+            usage = self.usage.get(name)
+            resident.append({
+                "name": name,
+                "size": self.footprint(name),
+                "expires_at": item.get("expires_at"),
+                "in_flight": usage.in_flight if usage else 0,
+                "last_used": usage.last_used if usage else None,
+                "hot": self.is_hot(name)
+            })
+        return {
+            "policy": self.policy,
+            "budget_bytes": self.budget_bytes,
+            "used_bytes": self.used_bytes(),
+            "evictions_total": self.evictions_total,
+            "resident": resident
+        }
+
+# 全局驻留管理器
+residency_manager = ResidencyManager(API_CONFIG["OLLAMA_BASE_URL"], detect_ram_budget())
@@ -0,0 +1,338 @@
+import asyncio
+import bisect
+import logging
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import AsyncExitStack
+from enum import IntEnum
+from typing import Any, AsyncContextManager, Awaitable, Callable, Dict, List, Optional
+
+from config import API_CONFIG, SCHEDULER_CONFIG
+from metrics import client_pool_in_use
+
+class Priority(IntEnum):
+    """请求优先级，数值越小越先被调度"""
+    INTERACTIVE = 0  # 交互式聊天
+    BACKGROUND = 1   # 后台任务
+    WARMUP = 2       # 模型预热
+
+class QueueFullError(Exception):
+    """等待队列已满，请求被拒绝"""
+    pass
+
+class _Ticket:
+    """等待中的请求"""
+
+    def __init__(self, username: str, priority: Priority, notifier=None):
+        self.username = username
+        self.priority = priority
+        self.notifier = notifier
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued_at = time.monotonic()
+        self.position: Optional[int] = None
+        # 待推送的排队位置帧，由每个请求各自的发送协程按顺序发送
+        self.outbox: deque = deque()
+        self.sender: Optional[asyncio.Task] = None
+
+class Histogram:
+    """固定分桶的直方图"""
+
+    def __init__(self, buckets: List[float]):
+        self.buckets = sorted(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        # 累计分桶计数，与 Prometheus 直方图的 le 语义一致
+        cumulative = []
+        total = 0
+        for bound, count in zip(self.buckets + [float("inf")], self.counts):
+            total += count
+            cumulative.append({"le": "+Inf" if bound == float("inf") else bound, "count": total})
+        return {"buckets": cumulative, "sum": round(self.sum, 6), "count": self.count}
+
+class SchedulerSlot:
+    """调度槽位，以异步上下文管理器的形式替代原来的信号量
+
+    用法与信号量相同：`async with slot:` 进入时排队等待，退出时释放。
+    - hold：从开始排队到释放槽位期间保持的上下文，如标记模型正在使用、排队期间不被淘汰
+    - prepare：获得槽位后、执行请求前的准备工作，如腾出内存并加载模型，受调度器的公平排队约束
+    """
+
+    def __init__(self, scheduler: "FairScheduler", username: Optional[str], priority: Priority, notifier=None,
+                 model: Optional[str] = None,
+                 prepare: Optional[Callable[[], Awaitable[Any]]] = None,
+                 hold: Optional[Callable[[], AsyncContextManager]] = None):
+        self.scheduler = scheduler
+        self.username = username or "anonymous"
+        self.priority = priority
+        self.notifier = notifier
+        # 占用槽位的模型，用于按模型统计客户端池的占用
+        self.model = model
+        self.prepare = prepare
+        self.hold = hold
+        self._acquired = False
+        self._stack: Optional[AsyncExitStack] = None
+        # 本次排队等待的时间（秒）
+        self.wait_seconds = 0.0
+
+    def check(self) -> None:
+        """不排队，只检查当前是否会因队列已满被拒绝"""
+        self.scheduler.check_admission(self.username, self.priority)
+
+    async def __aenter__(self) -> "SchedulerSlot":
+        stack = AsyncExitStack()
+        try:
+            if self.hold is not None:
+                await stack.enter_async_context(self.hold())
+            started = time.monotonic()
+            await self.scheduler.acquire(self.username, self.priority, self.notifier)
+            self.wait_seconds = time.monotonic() - started
+            self._acquired = True
+            # 先于 hold 退出：释放槽位后再解除模型的使用标记
+            stack.callback(self._release)
+            if self.model:
+                client_pool_in_use.inc(model=self.model)
+            if self.prepare is not None:
+                await self.prepare()
+        except BaseException:
+            await stack.aclose()
+            raise
+        self._stack = stack
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        stack, self._stack = self._stack, None
+        if stack is not None:
+            await stack.aclose()
+
+    def _release(self) -> None:
+        if self._acquired:
+            self._acquired = False
+            self.scheduler.release()
+            if self.model:
+                client_pool_in_use.dec(model=self.model)
+
+class FairScheduler:
+    """按用户公平排队的优先级调度器
+
+    - 高优先级的请求总是先于低优先级的请求被调度
+    - 同一优先级内按用户轮转，避免单个用户的大量长请求饿死其他用户
+    - 等待队列总长度和单用户排队数有上限，超出时直接拒绝
+    - 排队位置变化时通过 notifier.send_json 推送 queue_position 帧
+    """
+
+    def __init__(self, capacity: int, max_queue_length: int, max_queue_per_user: int, wait_buckets: List[float]):
+        self.capacity = capacity
+        self.max_queue_length = max_queue_length
+        self.max_queue_per_user = max_queue_per_user
+        self.active = 0
+        # 每个优先级一个 用户 -> 等待队列 的有序映射，轮转时把服务过的用户移到末尾
+        self.queues: Dict[Priority, "OrderedDict[str, deque]"] = {p: OrderedDict() for p in Priority}
+        self.wait_histograms: Dict[Priority, Histogram] = {p: Histogram(wait_buckets) for p in Priority}
+        self.granted_total: Dict[Priority, int] = {p: 0 for p in Priority}
+        self.rejected_total: Dict[Priority, int] = {p: 0 for p in Priority}
+        self.max_observed_depth = 0
+        # 最近一次交互式或后台请求进入调度器的时间，用于判断空闲
+        self.last_activity = time.monotonic()
+        # 正在推送排队位置的发送协程，保留引用以免任务在完成前被回收
+        self._send_tasks: set = set()
+
+    @property
+    def idle_seconds(self) -> float:
+        """没有请求在执行或排队时，距上次活动的秒数；否则为 0"""
+        if self.active or self.waiting:
+            return 0.0
+        return time.monotonic() - self.last_activity
+
+    @property
+    def waiting(self) -> int:
+        return sum(len(q) for queues in self.queues.values() for q in queues.values())
+
+    def slot(self, username: Optional[str], priority: Priority = Priority.INTERACTIVE, notifier=None,
+             model: Optional[str] = None,
+             prepare: Optional[Callable[[], Awaitable[Any]]] = None,
+             hold: Optional[Callable[[], AsyncContextManager]] = None) -> SchedulerSlot:
+        """创建一个调度槽位"""
+        return SchedulerSlot(self, username, priority, notifier, model, prepare, hold)
+
+    def check_admission(self, username: str, priority: Priority) -> None:
+        """请求需要排队且队列已满时抛出 QueueFullError"""
+        if self.active < self.capacity and self.waiting == 0:
+            return
+        if self.waiting >= self.max_queue_length:
+            self.rejected_total[priority] += 1
+            raise QueueFullError(f"请求队列已满（{self.max_queue_length}），请稍后重试")
+        user_queue = self.queues[priority].get(username)
+        if user_queue is not None and len(user_queue) >= self.max_queue_per_user:
+            self.rejected_total[priority] += 1
+            raise QueueFullError(f"排队中的请求过多（{self.max_queue_per_user}），请等待之前的请求完成")
+
+    async def acquire(self, username: str, priority: Priority, notifier=None) -> None:
+        """获取执行槽位，必要时排队等待"""
+        if priority != Priority.WARMUP:
+            self.last_activity = time.monotonic()
+        if self.active < self.capacity and self.waiting == 0:
+            self.active += 1
+            self._record_grant(priority, 0.0)
+            return
+
+        self.check_admission(username, priority)
+
+        ticket = _Ticket(username, priority, notifier)
+        self.queues[priority].setdefault(username, deque()).append(ticket)
+        self.max_observed_depth = max(self.max_observed_depth, self.waiting)
+        logging.info(f"用户 {username} 的请求进入等待队列，优先级: {priority.name}，当前排队: {self.waiting}")
+        self._notify_positions()
+
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            if ticket.future.done() and not ticket.future.cancelled():
+                # 已分配槽位但调用方被取消，归还槽位
+                self.release()
+            else:
+                self._remove(ticket)
+                self._notify_positions()
+            raise
+
+        if ticket.notifier is not None:
+            self._send(ticket, {"type": "queue_position", "position": 0, "queue_length": self.waiting,
+                                "priority": priority.name.lower()})
+
+    def release(self) -> None:
+        """释放槽位并调度下一个等待的请求"""
+        self.active = max(0, self.active - 1)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        dispatched = False
+        while self.active < self.capacity:
+            ticket = self._pop_next()
+            if ticket is None:
+                break
+            if ticket.future.done():
+                continue
+            self.active += 1
+            self._record_grant(ticket.priority, time.monotonic() - ticket.enqueued_at)
+            ticket.future.set_result(None)
+            dispatched = True
+        if dispatched:
+            self._notify_positions()
+
+    def _pop_next(self) -> Optional[_Ticket]:
+        for priority in Priority:
+            queues = self.queues[priority]
+            if not queues:
+                continue
+            username, user_queue = next(iter(queues.items()))
+            ticket = user_queue.popleft()
+            del queues[username]
+            if user_queue:
+                # 该用户还有请求，排到本优先级的末尾
+                queues[username] = user_queue
+            return ticket
+        return None
+
+    def _remove(self, ticket: _Ticket) -> None:
+        queues = self.queues[ticket.priority]
+        user_queue = queues.get(ticket.username)
+        if user_queue is None:
+            return
+        try:
+            user_queue.remove(ticket)
+        except ValueError:
+            return
+        if not user_queue:
+            del queues[ticket.username]
+
+    def _ordered(self) -> List[_Ticket]:
+        """按调度顺序排列所有等待中的请求"""
+        ordered = []
+        for priority in Priority:
+            user_queues = [list(q) for q in self.queues[priority].values()]
+            depth = max((len(q) for q in user_queues), default=0)
+            for i in range(depth):
+                ordered.extend(q[i] for q in user_queues if i < len(q))
+        return ordered
+
+    def _notify_positions(self) -> None:
+        ordered = self._ordered()
+        for position, ticket in enumerate(ordered, 1):
+            if ticket.notifier is None or ticket.position == position:
+                continue
+            ticket.position = position
+            self._send(ticket, {"type": "queue_position", "position": position, "queue_length": len(ordered),
+                                "priority": ticket.priority.name.lower()})
+
+    def _send(self, ticket: _Ticket, frame: Dict[str, Any]) -> None:
+        ticket.outbox.append(frame)
+        if ticket.sender is None or ticket.sender.done():
+            ticket.sender = asyncio.create_task(self._drain(ticket))
+            self._send_tasks.add(ticket.sender)
+            ticket.sender.add_done_callback(self._send_tasks.discard)
+
+    async def _drain(self, ticket: _Ticket) -> None:
+        """按入队顺序推送同一请求的排队位置帧"""
+        while ticket.outbox:
+            frame = ticket.outbox.popleft()
+            try:
+                await ticket.notifier.send_json(frame)
+            except Exception as e:
+                logging.debug(f"发送排队位置失败: {e}")
+
+    def _record_grant(self, priority: Priority, waited: float) -> None:
+        self.granted_total[priority] += 1
+        self.wait_histograms[priority].observe(waited)
+
+    def snapshot(self) -> Dict[str, Any]:
+        """调度器状态快照：队列深度和等待时间直方图"""
+        return {
+            "capacity": self.capacity,
+            "active": self.active,
+            "queue_depth": self.waiting,
+            "max_queue_depth": self.max_observed_depth,
+            "max_queue_length": self.max_queue_length,
+            "priorities": {
+                priority.name.lower(): {
+                    "queue_depth": sum(len(q) for q in self.queues[priority].values()),
+                    "waiting_users": len(self.queues[priority]),
+                    "granted_total": self.granted_total[priority],
+                    "rejected_total": self.rejected_total[priority],
+                    "wait_seconds": self.wait_histograms[priority].snapshot()
+                }
+                for priority in Priority
+            }
+        }
+
+def resolve_max_concurrent() -> int:
+    """从配置获取并发请求数，未配置时使用CPU核心数"""
+    max_concurrent = API_CONFIG.get("MAX_CONCURRENT_REQUESTS", 4)
+    if not isinstance(max_concurrent, int) or max_concurrent <= 0:
+        max_concurrent = os.cpu_count() or 4
+        logging.info(f"使用默认并发数: {max_concurrent}")
+    else:
+        logging.info(f"使用配置的并发数: {max_concurrent}")
+    return max_concurrent
+
+# 全局调度器
+scheduler: Optional[FairScheduler] = None
+
+def get_scheduler() -> FairScheduler:
+    """获取全局调度器，首次调用时创建"""
+    global scheduler
+    if scheduler is None:
+        scheduler = FairScheduler(
+            resolve_max_concurrent(),
+            SCHEDULER_CONFIG["MAX_QUEUE_LENGTH"],
+            SCHEDULER_CONFIG["MAX_QUEUE_PER_USER"],
+            SCHEDULER_CONFIG["WAIT_BUCKETS"]
+        )
+    return scheduler
@@ -49,3 +49,14 @@ class ModelUpdate(BaseModel):
     model_config = {
         'protected_namespaces': ()
     }
+
+class BatchJobCreate(BaseModel):
+    """批量推理任务"""
+    model: str
+    prompts: List[str]
+    system: Optional[str] = None
+    options: Optional[Dict[str, Any]] = None
+
+    model_config = {
+        'protected_namespaces': ()
+    }
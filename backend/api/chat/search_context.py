@@ -0,0 +1,185 @@
+import logging
+import math
+import re
+from collections import Counter
+from typing import Dict, Any, List, Optional, Tuple
+
+from config import SEARCH_CONTEXT_CONFIG
+
+_CJK = r"㐀-䶿一-鿿豈-﫿぀-ヿ가-힯"
+_TOKEN_RE = re.compile(rf"[{_CJK}]+|[a-z0-9]+(?:['._-][a-z0-9]+)*")
+_CJK_RE = re.compile(rf"[{_CJK}]")
+# 句子边界：中文句末标点，或英文句末标点后跟空白
+_SENTENCE_RE = re.compile(r"(?<=[。！？!?；;])|(?<=[.])\s+")
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符约一个 token，其余约四个字符一个 token"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+def tokenize(text: str) -> List[str]:
+    """分词：英文按单词，中日韩文本按单字和相邻二字组合"""
+    terms = []
+    for token in _TOKEN_RE.findall((text or "").lower()):
+        if _CJK_RE.match(token):
+            terms.extend(token)
+            terms.extend(token[i:i + 2] for i in range(len(token) - 1))
+        else:
+            terms.append(token)
+    return terms
+
+def split_passages(text: str, max_chars: int) -> List[str]:
+    """按段落切分，过长的段落再按句子合并为不超过 max_chars 的片段"""
+    passages = []
+    for paragraph in re.split(r"\n\s*\n|\n(?=[-*#\d])", text or ""):
+        paragraph = re.sub(r"\s+", " ", paragraph).strip()
+        if not paragraph:
+            continue
+        if len(paragraph) <= max_chars:
+            passages.append(paragraph)
+            continue
+        current = ""
+        for sentence in _SENTENCE_RE.split(paragraph):
+            sentence = sentence.strip()
+            if not sentence:
+                continue
+            if current and len(current) + len(sentence) + 1 > max_chars:
+                passages.append(current)
+                current = ""
+            # 没有句子边界的超长文本按长度硬切分
+            while len(sentence) > max_chars:
+                passages.append(sentence[:max_chars])
+                sentence = sentence[max_chars:]
+            current = f"{current} {sentence}" if current else sentence
+        if current:
+            passages.append(current)
+    return passages
+
+def _shingles(text: str, size: int = 5) -> set:
+    normalized = re.sub(r"\W+", "", text.lower())
+    if len(normalized) <= size:
+        return {normalized} if normalized else set()
+    return {normalized[i:i + size] for i in range(len(normalized) - size + 1)}
+
+class _Passage:
+    __slots__ = ("source", "order", "text", "terms", "shingles", "tokens", "score")
+
+    def __init__(self, source: int, order: int, text: str):
+        self.source = source
+        self.order = order
+        self.text = text
+        self.terms = tokenize(text)
+        self.shingles = _shingles(text)
+        self.tokens = estimate_tokens(text)
+        self.score = 0.0
+
+def dedupe(passages: List[_Passage], threshold: float) -> List[_Passage]:
+    """去掉与已保留片段高度重叠（Jaccard 相似度不低于 threshold）的片段"""
+    kept: List[_Passage] = []
+    for passage in passages:
+        if not passage.shingles:
+            continue
+        duplicate = False
+        for other in kept:
+            overlap = len(passage.shingles & other.shingles)
+            union = len(passage.shingles | other.shingles)
+            if union and overlap / union >= threshold:
+                duplicate = True
+                break
+            # 被已保留片段完整包含的短片段也视为重复
+            if overlap >= len(passage.shingles) * threshold and passage.tokens <= other.tokens:
+                duplicate = True
+                break
+        if not duplicate:
+            kept.append(passage)
+    return kept
+
+def bm25_scores(query_terms: List[str], documents: List[List[str]], k1: float, b: float) -> List[float]:
+    """以候选片段为语料计算每个片段对查询的 BM25 分数"""
+    if not documents:
+        return []
+    n = len(documents)
+    avg_len = sum(len(doc) for doc in documents) / n or 1.0
+    document_frequency = Counter()
+    for doc in documents:
+        document_frequency.update(set(doc))
+    query_counts = Counter(query_terms)
+
+    scores = []
+    for doc in documents:
+        frequencies = Counter(doc)
+        length_norm = k1 * (1 - b + b * len(doc) / avg_len)
+        score = 0.0
+        for term, query_count in query_counts.items():
+            tf = frequencies.get(term)
+            if not tf:
+                continue
+            df = document_frequency[term]
+            idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+            score += query_count * idf * tf * (k1 + 1) / (tf + length_norm)
+        scores.append(score)
+    return scores
+
+def build_search_context(query: str, results: List[Dict[str, Any]],
+                         token_budget: Optional[int] = None) -> Tuple[str, Dict[str, Any]]:
+    """将搜索结果压缩为不超过 token 预算的上下文
+
+    去重后按 BM25 对片段与问题的相关性排序，贪心选入预算内得分最高的片段，
+    再按来源和原文顺序输出，每个来源只列出一次标题和链接。
+
+    Returns:
+        (上下文文本, 统计信息)
+    """
+    config = SEARCH_CONTEXT_CONFIG
+    budget = token_budget or config["TOKEN_BUDGET"]
+
+    passages: List[_Passage] = []
+    original_tokens = 0
+    for source, result in enumerate(results):
+        content = result.get("content") or ""
+        original_tokens += estimate_tokens(content)
+        for order, text in enumerate(split_passages(content, config["MAX_PASSAGE_CHARS"])):
+            passages.append(_Passage(source, order, text))
+
+    candidates = dedupe(passages, config["DEDUPE_THRESHOLD"])
+    scores = bm25_scores(tokenize(query), [p.terms for p in candidates], config["BM25_K1"], config["BM25_B"])
+    if any(scores):
+        # 有片段与问题相关时，丢弃完全不相关的片段
+        candidates, scores = zip(*[(p, s) for p, s in zip(candidates, scores) if s > 0])
+    for passage, score in zip(candidates, scores):
+        # 搜索引擎排名靠前的来源略微加分，分数相同时保持原来的顺序
+        passage.score = score + config["SOURCE_RANK_WEIGHT"] / (passage.source + 1)
+
+    selected: List[_Passage] = []
+    used_tokens = 0
+    for passage in sorted(candidates, key=lambda p: (-p.score, p.source, p.order)):
+        if len(selected) >= config["MAX_PASSAGES"]:
+            break
+        if used_tokens + passage.tokens > budget:
+            continue
+        selected.append(passage)
+        used_tokens += passage.tokens
+
+    by_source: Dict[int, List[_Passage]] = {}
+    for passage in sorted(selected, key=lambda p: (p.source, p.order)):
+        by_source.setdefault(passage.source, []).append(passage)
+
+    blocks = []
+    for idx, (source, items) in enumerate(sorted(by_source.items()), 1):
+        result = results[source]
+        header = f"{idx}. {result.get('title') or ''}: {result.get('url') or ''}"
+        blocks.append(header + "\n" + "\n".join(p.text for p in items))
+
+    stats = {
+        "results": len(results),
+        "passages": len(passages),
+        "candidates": len(candidates),
+        "selected": len(selected),
+        "original_tokens": original_tokens,
+        "context_tokens": used_tokens,
+        "token_budget": budget
+    }
+    logging.debug(f"网页搜索结果压缩: {stats}")
+    return "\n\n".join(blocks), stats
@@ -0,0 +1,248 @@
+import asyncio
+import logging
+import time
+from typing import Dict, Any, Optional, Set
+
+from fastapi import WebSocket, WebSocketDisconnect
+from database import Database
+
+from config import WEBSOCKET_CONFIG
+from metrics import websocket_connections, websocket_streams, websocket_streams_total
+from tracing import finish_trace, start_trace
+from .websocket_handler import get_current_user_from_token, get_owned_conversation, run_chat_turn, resume_generation
+from .compare import run_compare_turn
+from .generation_registry import CancelReason, generation_registry
+
+class SessionStream:
+    """会话中的单个流，为发送的每一帧附加请求ID和对话ID"""
+
+    def __init__(self, session: "ChatSession", request_id: str, conversation_id: str):
+        self.session = session
+        self.request_id = request_id
+        self.conversation_id = conversation_id
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        frame = dict(data)
+        frame["request_id"] = self.request_id
+        frame["conversation_id"] = self.conversation_id
+        await self.session.send_json(frame)
+
+class ChatSession:
+    """长连接聊天会话
+
+    一次认证后，在同一个WebSocket上承载多轮、多对话的并发流。
+    客户端消息格式：
+    - {"type": "chat", "request_id": ..., "conversation_id": ..., "messages": [...], "model": ..., "web_search": ...}
+    - {"type": "compare", "request_id": ..., "conversation_id": ..., "messages": [...], "models": [...], "web_search": ...}
+    - {"type": "cancel", "request_id": ...}
+    - {"type": "resume", "request_id": ..., "generation_id": ..., "offset": ...}
+    - {"type": "ping"} / {"type": "pong"}
+
+    连接断开只会取消订阅，生成任务继续运行，在宽限期内重连可通过 resume 从偏移处续传。
+    心跳超时视为客户端已失联，立即取消本会话发起且仍在进行的生成；
+    同一对话之后由其他会话发起的生成不受影响。
+    """
+
+    def __init__(self, websocket: WebSocket, db: Database):
+        self.websocket = websocket
+        self.db = db
+        self.current_user: Optional[Dict[str, Any]] = None
+        self.streams: Dict[str, asyncio.Task] = {}
+        self.stream_conversations: Dict[str, str] = {}
+        # 各请求订阅的生成任务ID，用于按请求取消
+        self.stream_generations: Dict[str, str] = {}
+        # 本会话发起且尚未结束的生成任务ID，生成结束时移除
+        self.owned_generations: Set[str] = set()
+        self._send_lock = asyncio.Lock()
+        self._last_seen = time.monotonic()
+        self._closed = False
+
+    async def send_json(self, data: Dict[str, Any]) -> None:
+        """串行化发送，避免多个流同时写入同一个连接"""
+        if self._closed:
+            raise WebSocketDisconnect(code=1006)
+        async with self._send_lock:
+            await self.websocket.send_json(data)
+
+    async def run(self, token: str) -> None:
+        await self.websocket.accept()
+
+        # 仅在建立会话时认证一次
+        try:
+            self.current_user = await get_current_user_from_token(token)
+        except Exception as e:
+            await self.websocket.send_json({"type": "error", "error": f"认证失败: {str(e)}"})
+            await self.websocket.close()
+            return
+
+        await self.send_json({
+            "type": "session_ready",
+            "ping_interval": WEBSOCKET_CONFIG["PING_INTERVAL"],
+            "ping_timeout": WEBSOCKET_CONFIG["PING_TIMEOUT"]
+        })
+
+        heartbeat_task = asyncio.create_task(self._heartbeat())
+        websocket_connections.inc(endpoint="session")
+        try:
+            while True:
+                data = await self.websocket.receive_json()
+                self._last_seen = time.monotonic()
+                await self._dispatch(data)
+        except WebSocketDisconnect:
+            logging.info(f"用户 {self.current_user['username']} 的聊天会话已断开")
+        except Exception as e:
+            if self._closed:
+                logging.info(f"用户 {self.current_user['username']} 的聊天会话已关闭")
+            else:
+                logging.error(f"处理聊天会话消息失败: {str(e)}")
+                logging.exception(e)
+        finally:
+            self._closed = True
+            websocket_connections.dec(endpoint="session")
+            heartbeat_task.cancel()
+            for request_id in list(self.streams):
+                self.cancel_stream(request_id)
+            try:
+                await self.websocket.close()
+            except:
+                pass
+
+    async def _dispatch(self, data: Dict[str, Any]) -> None:
+        """根据消息类型分发处理"""
+        message_type = data.get("type")
+
+        if message_type == "chat":
+            await self._start_stream(data, run_chat_turn)
+        elif message_type == "compare":
+            await self._start_stream(data, run_compare_turn)
+        elif message_type == "resume":
+            await self._resume_stream(data)
+        elif message_type == "cancel":
+            request_id = data.get("request_id")
+            # 只取消该请求自己的生成，不影响同一对话中其他会话发起的生成
+            generation = generation_registry.get(self.stream_generations.get(request_id))
+            cancelled = generation is not None and generation.cancel(CancelReason.ABORT)
+            if cancelled or self.cancel_stream(request_id):
+                await self.send_json({"type": "cancel_ack", "request_id": request_id})
+            else:
+                await self.send_json({"type": "error", "request_id": request_id, "error": "没有找到进行中的生成"})
+        elif message_type == "ping":
+            await self.send_json({"type": "pong"})
+        elif message_type == "pong":
+            pass
+        else:
+            await self.send_json({"type": "error", "error": f"未知的消息类型: {message_type}"})
+
+    async def _start_stream(self, data: Dict[str, Any], turn) -> None:
+        request_id = data.get("request_id")
+        conversation_id = data.get("conversation_id")
+
+        if not request_id or not conversation_id:
+            await self.send_json({"type": "error", "request_id": request_id, "error": "缺少 request_id 或 conversation_id"})
+            return
+
+        if request_id in self.streams:
+            await self.send_json({"type": "error", "request_id": request_id, "error": "请求ID已存在"})
+            return
+
+        # 每轮都重新查询（按主键的一次查询）：对话可能已通过 REST 接口切换模型或被删除
+        try:
+            conversation = await get_owned_conversation(self.db, conversation_id, self.current_user["username"])
+        except Exception as e:
+            await self.send_json({"type": "error", "request_id": request_id, "error": f"获取对话失败: {str(e)}"})
+            return
+        if not conversation:
+            await self.send_json({"type": "error", "request_id": request_id, "error": "对话不存在或无权访问"})
+            return
+
+        stream = SessionStream(self, request_id, conversation_id)
+
+        def on_start(generation) -> None:
+            self.stream_generations[request_id] = generation.id
+            self.owned_generations.add(generation.id)
+            generation.task.add_done_callback(lambda _: self.owned_generations.discard(generation.id))
+
+        self._spawn(stream, turn(stream, self.db, conversation, self.current_user, data, on_start=on_start))
+
+    async def _resume_stream(self, data: Dict[str, Any]) -> None:
+        request_id = data.get("request_id")
+        generation = generation_registry.get(data.get("generation_id"))
+
+        if not request_id or request_id in self.streams:
+            await self.send_json({"type": "error", "request_id": request_id, "error": "请求ID无效或已存在"})
+            return
+
+        if generation is None or generation.username != self.current_user["username"]:
+            await self.send_json({"type": "error", "request_id": request_id, "error": "生成任务不存在或已过期"})
+            return
+
+        stream = SessionStream(self, request_id, generation.conversation_id)
+        self.stream_generations[request_id] = generation.id
+        self._spawn(stream, resume_generation(stream, generation.id, self.current_user, data.get("offset", 0)))
+
+    def _spawn(self, stream: SessionStream, coro) -> None:
+        task = asyncio.create_task(self._run_stream(stream, coro))
+        self.streams[stream.request_id] = task
+        self.stream_conversations[stream.request_id] = stream.conversation_id
+
+    async def _run_stream(self, stream: SessionStream, coro) -> None:
+        websocket_streams.inc(endpoint="session")
+        websocket_streams_total.inc(endpoint="session")
+        # 每个流单独追踪，结束时发送各阶段耗时的 timing 帧
+        trace, token = start_trace("ws stream", request_id=stream.request_id, conversation_id=stream.conversation_id)
+        try:
+            await coro
+            if trace is not None and not self._closed:
+                await stream.send_json(trace.timing_frame())
+        except asyncio.CancelledError:
+            logging.info(f"会话流 {stream.request_id} 已取消订阅")
+        except WebSocketDisconnect:
+            pass
+        except Exception as e:
+            logging.error(f"会话流 {stream.request_id} 处理失败: {str(e)}")
+            logging.exception(e)
+            try:
+                await stream.send_json({"error": f"处理消息失败: {str(e)}"})
+            except Exception:
+                pass
+        finally:
+            finish_trace(trace, token)
+            websocket_streams.dec(endpoint="session")
+            self.streams.pop(stream.request_id, None)
+            self.stream_conversations.pop(stream.request_id, None)
+            self.stream_generations.pop(stream.request_id, None)
+
+    def cancel_stream(self, request_id: Optional[str]) -> bool:
+        """取消指定请求在本会话中的订阅（不影响生成任务本身）"""
+        task = self.streams.get(request_id)
+        if task is None or task.done():
+            return False
+        task.cancel()
+        return True
+
+    async def _heartbeat(self) -> None:
+        """定期发送心跳，超时未收到任何消息则关闭连接"""
+        interval = WEBSOCKET_CONFIG["PING_INTERVAL"]
+        timeout = WEBSOCKET_CONFIG["PING_TIMEOUT"]
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                if time.monotonic() - self._last_seen > interval + timeout:
+                    logging.warning(f"用户 {self.current_user['username']} 的聊天会话心跳超时，关闭连接")
+                    self._closed = True
+                    for generation_id in list(self.owned_generations):
+                        generation = generation_registry.get(generation_id)
+                        if generation is not None:
+                            generation.cancel(CancelReason.HEARTBEAT_TIMEOUT)
+                    await self.websocket.close(code=1001, reason="心跳超时")
+                    return
+                await self.send_json({"type": "ping"})
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.debug(f"发送心跳失败: {str(e)}")
+
+async def handle_chat_session(websocket: WebSocket, token: str, db: Database):
+    """处理长连接聊天会话"""
+    session = ChatSession(websocket, db)
+    await session.run(token)
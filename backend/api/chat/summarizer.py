@@ -0,0 +1,153 @@
+import asyncio
+import logging
+from typing import Dict, Any, List, Optional
+
+from ollama.types import ChatMessage, ChatRequest, Options
+from database import Database, db
+from config import SUMMARY_CONFIG
+from .client_pool import get_available_client
+from .residency import residency_manager
+from .scheduler import Priority
+
+SUMMARY_INSTRUCTION = (
+    "你是对话摘要助手。请把下面的对话整理为简洁的摘要，保留用户的目标、偏好、已确认的事实、"
+    "关键结论和尚未解决的问题，省略寒暄和重复内容。如果提供了之前的摘要，请将新的对话内容合并进去，"
+    "输出一份完整的新摘要。只输出摘要本身，不要添加解释。"
+)
+
+class ConversationSummarizer:
+    """对话滚动摘要
+
+    对话超过 TRIGGER_MESSAGES 条消息后，较早的消息（最近 KEEP_RECENT 条之前）由后台任务
+    以低优先级压缩为摘要并保存到 conversations 表。构建提示词时用摘要替换这些消息，
+    之后每当又有 MIN_BATCH 条消息移出最近窗口时，把它们增量合并进摘要，
+    使提示词长度趋于稳定而不是随对话长度增长。
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self.runs_total = 0
+        self.failures_total = 0
+
+    @property
+    def enabled(self) -> bool:
+        return SUMMARY_CONFIG["ENABLED"]
+
+    async def load(self, conversation_id: str) -> Optional[Dict[str, Any]]:
+        """获取对话当前的摘要，没有摘要时返回None"""
+        if not self.enabled:
+            return None
+        row = await self.db.fetch_one(
+            "SELECT summary, summary_upto FROM conversations WHERE id = ?",
+            (conversation_id,)
+        )
+        if not row or not row["summary"]:
+            return None
+        return {"summary": row["summary"], "summary_upto": row["summary_upto"] or 0}
+
+    def apply(self, summary: Optional[Dict[str, Any]], history: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """去掉已被摘要覆盖的消息（按消息 id），历史消息需包含 id 字段"""
+        if not summary:
+            return history
+        return [msg for msg in history if (msg.get("id") or 0) > summary["summary_upto"]]
+
+    def as_message(self, summary: Dict[str, Any]) -> Dict[str, Any]:
+        """摘要对应的系统消息，放在历史消息之前"""
+        return {"role": "system", "content": f"以下是之前对话的摘要：\n{summary['summary']}"}
+
+    def schedule(self, conversation_id: str, model: str, username: str) -> None:
+        """在后台检查并更新对话摘要，同一对话同时只有一个任务"""
+        if not self.enabled:
+            return
+        task = self._tasks.get(conversation_id)
+        if task is not None and not task.done():
+            return
+        self._tasks[conversation_id] = asyncio.create_task(self._run(conversation_id, model, username))
+
+    async def _run(self, conversation_id: str, model: str, username: str) -> None:
+        try:
+            await self.update(conversation_id, model, username)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.failures_total += 1
+            logging.warning(f"更新对话 {conversation_id} 的摘要失败: {e}")
+        finally:
+            self._tasks.pop(conversation_id, None)
+
+    async def update(self, conversation_id: str, model: str, username: str) -> bool:
+        """把移出最近窗口的消息合并进摘要
+
+        Returns:
+            是否更新了摘要
+        """
+        rows = await self.db.fetch_all(
+            """
+            SELECT id, role, content
+            FROM messages
+            WHERE conversation_id = ? AND role IN ('user', 'assistant')
+            ORDER BY created_at ASC, id ASC
+            """,
+            (conversation_id,)
+        )
+        if len(rows) <= SUMMARY_CONFIG["TRIGGER_MESSAGES"]:
+            return False
+
+        current = await self.load(conversation_id)
+        covered = current["summary_upto"] if current else 0
+        pending = [row for row in rows if row["id"] > covered]
+        aged = pending[:-SUMMARY_CONFIG["KEEP_RECENT"]] if len(pending) > SUMMARY_CONFIG["KEEP_RECENT"] else []
+        if len(aged) < SUMMARY_CONFIG["MIN_BATCH"]:
+            return False
+
+        summary_model = SUMMARY_CONFIG["MODEL"] or model
+        transcript = "\n\n".join(
+            f"{'用户' if row['role'] == 'user' else '助手'}: {self._truncate(row['content'])}"
+            for row in aged
+        )
+        prompt = f"之前的摘要：\n{current['summary']}\n\n" if current else ""
+        prompt += f"新的对话内容：\n{transcript}"
+
+        # 以后台优先级排队，不与交互式请求竞争
+        client, _, slot = await get_available_client(model=summary_model, username=username, priority=Priority.BACKGROUND)
+        async with slot:
+            request = ChatRequest(
+                model=summary_model,
+                messages=[
+                    ChatMessage(role="system", content=SUMMARY_INSTRUCTION),
+                    ChatMessage(role="user", content=prompt)
+                ],
+                stream=False,
+                options=Options(num_predict=SUMMARY_CONFIG["MAX_TOKENS"], temperature=SUMMARY_CONFIG["TEMPERATURE"]),
+                keep_alive=residency_manager.keep_alive_for(summary_model)
+            )
+            summary = ""
+            async for response in client.chat(request):
+                if response.message:
+                    summary += response.message.content
+
+        summary = summary.strip()
+        if not summary:
+            raise RuntimeError("模型返回了空摘要")
+
+        await self.db.execute(
+            """
+            UPDATE conversations
+            SET summary = ?, summary_upto = ?, summary_updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+            """,
+            (summary, aged[-1]["id"], conversation_id)
+        )
+        await self.db.commit()
+        self.runs_total += 1
+        logging.info(f"已更新对话 {conversation_id} 的摘要，新覆盖 {len(aged)} 条消息，使用模型 {summary_model}")
+        return True
+
+    def _truncate(self, content: str) -> str:
+        limit = SUMMARY_CONFIG["MAX_MESSAGE_CHARS"]
+        content = content or ""
+        return content if len(content) <= limit else content[:limit] + "…"
+
+# 全局对话摘要器
+conversation_summarizer = ConversationSummarizer(db)
@@ -1,15 +1,21 @@
+import asyncio
 import logging
 import json
-from typing import Dict, Any
-from datetime import datetime
+import time
+from contextlib import aclosing
+from typing import Dict, Any, List, Callable, Optional
 
 from fastapi import WebSocket, WebSocketDisconnect
 from database import Database
+from metrics import inter_token_seconds, ttft_seconds, websocket_connections, websocket_streams, websocket_streams_total
+from tracing import finish_trace, span, start_trace
 
 from api.auth import decode_token
 from .db_operations import save_message
 from .message_processor import process_chat_messages, get_limited_history
 from .client_pool import get_available_client
+from .summarizer import conversation_summarizer
+from .generation_registry import Generation, GenerationConflictError, generation_registry, stream_generation
 
 # 用于存储活跃的 WebSocket 连接
 active_connections: Dict[str, WebSocket] = {}
@@ -28,20 +34,276 @@ async def get_current_user_from_token(token: str):
         logging.error(f"认证失败: {str(e)}")
         raise ValueError(f"认证失败: {str(e)}")
 
+async def get_owned_conversation(db: Database, conversation_id: str, username: str):
+    """查询属于指定用户的对话，不存在或无权访问时返回None"""
+    return await db.fetch_one(
+        """
+        SELECT id, model, user_id
+        FROM conversations
+        WHERE id = ? AND user_id = ?
+        """,
+        (conversation_id, username)
+    )
+
+async def load_history(db: Database, conversation_id: str, model: str = None) -> List[Dict[str, Any]]:
+    """加载对话历史，作为发送给模型的上下文
+    
+    已被滚动摘要覆盖的消息由摘要代替；对比模式下同一轮的多条助手回复只保留一条，
+    优先保留由 model 生成的回复。
+    """
+    try:
+        # 直接从消息表获取历史记录
+        history_messages = await db.fetch_all(
+            """
+            SELECT id, role, content, images, document, model, created_at
+            FROM messages
+            WHERE conversation_id = ?
+            ORDER BY created_at ASC
+            """,
+            (conversation_id,)
+        )
+        
+        # 已被滚动摘要覆盖的较早消息由摘要代替
+        summary = await conversation_summarizer.load(conversation_id)
+        history_messages = conversation_summarizer.apply(summary, history_messages)
+        history_messages = collapse_compared_replies(history_messages, model)
+        
+        # 将数据库查询结果转换为前端期望的消息格式
+        history = []
+        for msg in history_messages:
+            message_dict = {
+                "role": msg["role"],
+                "content": msg["content"]
+            }
+            # 处理图片数据
+            if msg["images"]:
+                try:
+                    message_dict["image"] = msg["images"]
+                except:
+                    # 如果解析失败，直接使用原始字符串
+                    message_dict["image"] = str(msg["images"])
+            
+            # 处理文档数据
+            if msg["document"]:
+                try:
+                    message_dict["document"] = msg["document"]
+                except:
+                    # 如果解析失败，直接使用原始字符串
+                    message_dict["document"] = str(msg["document"])
+            
+            history.append(message_dict)
+        
+        # 获取有限的历史记录用作上下文
+        history = get_limited_history(history, 20)  # 限制只使用最后20条消息作为上下文
+        if summary:
+            history.insert(0, conversation_summarizer.as_message(summary))
+        return history
+    except Exception as e:
+        logging.error(f"获取历史记录失败: {e}")
+        logging.exception(e)
+        return []
+
+def collapse_compared_replies(rows: List[Dict[str, Any]], model: str = None) -> List[Dict[str, Any]]:
+    """连续的多条助手回复（对比模式）只保留一条，优先保留由 model 生成的回复"""
+    collapsed = []
+    group: List[Dict[str, Any]] = []
+    
+    def flush():
+        if group:
+            preferred = [row for row in group if model and row.get("model") == model]
+            collapsed.append(preferred[0] if preferred else group[0])
+            group.clear()
+    
+    for row in rows:
+        if row["role"] == "assistant":
+            group.append(row)
+            continue
+        flush()
+        collapsed.append(row)
+    flush()
+    return collapsed
+
+async def run_chat_turn(
+    sender,
+    db: Database,
+    conversation: Dict[str, Any],
+    current_user: Dict[str, Any],
+    data: Dict[str, Any],
+    on_start: Optional[Callable[[Generation], None]] = None
+) -> bool:
+    """处理一轮对话：加载历史、保存用户消息、流式生成并保存回复
+    
+    Args:
+        sender: 具有 send_json 方法的发送对象（WebSocket 或会话流）
+        db: 数据库连接
+        conversation: 已通过权限校验的对话记录
+        current_user: 当前用户
+        data: 客户端发送的请求数据
+        on_start: 生成任务启动后的回调，调用方用来记录自己发起的生成
+        
+    Returns:
+        本轮是否正常完成
+    """
+    conversation_id = conversation["id"]
+    
+    # 提取消息和模型信息
+    messages = data.get("messages", [])
+    # 从数据库记录中获取model字段，如果没有则使用默认模型
+    model = data.get("model") or conversation["model"] or "llama2"
+    web_search = data.get("web_search", False)
+    
+    # 检查消息格式是否正确
+    if not messages or not isinstance(messages, list):
+        await sender.send_json({"error": "消息格式不正确"})
+        return False
+    
+    # 获取对话历史记录，避免重复发送上下文
+    async with span("history"):
+        history = await load_history(db, conversation_id, model)
+    
+    # 合并历史记录和新消息
+    combined_messages = history + messages
+    
+    user_message = messages[-1]["content"] if messages and messages[-1]["role"] == "user" else ""
+    user_image = messages[-1].get("image") if messages and messages[-1]["role"] == "user" else None
+    user_document = messages[-1].get("document") if messages and messages[-1]["role"] == "user" else None
+    
+    # 同一对话同时只允许一个进行中的生成
+    current_generation = generation_registry.get_for_conversation(conversation_id)
+    if current_generation and not current_generation.finished:
+        await sender.send_json({"error": "该对话已有进行中的生成", "generation_id": current_generation.id})
+        return False
+    
+    # 记录用户消息到数据库
+    try:
+        async with span("save_message"):
+            await save_message(
+                db, 
+                conversation_id, 
+                "user", 
+                user_message, 
+                images=user_image,
+                document=user_document
+            )
+    except Exception as e:
+        logging.error(f"保存用户消息失败: {e}")
+    
+    # 启动生成任务：生成与连接解耦，连接断开后继续生成并定期保存，客户端可重连续传
+    async def produce(generation: Generation):
+        await generate_reply(generation, combined_messages, model, web_search, current_user["username"])
+        # 较早的消息移出最近窗口后，在后台更新对话摘要
+        conversation_summarizer.schedule(conversation_id, model, current_user["username"])
+    
+    try:
+        generation = generation_registry.start(
+            conversation_id, current_user["username"], model, db, produce,
+            deadline=data.get("deadline")
+        )
+    except GenerationConflictError as e:
+        await sender.send_json({"error": str(e)})
+        return False
+    if on_start is not None:
+        on_start(generation)
+    
+    return await stream_generation(sender, generation)
+
+async def generate_reply(
+    generation: Generation,
+    messages: List[Dict[str, Any]],
+    model: str,
+    web_search: bool,
+    username: str
+) -> None:
+    """调用模型生成回复，并将内容写入生成任务"""
+    logging.debug(f"开始生成回复，使用模型 {model}...")
+    
+    # 先尝试获取客户端并预加载模型，模型加载状态会转发给所有订阅者
+    try:
+        # 包括节点选择和模型加载（预热）的时间
+        async with span("client"):
+            client, client_id, semaphore = await get_available_client(model=model, websocket=generation, username=username)
+    except Exception as e:
+        error_message = f"获取AI模型客户端失败: {str(e)}"
+        logging.error(error_message)
+        generation.fail({"error": error_message})
+        return
+    
+    # 异步生成回复内容，任务被取消时显式关闭生成器，从而关闭上游连接并释放信号量
+    async with aclosing(process_chat_messages(
+        messages, 
+        model, 
+        web_search=web_search,
+        username=username,
+        client=client,
+        client_index=client_id,
+        semaphore=semaphore
+    )) as chunks:
+        last_chunk_at = None
+        async for chunk_json in chunks:
+            # 解析JSON字符串为对象
+            chunk_data = json.loads(chunk_json)
+            
+            # 检查是否有错误
+            if "error" in chunk_data:
+                logging.error(f"生成过程中出错: {chunk_data['error']}")
+                generation.fail(chunk_data)
+                return
+            
+            # 提取内容并累加到响应中
+            if "message" in chunk_data and "content" in chunk_data["message"]:
+                now = time.perf_counter()
+                if last_chunk_at is not None:
+                    inter_token_seconds.observe(now - last_chunk_at, model=model)
+                last_chunk_at = now
+                await generation.append(chunk_data["message"]["content"])
+            
+            # 转发提示词评估统计，便于衡量 KV 缓存复用的效果
+            if chunk_data.get("stats"):
+                generation.stats = chunk_data["stats"]
+                if chunk_data["stats"].get("first_token_duration"):
+                    ttft_seconds.observe(chunk_data["stats"]["first_token_duration"] / 1e9, model=model)
+                await generation.send_json({"type": "prompt_stats", "model": model, **chunk_data["stats"]})
+    
+    logging.debug(f"完成生成回复，总长度: {len(generation.content)}")
+
+async def resume_generation(
+    sender,
+    generation_id: str,
+    current_user: Dict[str, Any],
+    offset: int = 0
+) -> bool:
+    """重连后从指定偏移继续接收生成输出"""
+    generation = generation_registry.get(generation_id)
+    if generation is None or generation.username != current_user["username"]:
+        await sender.send_json({"error": "生成任务不存在或已过期", "generation_id": generation_id})
+        return False
+    return await stream_generation(sender, generation, offset)
+
+async def wait_for_disconnect(websocket: WebSocket) -> None:
+    """等待客户端断开连接，期间收到的其他消息被忽略"""
+    while True:
+        message = await websocket.receive()
+        if message["type"] == "websocket.disconnect":
+            return
+
 async def handle_websocket_connection(
     websocket: WebSocket,
     conversation_id: str,
     token: str,
     db: Database
 ):
-    """处理WebSocket连接"""
+    """处理WebSocket连接（单轮对话，回复完成后关闭连接，断开后生成继续进行）"""
     await websocket.accept()
+    # 追踪整个连接（认证、加载历史、生成），回复结束时发送各阶段耗时的 timing 帧
+    trace, trace_token = start_trace("ws conversation", conversation_id=conversation_id)
     
-    # 验证用户令牌
+    # 验证用户令牌，提前返回前先结束追踪
     current_user = None
     try:
-        current_user = await get_current_user_from_token(token)
+        with span("auth"):
+            current_user = await get_current_user_from_token(token)
     except Exception as e:
+        finish_trace(trace, trace_token)
         await websocket.send_json({"error": f"认证失败: {str(e)}"})
         await websocket.close()
         return
@@ -49,24 +311,19 @@ async def handle_websocket_connection(
     # 验证会话存在性和权限
     try:
         # 修改为使用fetch_one方法查询对话，并使用username作为用户标识符
-        conversation = await db.fetch_one(
-            """
-            SELECT id, model, user_id
-            FROM conversations
-            WHERE id = ? AND user_id = ?
-            """,
-            (conversation_id, current_user["username"])
-        )
-        
-        if not conversation:
-            await websocket.send_json({"error": "对话不存在或无权访问"})
-            await websocket.close()
-            return
+        conversation = await get_owned_conversation(db, conversation_id, current_user["username"])
     except Exception as e:
+        finish_trace(trace, trace_token)
         await websocket.send_json({"error": f"获取对话失败: {str(e)}"})
         await websocket.close()
         return
+    if not conversation:
+        finish_trace(trace, trace_token)
+        await websocket.send_json({"error": "对话不存在或无权访问"})
+        await websocket.close()
+        return
     
+    websocket_connections.inc(endpoint="conversation")
     try:
         # 记录活跃连接
         active_connections[conversation_id] = websocket
@@ -74,163 +331,35 @@ async def handle_websocket_connection(
         # 接收客户端发送的消息
         data = await websocket.receive_json()
         
-        # 提取消息和模型信息
-        messages = data.get("messages", [])
-        # 从数据库记录中获取model字段，如果没有则使用默认模型
-        model = data.get("model") or conversation["model"] or "llama2"
-        web_search = data.get("web_search", False)
-        
-        # 检查消息格式是否正确
-        if not messages or not isinstance(messages, list):
-            await websocket.send_json({"error": "消息格式不正确"})
-            await websocket.close()
-            return
+        # 携带 generation_id 时表示断线重连，从 offset 处继续接收
+        if data.get("generation_id"):
+            turn = resume_generation(websocket, data["generation_id"], current_user, data.get("offset", 0))
+        elif data.get("models"):
+            # 携带 models 列表时进入多模型对比模式
+            from .compare import run_compare_turn
+            turn = run_compare_turn(websocket, db, conversation, current_user, data)
+        else:
+            turn = run_chat_turn(websocket, db, conversation, current_user, data)
         
-        # 获取对话历史记录，避免重复发送上下文
+        # 同时监听连接断开，断开后立即取消订阅，而不是等到下一次发送失败
+        websocket_streams.inc(endpoint="conversation")
+        websocket_streams_total.inc(endpoint="conversation")
         try:
-            # 直接从消息表获取历史记录
-            history_messages = await db.fetch_all(
-                """
-                SELECT role, content, images, document, created_at
-                FROM messages
-                WHERE conversation_id = ?
-                ORDER BY created_at ASC
-                """,
-                (conversation_id,)
-            )
-            
-            # 将数据库查询结果转换为前端期望的消息格式
-            history = []
-            for msg in history_messages:
-                message_dict = {
-                    "role": msg["role"],
-                    "content": msg["content"]
-                }
-                # 处理图片数据
-                if msg["images"]:
-                    try:
-                        message_dict["image"] = msg["images"]
-                    except:
-                        # 如果解析失败，直接使用原始字符串
-                        message_dict["image"] = str(msg["images"])
-                
-                # 处理文档数据
-                if msg["document"]:
-                    try:
-                        message_dict["document"] = msg["document"]
-                    except:
-                        # 如果解析失败，直接使用原始字符串
-                        message_dict["document"] = str(msg["document"])
-                
-                history.append(message_dict)
-            
-            # 获取有限的历史记录用作上下文
-            history = get_limited_history(history, 20)  # 限制只使用最后20条消息作为上下文
-        except Exception as e:
-            history = []
-            logging.error(f"获取历史记录失败: {e}")
-            logging.exception(e)
-        
-        # 合并历史记录和新消息
-        combined_messages = history + messages
-        
-        # 创建回应中
-        response_content = ""
-        user_message = messages[-1]["content"] if messages and messages[-1]["role"] == "user" else ""
-        user_image = messages[-1].get("image") if messages and messages[-1]["role"] == "user" else None
-        user_document = messages[-1].get("document") if messages and messages[-1]["role"] == "user" else None
-        
-        # 记录用户消息到数据库
-        try:
-            await save_message(
-                db, 
-                conversation_id, 
-                "user", 
-                user_message, 
-                images=user_image,
-                document=user_document
-            )
-        except Exception as e:
-            logging.error(f"保存用户消息失败: {e}")
-        
-        # 处理聊天消息
-        try:
-            logging.info(f"开始生成回复，使用模型 {model}...")
-            
-            # 先尝试获取客户端并预加载模型，通过传递websocket对象，可以发送模型加载状态
+            turn_task = asyncio.create_task(turn)
+            watcher_task = asyncio.create_task(wait_for_disconnect(websocket))
+            done, _ = await asyncio.wait({turn_task, watcher_task}, return_when=asyncio.FIRST_COMPLETED)
+            watcher_task.cancel()
+            if turn_task not in done:
+                logging.info(f"对话 {conversation_id} 的客户端已断开，取消订阅生成输出")
+                turn_task.cancel()
             try:
-                client, client_id, semaphore = await get_available_client(model=model, websocket=websocket)
-            except Exception as e:
-                error_message = f"获取AI模型客户端失败: {str(e)}"
-                logging.error(error_message)
-                await websocket.send_json({"error": error_message})
-                return
-            
-            # 异步生成回复内容
-            async for chunk_json in process_chat_messages(
-                combined_messages, 
-                model, 
-                web_search=web_search,
-                username=current_user["username"],
-                client=client,
-                client_index=client_id,
-                semaphore=semaphore
-            ):
-                # 解析JSON字符串为对象
-                chunk_data = json.loads(chunk_json)
-                
-                # 检查是否有错误
-                if "error" in chunk_data:
-                    # 如果有错误，直接将错误发送给客户端
-                    await websocket.send_json(chunk_data)
-                    logging.error(f"生成过程中出错: {chunk_data['error']}")
-                    continue
-                
-                # 提取内容并累加到响应中
-                if "message" in chunk_data and "content" in chunk_data["message"]:
-                    content = chunk_data["message"]["content"]
-                    response_content += content
-                    
-                    # 发送消息内容给客户端
-                    await websocket.send_json({
-                        "message": {
-                            "content": content
-                        }
-                    })
-                
-                # 检查是否完成
-                if chunk_data.get("done", False):
-                    await websocket.send_json({"done": True})
-            
-            logging.info(f"完成生成回复，总长度: {len(response_content)}")
-        except Exception as e:
-            error_message = f"生成回复失败: {str(e)}"
-            logging.error(error_message)
-            logging.exception(e)
-            await websocket.send_json({"error": error_message})
-            await websocket.close()
-            return
-        
-        # 保存AI回复到数据库
-        try:
-            # 只有在有内容且没有错误的情况下才保存回复
-            if response_content:
-                await save_message(db, conversation_id, "assistant", response_content)
-                
-                # 更新对话的最后更新时间
-                update_time = datetime.utcnow().isoformat()
-                await db.execute(
-                    """
-                    UPDATE conversations
-                    SET updated_at = ?
-                    WHERE id = ?
-                    """,
-                    (update_time, conversation_id)
-                )
-                await db.commit()  # 确保更改被提交
-        except Exception as e:
-            logging.error(f"保存AI回复失败: {e}")
-            logging.exception(e)
+                await turn_task
+            except asyncio.CancelledError:
+                pass
+            if trace is not None and turn_task in done:
+                await websocket.send_json(trace.timing_frame())
+        finally:
+            websocket_streams.dec(endpoint="conversation")
     
     except WebSocketDisconnect:
         logging.info("WebSocket连接断开")
@@ -243,10 +372,12 @@ async def handle_websocket_connection(
         except:
             pass
     finally:
+        finish_trace(trace, trace_token)
+        websocket_connections.dec(endpoint="conversation")
         # 从活跃连接中移除
         active_connections.pop(conversation_id, None)
         # 关闭WebSocket连接
         try:
             await websocket.close()
         except:
-            pass 
\ No newline at end of file
+            pass
@@ -7,6 +7,7 @@ import logging
 import aiohttp
 from fastapi import APIRouter, HTTPException
 from config import API_CONFIG
+from ollama.transport import ollama_transport
 from api.models.schemas import CustomModelRequest, CustomModelResponse
 from api.models.utils import validate_modelfile, ModelFileError, convert_model_name
 from database import get_db
@@ -188,7 +189,7 @@ async def custom_model(request: CustomModelRequest) -> CustomModelResponse:
         
         try:
             base_url = API_CONFIG["OLLAMA_BASE_URL"].rstrip('/')
-            async with aiohttp.ClientSession() as session:
+            async with ollama_transport.session() as session:
                 # 检查模型是否已存在
                 logger.info(f"检查模型 {safe_name} 是否已存在...")
                 check_process = subprocess.Popen(
@@ -1,200 +1,357 @@
-from fastapi import APIRouter, HTTPException
-import logging
+from fastapi import APIRouter, HTTPException, Path as FastAPIPath
+from sse_starlette.sse import EventSourceResponse, ServerSentEvent
+import aiohttp
+import asyncio
+import hashlib
 import json
+import logging
 import os
-import tempfile
-import hashlib
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Dict, Any
-import asyncio
-import subprocess
-from config import API_CONFIG
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+
+from config import API_CONFIG, MODEL_IMPORT_CONFIG
 from database import db
+from metrics import model_import_bytes_total
+from ollama import OllamaClient
 from .schemas import ImportModelRequest, ImportModelResponse
+from .utils import safe_show_model
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
 
-def generate_modelfile(name: str, file_path: str) -> str:
-    """生成简单的 Modelfile 内容"""
+SUPPORTED_EXTENSIONS = ('.gguf', '.safetensors')
+
+# 各阶段在总进度中所占的区间（计算摘要、上传、创建）
+STAGE_PROGRESS = {
+    "hashing": (0, 30),
+    "uploading": (30, 90),
+    "creating": (90, 99),
+}
+
+def build_create_request(name: str, file_path: str, digest: str) -> Dict[str, Any]:
+    """生成 /api/create 的请求内容，模型文件以已上传的 blob 摘要引用"""
+    filename = os.path.basename(file_path)
     ext = os.path.splitext(file_path)[1].lower()
     if ext == '.gguf':
-        return f"FROM {os.path.abspath(file_path)}"
+        return {"model": name, "files": {filename: digest}}
     elif ext == '.safetensors':
-        return f"FROM llama2\nADAPTER {os.path.abspath(file_path)}"
+        # 与之前的 Modelfile（FROM llama2 + ADAPTER）一致，作为 llama2 的适配器导入
+        return {"model": name, "from": "llama2", "adapters": {filename: digest}}
     else:
         raise ValueError("不支持的文件格式")
 
-async def run_command(cmd: str, cwd: str = None) -> tuple[int, str, str]:
-    """异步运行命令并返回结果"""
-    try:
-        logger.info(f"执行命令: {cmd}")
-        if cwd:
-            logger.info(f"在目录: {cwd}")
-            
-        process = await asyncio.create_subprocess_shell(
-            cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
-            cwd=cwd
-        )
-        stdout, stderr = await process.communicate()
-        
-        stdout_str = stdout.decode() if stdout else ""
-        stderr_str = stderr.decode() if stderr else ""
-        
-        if stdout_str:
-            logger.info(f"命令输出: {stdout_str}")
-        if stderr_str:
-            logger.error(f"命令错误: {stderr_str}")
-            
-        return (
-            process.returncode,
-            stdout_str,
-            stderr_str
-        )
-    except Exception as e:
-        logger.error(f"执行命令时出错: {str(e)}")
-        raise
-
-async def wait_for_model_creation(model_name: str, timeout: int = 300) -> bool:
-    """等待模型创建完成"""
-    start_time = datetime.now()
-    while True:
-        try:
-            # 使用 ollama list 命令检查模型是否存在
-            returncode, stdout, stderr = await run_command("ollama list")
-            if returncode == 0 and model_name in stdout:
-                logger.info(f"模型 {model_name} 创建成功")
-                return True
-        except Exception as e:
-            logger.warning(f"检查模型状态时出错: {str(e)}")
-        
-        # 超时检查
-        elapsed = (datetime.now() - start_time).total_seconds()
-        if elapsed > timeout:
-            logger.error(f"模型 {model_name} 创建超时，已等待 {elapsed} 秒")
-            return False
-            
-        logger.info(f"等待模型创建中... 已等待 {elapsed} 秒")
-        await asyncio.sleep(5)
+def hash_file(path: str, chunk_size: int, progress: Callable[[int], None]) -> str:
+    """分块计算文件的 SHA-256
 
-@router.post("/import")
-async def import_model(request: ImportModelRequest) -> ImportModelResponse:
-    """导入模型"""
-    try:
-        logger.info(f"开始导入模型: {request.name}")
-        
-        # 获取绝对路径
+    复用同一块缓冲区读取，内存占用与文件大小无关；在线程中运行，progress 在每块读取后调用。
+    """
+    sha256 = hashlib.sha256()
+    buffer = bytearray(chunk_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            sha256.update(view[:size])
+            progress(size)
+    return sha256.hexdigest()
+
+class ImportCancelled(Exception):
+    """导入已取消"""
+    pass
+
+class ModelImportJob:
+    """单个模型的导入任务
+
+    导入在后台任务中进行，不随 SSE 连接断开而中断，重新订阅时从当前状态继续推送。
+    """
+
+    def __init__(self, name: str, file_path: str, file_size: int):
+        self.name = name
+        self.file_path = file_path
+        self.file_size = file_size
+        self.state: Dict[str, Any] = {
+            "name": name,
+            "status": "hashing",
+            "progress": 0,
+            "completed": 0,
+            "total": file_size,
+            "message": "正在计算文件摘要"
+        }
+        self.version = 0
+        self.cancelled = False
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+        self._last_update = 0.0
+
+    @property
+    def finished(self) -> bool:
+        return self.state["status"] in ("success", "failed", "cancelled")
+
+    def update(self, **fields: Any) -> None:
+        self.state.update(fields)
+        self.version += 1
+        self._last_update = time.monotonic()
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    def set_stage(self, status: str, message: str, completed: int = 0) -> None:
+        self.update(status=status, message=message, completed=completed,
+                    progress=self._progress(status, completed))
+
+    def advance(self, status: str, size: int) -> None:
+        """累计当前阶段已处理的字节数，按 PROGRESS_INTERVAL 限制更新频率"""
+        if self.cancelled:
+            return
+        model_import_bytes_total.inc(size, stage="hash" if status == "hashing" else "upload")
+        completed = self.state["completed"] + size
+        self.state["completed"] = completed
+        if completed >= self.file_size or time.monotonic() - self._last_update >= MODEL_IMPORT_CONFIG["PROGRESS_INTERVAL"]:
+            self.update(progress=self._progress(status, completed))
+
+    def _progress(self, status: str, completed: int) -> int:
+        start, end = STAGE_PROGRESS[status]
+        if not self.file_size:
+            return start
+        return start + int((end - start) * min(completed, self.file_size) / self.file_size)
+
+    async def wait_update(self, seen: int) -> None:
+        """等待状态版本号不同于 seen"""
+        while self.version == seen:
+            await self._changed.wait()
+
+class ModelImporter:
+    """流式导入本地模型文件
+
+    - 摘要在线程中分块计算，按路径、大小和修改时间缓存，重复导入同一文件时不再重新计算
+    - 文件通过 /api/blobs/:digest 分块上传，Ollama 中已有该 blob 时跳过；连接中断后先检查是否已上传完成再重试
+    - 模型通过 /api/create 创建并逐条转发创建状态，不再调用 ollama 命令行和轮询模型列表
+    """
+
+    def __init__(self):
+        self.jobs: Dict[str, ModelImportJob] = {}
+        self._digests: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+
+    async def start(self, request: ImportModelRequest) -> ModelImportJob:
+        """校验文件并开始导入；同一模型正在导入同一文件时返回已有的任务"""
+        name = request.name.strip()
         file_path = os.path.abspath(request.file_path)
-        logger.info(f"模型文件绝对路径: {file_path}")
-        
-        # 验证文件路径
+        logger.info(f"开始导入模型: {name}，文件: {file_path}")
+
         if not os.path.isfile(file_path):
-            raise HTTPException(
-                status_code=400,
-                detail="文件不存在"
-            )
-            
-        # 检查文件扩展名
-        ext = os.path.splitext(file_path)[1].lower()
-        if ext not in ['.gguf', '.safetensors']:
+            raise HTTPException(status_code=400, detail="文件不存在")
+        if os.path.splitext(file_path)[1].lower() not in SUPPORTED_EXTENSIONS:
             raise HTTPException(
                 status_code=400,
                 detail="只支持 .gguf 和 .safetensors 格式的模型文件"
             )
-            
-        # 计算文件大小和摘要
-        file_size = os.path.getsize(file_path)
-        logger.info(f"模型文件大小: {file_size} 字节")
-        with open(file_path, 'rb') as f:
-            file_digest = hashlib.sha256(f.read()).hexdigest()
-            
-        # 生成简单的 Modelfile 内容
-        modelfile_content = generate_modelfile(request.name, file_path)
-        logger.info(f"生成的 Modelfile 内容:\n{modelfile_content}")
-            
-        # 保存 Modelfile 到临时文件
-        temp_dir = tempfile.mkdtemp(prefix="import_model_")
-        modelfile_path = os.path.join(temp_dir, "Modelfile")
-        with open(modelfile_path, "w", encoding="utf-8") as f:
-            f.write(modelfile_content)
-            
+
+        job = self.jobs.get(name)
+        if job is not None and not job.finished:
+            if job.file_path != file_path:
+                raise HTTPException(status_code=409, detail=f"模型 {name} 正在从其他文件导入")
+            return job
+
+        async with OllamaClient(API_CONFIG["OLLAMA_BASE_URL"]) as client:
+            exists = await safe_show_model(client, name)
+        if exists:
+            raise HTTPException(status_code=400, detail=f"模型 {name} 已存在")
+
+        # 检查模型是否存在时可能已有并发请求开始导入
+        job = self.jobs.get(name)
+        if job is not None and not job.finished:
+            return job
+        job = ModelImportJob(name, file_path, os.path.getsize(file_path))
+        self.jobs[name] = job
+        job.task = asyncio.create_task(self._run(job))
+        return job
+
+    async def _run(self, job: ModelImportJob) -> None:
         try:
-            # 检查模型是否已存在
-            returncode, stdout, stderr = await run_command("ollama list")
-            if returncode == 0 and request.name in stdout:
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"模型 {request.name} 已存在"
-                )
-                
-            # 使用 ollama create 命令创建模型
-            logger.info(f"开始创建模型: {request.name}")
-            try:
-                returncode, stdout, stderr = await run_command(
-                    f"ollama create {request.name}",
-                    cwd=temp_dir
-                )
-                
-                if returncode != 0:
-                    error_msg = stderr or stdout or "未知错误"
-                    logger.error(f"创建模型失败，返回码: {returncode}, 错误信息: {error_msg}")
-                    raise HTTPException(
-                        status_code=500,
-                        detail=f"创建模型失败: {error_msg}"
-                    )
-                    
-                logger.info("模型创建请求已发送")
-                
-            except Exception as e:
-                logger.error(f"执行 ollama create 命令时出错: {str(e)}")
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"创建模型失败: {str(e)}"
-                )
-
-            # 等待模型创建完成
-            if not await wait_for_model_creation(request.name):
-                raise HTTPException(
-                    status_code=500,
-                    detail=f"模型 {request.name} 创建超时，请检查 Ollama 服务日志"
-                )
-            
-            # 创建模型记录
-            model_data = {
-                'name': request.name,
+            async with OllamaClient(API_CONFIG["OLLAMA_BASE_URL"]) as client:
+                digest = await self._digest(job)
+                await self._upload(client, job, digest)
+                await self._create(client, job, digest)
+
+            await db.create_model({
+                'name': job.name,
                 'is_custom': True,
-                'size': file_size,
-                'digest': file_digest,
+                'size': job.file_size,
+                'digest': digest.split(":", 1)[1],
                 'status': 'ready',
                 'created_at': datetime.utcnow(),
                 'options': None
-            }
-            
-            await db.create_model(model_data)
-            logger.info(f"模型 {request.name} 导入完成")
-            
-            return ImportModelResponse(
-                status="success",
-                progress=100,
-                message=f"模型 {request.name} 导入成功"
-            )
-                
+            })
+            logger.info(f"模型 {job.name} 导入完成")
+            job.update(status="success", progress=100, message=f"模型 {job.name} 导入成功")
+        except ImportCancelled:
+            self._mark_cancelled(job)
+        except asyncio.CancelledError:
+            self._mark_cancelled(job)
+            raise
+        except Exception as e:
+            logger.error(f"导入模型 {job.name} 失败: {str(e)}")
+            job.update(status="failed", error=str(e), message=f"导入模型失败: {str(e)}")
         finally:
-            # 清理临时文件
-            try:
-                if os.path.exists(modelfile_path):
-                    os.unlink(modelfile_path)
-                os.rmdir(temp_dir)
-            except Exception as e:
-                logger.warning(f"清理临时文件失败: {str(e)}")
-                
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"导入模型失败: {str(e)}")
-        raise HTTPException(
-            status_code=500,
-            detail=f"导入模型失败: {str(e)}"
+            asyncio.get_running_loop().call_later(
+                MODEL_IMPORT_CONFIG["RETENTION_SECONDS"], self._remove, job
+            )
+
+    @staticmethod
+    def _mark_cancelled(job: ModelImportJob) -> None:
+        # 让仍在线程中计算摘要的任务尽快停止
+        job.cancelled = True
+        logger.info(f"模型 {job.name} 导入已取消")
+        job.update(status="cancelled", message="导入已取消")
+
+    def _remove(self, job: ModelImportJob) -> None:
+        """移除已结束的任务，同名模型之后又开始的导入不受影响"""
+        if self.jobs.get(job.name) is job:
+            del self.jobs[job.name]
+
+    async def _digest(self, job: ModelImportJob) -> str:
+        stat = os.stat(job.file_path)
+        key = (job.file_path, stat.st_size, stat.st_mtime_ns)
+        digest = self._digests.get(key)
+        if digest is not None:
+            self._digests.move_to_end(key)
+            job.set_stage("hashing", "文件摘要已计算过", job.file_size)
+            return digest
+
+        loop = asyncio.get_running_loop()
+
+        def progress(size: int) -> None:
+            if job.cancelled:
+                raise ImportCancelled()
+            loop.call_soon_threadsafe(job.advance, "hashing", size)
+
+        started = time.perf_counter()
+        digest = "sha256:" + await asyncio.to_thread(
+            hash_file, job.file_path, MODEL_IMPORT_CONFIG["CHUNK_MB"] * 1024 * 1024, progress
         )
+        logger.info(f"模型文件摘要计算完成，耗时 {time.perf_counter() - started:.1f} 秒: {digest}")
+        self._digests[key] = digest
+        while len(self._digests) > MODEL_IMPORT_CONFIG["DIGEST_CACHE_SIZE"]:
+            self._digests.popitem(last=False)
+        return digest
+
+    async def _upload(self, client: OllamaClient, job: ModelImportJob, digest: str) -> None:
+        if await client.has_blob(digest):
+            job.set_stage("uploading", "Ollama 中已有该模型文件，跳过上传", job.file_size)
+            return
+
+        retries = MODEL_IMPORT_CONFIG["UPLOAD_RETRIES"]
+        for attempt in range(1, retries + 1):
+            job.set_stage("uploading", "正在上传模型文件")
+            try:
+                await client.push_blob(digest, self._read_chunks(job), job.file_size)
+                return
+            except aiohttp.ClientResponseError as e:
+                # 摘要不匹配等请求错误重试也不会成功
+                if e.status < 500:
+                    raise
+                error = e
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            # Ollama 不支持续传部分内容，连接中断时可能已经收到了完整的文件
+            try:
+                if await client.has_blob(digest):
+                    return
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                pass
+            if attempt == retries:
+                raise RuntimeError(f"上传模型文件失败: {error}")
+            logger.warning(f"上传模型文件中断，第 {attempt} 次重试: {error}")
+            await asyncio.sleep(attempt * 2)
+
+    async def _read_chunks(self, job: ModelImportJob) -> AsyncIterator[bytes]:
+        """在线程中分块读取模型文件，上传的速度由连接的写缓冲控制"""
+        chunk_size = MODEL_IMPORT_CONFIG["CHUNK_MB"] * 1024 * 1024
+        f = await asyncio.to_thread(open, job.file_path, "rb")
+        try:
+            while True:
+                chunk = await asyncio.to_thread(f.read, chunk_size)
+                if not chunk:
+                    break
+                job.advance("uploading", len(chunk))
+                yield chunk
+        finally:
+            f.close()
+
+    async def _create(self, client: OllamaClient, job: ModelImportJob, digest: str) -> None:
+        job.set_stage("creating", "正在创建模型")
+        last_status = None
+        async for response in client.create_model_stream(build_create_request(job.name, job.file_path, digest)):
+            if "error" in response:
+                raise RuntimeError(f"创建模型失败: {response['error']}")
+            last_status = response.get("status") or last_status
+            if last_status:
+                job.update(message=last_status)
+        if last_status != "success":
+            raise RuntimeError(f"创建模型未完成，最后状态: {last_status or '无'}")
+
+    async def events(self, job: ModelImportJob) -> AsyncIterator[Dict[str, str]]:
+        """推送导入状态，直到导入结束"""
+        seen = -1
+        while True:
+            if job.version != seen:
+                seen = job.version
+                yield {"data": json.dumps(job.state, ensure_ascii=False)}
+                if job.finished:
+                    return
+            await job.wait_update(seen)
+
+    def close(self) -> None:
+        """取消进行中的导入，应用退出时调用"""
+        for job in self.jobs.values():
+            job.cancelled = True
+            if job.task is not None and not job.task.done():
+                job.task.cancel()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "active": sum(1 for job in self.jobs.values() if not job.finished),
+            "digest_cache_entries": len(self._digests)
+        }
+
+# 全局模型导入器
+model_importer = ModelImporter()
+
+def _event_response(events: AsyncIterator[Dict[str, str]]) -> EventSourceResponse:
+    return EventSourceResponse(
+        events,
+        ping=15,
+        ping_message_factory=lambda: ServerSentEvent(data="keep-alive"),
+        send_timeout=None
+    )
+
+@router.post("/import")
+async def import_model(request: ImportModelRequest) -> ImportModelResponse:
+    """导入模型，等待导入完成后返回"""
+    job = await model_importer.start(request)
+    # 客户端断开时导入继续在后台进行
+    await asyncio.shield(job.task)
+    if job.state["status"] != "success":
+        raise HTTPException(status_code=500, detail=job.state["message"])
+    return ImportModelResponse(status="success", progress=100, message=job.state["message"])
+
+@router.post("/import/stream")
+async def import_model_stream(request: ImportModelRequest) -> EventSourceResponse:
+    """导入模型并以 SSE 推送进度
+
+    每个事件的 data 为 {"name", "status", "progress", "completed", "total", "message"}，
+    status 依次为 hashing、uploading、creating，最后为 success、failed 或 cancelled。
+    """
+    job = await model_importer.start(request)
+    return _event_response(model_importer.events(job))
+
+@router.get("/import/{name:path}")
+async def get_import_events(name: str = FastAPIPath(..., description="模型名称")) -> EventSourceResponse:
+    """重新订阅导入进度（如连接断开后）"""
+    job = model_importer.jobs.get(name)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"没有模型 {name} 的导入任务")
+    return _event_response(model_importer.events(job))
@@ -8,11 +8,11 @@ from typing import Dict, Any
 
 from config import API_CONFIG
 from database import db
+from metrics import model_pull_bytes_total
 from ollama import OllamaClient, ModelPullRequest, ModelPullResponse
 from .utils import safe_show_model
 
 # 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter()
@@ -114,6 +114,7 @@ async def _pull_model(name: str, force: bool = False) -> EventSourceResponse:
                                 last_completed = None
                                 last_update_time = datetime.utcnow()
                                 model_saved = False  # 添加标志位，确保只保存一次
+                                digest_completed: Dict[str, int] = {}  # 每个分层已计入吞吐指标的字节数
                                 
                                 # 添加心跳任务，确保即使没有进度更新也能保持连接
                                 last_heartbeat_time = datetime.utcnow()
@@ -180,6 +181,14 @@ async def _pull_model(name: str, force: bool = False) -> EventSourceResponse:
                                         current_total = response_dict.get("total", 0)
                                         current_completed = response_dict.get("completed", 0)
                                         
+                                        # 按分层累计新下载的字节数
+                                        digest = response_dict.get("digest")
+                                        if digest and current_completed:
+                                            delta = current_completed - digest_completed.get(digest, 0)
+                                            if delta > 0:
+                                                model_pull_bytes_total.inc(delta, model=name)
+                                                digest_completed[digest] = current_completed
+                                        
                                         # 计算进度
                                         progress = 0
                                         if current_total and current_total > 0:
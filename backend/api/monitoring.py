@@ -0,0 +1,273 @@
+import hmac
+import logging
+from typing import Any, Dict, List
+
+from fastapi import APIRouter, HTTPException, Request
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel
+
+from config import METRICS_CONFIG
+from metrics import Counter, Gauge, Histogram, Metric, registry
+from api.chat.scheduler import get_scheduler
+from api.chat.generation_registry import generation_registry
+from api.chat.residency import residency_manager
+from api.chat.node_registry import node_registry
+from api.chat.message_processor import prompt_metrics
+from api.chat.analytics import generation_stats
+from api.chat.batch import batch_manager
+from api.models.pull import download_status
+from api.models.import_model import model_importer
+from api.tools.tavily_search import tavily_pool
+from api.tools.search_cache import search_cache
+from api.tools.image_store import image_store
+from api.tools.vision import vision_preprocessor
+from api.tools.doc_format import service as document_service
+from api.tools.doc_stream import progressive_converter
+from ollama.transport import ollama_transport
+from tracing import trace_exporter
+from log_setup import log_pipeline
+
+router = APIRouter()
+
+# 视为本机的客户端地址
+LOOPBACK_HOSTS = ("127.0.0.1", "::1", "localhost")
+
+def _load_histogram(metric: Histogram, snapshot: Dict[str, Any], **labels) -> None:
+    """载入已有直方图快照（累计分桶计数）"""
+    counts = []
+    previous = 0
+    for bucket in snapshot["buckets"]:
+        counts.append(bucket["count"] - previous)
+        previous = bucket["count"]
+    metric.load(counts, snapshot["sum"], **labels)
+
+def collect_scheduler() -> List[Metric]:
+    snapshot = get_scheduler().snapshot()
+    capacity = Gauge("kunlab_scheduler_capacity", "调度器的并发槽位数")
+    active = Gauge("kunlab_scheduler_active", "正在执行的请求数")
+    queue_depth = Gauge("kunlab_scheduler_queue_depth", "按优先级统计的排队请求数", ("priority",))
+    waiting_users = Gauge("kunlab_scheduler_waiting_users", "按优先级统计的排队用户数", ("priority",))
+    granted = Counter("kunlab_scheduler_granted_total", "获得槽位的请求数", ("priority",))
+    rejected = Counter("kunlab_scheduler_rejected_total", "因队列已满被拒绝的请求数", ("priority",))
+    wait = Histogram(
+        "kunlab_scheduler_wait_seconds", "获得槽位前的排队时间", ("priority",),
+        [bucket["le"] for bucket in snapshot["priorities"]["interactive"]["wait_seconds"]["buckets"][:-1]]
+    )
+    capacity.set(snapshot["capacity"])
+    active.set(snapshot["active"])
+    for priority, stats in snapshot["priorities"].items():
+        queue_depth.set(stats["queue_depth"], priority=priority)
+        waiting_users.set(stats["waiting_users"], priority=priority)
+        granted.set(stats["granted_total"], priority=priority)
+        rejected.set(stats["rejected_total"], priority=priority)
+        _load_histogram(wait, stats["wait_seconds"], priority=priority)
+    return [capacity, active, queue_depth, waiting_users, granted, rejected, wait]
+
+def collect_generations() -> List[Metric]:
+    snapshot = generation_registry.snapshot()
+    running = Gauge("kunlab_generations_running", "进行中的生成任务数")
+    detached = Gauge("kunlab_generations_detached", "没有客户端订阅的生成任务数")
+    started = Counter("kunlab_generations_started_total", "启动的生成任务数")
+    completed = Counter("kunlab_generations_completed_total", "正常完成的生成任务数")
+    failed = Counter("kunlab_generations_failed_total", "失败的生成任务数")
+    cancelled = Counter("kunlab_generations_cancelled_total", "按原因统计取消的生成任务数", ("reason",))
+    running.set(snapshot["running"])
+    detached.set(snapshot["detached"])
+    started.set(snapshot["started_total"])
+    completed.set(snapshot["completed_total"])
+    failed.set(snapshot["failed_total"])
+    for reason, count in snapshot["cancelled_total"].items():
+        cancelled.set(count, reason=reason)
+    return [running, detached, started, completed, failed, cancelled]
+
+def collect_residency() -> List[Metric]:
+    snapshot = residency_manager.snapshot()
+    budget = Gauge("kunlab_model_ram_budget_bytes", "模型可用的内存预算")
+    used = Gauge("kunlab_model_ram_used_bytes", "已驻留模型占用的内存")
+    resident = Gauge("kunlab_model_resident", "驻留在本机 Ollama 中的模型", ("model",))
+    in_flight = Gauge("kunlab_model_in_flight", "按模型统计进行中的请求数", ("model",))
+    evictions = Counter("kunlab_model_evictions_total", "为腾出内存卸载的模型数")
+    budget.set(snapshot["budget_bytes"] or 0)
+    used.set(snapshot["used_bytes"])
+    evictions.set(snapshot["evictions_total"])
+    for item in snapshot["resident"]:
+        resident.set(1, model=item["name"])
+        in_flight.set(item["in_flight"], model=item["name"])
+    return [budget, used, resident, in_flight, evictions]
+
+def collect_nodes() -> List[Metric]:
+    snapshot = node_registry.snapshot()
+    healthy = Gauge("kunlab_ollama_node_healthy", "Ollama 节点是否可用", ("node",))
+    in_flight = Gauge("kunlab_ollama_node_in_flight", "节点上进行中的请求数", ("node",))
+    requests = Counter("kunlab_ollama_node_requests_total", "发往节点的聊天请求数", ("node",))
+    errors = Counter("kunlab_ollama_node_errors_total", "节点上失败的聊天请求数", ("node",))
+    hedges = Counter("kunlab_ollama_hedges_total", "发起的对冲请求数")
+    for node in snapshot["nodes"]:
+        healthy.set(1 if node["healthy"] else 0, node=node["base_url"])
+        in_flight.set(node["in_flight"], node=node["base_url"])
+        requests.set(node["requests_total"], node=node["base_url"])
+        errors.set(node["errors_total"], node=node["base_url"])
+    hedges.set(snapshot["hedges_total"])
+    return [healthy, in_flight, requests, errors, hedges]
+
+def collect_transport() -> List[Metric]:
+    snapshot = ollama_transport.snapshot()
+    connections = Counter("kunlab_ollama_connections_total", "Ollama 连接的获取次数", ("reused",))
+    connections.set(snapshot["connections_created"], reused="false")
+    connections.set(snapshot["connections_reused"], reused="true")
+    return [connections]
+
+def collect_tavily() -> List[Metric]:
+    snapshot = tavily_pool.snapshot()
+    in_flight = Gauge("kunlab_tavily_in_flight", "进行中的 Tavily 请求数")
+    in_flight.set(snapshot["in_flight"])
+    return [in_flight]
+
+async def collect_search_cache() -> List[Metric]:
+    snapshot = await search_cache.snapshot()
+    entries = Gauge("kunlab_search_cache_entries", "缓存的搜索结果数")
+    lookups = Counter("kunlab_search_cache_lookups_total", "按结果统计的缓存查询次数", ("result",))
+    entries.set(snapshot["entries"])
+    lookups.set(snapshot["hits"], result="hit")
+    lookups.set(snapshot["stale_hits"], result="stale")
+    lookups.set(snapshot["misses"], result="miss")
+    return [entries, lookups]
+
+def collect_prompts() -> List[Metric]:
+    snapshot = prompt_metrics.snapshot()
+    tokens = Histogram(
+        "kunlab_prompt_eval_tokens", "每轮对话的提示词评估 token 数（未命中 KV 缓存的部分）", (),
+        [bucket["le"] for bucket in snapshot["prompt_eval_tokens"]["buckets"][:-1]]
+    )
+    seconds = Counter("kunlab_prompt_eval_seconds_total", "提示词评估的总耗时")
+    _load_histogram(tokens, snapshot["prompt_eval_tokens"])
+    seconds.set(snapshot["prompt_eval_seconds_total"])
+    return [tokens, seconds]
+
+def collect_batch() -> List[Metric]:
+    snapshot = batch_manager.snapshot()
+    jobs = Gauge("kunlab_batch_jobs_running", "运行中的批量任务数")
+    items = Counter("kunlab_batch_items_total", "按结果统计处理的批量条目数", ("outcome",))
+    jobs.set(snapshot["running_jobs"])
+    items.set(snapshot["items_total"] - snapshot["items_failed"], outcome="completed")
+    items.set(snapshot["items_failed"], outcome="failed")
+    return [jobs, items]
+
+def collect_pulls() -> List[Metric]:
+    active = Gauge("kunlab_model_pulls_active", "正在拉取的模型数")
+    active.set(sum(1 for status in download_status.values() if status.get("status") == "downloading"))
+    imports = Gauge("kunlab_model_imports_active", "正在导入的本地模型数")
+    imports.set(model_importer.snapshot()["active"])
+    return [active, imports]
+
+def collect_analytics() -> List[Metric]:
+    snapshot = generation_stats.snapshot()
+    records = Counter("kunlab_generation_stats_records_total", "按结果统计记录生成统计的次数", ("outcome",))
+    records.set(snapshot["records_total"], outcome="ok")
+    records.set(snapshot["failures_total"], outcome="error")
+    return [records]
+
+def collect_images() -> List[Metric]:
+    snapshot = image_store.snapshot()
+    uploads = Counter("kunlab_image_uploads_total", "按结果统计上传的图片数", ("outcome",))
+    loads = Counter("kunlab_image_loads_total", "组装模型请求时读取的图片数")
+    uploads.set(snapshot["uploads_total"] - snapshot["dedup_total"], outcome="stored")
+    uploads.set(snapshot["dedup_total"], outcome="deduplicated")
+    loads.set(snapshot["loads_total"])
+    orphans = Counter("kunlab_image_orphans_deleted_total", "删除的未被消息引用的图片数")
+    orphans.set(snapshot["orphans_deleted_total"])
+    return [uploads, loads, orphans]
+
+def collect_vision() -> List[Metric]:
+    snapshot = vision_preprocessor.snapshot()
+    images = Counter("kunlab_vision_images_total", "按结果统计预处理的图片数", ("outcome",))
+    image_bytes = Counter("kunlab_vision_bytes_total", "预处理前后的图片字节数", ("stage",))
+    images.set(snapshot["processed_total"], outcome="processed")
+    images.set(snapshot["cache_hits"], outcome="cached")
+    images.set(snapshot["failures_total"], outcome="failed")
+    image_bytes.set(snapshot["bytes_in_total"], stage="input")
+    image_bytes.set(snapshot["bytes_out_total"], stage="output")
+    return [images, image_bytes]
+
+def collect_documents() -> List[Metric]:
+    snapshot = document_service.snapshot()
+    in_flight = Gauge("kunlab_document_conversions_in_flight", "进行中的文档转换数")
+    conversions = Counter("kunlab_document_conversions_total", "按结果统计的文档转换请求数", ("outcome",))
+    seconds = Counter("kunlab_document_convert_seconds_total", "文档转换的总耗时")
+    in_flight.set(snapshot["in_flight"])
+    conversions.set(snapshot["conversions_total"], outcome="converted")
+    conversions.set(snapshot["cache_hits"], outcome="cached")
+    conversions.set(snapshot["failures_total"], outcome="failed")
+    seconds.set(snapshot["convert_seconds_total"])
+    progressive = Gauge("kunlab_document_progressive_in_flight", "进行中的渐进式文档转换数")
+    progressive.set(progressive_converter.snapshot()["in_flight"])
+    return [in_flight, conversions, seconds, progressive]
+
+def collect_tracing() -> List[Metric]:
+    snapshot = trace_exporter.snapshot()
+    traces = Counter("kunlab_traces_exported_total", "按结果统计导出到 JSONL 文件的追踪数", ("outcome",))
+    traces.set(snapshot["exported_total"], outcome="written")
+    traces.set(snapshot["dropped_total"], outcome="dropped")
+    return [traces]
+
+def collect_logging() -> List[Metric]:
+    snapshot = log_pipeline.snapshot()
+    queue_depth = Gauge("kunlab_log_queue_depth", "等待写入的日志条数")
+    dropped = Counter("kunlab_log_records_dropped_total", "按原因统计未写入的日志条数", ("reason",))
+    queue_depth.set(snapshot["queue_depth"])
+    dropped.set(snapshot["dropped_total"], reason="queue_full")
+    dropped.set(snapshot["suppressed_total"], reason="rate_limited")
+    return [queue_depth, dropped]
+
+for collector in (collect_scheduler, collect_generations, collect_residency, collect_nodes, collect_transport,
+                  collect_tavily, collect_search_cache, collect_prompts, collect_batch, collect_pulls, collect_analytics,
+                  collect_images, collect_vision, collect_documents,
+                  collect_tracing, collect_logging):
+    registry.register_collector(collector)
+
+class LogLevelUpdate(BaseModel):
+    logger: str = "root"
+    level: str
+
+def require_ops_access(request: Request) -> None:
+    """运维接口的访问控制
+
+    设置了 METRICS_CONFIG["TOKEN"] 时，无论来源都必须携带 Bearer 令牌（本机上的反向代理
+    也会让远程请求看起来来自本机）；未设置时只允许本机访问。
+    """
+    client_host = request.client.host if request.client else None
+    token = METRICS_CONFIG["TOKEN"]
+    if token:
+        scheme, _, credentials = request.headers.get("Authorization", "").partition(" ")
+        if scheme.lower() == "bearer" and hmac.compare_digest(credentials.strip().encode(), token.encode()):
+            return
+        logging.warning(f"拒绝来自 {client_host} 的运维请求 {request.url.path}：令牌无效")
+        raise HTTPException(status_code=401, detail="需要有效的运维访问令牌", headers={"WWW-Authenticate": "Bearer"})
+    if client_host not in LOOPBACK_HOSTS:
+        logging.warning(f"拒绝来自 {client_host} 的运维请求 {request.url.path}")
+        raise HTTPException(status_code=403, detail="只允许本机访问，远程访问需设置 KUNLAB_OPS_TOKEN")
+
+@router.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics(request: Request):
+    """以 Prometheus 文本格式导出运行指标，默认只允许本机抓取，设置令牌后需携带令牌"""
+    if not METRICS_CONFIG["ENABLED"]:
+        raise HTTPException(status_code=404, detail="指标接口未启用")
+    require_ops_access(request)
+    return PlainTextResponse(await registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+@router.get("/logging")
+async def get_logging_status(request: Request):
+    """日志管道状态和各 logger 的当前级别"""
+    require_ops_access(request)
+    return log_pipeline.snapshot()
+
+@router.put("/logging/levels")
+async def update_log_level(update: LogLevelUpdate, request: Request):
+    """运行时修改日志级别，如 {"logger": "database", "level": "DEBUG"}"""
+    require_ops_access(request)
+    try:
+        log_pipeline.set_level(update.logger, update.level)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    logging.warning(f"日志级别已修改: {update.logger} -> {update.level.upper()}")
+    return {"levels": log_pipeline.get_levels()}
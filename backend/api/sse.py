@@ -0,0 +1,19 @@
+"""
+Server-Sent Events 的公共工具，供批量任务、渐进式文档转换等推送进度的接口共用
+"""
+import json
+from typing import Any, AsyncIterator, Dict
+
+from fastapi.responses import StreamingResponse
+
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    """格式化一条 SSE 事件"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+def sse_response(events: AsyncIterator[str]) -> StreamingResponse:
+    """以 SSE 返回事件流，禁止缓存和反向代理缓冲"""
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
@@ -0,0 +1,175 @@
+"""
+文档附件存储 - 渐进式转换的结果边转换边写入磁盘，聊天消息中只保存附件引用
+"""
+import asyncio
+import json
+import os
+import re
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from config import DOCUMENT_CONFIG
+
+_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+# 附件状态
+CONVERTING = "converting"
+DONE = "done"
+FAILED = "failed"
+
+def parse_attachment_ref(document: Any) -> Optional[Dict[str, Any]]:
+    """从消息的 document 字段中取出附件引用
+
+    引用为 {"attachment_id", "name", "type"}，保存到数据库时会被序列化为 JSON 字符串。
+    前端发送的引用还带有预览内容，附件 ID 可能出现在字符串的任意位置。
+    """
+    if isinstance(document, str):
+        if not document.startswith("{") or '"attachment_id"' not in document:
+            return None
+        try:
+            document = json.loads(document)
+        except ValueError:
+            return None
+    if isinstance(document, dict) and _ID_RE.match(str(document.get("attachment_id", ""))):
+        return document
+    return None
+
+def attachment_reference(attachment: Dict[str, Any]) -> Dict[str, Any]:
+    """保存到消息中的附件引用，不包含预览内容"""
+    return {
+        "attachment_id": attachment["attachment_id"],
+        "name": attachment.get("name"),
+        "type": attachment.get("type")
+    }
+
+class AttachmentStore:
+    """按文件内容哈希保存的文档附件
+
+    - 转换结果按段追加到 <id>.md，状态（进度、是否完成）保存在 <id>.json 中
+    - 正在转换的附件在内存中保存状态和更新通知，读取方可以边转换边读取
+    - 聊天消息引用附件后，组装模型请求时读取当前已转换的内容，不必等待转换完成
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self._active: Dict[str, Dict[str, Any]] = {}
+        self._updates: Dict[str, asyncio.Condition] = {}
+
+    def text_path(self, attachment_id: str) -> Path:
+        return self.root / f"{attachment_id}.md"
+
+    def _status_path(self, attachment_id: str) -> Path:
+        return self.root / f"{attachment_id}.json"
+
+    def _write_status(self, attachment_id: str, status: Dict[str, Any]) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        path = self._status_path(attachment_id)
+        tmp = path.with_name(path.name + ".tmp")
+        tmp.write_text(json.dumps(status, ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, path)
+
+    def get_status(self, attachment_id: str) -> Optional[Dict[str, Any]]:
+        if not _ID_RE.match(attachment_id or ""):
+            return None
+        status = self._active.get(attachment_id)
+        if status is not None:
+            return dict(status)
+        try:
+            status = json.loads(self._status_path(attachment_id).read_text(encoding="utf-8"))
+        except (FileNotFoundError, ValueError):
+            return None
+        if status.get("status") == CONVERTING:
+            # 转换过程中服务重启，已写入的内容仍然可用
+            status["status"] = FAILED
+            status["error"] = "转换被中断"
+        return status
+
+    def reserve(self, attachment_id: str, name: str, content_type: str, total: Optional[int]) -> None:
+        """在内存中登记转换中的附件（不写磁盘），登记后 get_status 立即返回转换中"""
+        self._active[attachment_id] = {"attachment_id": attachment_id, "name": name, "type": content_type,
+                                       "status": CONVERTING, "completed": 0, "total": total, "chars": 0}
+        self._updates.setdefault(attachment_id, asyncio.Condition())
+
+    async def begin(self, attachment_id: str, name: str, content_type: str, total: Optional[int]) -> None:
+        """开始写入附件，清空之前未完成的内容"""
+        self.reserve(attachment_id, name, content_type, total)
+        status = self._active[attachment_id]
+        await asyncio.to_thread(self._write_status, attachment_id, status)
+        await asyncio.to_thread(self.text_path(attachment_id).write_text, "", encoding="utf-8")
+
+    def _append_text(self, attachment_id: str, text: str) -> None:
+        with open(self.text_path(attachment_id), "a", encoding="utf-8") as f:
+            f.write(text)
+
+    async def append(self, attachment_id: str, text: str, completed: int, total: Optional[int] = None) -> None:
+        """追加一段转换结果并更新进度"""
+        status = self._active[attachment_id]
+        if text:
+            await asyncio.to_thread(self._append_text, attachment_id, text)
+            status["chars"] += len(text)
+        status["completed"] = completed
+        if total is not None:
+            status["total"] = total
+        await asyncio.to_thread(self._write_status, attachment_id, status)
+        await self._notify(attachment_id)
+
+    async def finish(self, attachment_id: str, error: Optional[str] = None) -> None:
+        """结束转换，error 不为空时标记为失败（已写入的内容保留）"""
+        status = self._active.get(attachment_id)
+        if status is None:
+            return
+        final = {**status, "status": FAILED if error else DONE}
+        if error:
+            final["error"] = error
+        # 先写入最终状态再移除内存中的状态，避免读取方在两者之间看到转换被中断
+        await asyncio.to_thread(self._write_status, attachment_id, final)
+        self._active.pop(attachment_id, None)
+        await self._notify(attachment_id)
+        self._updates.pop(attachment_id, None)
+
+    async def _notify(self, attachment_id: str) -> None:
+        condition = self._updates.get(attachment_id)
+        if condition is not None:
+            async with condition:
+                condition.notify_all()
+
+    async def wait_update(self, attachment_id: str, timeout: float) -> bool:
+        """等待附件有新内容或转换结束，超时返回 False"""
+        condition = self._updates.get(attachment_id)
+        if condition is None:
+            return True
+        try:
+            async with condition:
+                await asyncio.wait_for(condition.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+    def _read_text(self, attachment_id: str, max_chars: int) -> str:
+        try:
+            with open(self.text_path(attachment_id), "r", encoding="utf-8", errors="ignore") as f:
+                return f.read(max_chars)
+        except FileNotFoundError:
+            return ""
+
+    async def read(self, attachment_id: str, max_chars: int) -> Tuple[str, Optional[Dict[str, Any]]]:
+        """读取已转换的内容（最多 max_chars 个字符）和附件状态"""
+        status = self.get_status(attachment_id)
+        if status is None:
+            return "", None
+        return await asyncio.to_thread(self._read_text, attachment_id, max_chars), status
+
+    async def read_for_prompt(self, attachment_id: str, max_chars: int) -> str:
+        """组装模型请求时读取附件，仍在转换时附加进度说明"""
+        text, status = await self.read(attachment_id, max_chars)
+        if status is None:
+            return "[文档不存在或已被删除]"
+        if status["status"] == CONVERTING:
+            progress = f"{status['completed']}/{status['total']}" if status.get("total") else str(status["completed"])
+            text += f"\n\n[文档仍在转换中，以上为已转换的部分（{progress}）]"
+        elif status["status"] == FAILED:
+            text += f"\n\n[文档转换未完成: {status.get('error', '未知错误')}]"
+        return text
+
+# 全局附件存储
+attachment_store = AttachmentStore(DOCUMENT_CONFIG["ATTACHMENT_DIR"])
@@ -1,10 +1,25 @@
 from fastapi import APIRouter, UploadFile, File, HTTPException
-from markitdown import MarkItDown
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+import asyncio
+import hashlib
+import io
+import logging
+import multiprocessing
 import os
 import re
+import shutil
+import tempfile
+import time
+
+import doc_worker
+from config import DOCUMENT_CONFIG
 
 router = APIRouter()
-md = MarkItDown()  # 初始化MarkItDown
+
+CHUNK_SIZE = 1024 * 1024
 
 def get_mime_type_from_filename(filename):
     """根据文件名获取 MIME 类型
@@ -45,35 +60,245 @@ def get_mime_type_from_filename(filename):
     return mime_types.get(file_extension, 'text/markdown')
 
 class MarkitdownService:
+    """文档转换服务
+
+    - 上传的文件分块读取并计算 SHA-256，较小的文件保留在内存中，较大的写入唯一的临时文件
+    - 转换在预先加载了 MarkItDown 和 magika 的进程池中执行，不阻塞事件循环
+    - 转换结果按文件内容的 SHA-256 缓存在磁盘上，重复上传同一文件时直接返回
+    """
+
+    def __init__(self, cache_dir: Path, max_workers: int):
+        self.cache_dir = Path(cache_dir)
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self._warmup_task: Optional[asyncio.Task] = None
+        self.conversions_total = 0
+        self.cache_hits = 0
+        self.failures_total = 0
+        self.convert_seconds_total = 0.0
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # 使用 spawn 启动子进程，避免在已有多个线程（日志、追踪导出）的进程中 fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=doc_worker.init_worker
+            )
+        return self._executor
+
+    async def start(self) -> None:
+        """在后台预先启动转换进程，避免首次转换时等待加载"""
+        if DOCUMENT_CONFIG["PROCESS_POOL"] and DOCUMENT_CONFIG["PRELOAD"]:
+            self._warmup_task = asyncio.create_task(self._warmup())
+
+    async def _warmup(self) -> None:
+        loop = asyncio.get_running_loop()
+        try:
+            executor = self._get_executor()
+            # 提交与进程数相同的任务，进程池会启动全部工作进程并各自执行 initializer
+            await asyncio.gather(*(loop.run_in_executor(executor, doc_worker.ping)
+                                   for _ in range(self.max_workers)))
+            logging.info(f"文档转换进程已预热，进程数: {self.max_workers}")
+        except Exception as e:
+            logging.warning(f"预先启动文档转换进程失败: {e}")
+
+    def close(self) -> None:
+        """关闭进程池，应用退出时调用"""
+        if self._warmup_task is not None:
+            self._warmup_task.cancel()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def cache_path(self, digest: str) -> Path:
+        return self.cache_dir / digest[:2] / f"{digest}.md"
+
+    async def run_in_pool(self, func, *args) -> Any:
+        """在转换进程池中执行 doc_worker 中的函数，关闭进程池时在线程中执行"""
+        if not DOCUMENT_CONFIG["PROCESS_POOL"]:
+            return await asyncio.wait_for(asyncio.to_thread(func, *args), DOCUMENT_CONFIG["TIMEOUT"])
+        loop = asyncio.get_running_loop()
+        try:
+            # 超时后转换进程仍会运行到结束，这里只是不再等待
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._get_executor(), func, *args),
+                DOCUMENT_CONFIG["TIMEOUT"]
+            )
+        except BrokenProcessPool:
+            # 转换进程异常退出（如内存不足被杀），下次请求时重建进程池
+            self._executor = None
+            raise
+
+    async def spool(self, file: UploadFile, spool_bytes: Optional[int] = None) -> Dict[str, Any]:
+        """分块读取上传的文件，返回内容的 SHA-256 以及内存中的数据或临时文件路径
+
+        spool_bytes 为保留在内存中的大小上限，默认使用配置，为 0 时总是写入临时文件。
+        """
+        max_bytes = DOCUMENT_CONFIG["MAX_UPLOAD_MB"] * 1024 * 1024
+        if spool_bytes is None:
+            spool_bytes = DOCUMENT_CONFIG["SPOOL_MAX_MB"] * 1024 * 1024
+        digest = hashlib.sha256()
+        buffer = io.BytesIO()
+        temp_file = None
+        size = 0
+        try:
+            while True:
+                chunk = await file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_bytes:
+                    raise HTTPException(status_code=413, detail=f"文档不能超过 {DOCUMENT_CONFIG['MAX_UPLOAD_MB']} MB")
+                digest.update(chunk)
+                if temp_file is None and size > spool_bytes:
+                    # 超过内存上限，转存到唯一命名的临时文件，保留扩展名供转换器识别格式
+                    suffix = os.path.splitext(file.filename or "")[1]
+                    temp_file = tempfile.NamedTemporaryFile(prefix="kunlab-doc-", suffix=suffix, delete=False)
+                    await asyncio.to_thread(temp_file.write, buffer.getvalue())
+                    buffer = None
+                if temp_file is not None:
+                    await asyncio.to_thread(temp_file.write, chunk)
+                else:
+                    buffer.write(chunk)
+            if temp_file is None and spool_bytes == 0:
+                # 空文件也写入临时文件，保证调用方总能拿到路径
+                temp_file = tempfile.NamedTemporaryFile(prefix="kunlab-doc-", suffix=os.path.splitext(file.filename or "")[1],
+                                                        delete=False)
+                buffer = None
+        except BaseException:
+            if temp_file is not None:
+                temp_file.close()
+                os.remove(temp_file.name)
+            raise
+        if temp_file is not None:
+            temp_file.close()
+        return {
+            "digest": digest.hexdigest(),
+            "size": size,
+            "data": buffer.getvalue() if buffer is not None else None,
+            "path": temp_file.name if temp_file is not None else None
+        }
+
+    async def read_cache(self, digest: str) -> Optional[str]:
+        path = self.cache_path(digest)
+        try:
+            text = await asyncio.to_thread(path.read_text, encoding="utf-8")
+        except FileNotFoundError:
+            return None
+        # 更新访问时间，淘汰时保留最近使用的结果
+        os.utime(path)
+        return text
+
+    def write_cache(self, digest: str, text: Optional[str] = None, source: Optional[Path] = None) -> None:
+        """写入缓存（文本或已有文件的副本）并淘汰最久未使用的结果；在线程中运行"""
+        path = self.cache_path(digest)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = path.with_name(path.name + ".tmp")
+        if source is not None:
+            shutil.copyfile(source, tmp)
+        else:
+            tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, path)
+        entries = list(self.cache_dir.glob("*/*.md"))
+        excess = len(entries) - DOCUMENT_CONFIG["CACHE_MAX_ENTRIES"]
+        if excess > 0:
+            for old in sorted(entries, key=lambda p: p.stat().st_mtime)[:excess]:
+                old.unlink(missing_ok=True)
+
+    async def convert_text(self, spooled: Dict[str, Any], filename: str) -> str:
+        """转换已读取的文档，返回 Markdown 文本（不含文件信息头）
+
+        临时文件由转换任务负责删除；命中缓存或复用其他请求的转换时在这里删除。
+        """
+        digest = spooled["digest"]
+        handed_off = False
+        try:
+            cached = await self.read_cache(digest)
+            if cached is not None:
+                self.cache_hits += 1
+                logging.debug(f"文档 {filename} 命中转换缓存 {digest[:12]}")
+                return cached
+
+            task = self._inflight.get(digest)
+            if task is None:
+                # 同一文件的并发转换只执行一次，转换不随发起请求的取消而中断
+                task = asyncio.ensure_future(self._convert(spooled, filename))
+                self._inflight[digest] = task
+                task.add_done_callback(lambda done: self._finished(digest, done))
+                handed_off = True
+            return await asyncio.shield(task)
+        finally:
+            if not handed_off:
+                self.discard(spooled)
+
+    @staticmethod
+    def discard(spooled: Dict[str, Any]) -> None:
+        if spooled["path"]:
+            Path(spooled["path"]).unlink(missing_ok=True)
+
+    def _finished(self, digest: str, task: asyncio.Task) -> None:
+        self._inflight.pop(digest, None)
+        if not task.cancelled():
+            task.exception()
+
+    async def _convert(self, spooled: Dict[str, Any], filename: str) -> str:
+        started = time.perf_counter()
+        try:
+            text = await self.run_in_pool(doc_worker.convert_document, spooled["path"], spooled["data"], filename)
+        except Exception:
+            self.failures_total += 1
+            raise
+        finally:
+            # 删除临时文件
+            self.discard(spooled)
+        elapsed = time.perf_counter() - started
+        self.conversions_total += 1
+        self.convert_seconds_total += elapsed
+        logging.info(f"文档 {filename} 转换完成，大小: {spooled['size']} 字节，耗时 {elapsed:.2f} 秒")
+        try:
+            await asyncio.to_thread(self.write_cache, spooled["digest"], text)
+        except Exception as e:
+            logging.warning(f"写入文档转换缓存失败: {e}")
+        return text
+
     async def convert_document(self, file: UploadFile) -> dict:
         """转换文件为Markdown格式"""
         try:
-            # 保存上传的文件到临时目录
-            temp_path = f"temp_{file.filename}"
-            with open(temp_path, "wb") as temp_file:
-                content = await file.read()
-                temp_file.write(content)
-
-            # 使用MarkItDown转换文件
-            result = md.convert(temp_path)
-            
-            # 删除临时文件
-            os.remove(temp_path)
+            spooled = await self.spool(file)
+            text = await self.convert_text(spooled, file.filename)
 
             # 在 Markdown 内容开头添加文件信息
             file_info = f"# 文件: {file.filename}\n\n"
-            markdown_content = file_info + result.text_content
+            markdown_content = file_info + text
 
             return {
                 "name": file.filename,
                 "content": markdown_content,
                 "type": get_mime_type_from_filename(file.filename) or file.content_type or "text/markdown"
             }
+        except HTTPException:
+            raise
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=504, detail=f"文档转换超时（{DOCUMENT_CONFIG['TIMEOUT']} 秒）")
         except Exception as e:
+            logging.error(f"文档 {file.filename} 转换失败: {e}")
             raise HTTPException(status_code=500, detail=str(e))
 
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "process_pool": DOCUMENT_CONFIG["PROCESS_POOL"],
+            "max_workers": self.max_workers,
+            "in_flight": len(self._inflight),
+            "conversions_total": self.conversions_total,
+            "cache_hits": self.cache_hits,
+            "failures_total": self.failures_total,
+            "convert_seconds_total": round(self.convert_seconds_total, 3)
+        }
+
 # 创建服务实例
-service = MarkitdownService()
+service = MarkitdownService(DOCUMENT_CONFIG["CACHE_DIR"], DOCUMENT_CONFIG["MAX_WORKERS"])
 
 @router.post("/convert")
 async def convert_document(file: UploadFile = File(...)):
@@ -82,3 +307,21 @@ async def convert_document(file: UploadFile = File(...)):
     将上传的文档转换为Markdown格式
     """
     return await service.convert_document(file)
+
+@router.post("/convert/batch")
+async def convert_documents(files: List[UploadFile] = File(...)):
+    """批量转换文档API端点
+
+    同时转换多个文档，单个文档失败不影响其他文档，结果顺序与上传顺序一致
+    """
+    if len(files) > DOCUMENT_CONFIG["BATCH_MAX_FILES"]:
+        raise HTTPException(status_code=400, detail=f"一次最多转换 {DOCUMENT_CONFIG['BATCH_MAX_FILES']} 个文档")
+
+    async def convert_one(file: UploadFile) -> Dict[str, Any]:
+        try:
+            return {"success": True, **await service.convert_document(file)}
+        except HTTPException as e:
+            return {"success": False, "name": file.filename, "error": e.detail}
+
+    results = await asyncio.gather(*(convert_one(file) for file in files))
+    return {"results": results}
@@ -0,0 +1,218 @@
+"""
+渐进式文档转换 - 大文档按页分段转换，通过 SSE 推送已转换的内容和进度
+"""
+import asyncio
+import codecs
+import logging
+import os
+from collections import deque
+from typing import Any, AsyncGenerator, Dict, Optional
+
+from fastapi import APIRouter, File, HTTPException, UploadFile
+
+import doc_worker
+from config import DOCUMENT_CONFIG
+from api.sse import format_sse, sse_response
+from .attachments import CONVERTING, DONE, AttachmentStore, attachment_store
+from .doc_format import MarkitdownService, get_mime_type_from_filename, service
+
+router = APIRouter()
+
+# SSE 每个 chunk 事件最多读取的字节数
+READ_BLOCK_BYTES = 64 * 1024
+
+def is_pdf(filename: str, content_type: Optional[str]) -> bool:
+    return os.path.splitext(filename or "")[1].lower() == ".pdf" or content_type == "application/pdf"
+
+class ProgressiveConverter:
+    """渐进式文档转换
+
+    - PDF 按 PAGES_PER_CHUNK 页分段，在转换进程池中并行转换，按顺序追加到附件存储
+    - 其他格式整体转换后一次写入（MarkItDown 不支持分段转换这些格式）
+    - 转换在后台任务中进行，不随 SSE 连接断开而中断；已转换的部分可以立即作为聊天附件使用
+    - 内存中只保留正在转换的几段内容，完整结果只存在于磁盘上
+    """
+
+    def __init__(self, converter: MarkitdownService, store: AttachmentStore):
+        self.converter = converter
+        self.store = store
+        self._tasks: Dict[str, asyncio.Task] = {}
+
+    async def start(self, file: UploadFile) -> Dict[str, Any]:
+        """保存上传的文件并开始转换，返回附件状态；同一文件已转换或正在转换时直接复用"""
+        filename = file.filename or "document"
+        content_type = get_mime_type_from_filename(filename) or file.content_type or "text/markdown"
+        # 分段转换需要按路径读取文件，总是写入临时文件
+        spooled = await self.converter.spool(file, spool_bytes=0)
+        attachment_id = spooled["digest"]
+
+        # 检查和登记之间不能有 await，否则同一文件的并发上传会各自开始转换、互相清空内容
+        status = self.store.get_status(attachment_id)
+        if attachment_id in self._tasks or (status is not None and status["status"] == DONE):
+            self.converter.discard(spooled)
+            return status or self.store.get_status(attachment_id)
+
+        task = asyncio.create_task(self._run(attachment_id, spooled, filename, content_type,
+                                             is_pdf(filename, file.content_type)))
+        self._tasks[attachment_id] = task
+        task.add_done_callback(lambda _: self._tasks.pop(attachment_id, None))
+        self.store.reserve(attachment_id, filename, content_type, None)
+        return self.store.get_status(attachment_id)
+
+    @staticmethod
+    def _copy(source, target) -> None:
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            while True:
+                block = src.read(READ_BLOCK_BYTES)
+                if not block:
+                    break
+                dst.write(block)
+
+    async def _run(self, attachment_id: str, spooled: Dict[str, Any], filename: str, content_type: str,
+                   pdf: bool) -> None:
+        pending: deque = deque()
+        try:
+            cache_path = self.converter.cache_path(attachment_id)
+            if cache_path.exists():
+                # 之前通过 /doc/convert 转换过，直接复制转换结果
+                self.converter.cache_hits += 1
+                await self.store.begin(attachment_id, filename, content_type, 1)
+                await asyncio.to_thread(self._copy, cache_path, self.store.text_path(attachment_id))
+                await self.store.append(attachment_id, "", 1)
+                await self.store.finish(attachment_id)
+                return
+
+            await self.store.begin(attachment_id, filename, content_type, None)
+            if pdf:
+                await self._convert_pdf(attachment_id, spooled["path"], pending)
+            else:
+                text = await self.converter.run_in_pool(doc_worker.convert_document, spooled["path"], None, filename)
+                await self.store.append(attachment_id, text, 1, 1)
+            await self.store.finish(attachment_id)
+            self.converter.conversions_total += 1
+            logging.info(f"文档 {filename} 渐进式转换完成，附件: {attachment_id[:12]}")
+            # 完整结果同时放入转换缓存，之后通过 /doc/convert 上传同一文件时直接返回
+            await asyncio.to_thread(self.converter.write_cache, attachment_id, None,
+                                    self.store.text_path(attachment_id))
+        except asyncio.CancelledError:
+            await self.store.finish(attachment_id, error="转换已取消")
+            raise
+        except Exception as e:
+            self.converter.failures_total += 1
+            logging.error(f"文档 {filename} 渐进式转换失败: {e}")
+            await self.store.finish(attachment_id, error=str(e) or type(e).__name__)
+        finally:
+            for _, task in pending:
+                task.cancel()
+            self.converter.discard(spooled)
+
+    async def _convert_pdf(self, attachment_id: str, path: str, pending: deque) -> None:
+        total = await self.converter.run_in_pool(doc_worker.count_pdf_pages, path)
+        await self.store.append(attachment_id, "", 0, total)
+        size = DOCUMENT_CONFIG["PAGES_PER_CHUNK"]
+        ranges = deque((start, min(start + size, total)) for start in range(0, total, size))
+        # 最多同时转换与进程数相同的段，按顺序写入
+        while ranges or pending:
+            while ranges and len(pending) < self.converter.max_workers:
+                start, end = ranges.popleft()
+                task = asyncio.ensure_future(
+                    self.converter.run_in_pool(doc_worker.convert_pdf_pages, path, start, end))
+                pending.append((end, task))
+            end, task = pending[0]
+            text = await task
+            pending.popleft()
+            await self.store.append(attachment_id, text, end)
+
+    def close(self) -> None:
+        """取消进行中的转换，应用退出时调用"""
+        for task in list(self._tasks.values()):
+            task.cancel()
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"in_flight": len(self._tasks)}
+
+    async def events(self, attachment_id: str) -> AsyncGenerator[str, None]:
+        """以 SSE 推送附件内容和进度，从头开始读取，直到转换结束"""
+        status = self.store.get_status(attachment_id)
+        if status is None:
+            yield format_sse("error", {"attachment_id": attachment_id, "error": "附件不存在"})
+            return
+        yield format_sse("start", status)
+
+        path = self.store.text_path(attachment_id)
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="ignore")
+        offset = 0
+        sent_chars = 0
+        last_progress = None
+        while True:
+            # 先取状态再读取内容，状态为已结束时保证读到的是全部内容
+            status = self.store.get_status(attachment_id)
+            while True:
+                block = await asyncio.to_thread(self._read_block, path, offset)
+                if not block:
+                    break
+                offset += len(block)
+                text = decoder.decode(block)
+                if text:
+                    sent_chars += len(text)
+                    yield format_sse("chunk", {"attachment_id": attachment_id, "markdown": text})
+
+            progress = (status["completed"], status.get("total"))
+            if progress != last_progress:
+                last_progress = progress
+                yield format_sse("progress", {"attachment_id": attachment_id, "completed": status["completed"],
+                                              "total": status.get("total"), "chars": sent_chars})
+
+            if status["status"] != CONVERTING:
+                event = "done" if status["status"] == DONE else "error"
+                yield format_sse(event, {**status, "chars": sent_chars})
+                return
+            current = self.store.get_status(attachment_id)
+            if current and current["status"] == CONVERTING and current["chars"] <= sent_chars \
+                    and current["completed"] == status["completed"]:
+                if not await self.store.wait_update(attachment_id, DOCUMENT_CONFIG["SSE_KEEPALIVE"]):
+                    yield ": keepalive\n\n"
+
+    @staticmethod
+    def _read_block(path, offset: int) -> bytes:
+        try:
+            with open(path, "rb") as f:
+                f.seek(offset)
+                return f.read(READ_BLOCK_BYTES)
+        except FileNotFoundError:
+            return b""
+
+# 全局渐进式转换器
+progressive_converter = ProgressiveConverter(service, attachment_store)
+
+@router.post("/convert/stream")
+async def convert_document_stream(file: UploadFile = File(...)):
+    """渐进式转换文档
+
+    以 SSE 返回事件：start（附件 ID 和文件信息）、chunk（新转换的 Markdown）、
+    progress（已完成/总页数）、done 或 error。收到 start 后即可在聊天消息中以
+    {"attachment_id", "name", "type"} 引用该文档，模型请求中使用当时已转换的内容。
+    """
+    try:
+        status = await progressive_converter.start(file)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logging.error(f"文档 {file.filename} 渐进式转换启动失败: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+    return sse_response(progressive_converter.events(status["attachment_id"]))
+
+@router.get("/attachments/{attachment_id}/events")
+async def get_attachment_events(attachment_id: str):
+    """重新订阅附件的转换进度（如连接断开后），从头推送已转换的内容"""
+    if attachment_store.get_status(attachment_id) is None:
+        raise HTTPException(status_code=404, detail="附件不存在")
+    return sse_response(progressive_converter.events(attachment_id))
+
+@router.get("/attachments/{attachment_id}")
+async def get_attachment(attachment_id: str, max_chars: int = 200000):
+    """获取附件状态和已转换的内容（最多 max_chars 个字符）"""
+    content, status = await attachment_store.read(attachment_id, max(0, max_chars))
+    if status is None:
+        raise HTTPException(status_code=404, detail="附件不存在")
+    return {**status, "content": content}
@@ -1,51 +1,115 @@
-from fastapi import APIRouter, UploadFile, File, HTTPException
-from typing import Dict
-import base64
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Request
+from fastapi.responses import FileResponse, Response
+from typing import Any, Dict, Optional
 import logging
 
+from config import IMAGE_CONFIG
+from database import Database, get_db
+from api.auth import get_current_user
+from .image_store import allowed_content_types, image_store
+
 router = APIRouter(prefix="/images", tags=["images"])
 
 @router.post("/upload")
 async def upload_image(
-    file: UploadFile = File(...)
+    file: UploadFile = File(...),
+    inline: bool = False,
+    current_user: Dict[str, Any] = Depends(get_current_user)
 ):
     """
-    将上传的图片转换为base64格式
-    
+    上传图片，图片按内容哈希保存在服务端，返回图片句柄
+
     参数:
     - file: 图片文件
-    
+    - inline: 为 true 时同时返回 base64 数据（兼容旧客户端）
+
     返回:
     ```json
     {
         "success": true,
-        "image_data": "base64编码的图片数据"
+        "image_id": "kunimg:<sha256>",
+        "url": "/api/images/<sha256>",
+        "thumbnail_url": "/api/images/<sha256>/thumbnail"
     }
     ```
+    发送消息时在 image 字段中传入 image_id 即可，图片只在组装模型请求时读取。
     """
     try:
-        # 验证文件类型
-        if not file.content_type.startswith('image/'):
+        # 声明的类型只做初步检查，保存时按 Pillow 识别的实际格式校验
+        if not file.content_type or not file.content_type.startswith('image/'):
             raise HTTPException(
                 status_code=400,
                 detail="只允许上传图片文件"
             )
-        
-        # 读取图片内容
-        content = await file.read()
-        
-        # 转换为 base64
-        image_data = base64.b64encode(content).decode()
-        base64_image = f"data:{file.content_type};base64,{image_data}"
-        
-        return {
-            "success": True,
-            "image_data": base64_image
-        }
-        
+
+        result = await image_store.save_upload(file, current_user["username"])
+        response = {"success": True, **result}
+
+        if inline:
+            image_data = await image_store.load_base64(result["image_id"])
+            response["image_data"] = f"data:{result['content_type']};base64,{image_data}"
+
+        return response
+
+    except HTTPException:
+        raise
     except Exception as e:
         logging.error(f"图片上传错误: {str(e)}")
         raise HTTPException(
             status_code=500,
             detail=f"图片处理失败: {str(e)}"
         )
+
+async def get_image_user(
+    request: Request,
+    token: Optional[str] = None,
+    db: Database = Depends(get_db)
+) -> Dict[str, Any]:
+    """图片地址会直接用在 <img> 标签中，除 Authorization 头外也接受 ?token= 参数"""
+    authorization = request.headers.get("authorization", "")
+    if authorization.lower().startswith("bearer "):
+        token = authorization[7:]
+    if not token:
+        raise HTTPException(status_code=401, detail="Not authenticated", headers={"WWW-Authenticate": "Bearer"})
+    return await get_current_user(token, db)
+
+async def _accessible_info(image_id: str, username: str):
+    """读取图片元数据，图片不存在或用户无权访问时都返回 404，不暴露图片是否存在"""
+    info = await image_store.get_info(image_id)
+    if info is None or not await image_store.can_access(image_id, username):
+        raise HTTPException(status_code=404, detail="图片不存在")
+    return info
+
+def _cached_response(request: Request, path, media_type: str, etag: str):
+    """图片内容由哈希决定、不会改变，可以长期缓存；需要登录才能访问，只允许浏览器私有缓存"""
+    headers = {
+        "Cache-Control": f"private, max-age={IMAGE_CONFIG['CACHE_MAX_AGE']}, immutable",
+        "ETag": etag,
+        # 禁止浏览器按内容猜测类型，避免把图片当作 HTML 执行
+        "X-Content-Type-Options": "nosniff"
+    }
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+def _original_media_type(info) -> str:
+    """原图的类型，早期按客户端声明保存的非位图类型按二进制文件返回"""
+    content_type = info["content_type"]
+    return content_type if content_type in allowed_content_types() else "application/octet-stream"
+
+@router.get("/{image_id}")
+async def get_image(image_id: str, request: Request, current_user: Dict[str, Any] = Depends(get_image_user)):
+    """获取原图"""
+    info = await _accessible_info(image_id, current_user["username"])
+    return _cached_response(request, image_store.original_path(image_id),
+                            _original_media_type(info), f'"{image_id}"')
+
+@router.get("/{image_id}/thumbnail")
+async def get_thumbnail(image_id: str, request: Request, current_user: Dict[str, Any] = Depends(get_image_user)):
+    """获取历史消息中显示的缩略图，无法生成缩略图时返回原图"""
+    info = await _accessible_info(image_id, current_user["username"])
+    thumbnail = image_store.thumbnail_path(image_id)
+    if thumbnail.exists():
+        return _cached_response(request, thumbnail, "image/webp", f'"{image_id}-thumb"')
+    return _cached_response(request, image_store.original_path(image_id),
+                            _original_media_type(info), f'"{image_id}"')
@@ -0,0 +1,254 @@
+"""
+图片存储 - 上传的图片按内容哈希保存在磁盘上，消息中只保存图片句柄
+"""
+import asyncio
+import base64
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import time
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from fastapi import HTTPException, UploadFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from config import IMAGE_CONFIG
+from database import Database, db
+
+# 消息中保存的图片句柄：前缀 + 内容的 SHA-256
+HANDLE_PREFIX = "kunimg:"
+_HANDLE_RE = re.compile(r"^kunimg:([0-9a-f]{64})$")
+_ID_RE = re.compile(r"^[0-9a-f]{64}$")
+
+CHUNK_SIZE = 1024 * 1024
+
+def is_image_handle(value: Any) -> bool:
+    return isinstance(value, str) and _HANDLE_RE.match(value) is not None
+
+def image_id_from_handle(handle: str) -> Optional[str]:
+    match = _HANDLE_RE.match(handle or "")
+    return match.group(1) if match else None
+
+def image_urls(image_id: str) -> Dict[str, str]:
+    """图片原图和缩略图的访问路径"""
+    return {
+        "url": f"/api/images/{image_id}",
+        "thumbnail_url": f"/api/images/{image_id}/thumbnail"
+    }
+
+def allowed_content_types() -> set:
+    """允许返回给浏览器的图片类型"""
+    return {Image.MIME[fmt] for fmt in IMAGE_CONFIG["ALLOWED_FORMATS"] if fmt in Image.MIME}
+
+def inspect_image(path: str) -> Dict[str, Any]:
+    """用 Pillow 识别图片的实际格式并校验，返回类型和尺寸；在线程中运行
+
+    不信任客户端声明的类型：SVG、HTML 等非位图内容无法被识别，直接拒绝。
+    """
+    try:
+        with Image.open(path) as img:
+            fmt = img.format
+            width, height = img.size
+            img.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError, SyntaxError) as e:
+        raise HTTPException(status_code=400, detail=f"无法识别的图片文件: {e}")
+    if fmt not in IMAGE_CONFIG["ALLOWED_FORMATS"]:
+        raise HTTPException(status_code=400, detail=f"不支持的图片格式: {fmt}")
+    return {"content_type": Image.MIME[fmt], "width": width, "height": height}
+
+def _make_thumbnail(source: Path, target: Path) -> None:
+    """生成缩略图，在线程中运行"""
+    with Image.open(source) as img:
+        thumb = ImageOps.exif_transpose(img)
+        thumb.thumbnail((IMAGE_CONFIG["THUMBNAIL_SIZE"], IMAGE_CONFIG["THUMBNAIL_SIZE"]))
+        if thumb.mode not in ("RGB", "RGBA"):
+            thumb = thumb.convert("RGBA")
+        tmp = target.with_name(target.name + ".tmp")
+        thumb.save(tmp, "WEBP", quality=IMAGE_CONFIG["THUMBNAIL_QUALITY"])
+        os.replace(tmp, target)
+
+class ImageStore:
+    """按内容寻址的图片存储
+
+    - 上传流式写入临时文件，同时计算 SHA-256，相同内容只保存一份
+    - 文件按哈希前两位分目录保存，元数据（类型、大小、尺寸）保存在 images 表中
+    - 历史消息只保存 kunimg:<sha256> 句柄，页面通过缩略图地址按需加载
+    - 只有组装发给模型的请求时才读取原图并编码为 base64
+    - 上传者记录在 image_owners 表中，只有上传者和引用了该图片的对话的所有者可以读取
+    - 上传后超过 ORPHAN_GRACE_HOURS 仍未被任何消息引用的图片会被删除
+    """
+
+    def __init__(self, database: Database, root: Path):
+        self.db = database
+        self.root = Path(root)
+        self.uploads_total = 0
+        self.dedup_total = 0
+        self.loads_total = 0
+        self.orphans_deleted_total = 0
+        self._last_cleanup = 0.0
+
+    def original_path(self, image_id: str) -> Path:
+        return self.root / image_id[:2] / image_id
+
+    def thumbnail_path(self, image_id: str) -> Path:
+        return self.root / "thumbs" / image_id[:2] / f"{image_id}.webp"
+
+    async def save_upload(self, file: UploadFile, username: str) -> Dict[str, Any]:
+        """保存 username 上传的图片，返回图片句柄和访问地址"""
+        max_bytes = IMAGE_CONFIG["MAX_UPLOAD_MB"] * 1024 * 1024
+        self.root.mkdir(parents=True, exist_ok=True)
+        digest = hashlib.sha256()
+        size = 0
+        fd, tmp_name = tempfile.mkstemp(dir=self.root, prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as tmp:
+                while True:
+                    chunk = await file.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise HTTPException(status_code=413, detail=f"图片不能超过 {IMAGE_CONFIG['MAX_UPLOAD_MB']} MB")
+                    digest.update(chunk)
+                    # 写文件在线程中进行，避免大图阻塞事件循环
+                    await asyncio.to_thread(tmp.write, chunk)
+            if size == 0:
+                raise HTTPException(status_code=400, detail="图片文件为空")
+            # 按实际内容确定图片类型，不使用客户端声明的类型
+            info = await asyncio.to_thread(inspect_image, tmp_name)
+
+            image_id = digest.hexdigest()
+            target = self.original_path(image_id)
+            if target.exists():
+                self.dedup_total += 1
+                logging.debug(f"图片 {image_id[:12]} 已存在，复用已保存的文件")
+            else:
+                target.parent.mkdir(parents=True, exist_ok=True)
+                os.replace(tmp_name, target)
+        finally:
+            if os.path.exists(tmp_name):
+                os.remove(tmp_name)
+
+        await self._ensure_thumbnail(image_id)
+        now = datetime.now().isoformat()
+        # 重新上传已有的图片时刷新上传时间，避免刚上传就被当作未引用的旧图片清理
+        await self.db.execute(
+            """INSERT INTO images (id, content_type, size, width, height, created_at)
+               VALUES (?, ?, ?, ?, ?, ?)
+               ON CONFLICT(id) DO UPDATE SET created_at = excluded.created_at""",
+            (image_id, info["content_type"], size, info["width"], info["height"], now)
+        )
+        await self.db.execute(
+            "INSERT OR IGNORE INTO image_owners (image_id, user_id, created_at) VALUES (?, ?, ?)",
+            (image_id, username, now)
+        )
+        await self.db.commit()
+        self.uploads_total += 1
+        logging.info(f"用户 {username} 上传了图片 {image_id[:12]}，大小: {size} 字节")
+
+        if time.monotonic() - self._last_cleanup > IMAGE_CONFIG["CLEANUP_INTERVAL"]:
+            await self.delete_orphans()
+        return {"image_id": HANDLE_PREFIX + image_id, "size": size, "content_type": info["content_type"],
+                **image_urls(image_id)}
+
+    async def _ensure_thumbnail(self, image_id: str) -> None:
+        target = self.thumbnail_path(image_id)
+        if target.exists():
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            await asyncio.to_thread(_make_thumbnail, self.original_path(image_id), target)
+        except Exception as e:
+            # 缩略图生成失败时缩略图接口返回原图
+            logging.warning(f"生成图片 {image_id[:12]} 的缩略图失败: {e}")
+
+    async def get_info(self, image_id: str) -> Optional[Dict[str, Any]]:
+        if not _ID_RE.match(image_id or ""):
+            return None
+        info = await self.db.fetch_one("SELECT * FROM images WHERE id = ?", (image_id,))
+        if info is None or not self.original_path(image_id).exists():
+            return None
+        return info
+
+    async def can_access(self, image_id: str, username: str) -> bool:
+        """用户是否可以读取图片：上传者，或者自己的对话中有消息引用了该图片"""
+        owner = await self.db.fetch_one(
+            "SELECT 1 FROM image_owners WHERE image_id = ? AND user_id = ?", (image_id, username)
+        )
+        if owner:
+            return True
+        referenced = await self.db.fetch_one(
+            """SELECT 1 FROM messages m JOIN conversations c ON c.id = m.conversation_id
+               WHERE c.user_id = ? AND m.images LIKE ? LIMIT 1""",
+            (username, f"%{HANDLE_PREFIX}{image_id}%")
+        )
+        return referenced is not None
+
+    async def delete_orphans(self) -> int:
+        """删除上传超过 ORPHAN_GRACE_HOURS 且没有任何消息引用的图片，返回删除的数量"""
+        self._last_cleanup = time.monotonic()
+        cutoff = (datetime.now() - timedelta(hours=IMAGE_CONFIG["ORPHAN_GRACE_HOURS"])).isoformat()
+        try:
+            rows = await self.db.fetch_all(
+                """SELECT id FROM images i WHERE i.created_at < ? AND NOT EXISTS (
+                       SELECT 1 FROM messages m WHERE m.images LIKE '%' || ? || i.id || '%'
+                   )""",
+                (cutoff, HANDLE_PREFIX)
+            )
+            for row in rows:
+                image_id = row["id"]
+                await self.db.execute("DELETE FROM image_owners WHERE image_id = ?", (image_id,))
+                await self.db.execute("DELETE FROM images WHERE id = ?", (image_id,))
+                for path in (self.original_path(image_id), self.thumbnail_path(image_id)):
+                    await asyncio.to_thread(path.unlink, missing_ok=True)
+            await self.db.commit()
+        except Exception as e:
+            logging.warning(f"清理未引用的图片失败: {e}")
+            return 0
+        if rows:
+            self.orphans_deleted_total += len(rows)
+            logging.info(f"已删除 {len(rows)} 张未被消息引用的图片")
+        return len(rows)
+
+    async def load_base64(self, handle: str) -> Optional[str]:
+        """读取句柄对应的原图并编码为 base64，图片不存在时返回 None"""
+        image_id = image_id_from_handle(handle)
+        if image_id is None:
+            return None
+        path = self.original_path(image_id)
+        try:
+            data = await asyncio.to_thread(path.read_bytes)
+        except FileNotFoundError:
+            logging.warning(f"图片 {image_id[:12]} 不存在，已从请求中省略")
+            return None
+        self.loads_total += 1
+        return base64.b64encode(data).decode()
+
+    async def resolve(self, value: Any) -> Optional[str]:
+        """把消息中的图片转为 Ollama 需要的 base64
+
+        新消息保存的是图片句柄；旧消息中保存的 base64 或 data URL 继续兼容。
+        """
+        if not value or not isinstance(value, str):
+            return None
+        if is_image_handle(value):
+            return await self.load_base64(value)
+        if value.startswith("data:") and "," in value:
+            return value.split(",", 1)[1]
+        return value
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "root": str(self.root),
+            "uploads_total": self.uploads_total,
+            "dedup_total": self.dedup_total,
+            "loads_total": self.loads_total,
+            "orphans_deleted_total": self.orphans_deleted_total
+        }
+
+# 全局图片存储
+image_store = ImageStore(db, IMAGE_CONFIG["STORE_DIR"])
@@ -6,7 +6,6 @@ from api.auth import get_current_user
 import logging
 
 # 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 router = APIRouter(tags=["notes"])
@@ -10,6 +10,7 @@ from pydantic import BaseModel
 from api.auth import get_current_user
 from database import Database, get_db
 from config import API_CONFIG
+from ollama.transport import ollama_transport
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -224,7 +225,7 @@ async def check_ollama_connection(
         
         # 发送请求检查连接
         try:
-            async with aiohttp.ClientSession() as session:
+            async with ollama_transport.session() as session:
                 async with session.get(f"{host}/api/version", timeout=5) as response:
                     if response.status == 200:
                         version_data = await response.json()
@@ -249,3 +250,13 @@ async def check_ollama_connection(
     except Exception as e:
         logger.error(f"检查 Ollama 连接失败: {str(e)}")
         raise HTTPException(status_code=500, detail=f"检查 Ollama 连接失败: {str(e)}")
+
+# 获取 Ollama 连接池状态
+@router.get("/transport")
+async def get_transport_metrics(
+    current_user: Dict[str, Any] = Depends(get_current_user)
+):
+    """
+    获取 Ollama 连接池状态和连接复用统计
+    """
+    return ollama_transport.snapshot()
@@ -0,0 +1,230 @@
+"""
+网页搜索结果缓存 - 避免相同的查询重复调用 Tavily
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import time
+import unicodedata
+from typing import Any, Awaitable, Callable, Dict, Iterable, Optional, Union
+
+from database import Database, db
+from config import SEARCH_CACHE_CONFIG
+
+Domains = Optional[Union[str, Iterable[str]]]
+
+def normalize_query(query: str) -> str:
+    """规范化查询：统一全半角和大小写，合并空白，去掉首尾的标点"""
+    query = unicodedata.normalize("NFKC", query or "").lower()
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.strip(" ?!.,;:。？！，；：、")
+
+def normalize_domains(domains: Domains) -> list:
+    if not domains:
+        return []
+    if isinstance(domains, str):
+        domains = domains.split(",")
+    return sorted({d.strip().lower() for d in domains if d and d.strip()})
+
+class SearchCache:
+    """存储在 SQLite 中的搜索结果缓存
+
+    - 以规范化的查询、搜索深度、结果数量和域名过滤作为缓存键
+    - 超过 TTL_SECONDS 的结果视为过期；在 STALE_SECONDS 内仍先返回旧结果，同时在后台刷新
+    - 条目数超过 MAX_ENTRIES 时按最近访问时间淘汰
+    - SCOPE 为 user 时每个用户的缓存相互隔离
+    - 同一个键的并发未命中只调用一次搜索
+    """
+
+    def __init__(self, database: Database):
+        self.db = database
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self._background: set = set()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.refreshes = 0
+
+    @property
+    def enabled(self) -> bool:
+        return SEARCH_CACHE_CONFIG["ENABLED"]
+
+    def scope_for(self, username: Optional[str]) -> str:
+        return (username or "") if SEARCH_CACHE_CONFIG["SCOPE"] == "user" else ""
+
+    def make_key(self, query: str, search_depth: str, max_results: int,
+                 include_domains: Domains = None, exclude_domains: Domains = None,
+                 username: Optional[str] = None) -> Dict[str, Any]:
+        """生成缓存键及其组成部分"""
+        params = {
+            "search_depth": search_depth or "basic",
+            "max_results": max_results,
+            "include_domains": normalize_domains(include_domains),
+            "exclude_domains": normalize_domains(exclude_domains)
+        }
+        normalized = normalize_query(query)
+        scope = self.scope_for(username)
+        digest = hashlib.sha256(
+            json.dumps([scope, normalized, params], ensure_ascii=False, sort_keys=True).encode("utf-8")
+        ).hexdigest()
+        return {"cache_key": digest, "scope": scope, "query": normalized, "params": params}
+
+    async def get(self, cache_key: str) -> Optional[Dict[str, Any]]:
+        """读取缓存条目，返回结果和写入后经过的秒数"""
+        row = await self.db.fetch_one(
+            "SELECT response, created_at FROM search_cache WHERE cache_key = ?",
+            (cache_key,)
+        )
+        if not row:
+            return None
+        return {"response": json.loads(row["response"]), "age": time.time() - row["created_at"]}
+
+    async def put(self, key: Dict[str, Any], response: Dict[str, Any]) -> None:
+        now = time.time()
+        await self.db.execute(
+            """
+            INSERT OR REPLACE INTO search_cache (cache_key, scope, query, params, response, created_at, last_access, hits)
+            VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+            """,
+            (key["cache_key"], key["scope"], key["query"], json.dumps(key["params"], ensure_ascii=False),
+             json.dumps(response, ensure_ascii=False), now, now)
+        )
+        await self.prune(commit=False)
+        await self.db.commit()
+
+    async def prune(self, commit: bool = True) -> None:
+        """删除彻底过期的条目，并按最近访问时间淘汰超出上限的条目"""
+        expire_before = time.time() - SEARCH_CACHE_CONFIG["TTL_SECONDS"] - SEARCH_CACHE_CONFIG["STALE_SECONDS"]
+        await self.db.execute("DELETE FROM search_cache WHERE created_at < ?", (expire_before,))
+        await self.db.execute(
+            """
+            DELETE FROM search_cache WHERE cache_key IN (
+                SELECT cache_key FROM search_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+            )
+            """,
+            (SEARCH_CACHE_CONFIG["MAX_ENTRIES"],)
+        )
+        if commit:
+            await self.db.commit()
+
+    async def _touch(self, cache_key: str) -> None:
+        try:
+            await self.db.execute(
+                "UPDATE search_cache SET last_access = ?, hits = hits + 1 WHERE cache_key = ?",
+                (time.time(), cache_key)
+            )
+            await self.db.commit()
+        except Exception as e:
+            logging.debug(f"更新搜索缓存访问时间失败: {e}")
+
+    def _spawn(self, coro: Awaitable) -> None:
+        task = asyncio.ensure_future(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    async def _load(self, key: Dict[str, Any], loader: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """调用搜索并写入缓存，同一个键同时只有一个搜索在进行"""
+        cache_key = key["cache_key"]
+        future = self._inflight.get(cache_key)
+        if future is not None:
+            self.coalesced += 1
+            return await asyncio.shield(future)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[cache_key] = future
+        try:
+            response = await loader()
+            # 不缓存失败或空的结果
+            if response and not response.get("error") and response.get("results"):
+                try:
+                    await self.put(key, response)
+                except Exception as e:
+                    logging.warning(f"写入搜索缓存失败: {e}")
+            future.set_result(response)
+            return response
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 避免没有其他等待者时出现未获取异常的警告
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(cache_key, None)
+
+    async def _refresh(self, key: Dict[str, Any], loader: Callable[[], Awaitable[Dict[str, Any]]]) -> None:
+        self.refreshes += 1
+        try:
+            await self._load(key, loader)
+        except Exception as e:
+            logging.warning(f"后台刷新搜索缓存失败: {e}")
+
+    async def fetch(self, key: Dict[str, Any], loader: Callable[[], Awaitable[Dict[str, Any]]]) -> Dict[str, Any]:
+        """读取缓存，未命中或过期时调用 loader 获取结果
+
+        Args:
+            key: make_key 生成的缓存键
+            loader: 执行实际搜索的协程函数
+        """
+        if not self.enabled:
+            return await loader()
+
+        cache_key = key["cache_key"]
+        try:
+            cached = await self.get(cache_key)
+        except Exception as e:
+            logging.warning(f"读取搜索缓存失败: {e}")
+            cached = None
+
+        if cached is not None:
+            if cached["age"] <= SEARCH_CACHE_CONFIG["TTL_SECONDS"]:
+                self.hits += 1
+                self._spawn(self._touch(cache_key))
+                logging.info(f"搜索缓存命中: {key['query']}")
+                return cached["response"]
+            if cached["age"] <= SEARCH_CACHE_CONFIG["TTL_SECONDS"] + SEARCH_CACHE_CONFIG["STALE_SECONDS"]:
+                # 先返回旧结果，同时在后台刷新
+                self.stale_hits += 1
+                self._spawn(self._touch(cache_key))
+                if cache_key not in self._inflight:
+                    self._spawn(self._refresh(key, loader))
+                logging.info(f"搜索缓存已过期，返回旧结果并在后台刷新: {key['query']}")
+                return cached["response"]
+
+        self.misses += 1
+        return await self._load(key, loader)
+
+    async def clear(self, username: Optional[str] = None) -> int:
+        """清空缓存，按用户隔离时只清空该用户的缓存"""
+        scope = self.scope_for(username)
+        if SEARCH_CACHE_CONFIG["SCOPE"] == "user":
+            cursor = await self.db.execute("DELETE FROM search_cache WHERE scope = ?", (scope,))
+        else:
+            cursor = await self.db.execute("DELETE FROM search_cache")
+        await self.db.commit()
+        return cursor.rowcount
+
+    async def snapshot(self) -> Dict[str, Any]:
+        row = await self.db.fetch_one("SELECT COUNT(*) AS entries FROM search_cache")
+        lookups = self.hits + self.stale_hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "scope": SEARCH_CACHE_CONFIG["SCOPE"],
+            "ttl_seconds": SEARCH_CACHE_CONFIG["TTL_SECONDS"],
+            "stale_seconds": SEARCH_CACHE_CONFIG["STALE_SECONDS"],
+            "max_entries": SEARCH_CACHE_CONFIG["MAX_ENTRIES"],
+            "entries": row["entries"] if row else 0,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "refreshes": self.refreshes,
+            "hit_ratio": round((self.hits + self.stale_hits) / lookups, 4) if lookups else 0.0
+        }
+
+# 全局搜索结果缓存
+search_cache = SearchCache(db)
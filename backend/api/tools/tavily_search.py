@@ -2,28 +2,138 @@
 Tavily搜索工具 - 为Ollama LLM提供网页搜索功能
 """
 import os
+import asyncio
 import logging
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, Any, Optional, List
 from tavily import TavilyClient
 from fastapi import APIRouter, Depends, HTTPException, status
 from pydantic import BaseModel
 from api.auth import get_current_user
-from config import API_CONFIG
+from config import API_CONFIG, TAVILY_CONFIG
 from database import Database, get_db
+from metrics import tavily_call_seconds
+from tracing import record_span
+from .search_cache import search_cache
 
 router = APIRouter()
 
-# 全局变量
+# 环境变量中配置的全局API密钥
 TAVILY_API_KEY = API_CONFIG.get("TAVILY_API_KEY", "")
 
-# 创建Tavily客户端
-tavily_client = None
-if TAVILY_API_KEY:
-    try:
-        tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
-        logging.info("Tavily客户端初始化成功")
-    except Exception as e:
-        logging.error(f"Tavily客户端初始化失败: {str(e)}")
+class TavilyPool:
+    """Tavily 请求池
+
+    TavilyClient 只提供同步接口，直接在协程中调用会阻塞事件循环，
+    使所有用户的流式输出在搜索期间停顿。这里在有界线程池中执行请求，
+    并按 API 密钥缓存客户端（复用其 HTTP 连接），同时限制并发数和超时时间。
+    """
+
+    def __init__(self, max_workers: int, max_concurrent: int, timeout: float, client_cache_size: int):
+        self.timeout = timeout
+        self.client_cache_size = client_cache_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tavily")
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._clients: "OrderedDict[str, TavilyClient]" = OrderedDict()
+        self.in_flight = 0
+        self.requests_total = 0
+        self.timeouts_total = 0
+        self.errors_total = 0
+
+    def get_client(self, api_key: str) -> TavilyClient:
+        """获取指定API密钥的客户端，按最近使用淘汰"""
+        client = self._clients.get(api_key)
+        if client is None:
+            client = TavilyClient(api_key=api_key)
+            self._clients[api_key] = client
+            while len(self._clients) > self.client_cache_size:
+                self._clients.popitem(last=False)
+        else:
+            self._clients.move_to_end(api_key)
+        return client
+
+    async def call(self, api_key: str, method: str, timeout: Optional[float] = None, **kwargs) -> Any:
+        """在线程池中调用客户端方法
+
+        Args:
+            api_key: Tavily API密钥
+            method: 客户端方法名，如 search、qna_search、get_search_context
+            timeout: 超时时间（秒），包括排队时间，默认使用配置
+            **kwargs: 传给客户端方法的参数
+        """
+        client = self.get_client(api_key)
+        func = getattr(client, method)
+        loop = asyncio.get_running_loop()
+
+        async def run():
+            async with self._semaphore:
+                self.in_flight += 1
+                try:
+                    return await loop.run_in_executor(self._executor, lambda: func(**kwargs))
+                finally:
+                    self.in_flight -= 1
+
+        self.requests_total += 1
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            return await asyncio.wait_for(run(), timeout or self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts_total += 1
+            outcome = "timeout"
+            raise
+        except Exception:
+            self.errors_total += 1
+            outcome = "error"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            tavily_call_seconds.observe(elapsed, method=method, outcome=outcome)
+            record_span("tavily", elapsed, method=method, outcome=outcome)
+
+    async def search(self, api_key: str, **kwargs) -> Dict[str, Any]:
+        return await self.call(api_key, "search", **kwargs)
+
+    def close(self) -> None:
+        """关闭线程池，应用退出时调用"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "in_flight": self.in_flight,
+            "requests_total": self.requests_total,
+            "timeouts_total": self.timeouts_total,
+            "errors_total": self.errors_total,
+            "cached_clients": len(self._clients)
+        }
+
+# 全局 Tavily 请求池
+tavily_pool = TavilyPool(
+    TAVILY_CONFIG["MAX_WORKERS"],
+    TAVILY_CONFIG["MAX_CONCURRENT"],
+    TAVILY_CONFIG["TIMEOUT"],
+    TAVILY_CONFIG["CLIENT_CACHE_SIZE"]
+)
+
+TAVILY_SETTING_KEYS = ("tavily_api_key", "tavily_search_depth", "tavily_include_domains", "tavily_exclude_domains")
+
+async def get_user_tavily_settings(db: Database, username: str) -> Dict[str, str]:
+    """一次查询获取用户的全部Tavily设置"""
+    rows = await db.fetch_all(
+        f"""
+        SELECT key, value FROM settings
+        WHERE user_id = ? AND key IN ({", ".join("?" for _ in TAVILY_SETTING_KEYS)})
+        """,
+        (username, *TAVILY_SETTING_KEYS)
+    )
+    return {row["key"]: row["value"] for row in rows if row["value"]}
+
+async def resolve_api_key(db: Database, username: str) -> Optional[str]:
+    """优先使用用户的API密钥，其次使用全局API密钥"""
+    settings = await get_user_tavily_settings(db, username)
+    return settings.get("tavily_api_key") or TAVILY_API_KEY or None
 
 # 定义请求模型
 class TavilySettings(BaseModel):
@@ -119,8 +229,6 @@ async def update_tavily_settings(
     """
     更新Tavily API设置
     """
-    global TAVILY_API_KEY, tavily_client
-    
     try:
         # 如果提供了API密钥，直接保存，不进行验证
         if settings.api_key is not None:
@@ -134,15 +242,6 @@ async def update_tavily_settings(
                     ("tavily_api_key", settings.api_key, current_user["username"])
                 )
                 
-                # 更新全局变量
-                global TAVILY_API_KEY, tavily_client
-                TAVILY_API_KEY = settings.api_key
-                try:
-                    tavily_client = TavilyClient(api_key=TAVILY_API_KEY)
-                    logging.info("已更新Tavily客户端实例")
-                except Exception as e:
-                    logging.warning(f"创建Tavily客户端实例失败: {str(e)}")
-                
                 logging.info(f"已保存用户 {current_user['username']} 的Tavily API密钥")
             else:
                 # 如果API密钥是空字符串，则清除API密钥
@@ -154,9 +253,6 @@ async def update_tavily_settings(
                     ("tavily_api_key", current_user["username"])
                 )
                 
-                # 更新全局变量
-                TAVILY_API_KEY = None
-                tavily_client = None
                 logging.info(f"已清除用户 {current_user['username']} 的Tavily API密钥")
         
         # 更新搜索深度设置
@@ -228,8 +324,7 @@ async def test_tavily_connection(
         # 测试连接
         try:
             logging.info(f"用户 {current_user['username']} 正在测试Tavily API连接")
-            test_client = TavilyClient(api_key=setting["value"])
-            response = test_client.search("test connection", max_results=1, search_depth="basic")
+            response = await tavily_pool.search(setting["value"], query="test connection", max_results=1, search_depth="basic")
             logging.info(f"用户 {current_user['username']} 的Tavily API连接测试成功")
             return {"status": "success", "message": "Tavily API连接成功", "response": response}
         except Exception as e:
@@ -256,7 +351,7 @@ async def test_tavily_connection(
                 friendly_message = "请求频率过高，请稍后再试"
             elif "invalid topic" in error_message.lower():
                 friendly_message = "无效的主题参数，必须是'general'或'news'"
-            elif "timeout" in error_message.lower():
+            elif error_type == "TimeoutError" or "timeout" in error_message.lower():
                 friendly_message = "API请求超时，请稍后再试"
             elif "internal server error" in error_message.lower() or "500" in error_message:
                 friendly_message = "Tavily服务器内部错误，请稍后再试"
@@ -324,7 +419,8 @@ async def search(
     include_answer: bool = True,
     include_domains: Optional[str] = None,
     exclude_domains: Optional[str] = None,
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    db: Database = Depends(get_db)
 ) -> Dict[str, Any]:
     """
     执行Tavily搜索
@@ -340,10 +436,11 @@ async def search(
     Returns:
         搜索结果
     """
-    if not tavily_client:
+    api_key = await resolve_api_key(db, current_user["username"])
+    if not api_key:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Tavily搜索服务未配置，请设置TAVILY_API_KEY环境变量"
+            detail="Tavily搜索服务未配置，请设置Tavily API密钥或TAVILY_API_KEY环境变量"
         )
     
     if not query:
@@ -354,7 +451,8 @@ async def search(
     
     try:
         # 执行搜索
-        response = tavily_client.search(
+        response = await tavily_pool.search(
+            api_key,
             query=query,
             search_depth=search_depth,
             max_results=max_results,
@@ -377,7 +475,8 @@ async def search_context(
     search_depth: str = "basic",
     include_domains: Optional[str] = None,
     exclude_domains: Optional[str] = None,
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    db: Database = Depends(get_db)
 ) -> Dict[str, Any]:
     """
     获取搜索上下文，适用于RAG应用
@@ -391,10 +490,11 @@ async def search_context(
     Returns:
         搜索上下文
     """
-    if not tavily_client:
+    api_key = await resolve_api_key(db, current_user["username"])
+    if not api_key:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Tavily搜索服务未配置，请设置TAVILY_API_KEY环境变量"
+            detail="Tavily搜索服务未配置，请设置Tavily API密钥或TAVILY_API_KEY环境变量"
         )
     
     if not query:
@@ -405,7 +505,9 @@ async def search_context(
     
     try:
         # 获取搜索上下文
-        context = tavily_client.get_search_context(
+        context = await tavily_pool.call(
+            api_key,
+            "get_search_context",
             query=query,
             search_depth=search_depth,
             include_domains=include_domains,
@@ -426,7 +528,8 @@ async def qna_search(
     search_depth: str = "basic",
     include_domains: Optional[str] = None,
     exclude_domains: Optional[str] = None,
-    current_user: Dict[str, Any] = Depends(get_current_user)
+    current_user: Dict[str, Any] = Depends(get_current_user),
+    db: Database = Depends(get_db)
 ) -> Dict[str, Any]:
     """
     问答搜索，直接返回问题的答案
@@ -440,10 +543,11 @@ async def qna_search(
     Returns:
         问题的答案
     """
-    if not tavily_client:
+    api_key = await resolve_api_key(db, current_user["username"])
+    if not api_key:
         raise HTTPException(
             status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-            detail="Tavily搜索服务未配置，请设置TAVILY_API_KEY环境变量"
+            detail="Tavily搜索服务未配置，请设置Tavily API密钥或TAVILY_API_KEY环境变量"
         )
     
     if not query:
@@ -454,7 +558,9 @@ async def qna_search(
     
     try:
         # 执行问答搜索
-        response = tavily_client.qna_search(
+        response = await tavily_pool.call(
+            api_key,
+            "qna_search",
             query=query,
             search_depth=search_depth,
             include_domains=include_domains,
@@ -469,10 +575,57 @@ async def qna_search(
             detail=f"问答搜索失败: {str(e)}"
         )
 
+# 请求池状态
+@router.get("/pool")
+async def get_pool_status(
+    current_user: Dict[str, Any] = Depends(get_current_user)
+) -> Dict[str, Any]:
+    """
+    获取Tavily请求池的状态
+    """
+    return tavily_pool.snapshot()
+
+# 搜索结果缓存状态
+@router.get("/cache")
+async def get_cache_status(
+    current_user: Dict[str, Any] = Depends(get_current_user)
+) -> Dict[str, Any]:
+    """
+    获取搜索结果缓存的状态
+    """
+    try:
+        return await search_cache.snapshot()
+    except Exception as e:
+        logging.error(f"获取搜索缓存状态失败: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"获取搜索缓存状态失败: {str(e)}"
+        )
+
+# 清空搜索结果缓存
+@router.delete("/cache")
+async def clear_cache(
+    current_user: Dict[str, Any] = Depends(get_current_user)
+) -> Dict[str, Any]:
+    """
+    清空搜索结果缓存，按用户隔离时只清空当前用户的缓存
+    """
+    try:
+        deleted = await search_cache.clear(current_user["username"])
+        return {"status": "success", "deleted": deleted}
+    except Exception as e:
+        logging.error(f"清空搜索缓存失败: {str(e)}")
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"清空搜索缓存失败: {str(e)}"
+        )
+
 # 为消息处理提供的网页搜索函数
 async def search_web(query: str, search_depth: str = None, max_results: int = 5, include_domains: Optional[str] = None, exclude_domains: Optional[str] = None, username: str = None) -> Dict[str, Any]:
     """
     执行网页搜索，供消息处理使用
+
+    搜索在 Tavily 请求池中执行，不会阻塞事件循环。
     
     Args:
         query: 搜索查询
@@ -485,125 +638,62 @@ async def search_web(query: str, search_depth: str = None, max_results: int = 5,
     Returns:
         搜索结果
     """
-    global tavily_client, TAVILY_API_KEY
     user_api_key = None
     
-    # 如果未提供搜索深度或域名过滤，且提供了用户名，则尝试从数据库获取用户设置
+    # 如果提供了用户名，则从数据库获取用户设置，未显式提供的参数使用用户设置
     if username:
         try:
             # 获取数据库连接
             db = await get_db().__anext__()
+            settings = await get_user_tavily_settings(db, username)
             
-            # 获取API密钥
-            api_key_setting = await db.fetch_one(
-                """
-                SELECT value FROM settings
-                WHERE key = 'tavily_api_key' AND user_id = ?
-                """,
-                (username,)
-            )
-            
-            if api_key_setting and api_key_setting["value"]:
-                user_api_key = api_key_setting["value"]
-                logging.info(f"从数据库获取到用户 {username} 的API密钥")
+            user_api_key = settings.get("tavily_api_key")
+            if user_api_key:
+                logging.debug(f"从数据库获取到用户 {username} 的API密钥")
             
-            # 如果未提供搜索深度，则获取用户设置的搜索深度
             if search_depth is None:
-                search_depth_setting = await db.fetch_one(
-                    """
-                    SELECT value FROM settings
-                    WHERE key = 'tavily_search_depth' AND user_id = ?
-                    """,
-                    (username,)
-                )
-                search_depth = search_depth_setting["value"] if search_depth_setting else "basic"
-            
-            # 如果未提供包含域名，则获取用户设置的包含域名
-            if include_domains is None:
-                include_domains_setting = await db.fetch_one(
-                    """
-                    SELECT value FROM settings
-                    WHERE key = 'tavily_include_domains' AND user_id = ?
-                    """,
-                    (username,)
-                )
-                include_domains = include_domains_setting["value"].split(",") if include_domains_setting and include_domains_setting["value"] else None
-            
-            # 如果未提供排除域名，则获取用户设置的排除域名
-            if exclude_domains is None:
-                exclude_domains_setting = await db.fetch_one(
-                    """
-                    SELECT value FROM settings
-                    WHERE key = 'tavily_exclude_domains' AND user_id = ?
-                    """,
-                    (username,)
-                )
-                exclude_domains = exclude_domains_setting["value"].split(",") if exclude_domains_setting and exclude_domains_setting["value"] else None
+                search_depth = settings.get("tavily_search_depth")
+            if include_domains is None and settings.get("tavily_include_domains"):
+                include_domains = settings["tavily_include_domains"].split(",")
+            if exclude_domains is None and settings.get("tavily_exclude_domains"):
+                exclude_domains = settings["tavily_exclude_domains"].split(",")
         except Exception as e:
             logging.error(f"获取用户Tavily设置失败: {str(e)}")
-            # 使用默认值
-            if search_depth is None:
-                search_depth = "basic"
-    elif search_depth is None:
-        # 如果未提供搜索深度且没有用户名，则使用默认值
+    
+    if search_depth is None:
         search_depth = "basic"
     
-    # 尝试使用用户的API密钥
+    # 依次尝试用户的API密钥和环境变量中的API密钥
+    candidates = []
     if user_api_key:
-        try:
-            logging.info(f"尝试使用用户 {username} 的API密钥进行搜索")
-            temp_client = TavilyClient(api_key=user_api_key)
-            response = temp_client.search(
-                query=query,
-                search_depth=search_depth,
-                max_results=max_results,
-                include_domains=include_domains,
-                exclude_domains=exclude_domains
-            )
-            
-            # 如果成功，更新全局客户端
-            TAVILY_API_KEY = user_api_key
-            tavily_client = temp_client
-            logging.info(f"使用用户 {username} 的API密钥搜索成功")
-            
-            return response
-        except Exception as e:
-            logging.error(f"使用用户 {username} 的API密钥搜索失败: {str(e)}")
+        candidates.append(("用户 " + username, user_api_key))
+    if TAVILY_API_KEY and TAVILY_API_KEY != user_api_key:
+        candidates.append(("环境变量", TAVILY_API_KEY))
     
-    # 尝试使用全局客户端
-    if tavily_client:
-        try:
-            logging.info("尝试使用全局客户端进行搜索")
-            # 执行搜索
-            response = tavily_client.search(
-                query=query,
-                search_depth=search_depth,
-                max_results=max_results,
-                include_domains=include_domains,
-                exclude_domains=exclude_domains
-            )
-            logging.info("使用全局客户端搜索成功")
-            return response
-        except Exception as e:
-            logging.error(f"使用全局客户端搜索失败: {str(e)}")
+    if not candidates:
+        logging.warning("未配置有效的Tavily API密钥，无法执行搜索")
+        return {"error": "无法执行搜索，未配置有效的Tavily API密钥"}
     
-    # 如果全局客户端不可用或搜索失败，尝试使用环境变量中的API密钥
-    if API_CONFIG.get("TAVILY_API_KEY"):
-        try:
-            logging.info("尝试使用环境变量中的API密钥进行搜索")
-            temp_client = TavilyClient(api_key=API_CONFIG["TAVILY_API_KEY"])
-            response = temp_client.search(
-                query=query,
-                search_depth=search_depth,
-                max_results=max_results,
-                include_domains=include_domains,
-                exclude_domains=exclude_domains
-            )
-            logging.info("使用环境变量中的API密钥搜索成功")
-            return response
-        except Exception as e:
-            logging.error(f"使用环境变量API密钥搜索失败: {str(e)}")
+    async def run_search() -> Dict[str, Any]:
+        for source, api_key in candidates:
+            try:
+                logging.debug(f"尝试使用{source}的API密钥进行搜索")
+                response = await tavily_pool.search(
+                    api_key,
+                    query=query,
+                    search_depth=search_depth,
+                    max_results=max_results,
+                    include_domains=include_domains,
+                    exclude_domains=exclude_domains
+                )
+                logging.debug(f"使用{source}的API密钥搜索成功")
+                return response
+            except asyncio.TimeoutError:
+                logging.error(f"使用{source}的API密钥搜索超时（{tavily_pool.timeout}秒）")
+            except Exception as e:
+                logging.error(f"使用{source}的API密钥搜索失败: {str(e)}")
+        return {"error": "网页搜索失败或超时，请稍后重试"}
     
-    # 如果所有尝试都失败
-    logging.warning("所有搜索尝试都失败，未配置有效的Tavily API密钥")
-    return {"error": "无法执行搜索，未配置有效的Tavily API密钥"}
+    # 相同的查询和参数优先使用缓存的结果
+    key = search_cache.make_key(query, search_depth, max_results, include_domains, exclude_domains, username)
+    return await search_cache.fetch(key, run_search)
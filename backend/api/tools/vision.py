@@ -0,0 +1,185 @@
+"""
+视觉模型图片预处理 - 在进程池中把图片缩放到模型的原生视觉分辨率
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from pathlib import Path
+from typing import Any, Dict, Optional
+
+from config import VISION_CONFIG
+from tracing import record_span
+from .image_store import ImageStore, image_id_from_handle, image_store
+
+try:
+    from image_worker import preprocess_image
+except ImportError:  # 未安装 Pillow 时直接发送原图
+    preprocess_image = None
+
+class VisionPreprocessor:
+    """视觉请求的图片预处理
+
+    手机照片动辄上千万像素，而视觉模型收到后会立即缩小到几百到一千多像素。
+    这里在发送前先完成解码、按 EXIF 方向旋转、缩放和重新编码，减少 base64 编码和传输的数据量。
+    - 解码和缩放是 CPU 密集的操作，在进程池中执行，不占用事件循环和 GIL
+    - 结果按原图的 SHA-256、目标尺寸和质量缓存在磁盘上，同一张图片在后续轮次中不再重复处理；
+      缓存超过 CACHE_MAX_ENTRIES 条时删除最久未使用的结果
+    - 同一张图片的并发请求只处理一次
+    - 预处理失败或超时时退回发送原图
+    """
+
+    def __init__(self, store: ImageStore, cache_dir: Path, max_workers: int):
+        self.store = store
+        self.cache_dir = Path(cache_dir)
+        self.max_workers = max_workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.processed_total = 0
+        self.cache_hits = 0
+        self.failures_total = 0
+        self.bytes_in_total = 0
+        self.bytes_out_total = 0
+
+    @property
+    def enabled(self) -> bool:
+        return VISION_CONFIG["ENABLED"] and preprocess_image is not None
+
+    def max_side_for(self, model: Optional[str]) -> int:
+        """模型的目标分辨率（最长边），按模型名前缀匹配"""
+        name = (model or "").lower().split("/")[-1]
+        matches = [prefix for prefix in VISION_CONFIG["MODEL_MAX_SIDE"] if name.startswith(prefix.lower())]
+        if matches:
+            return VISION_CONFIG["MODEL_MAX_SIDE"][max(matches, key=len)]
+        return VISION_CONFIG["DEFAULT_MAX_SIDE"]
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # 使用 spawn 启动子进程，避免在已有多个线程（日志、追踪导出）的进程中 fork
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers,
+                mp_context=multiprocessing.get_context("spawn")
+            )
+        return self._executor
+
+    async def prepare(self, value: Any, model: Optional[str]) -> Optional[str]:
+        """返回发给模型的 base64 图片，value 为图片句柄、data URL 或 base64"""
+        if not value or not isinstance(value, str):
+            return None
+        if not self.enabled:
+            return await self.store.resolve(value)
+
+        image_id = image_id_from_handle(value)
+        data = None
+        if image_id is None:
+            # 旧消息中直接保存的 base64 图片
+            encoded = value.split(",", 1)[1] if value.startswith("data:") and "," in value else value
+            try:
+                data = base64.b64decode(encoded, validate=True)
+            except (binascii.Error, ValueError):
+                logging.warning("无法解码消息中的图片数据，按原样发送")
+                return encoded
+            image_id = hashlib.sha256(data).hexdigest()
+        elif not self.store.original_path(image_id).exists():
+            logging.warning(f"图片 {image_id[:12]} 不存在，已从请求中省略")
+            return None
+
+        max_side = self.max_side_for(model)
+        quality = VISION_CONFIG["QUALITY"]
+        target = self.cache_dir / image_id[:2] / f"{image_id}-{max_side}-q{quality}"
+
+        started = time.perf_counter()
+        try:
+            if target.exists():
+                self.cache_hits += 1
+                # 更新访问时间，淘汰时保留最近使用的结果
+                await asyncio.to_thread(os.utime, target)
+            else:
+                await self._process(image_id, data, target, max_side, quality)
+            content = await asyncio.to_thread(target.read_bytes)
+        except Exception as e:
+            self.failures_total += 1
+            logging.warning(f"预处理图片 {image_id[:12]} 失败，发送原图: {e}")
+            return base64.b64encode(data).decode() if data is not None else await self.store.resolve(value)
+        finally:
+            record_span("vision", time.perf_counter() - started, max_side=max_side)
+        return base64.b64encode(content).decode()
+
+    async def _process(self, image_id: str, data: Optional[bytes], target: Path, max_side: int, quality: int) -> None:
+        key = target.name
+        task = self._inflight.get(key)
+        if task is None:
+            # 处理任务不随某个请求取消，同一张图片的并发请求共用一个任务
+            task = asyncio.ensure_future(self._run(image_id, data, target, max_side, quality))
+            self._inflight[key] = task
+            task.add_done_callback(lambda done: self._finished(key, done))
+        await asyncio.shield(task)
+
+    def _finished(self, key: str, task: asyncio.Task) -> None:
+        self._inflight.pop(key, None)
+        # 所有请求都已取消时仍然取走异常，避免未获取异常的警告
+        if not task.cancelled():
+            task.exception()
+
+    async def _run(self, image_id: str, data: Optional[bytes], target: Path, max_side: int, quality: int) -> None:
+        source = None if data is not None else str(self.store.original_path(image_id))
+        loop = asyncio.get_running_loop()
+        try:
+            result = await asyncio.wait_for(
+                loop.run_in_executor(self._get_executor(), preprocess_image,
+                                     source, data, str(target), max_side, quality),
+                VISION_CONFIG["TIMEOUT"]
+            )
+        except BrokenProcessPool:
+            # 工作进程异常退出（如内存不足被杀），下次请求时重建进程池
+            self._executor = None
+            raise
+        self.processed_total += 1
+        self.bytes_in_total += len(data) if data is not None else Path(source).stat().st_size
+        self.bytes_out_total += result["bytes"]
+        logging.debug(f"图片 {image_id[:12]} 预处理完成: {result}")
+        await asyncio.to_thread(self._prune_cache)
+
+    def _prune_cache(self) -> None:
+        """淘汰最久未使用的预处理结果；在线程中运行"""
+        entries = []
+        for path in self.cache_dir.glob("*/*"):
+            if path.name.endswith(".tmp"):
+                continue
+            try:
+                entries.append((path.stat().st_mtime, path))
+            except FileNotFoundError:
+                # 并发的淘汰已经删除
+                continue
+        excess = len(entries) - VISION_CONFIG["CACHE_MAX_ENTRIES"]
+        if excess <= 0:
+            return
+        entries.sort(key=lambda entry: entry[0])
+        for _, old in entries[:excess]:
+            old.unlink(missing_ok=True)
+
+    def close(self) -> None:
+        """关闭进程池，应用退出时调用"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "max_workers": self.max_workers,
+            "processed_total": self.processed_total,
+            "cache_hits": self.cache_hits,
+            "failures_total": self.failures_total,
+            "bytes_in_total": self.bytes_in_total,
+            "bytes_out_total": self.bytes_out_total
+        }
+
+# 全局图片预处理器
+vision_preprocessor = VisionPreprocessor(image_store, VISION_CONFIG["CACHE_DIR"], VISION_CONFIG["MAX_WORKERS"])
@@ -0,0 +1,102 @@
+"""
+NDJSON 解码开销基准测试
+
+比较 Ollama 聊天流在不同解码方式下每秒可处理的 token 数（只测解码开销，不含网络）：
+- stdlib:  line.decode() + json.loads + 每个 token 构造 ChatResponse（原实现）
+- fast:    orjson/msgspec 解析 + 每个 token 构造 ChatResponse
+- lazy:    LazyChunk，只读取 content 字段
+- raw:     透传原始字节，只查看 done 标记
+
+用法（在 backend 目录下）:
+    python -m benchmarks.ndjson_decode --tokens 200000
+"""
+import argparse
+import asyncio
+import json
+import time
+from typing import AsyncIterator, Callable, Dict
+
+from ollama.ndjson import PARSER, LazyChunk, iter_lines, loads, peek_done
+from ollama.types import ChatResponse
+
+def build_stream(tokens: int) -> bytes:
+    """构造与 Ollama /api/chat 相同格式的流式响应"""
+    lines = []
+    for i in range(tokens):
+        lines.append(json.dumps({
+            "model": "llama3:latest",
+            "created_at": "2025-01-01T00:00:00.000000Z",
+            "message": {"role": "assistant", "content": f" token{i % 97}"},
+            "done": False
+        }, separators=(",", ":")))
+    lines.append(json.dumps({
+        "model": "llama3:latest",
+        "created_at": "2025-01-01T00:00:00.000000Z",
+        "message": {"role": "assistant", "content": ""},
+        "done": True,
+        "total_duration": 1, "load_duration": 1, "prompt_eval_count": 10,
+        "prompt_eval_duration": 1, "eval_count": tokens, "eval_duration": 1
+    }, separators=(",", ":")))
+    return ("\n".join(lines) + "\n").encode()
+
+async def chunked(data: bytes, size: int) -> AsyncIterator[bytes]:
+    """按固定大小切分，模拟网络读取到的任意字节块"""
+    for start in range(0, len(data), size):
+        yield data[start:start + size]
+
+async def run_stdlib(data: bytes, size: int) -> int:
+    count = 0
+    async for line in iter_lines(chunked(data, size)):
+        response = ChatResponse(**json.loads(line.decode()))
+        count += len(response.message.content) > 0 if response.message else 0
+    return count
+
+async def run_fast(data: bytes, size: int) -> int:
+    count = 0
+    async for line in iter_lines(chunked(data, size)):
+        response = ChatResponse(**loads(line))
+        count += len(response.message.content) > 0 if response.message else 0
+    return count
+
+async def run_lazy(data: bytes, size: int) -> int:
+    count = 0
+    async for line in iter_lines(chunked(data, size)):
+        count += len(LazyChunk(line).content) > 0
+    return count
+
+async def run_raw(data: bytes, size: int) -> int:
+    count = 0
+    async for line in iter_lines(chunked(data, size)):
+        if peek_done(line):
+            # 只有最后一块需要解析统计信息
+            LazyChunk(line).stats
+        else:
+            count += 1
+    return count
+
+MODES: Dict[str, Callable] = {
+    "stdlib": run_stdlib,
+    "fast": run_fast,
+    "lazy": run_lazy,
+    "raw": run_raw,
+}
+
+async def main(tokens: int, chunk_size: int, repeat: int) -> None:
+    data = build_stream(tokens)
+    print(f"解析器: {PARSER}，token 数: {tokens}，流大小: {len(data) / 1024 / 1024:.2f} MB，块大小: {chunk_size}")
+    print(f"{'模式':<8}{'最佳耗时(s)':>14}{'tokens/s':>16}")
+    for name, runner in MODES.items():
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            await runner(data, chunk_size)
+            best = min(best, time.perf_counter() - start)
+        print(f"{name:<8}{best:>14.4f}{tokens / best:>16,.0f}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NDJSON 解码开销基准测试")
+    parser.add_argument("--tokens", type=int, default=100000, help="模拟的 token 数")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="每次读取的字节数")
+    parser.add_argument("--repeat", type=int, default=3, help="每种模式重复次数，取最佳值")
+    args = parser.parse_args()
+    asyncio.run(main(args.tokens, args.chunk_size, args.repeat))
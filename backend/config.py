@@ -3,7 +3,7 @@ import sys
 from pathlib import Path
 from typing import Dict, Any
 from dotenv import load_dotenv
-from data_path import get_user_data_dir, get_models_dir, get_prompts_dir, get_chat_history_dir
+from data_path import get_user_data_dir, get_models_dir, get_prompts_dir, get_chat_history_dir, get_logs_dir
 
 # 加载环境变量
 load_dotenv()
@@ -60,6 +60,229 @@ WEBSOCKET_CONFIG = {
     "PING_TIMEOUT": 10,   # 秒
 }
 
+# Ollama 多节点配置
+OLLAMA_NODES_CONFIG = {
+    # 多个节点用逗号分隔，未设置时只使用 OLLAMA_BASE_URL
+    "BASE_URLS": [url for url in os.getenv("OLLAMA_BASE_URLS", "").split(",") if url.strip()] or [API_CONFIG["OLLAMA_BASE_URL"]],
+    "HEALTH_INTERVAL": 10,           # 健康检查间隔（秒）
+    "HEALTH_TIMEOUT": 5,             # 健康检查超时（秒）
+    "FAIL_THRESHOLD": 2,             # 连续失败多少次后标记节点不可用
+    "EWMA_ALPHA": 0.3,               # 首个 token 延迟的平滑系数
+    "HEDGE_ENABLED": os.getenv("OLLAMA_HEDGE_REQUESTS", "false").lower() in ("true", "1", "yes"),
+    "HEDGE_DELAY": 3.0,              # 主节点超过多少秒没有返回首个 token 时发起对冲请求
+}
+
+# Ollama 连接池配置
+OLLAMA_TRANSPORT_CONFIG = {
+    "LIMIT": 100,                    # 连接池的最大连接数
+    "LIMIT_PER_HOST": 32,            # 每个主机的最大连接数
+    "KEEPALIVE_TIMEOUT": 60,         # 空闲连接的保留时间（秒）
+    "DNS_CACHE_TTL": 300,            # DNS 缓存时间（秒）
+    "CONNECT_TIMEOUT": 60.0,         # 连接超时（秒）
+    "SOCK_READ_TIMEOUT": 1800.0,     # 套接字读取超时（秒），长时间下载和生成时不会断开
+    "UNIX_SOCKET": os.getenv("OLLAMA_UNIX_SOCKET") or None,  # 同机部署时通过 Unix 域套接字连接
+}
+
+# 生成任务配置
+GENERATION_CONFIG = {
+    "CHECKPOINT_INTERVAL": 2.0,      # 部分回复写入数据库的间隔（秒）
+    "SUBSCRIBER_QUEUE_SIZE": 256,    # 每个订阅者的待发送帧上限，积压超出时改为从当前内容整体补发
+    "RETENTION_SECONDS": 300,        # 生成结束后在内存中保留的时间（秒），供重连获取结尾
+    "DETACH_GRACE_SECONDS": 30,      # 没有任何客户端订阅时，等待重连的时间（秒），超时后取消上游请求
+    "DEADLINE_SECONDS": 900,         # 单次生成的最长时间（秒），客户端可请求更短的期限
+    "MAX_COMPARE_MODELS": 4,         # 对比模式下同时生成的最大模型数
+}
+
+# 请求调度配置
+SCHEDULER_CONFIG = {
+    "MAX_QUEUE_LENGTH": 64,          # 等待队列的最大长度，超出时拒绝新请求
+    "MAX_QUEUE_PER_USER": 8,         # 单个用户最多排队的请求数
+    "WAIT_BUCKETS": [0.01, 0.05, 0.1, 0.5, 1, 2, 5, 10, 30, 60, 120],  # 等待时间直方图分桶（秒）
+}
+
+# 模型驻留配置
+RESIDENCY_CONFIG = {
+    "RAM_BUDGET_GB": float(os.getenv("KUNLAB_MODEL_RAM_BUDGET_GB", "0")) or None,  # 模型可用的内存预算，未设置时按比例计算
+    "RAM_BUDGET_RATIO": 0.6,         # 未设置预算时，占系统总内存的比例
+    "POLICY": "lru",                 # 淘汰策略：lru 或 lfu
+    "POLL_INTERVAL": 15,             # 轮询 /api/ps 的间隔（秒）
+    "DEFAULT_KEEP_ALIVE": "5m",      # 普通模型请求后的保留时间
+    "PIN_KEEP_ALIVE": "2h",          # 热点模型请求后的保留时间
+    "HOT_MIN_USES": 3,               # 在统计窗口内至少使用多少次视为热点模型
+    "HOT_WINDOW_SECONDS": 1800,      # 热点统计窗口（秒）
+}
+
+# 模型预加载配置
+PRELOAD_CONFIG = {
+    "ENABLED": os.getenv("KUNLAB_PRELOAD_MODELS", "true").lower() in ("true", "1", "yes"),
+    "STARTUP_DELAY": 5,              # 启动后等待多久开始预加载（秒）
+    "IDLE_SECONDS": 600,             # 空闲多久后再次预加载（秒）
+    "IDLE_CHECK_INTERVAL": 60,       # 检查空闲的间隔（秒）
+    "LOOKBACK_DAYS": 14,             # 统计最近多少天的对话
+    "HALF_LIFE_HOURS": 48,           # 使用记录的权重半衰期（小时）
+    "MAX_MODELS": 3,                 # 最多预加载的模型数量
+}
+
+# Tavily 搜索配置
+TAVILY_CONFIG = {
+    "MAX_WORKERS": 8,                # 执行同步 Tavily 请求的线程数
+    "MAX_CONCURRENT": 8,             # 同时进行的搜索请求数，超出时排队
+    "TIMEOUT": 20.0,                 # 单次搜索的超时时间（秒），包括排队时间
+    "CLIENT_CACHE_SIZE": 32,         # 按 API 密钥缓存的客户端数量
+}
+
+# 网页搜索结果缓存配置
+SEARCH_CACHE_CONFIG = {
+    "ENABLED": os.getenv("KUNLAB_SEARCH_CACHE", "true").lower() in ("true", "1", "yes"),
+    "TTL_SECONDS": 1800,             # 缓存结果的新鲜期（秒）
+    "STALE_SECONDS": 21600,          # 过期后仍可先返回旧结果、同时在后台刷新的时间（秒），为 0 时关闭
+    "MAX_ENTRIES": 2000,             # 最多缓存的条目数，超出时按最近访问时间淘汰
+    "SCOPE": os.getenv("KUNLAB_SEARCH_CACHE_SCOPE", "shared"),  # shared：所有用户共享；user：按用户隔离
+}
+
+# 网页搜索上下文压缩配置
+SEARCH_CONTEXT_CONFIG = {
+    "TOKEN_BUDGET": int(os.getenv("KUNLAB_SEARCH_TOKEN_BUDGET", "1500")),  # 搜索结果在提示词中的 token 预算
+    "MAX_PASSAGE_CHARS": 500,        # 单个片段的最大字符数
+    "MAX_PASSAGES": 12,              # 最多选入的片段数
+    "DEDUPE_THRESHOLD": 0.7,         # 片段相似度（Jaccard）达到该值时视为重复
+    "BM25_K1": 1.5,
+    "BM25_B": 0.75,
+    "SOURCE_RANK_WEIGHT": 0.5,       # 搜索引擎排名靠前的来源的加分
+}
+
+# 对话滚动摘要配置
+SUMMARY_CONFIG = {
+    "ENABLED": os.getenv("KUNLAB_CONVERSATION_SUMMARY", "false").lower() in ("true", "1", "yes"),
+    "MODEL": os.getenv("KUNLAB_SUMMARY_MODEL") or None,  # 生成摘要的模型，未设置时使用对话的模型
+    "TRIGGER_MESSAGES": 20,          # 对话消息数超过该值后开始生成摘要
+    "KEEP_RECENT": 10,               # 始终原样保留的最近消息数
+    "MIN_BATCH": 6,                  # 至少有多少条消息移出最近窗口时才更新摘要
+    "MAX_MESSAGE_CHARS": 2000,       # 生成摘要时单条消息的最大字符数
+    "MAX_TOKENS": 512,               # 摘要的最大 token 数
+    "TEMPERATURE": 0.2,
+}
+
+# 提示词组装配置
+PROMPT_CONFIG = {
+    # 前缀稳定模式：固定的系统前导、易变的上下文放在末尾、历史窗口按块滑动，以便 Ollama 复用 KV 缓存
+    "PREFIX_STABLE": os.getenv("KUNLAB_PREFIX_STABLE_PROMPT", "true").lower() in ("true", "1", "yes"),
+    "HISTORY_BLOCK": 8,              # 历史窗口每次滑动的消息数
+    "PROMPT_TOKEN_BUCKETS": [128, 256, 512, 1024, 2048, 4096, 8192, 16384],  # 提示词评估 token 数直方图分桶
+}
+
+# 批量推理任务配置
+BATCH_CONFIG = {
+    "MAX_WORKERS": int(os.getenv("KUNLAB_BATCH_WORKERS", "0")) or None,  # 同时处理的条目数，未设置时为调度器槽位数减一，为交互式聊天保留一个槽位
+    "MAX_PROMPTS": 1000,             # 单个任务最多的提示词数
+    "MAX_ATTEMPTS": 2,               # 单个条目生成失败时的最多尝试次数
+    "QUEUE_RETRY_DELAY": 2.0,        # 调度队列已满时重试的间隔（秒）
+    "SSE_KEEPALIVE": 15,             # 进度事件流的保活间隔（秒）
+    "RESULTS_PAGE_SIZE": 200,        # 下载结果时每次从数据库读取的条目数
+}
+
+# 生成统计配置
+ANALYTICS_CONFIG = {
+    "ENABLED": os.getenv("KUNLAB_GENERATION_STATS", "true").lower() in ("true", "1", "yes"),
+    "HOURLY_RETENTION_DAYS": 30,     # 按小时汇总的数据保留天数，按天汇总的数据一直保留
+    "TTFT_BUCKETS_MS": [100, 250, 500, 1000, 2000, 5000, 10000, 30000, 60000],            # 首 token 延迟分桶（毫秒）
+    "LATENCY_BUCKETS_MS": [1000, 2000, 5000, 10000, 20000, 30000, 60000, 120000, 300000],  # 总耗时分桶（毫秒）
+    "TPS_BUCKETS": [1, 2, 5, 10, 15, 20, 30, 40, 60, 80, 120, 200],                       # 生成速度分桶（tokens/s）
+}
+
+# 指标接口配置
+METRICS_CONFIG = {
+    "ENABLED": os.getenv("KUNLAB_METRICS", "true").lower() in ("true", "1", "yes"),
+    # 运维接口（/metrics、/logging）的访问令牌：设置后所有请求都必须携带 Authorization: Bearer <令牌>，未设置时只允许本机访问
+    "TOKEN": os.getenv("KUNLAB_OPS_TOKEN", ""),
+}
+
+# 请求追踪配置
+TRACING_CONFIG = {
+    "ENABLED": os.getenv("KUNLAB_TRACING", "true").lower() in ("true", "1", "yes"),  # 记录各阶段耗时，返回 Server-Timing 头和 timing 帧
+    "SAMPLE_RATE": float(os.getenv("KUNLAB_TRACE_SAMPLE_RATE", "0")),  # 导出到 JSONL 文件的追踪比例，为 0 时只导出慢请求
+    "SLOW_TRACE_MS": int(os.getenv("KUNLAB_SLOW_TRACE_MS", "0")),      # 超过该耗时（毫秒）的追踪总是导出，为 0 时关闭
+    "EXPORT_PATH": os.getenv("KUNLAB_TRACE_FILE") or str(get_logs_dir() / "traces.jsonl"),
+    "MAX_FILE_BYTES": 50 * 1024 * 1024,  # 追踪文件超过该大小时轮转
+    "EXPORT_QUEUE_SIZE": 1000,       # 等待写入的追踪数上限，超出时丢弃
+    "MAX_SPANS": 256,                # 单个追踪最多记录的阶段数
+}
+
+# 日志配置
+LOGGING_CONFIG = {
+    "FORMAT": os.getenv("KUNLAB_LOG_FORMAT", "text").lower(),  # text：原有的文本格式；json：每行一条 JSON
+    "MAX_BYTES": 10 * 1024 * 1024,   # 日志文件超过该大小时轮转
+    "BACKUP_COUNT": 5,               # 保留的轮转文件数
+    "QUEUE_SIZE": 10000,             # 等待写入的日志条数上限，超出时丢弃，不阻塞事件循环
+    # 热点路径的限流（每秒最多条数）和采样（保留比例），只作用于 INFO 及以下级别，按 logger 名称或模块名前缀匹配
+    "RATE_LIMITS": {
+        "database": 20,
+        "message_processor": 20,
+        "websocket_handler": 20,
+        "tavily_search": 10,
+    },
+    "SAMPLE_RATES": {},
+}
+
+# 图片存储配置
+IMAGE_CONFIG = {
+    "STORE_DIR": DATA_DIR / "images",  # 上传的图片按内容哈希保存在该目录
+    "MAX_UPLOAD_MB": 20,             # 单张图片的大小上限
+    "THUMBNAIL_SIZE": 256,           # 历史消息中显示的缩略图最长边（像素）
+    "THUMBNAIL_QUALITY": 80,         # 缩略图的 WebP 质量
+    "CACHE_MAX_AGE": 31536000,       # 图片内容不可变，浏览器可长期缓存（秒）
+    "ALLOWED_FORMATS": ("JPEG", "PNG", "GIF", "WEBP", "BMP"),  # 允许上传的位图格式（按 Pillow 识别的实际格式）
+    "ORPHAN_GRACE_HOURS": 24,        # 上传后超过该时间仍未被任何消息引用的图片会被删除
+    "CLEANUP_INTERVAL": 3600,        # 清理未引用图片的最小间隔（秒），在上传图片时触发
+}
+
+# 视觉模型图片预处理配置
+VISION_CONFIG = {
+    "ENABLED": os.getenv("KUNLAB_VISION_PREPROCESS", "true").lower() in ("true", "1", "yes"),
+    "MAX_WORKERS": int(os.getenv("KUNLAB_VISION_WORKERS", "2")),  # 预处理进程数
+    "DEFAULT_MAX_SIDE": int(os.getenv("KUNLAB_VISION_MAX_SIDE", "1024")),  # 未单独配置的模型，图片最长边（像素）
+    # 各模型的原生视觉分辨率（最长边），按模型名前缀匹配，最长的前缀优先
+    "MODEL_MAX_SIDE": {
+        "llava": 672,
+        "bakllava": 672,
+        "llama3.2-vision": 1120,
+        "gemma3": 896,
+        "qwen2.5vl": 1024,
+        "minicpm-v": 1344,
+        "moondream": 378,
+        "granite3.2-vision": 768,
+    },
+    "QUALITY": 85,                   # 重新编码的 JPEG 质量
+    "CACHE_DIR": DATA_DIR / "images" / "vision",  # 预处理结果按原图哈希和目标尺寸缓存
+    "CACHE_MAX_ENTRIES": 1000,       # 缓存的预处理结果数上限，超出时删除最久未使用的
+    "TIMEOUT": 60,                   # 单张图片的预处理超时（秒），超时后发送原图
+}
+
+# 文档转换配置
+DOCUMENT_CONFIG = {
+    "PROCESS_POOL": os.getenv("KUNLAB_DOC_PROCESS_POOL", "true").lower() in ("true", "1", "yes"),  # 关闭时在线程中转换
+    "MAX_WORKERS": int(os.getenv("KUNLAB_DOC_WORKERS", "2")),  # 转换进程数
+    "PRELOAD": os.getenv("KUNLAB_DOC_PRELOAD", "true").lower() in ("true", "1", "yes"),  # 启动时预先加载转换进程
+    "MAX_UPLOAD_MB": 100,            # 单个文档的大小上限
+    "SPOOL_MAX_MB": 8,               # 不超过该大小的文档在内存中传给转换进程，更大的写入临时文件
+    "TIMEOUT": 300,                  # 单个文档的转换超时（秒）
+    "CACHE_DIR": DATA_DIR / "documents" / "cache",  # 转换结果按文件内容的 SHA-256 缓存
+    "CACHE_MAX_ENTRIES": 500,        # 缓存的转换结果数上限，超出时删除最久未使用的
+    "BATCH_MAX_FILES": 10,           # 批量转换接口一次最多上传的文件数
+    "PAGES_PER_CHUNK": 10,           # 渐进式转换时 PDF 每段的页数
+    "ATTACHMENT_DIR": DATA_DIR / "documents" / "attachments",  # 渐进式转换的结果，聊天消息通过附件 ID 引用
+    "SSE_KEEPALIVE": 15,             # 渐进式转换的 SSE 保活间隔（秒）
+}
+
+# 模型导入配置
+MODEL_IMPORT_CONFIG = {
+    "CHUNK_MB": 8,                   # 计算摘要和上传时每次读取的块大小，内存占用与文件大小无关
+    "UPLOAD_RETRIES": 3,             # 上传中断后的重试次数，重试前先检查 blob 是否已上传完成
+    "PROGRESS_INTERVAL": 0.5,        # 进度事件的最小间隔（秒）
+    "DIGEST_CACHE_SIZE": 32,         # 按路径、大小和修改时间缓存的文件摘要数，重复导入时不再重新计算
+    "RETENTION_SECONDS": 300,        # 导入结束后任务在内存中保留的时间（秒），供重新订阅获取结果
+}
+
 # 文件存储配置
 STORAGE_CONFIG = {
     "MAX_HISTORY_SIZE": 1000,  # 每个用户最大历史记录数
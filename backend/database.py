@@ -4,12 +4,13 @@ from pathlib import Path
 import json
 from typing import Optional, Any, Dict, List
 import logging
+import time
 import uuid
 from datetime import datetime
 from data_path import get_db_path
+from metrics import db_query_seconds
+from tracing import span
 
-# 配置日志
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 # 获取应用基础路径
@@ -32,6 +33,17 @@ DATA_DIR.mkdir(exist_ok=True)
 # 数据库文件路径
 DB_PATH = get_db_path()
 
+# 指标中区分的语句类型
+QUERY_OPERATIONS = ("SELECT", "INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "PRAGMA")
+
+def _operation(query: str) -> str:
+    """SQL 语句的类型，用作查询耗时指标的标签"""
+    keyword = query.lstrip()[:7].upper()
+    for operation in QUERY_OPERATIONS:
+        if keyword.startswith(operation):
+            return operation.lower()
+    return "other"
+
 class Database:
     def __init__(self, db_path: Path = DB_PATH):
         self.db_path = db_path
@@ -151,6 +163,20 @@ class Database:
                     )
                 """)
                 
+                # 对话滚动摘要字段
+                for column, definition in (
+                    ("summary", "TEXT"),
+                    ("summary_upto", "INTEGER DEFAULT 0"),
+                    ("summary_updated_at", "TIMESTAMP")
+                ):
+                    try:
+                        await self._connection.execute(f"ALTER TABLE conversations ADD COLUMN {column} {definition}")
+                        await self._connection.commit()
+                        logger.info(f"Added {column} column to conversations table")
+                    except Exception as e:
+                        if "duplicate column name" not in str(e).lower():
+                            logger.warning(f"Error adding {column} column: {str(e)}")
+                
                 # 创建messages表
                 await self._connection.execute("""
                     CREATE TABLE IF NOT EXISTS messages (
@@ -178,6 +204,17 @@ class Database:
                     else:
                         logger.info("Document column already exists")
                 
+                # 检查 model 字段是否存在，如果不存在则添加（记录生成助手回复的模型）
+                try:
+                    await self._connection.execute("""
+                        ALTER TABLE messages ADD COLUMN model TEXT
+                    """)
+                    await self._connection.commit()
+                    logger.info("Added model column to messages table")
+                except Exception as e:
+                    if "duplicate column name" not in str(e).lower():
+                        logger.warning(f"Error adding model column: {str(e)}")
+                
                 # 创建models表
                 await self._connection.execute("""
                     CREATE TABLE IF NOT EXISTS models (
@@ -252,6 +289,136 @@ class Database:
                     )
                 """)
                 
+                # 创建网页搜索结果缓存表
+                await self._connection.execute("""
+                    CREATE TABLE IF NOT EXISTS search_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        scope TEXT NOT NULL DEFAULT '',    -- 按用户隔离时为用户名，共享时为空
+                        query TEXT NOT NULL,               -- 规范化后的查询
+                        params TEXT,                       -- 搜索深度、域名过滤等参数（JSON）
+                        response TEXT NOT NULL,            -- Tavily 返回的结果（JSON）
+                        created_at REAL NOT NULL,          -- 写入时间（Unix 时间戳）
+                        last_access REAL NOT NULL,         -- 最近访问时间，用于 LRU 淘汰
+                        hits INTEGER DEFAULT 0
+                    )
+                """)
+                await self._connection.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_search_cache_last_access ON search_cache(last_access)
+                """)
+
+                # 创建批量推理任务表
+                await self._connection.execute("""
+                    CREATE TABLE IF NOT EXISTS batch_jobs (
+                        id TEXT PRIMARY KEY,
+                        user_id TEXT NOT NULL,
+                        model TEXT NOT NULL,
+                        system_prompt TEXT,
+                        options TEXT,                      -- 生成参数（JSON）
+                        status TEXT NOT NULL DEFAULT 'queued',  -- queued / running / completed / cancelled / failed
+                        error TEXT,                        -- 任务异常中止时的错误信息
+                        total INTEGER NOT NULL DEFAULT 0,
+                        completed INTEGER NOT NULL DEFAULT 0,
+                        failed INTEGER NOT NULL DEFAULT 0,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        finished_at TIMESTAMP,
+                        FOREIGN KEY (user_id) REFERENCES users(username) ON DELETE CASCADE
+                    )
+                """)
+                try:
+                    await self._connection.execute("ALTER TABLE batch_jobs ADD COLUMN error TEXT")
+                    await self._connection.commit()
+                    logger.info("Added error column to batch_jobs table")
+                except Exception as e:
+                    if "duplicate column name" not in str(e).lower():
+                        logger.warning(f"Error adding error column: {str(e)}")
+                await self._connection.execute("""
+                    CREATE TABLE IF NOT EXISTS batch_items (
+                        job_id TEXT NOT NULL,
+                        idx INTEGER NOT NULL,
+                        prompt TEXT NOT NULL,
+                        status TEXT NOT NULL DEFAULT 'pending',  -- pending / running / done / error
+                        response TEXT,
+                        error TEXT,
+                        attempts INTEGER NOT NULL DEFAULT 0,
+                        prompt_eval_count INTEGER,
+                        eval_count INTEGER,
+                        duration REAL,                     -- 生成耗时（秒）
+                        updated_at TIMESTAMP,
+                        PRIMARY KEY (job_id, idx),
+                        FOREIGN KEY (job_id) REFERENCES batch_jobs(id) ON DELETE CASCADE
+                    )
+                """)
+                await self._connection.execute("""
+                    CREATE INDEX IF NOT EXISTS idx_batch_items_status ON batch_items(job_id, status)
+                """)
+
+                # 创建消息生成统计表（时间单位为毫秒）
+                await self._connection.execute("""
+                    CREATE TABLE IF NOT EXISTS message_stats (
+                        message_id INTEGER PRIMARY KEY,
+                        conversation_id TEXT,
+                        user_id TEXT NOT NULL,
+                        model TEXT NOT NULL,
+                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                        total_ms INTEGER,                  -- Ollama 报告的总耗时
+                        load_ms INTEGER,                   -- 模型加载耗时
+                        queue_ms INTEGER,                  -- 调度器排队时间
+                        ttft_ms INTEGER,                   -- 服务端首 token 延迟
+                        prompt_tokens INTEGER,
+                        prompt_eval_ms INTEGER,
+                        eval_tokens INTEGER,
+                        eval_ms INTEGER,
+                        FOREIGN KEY (message_id) REFERENCES messages(id) ON DELETE CASCADE
+                    )
+                """)
+
+                # 创建按小时和按天汇总的生成统计表
+                for table in ("stats_hourly", "stats_daily"):
+                    await self._connection.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {table} (
+                            bucket TEXT NOT NULL,              -- 小时：YYYY-MM-DDTHH，天：YYYY-MM-DD
+                            user_id TEXT NOT NULL,
+                            model TEXT NOT NULL,
+                            requests INTEGER NOT NULL DEFAULT 0,
+                            prompt_tokens INTEGER NOT NULL DEFAULT 0,
+                            eval_tokens INTEGER NOT NULL DEFAULT 0,
+                            prompt_eval_ms INTEGER NOT NULL DEFAULT 0,
+                            eval_ms INTEGER NOT NULL DEFAULT 0,
+                            total_ms INTEGER NOT NULL DEFAULT 0,
+                            load_ms INTEGER NOT NULL DEFAULT 0,
+                            queue_ms INTEGER NOT NULL DEFAULT 0,
+                            ttft_ms INTEGER NOT NULL DEFAULT 0,
+                            ttft_hist TEXT,                    -- 首 token 延迟直方图（JSON 计数数组）
+                            latency_hist TEXT,                 -- 总耗时直方图
+                            tps_hist TEXT,                     -- 生成速度直方图
+                            PRIMARY KEY (bucket, user_id, model)
+                        )
+                    """)
+
+                # 创建图片元数据表，图片文件按内容哈希保存在图片存储目录中
+                await self._connection.execute("""
+                    CREATE TABLE IF NOT EXISTS images (
+                        id TEXT PRIMARY KEY,               -- 图片内容的 SHA-256
+                        content_type TEXT,
+                        size INTEGER NOT NULL,
+                        width INTEGER,
+                        height INTEGER,
+                        created_at TEXT NOT NULL           -- 最近一次上传的时间，未被消息引用的图片按此清理
+                    )
+                """)
+                # 上传过图片的用户，相同内容的图片只保存一份，可以有多个上传者
+                await self._connection.execute("""
+                    CREATE TABLE IF NOT EXISTS image_owners (
+                        image_id TEXT NOT NULL,
+                        user_id TEXT NOT NULL,
+                        created_at TEXT NOT NULL,
+                        PRIMARY KEY (image_id, user_id),
+                        FOREIGN KEY (image_id) REFERENCES images(id) ON DELETE CASCADE,
+                        FOREIGN KEY (user_id) REFERENCES users(username) ON DELETE CASCADE
+                    )
+                """)
+
                 # 为笔记表创建更新时间触发器
                 await self._connection.execute("""
                     CREATE TRIGGER IF NOT EXISTS update_notes_timestamp 
@@ -287,8 +454,13 @@ class Database:
         """执行SQL查询"""
         await self.ensure_connected()
         try:
-            logger.info(f"Executing query: {query} with params: {params}")
-            return await self._connection.execute(query, params)
+            logger.debug(f"Executing query: {query} with params: {params}")
+            operation = _operation(query)
+            started = time.perf_counter()
+            with span("db", operation=operation):
+                cursor = await self._connection.execute(query, params)
+            db_query_seconds.observe(time.perf_counter() - started, operation=operation)
+            return cursor
         except Exception as e:
             logger.error(f"Error executing query: {str(e)}")
             raise
@@ -297,8 +469,12 @@ class Database:
         """执行多个SQL查询"""
         await self.ensure_connected()
         try:
-            logger.info(f"Executing multiple queries: {query} with params: {params_list}")
-            return await self._connection.executemany(query, params_list)
+            logger.debug(f"Executing multiple queries: {query} with params: {params_list}")
+            started = time.perf_counter()
+            with span("db", operation="executemany"):
+                cursor = await self._connection.executemany(query, params_list)
+            db_query_seconds.observe(time.perf_counter() - started, operation="executemany")
+            return cursor
         except Exception as e:
             logger.error(f"Error executing multiple queries: {str(e)}")
             raise
@@ -363,9 +539,12 @@ class Database:
         await self.ensure_connected()
         try:
             if self._connection:
-                logger.info("Committing transaction")
-                await self._connection.commit()
-                logger.info("Transaction committed")
+                logger.debug("Committing transaction")
+                started = time.perf_counter()
+                with span("db", operation="commit"):
+                    await self._connection.commit()
+                db_query_seconds.observe(time.perf_counter() - started, operation="commit")
+                logger.debug("Transaction committed")
         except Exception as e:
             logger.error(f"Error committing transaction: {str(e)}")
             raise
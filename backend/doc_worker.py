@@ -0,0 +1,54 @@
+"""
+文档转换工作进程
+
+在进程池中运行，进程启动时预先加载 MarkItDown（包括 magika 文件类型识别模型），
+之后的每次转换都不再重复初始化。
+"""
+import io
+import os
+from typing import Optional
+
+from markitdown import MarkItDown, StreamInfo
+
+_md: Optional[MarkItDown] = None
+
+def init_worker() -> None:
+    """进程池的 initializer，预先加载转换器"""
+    global _md
+    if _md is None:
+        _md = MarkItDown()
+
+def ping() -> int:
+    """用于启动时预热工作进程"""
+    init_worker()
+    return os.getpid()
+
+def convert_document(path: Optional[str], data: Optional[bytes], filename: str) -> str:
+    """把文档转换为 Markdown 文本
+
+    path 为临时文件路径，data 为文件内容（较小的文件直接在内存中传递），二者取其一。
+    """
+    init_worker()
+    extension = os.path.splitext(filename)[1].lower() or None
+    stream_info = StreamInfo(extension=extension, filename=filename)
+    if path is not None:
+        result = _md.convert_local(path, stream_info=stream_info)
+    else:
+        result = _md.convert_stream(io.BytesIO(data), stream_info=stream_info)
+    return result.text_content
+
+def count_pdf_pages(path: str) -> int:
+    """PDF 的页数，只解析页面树，不做版面分析"""
+    from pdfminer.pdfpage import PDFPage
+
+    with open(path, "rb") as f:
+        return sum(1 for _ in PDFPage.get_pages(f))
+
+def convert_pdf_pages(path: str, start: int, end: int) -> str:
+    """提取 PDF 第 start 到 end - 1 页（从 0 开始）的文本
+
+    与 MarkItDown 的 PDF 转换一样使用 pdfminer，只对指定的页做版面分析。
+    """
+    from pdfminer.high_level import extract_text
+
+    return extract_text(path, page_numbers=range(start, end))
@@ -0,0 +1,61 @@
+"""
+图片预处理工作进程
+
+在进程池中运行，只依赖 Pillow，避免子进程导入整个后端。
+"""
+import io
+import os
+from typing import Any, Dict, Optional
+
+from PIL import Image, ImageOps
+
+# 不需要缩放和旋转时直接使用原文件的格式
+PASSTHROUGH_FORMATS = ("JPEG", "PNG")
+
+def preprocess_image(source: Optional[str], data: Optional[bytes], target: str,
+                     max_side: int, quality: int) -> Dict[str, Any]:
+    """解码、按 EXIF 方向旋转、缩放到最长边不超过 max_side，并写入 target
+
+    source 为原图路径，data 为原图内容（旧消息中的 base64 图片），二者取其一。
+    """
+    raw = data
+    with Image.open(source if source is not None else io.BytesIO(data)) as img:
+        original_size = img.size
+        original_format = img.format
+        orientation = img.getexif().get(0x0112, 1)
+        needs_resize = max(original_size) > max_side
+
+        if not needs_resize and orientation == 1 and original_format in PASSTHROUGH_FORMATS:
+            # 尺寸已经合适，保留原图避免重复压缩
+            if raw is None:
+                with open(source, "rb") as f:
+                    raw = f.read()
+            _write(target, raw)
+            return {"width": original_size[0], "height": original_size[1], "resized": False, "bytes": len(raw)}
+
+        if needs_resize and original_format == "JPEG":
+            # 让 JPEG 解码器直接按比例缩小解码，大幅减少内存和解码时间
+            img.draft("RGB", (max_side, max_side))
+        image = ImageOps.exif_transpose(img)
+        image.thumbnail((max_side, max_side), Image.LANCZOS)
+
+        if image.mode in ("RGBA", "LA", "PA") or (image.mode == "P" and "transparency" in image.info):
+            # JPEG 不支持透明通道，合成到白色背景上
+            rgba = image.convert("RGBA")
+            image = Image.new("RGB", rgba.size, (255, 255, 255))
+            image.paste(rgba, mask=rgba.getchannel("A"))
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=quality, optimize=True)
+        output = buffer.getvalue()
+        _write(target, output)
+        return {"width": image.size[0], "height": image.size[1], "resized": needs_resize, "bytes": len(output)}
+
+def _write(target: str, content: bytes) -> None:
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    tmp = f"{target}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, target)
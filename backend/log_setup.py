@@ -0,0 +1,221 @@
+import atexit
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple
+
+from config import LOGGING_CONFIG
+from tracing import current_trace
+
+LEVEL_NAMES = ("CRITICAL", "ERROR", "WARNING", "INFO", "DEBUG")
+
+def record_source(record: logging.LogRecord) -> str:
+    """日志来源：具名 logger 使用其名称，直接调用 logging.info 等的模块使用模块名"""
+    return record.module if record.name == "root" else record.name
+
+class HotPathFilter(logging.Filter):
+    """热点路径日志的限流和采样
+
+    只作用于 INFO 及以下级别，警告和错误总是输出。
+    - RATE_LIMITS: {来源: 每秒最多条数}，按令牌桶限流，被省略的条数附加到下一条输出的日志中
+    - SAMPLE_RATES: {来源: 保留比例}，按比例随机保留
+    来源按前缀匹配，如 "api.models" 匹配 "api.models.pull"。
+    """
+
+    def __init__(self, rate_limits: Dict[str, float], sample_rates: Dict[str, float]):
+        super().__init__()
+        self.rate_limits = rate_limits
+        self.sample_rates = sample_rates
+        # 来源 -> [令牌数, 上次补充时间, 被省略的条数]
+        self._buckets: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self.suppressed_total = 0
+
+    @staticmethod
+    def _match(rules: Dict[str, float], source: str) -> Optional[Tuple[str, float]]:
+        for prefix, value in rules.items():
+            if source == prefix or source.startswith(prefix + "."):
+                return prefix, value
+        return None
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno >= logging.WARNING:
+            return True
+        source = record_source(record)
+
+        sample = self._match(self.sample_rates, source)
+        if sample and random.random() >= sample[1]:
+            self.suppressed_total += 1
+            return False
+
+        limit = self._match(self.rate_limits, source)
+        if not limit:
+            return True
+        prefix, rate = limit
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.setdefault(prefix, [rate, now, 0])
+            bucket[0] = min(rate, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                self.suppressed_total += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+class ContextFilter(logging.Filter):
+    """在产生日志的线程中附加追踪 ID，写入由监听线程完成时上下文已经不可用"""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        trace = current_trace()
+        record.trace_id = trace.id if trace is not None else None
+        return True
+
+class JsonFormatter(logging.Formatter):
+    """每条日志输出为一行 JSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry: Dict[str, Any] = {
+            "ts": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "msg": record.getMessage()
+        }
+        if getattr(record, "trace_id", None):
+            entry["trace_id"] = record.trace_id
+        if getattr(record, "suppressed", None):
+            entry["suppressed"] = record.suppressed
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+class TextFormatter(logging.Formatter):
+    """原有的文本格式，被限流省略的条数附加在末尾"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        text = super().format(record)
+        if getattr(record, "suppressed", None):
+            text += f" (此前省略 {record.suppressed} 条)"
+        return text
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """队列已满时直接丢弃日志，不阻塞事件循环"""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped_total = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # 在当前线程合并消息参数并把异常转为文本（参数和异常对象不一定能跨线程安全使用），
+        # 其余格式化留给监听线程中的各个处理器
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = record.exc_text or logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped_total += 1
+
+class LogPipeline:
+    """异步日志管道
+
+    各模块的日志经 QueueHandler 放入内存队列，由监听线程写入按大小轮转的日志文件
+    （以及启用详细日志时的控制台），文件写入不会在事件循环中进行。
+    """
+
+    def __init__(self):
+        self.queue_handler: Optional[NonBlockingQueueHandler] = None
+        self.hot_path_filter: Optional[HotPathFilter] = None
+        self.listener: Optional[logging.handlers.QueueListener] = None
+        self.log_file: Optional[Path] = None
+
+    def setup(self, log_file: Path, level: str = "INFO", verbose: bool = False) -> None:
+        if self.listener is not None:
+            return
+        self.log_file = log_file
+        formatter = JsonFormatter() if LOGGING_CONFIG["FORMAT"] == "json" else TextFormatter(
+            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+        )
+        file_handler = logging.handlers.RotatingFileHandler(
+            log_file,
+            maxBytes=LOGGING_CONFIG["MAX_BYTES"],
+            backupCount=LOGGING_CONFIG["BACKUP_COUNT"],
+            encoding="utf-8"
+        )
+        file_handler.setFormatter(formatter)
+        handlers = [file_handler]
+        if verbose:
+            console_handler = logging.StreamHandler(sys.stderr)
+            console_handler.setFormatter(formatter)
+            handlers.append(console_handler)
+
+        log_queue: queue.Queue = queue.Queue(maxsize=LOGGING_CONFIG["QUEUE_SIZE"])
+        self.queue_handler = NonBlockingQueueHandler(log_queue)
+        self.hot_path_filter = HotPathFilter(LOGGING_CONFIG["RATE_LIMITS"], LOGGING_CONFIG["SAMPLE_RATES"])
+        self.queue_handler.addFilter(self.hot_path_filter)
+        self.queue_handler.addFilter(ContextFilter())
+
+        root = logging.getLogger()
+        # 移除其他地方添加的处理器，所有日志都经过队列
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(getattr(logging, level.upper(), logging.INFO))
+
+        self.listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        self.listener.start()
+        atexit.register(self.stop)
+
+    def stop(self) -> None:
+        """停止监听线程，写完队列中剩余的日志"""
+        if self.listener is not None:
+            self.listener.stop()
+            self.listener = None
+
+    def get_levels(self) -> Dict[str, str]:
+        """根 logger 和已设置级别的具名 logger 的当前级别"""
+        levels = {"root": logging.getLevelName(logging.getLogger().level)}
+        for name, logger in sorted(logging.Logger.manager.loggerDict.items()):
+            if isinstance(logger, logging.Logger) and logger.level != logging.NOTSET:
+                levels[name] = logging.getLevelName(logger.level)
+        return levels
+
+    def set_level(self, name: str, level: str) -> None:
+        """运行时修改 logger 级别，name 为 root 时修改根 logger"""
+        level = level.upper()
+        if level not in LEVEL_NAMES:
+            raise ValueError(f"无效的日志级别: {level}")
+        logger = logging.getLogger() if name in ("", "root") else logging.getLogger(name)
+        logger.setLevel(level)
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "log_file": str(self.log_file) if self.log_file else None,
+            "format": LOGGING_CONFIG["FORMAT"],
+            "queue_depth": self.queue_handler.queue.qsize() if self.queue_handler else 0,
+            "dropped_total": self.queue_handler.dropped_total if self.queue_handler else 0,
+            "suppressed_total": self.hot_path_filter.suppressed_total if self.hot_path_filter else 0,
+            "levels": self.get_levels()
+        }
+
+# 全局日志管道
+log_pipeline = LogPipeline()
@@ -1,14 +1,30 @@
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
 import uvicorn
+import multiprocessing
 import os
 import sys
+import time
 from typing import List
 from api import api_router
+from api.monitoring import router as monitoring_router
 from config import API_CONFIG
 import logging
 from database import db  # 导入数据库实例
+from metrics import http_request_seconds
+from tracing import finish_trace, start_trace
+from log_setup import log_pipeline
+from api.chat.residency import residency_manager
+from api.chat.preloader import model_preloader
+from api.chat.node_registry import node_registry
+from api.chat.batch import batch_manager
+from ollama.transport import ollama_transport
+from api.tools.tavily_search import tavily_pool
+from api.tools.vision import vision_preprocessor
+from api.tools.doc_format import service as document_service
+from api.tools.doc_stream import progressive_converter
+from api.models.import_model import model_importer
 from contextlib import asynccontextmanager
 from ensure_dirs import ensure_directories  # 导入目录确保函数
 from data_path import get_avatars_dir, get_logs_dir  # 导入获取目录函数
@@ -24,14 +40,8 @@ ensure_directories()
 logs_dir = get_logs_dir()
 log_file = logs_dir / "kun-lab_backend.log"
 
-logging.basicConfig(
-    level=getattr(logging, log_level, logging.INFO),
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(log_file),
-        logging.StreamHandler() if verbose_logging else logging.StreamHandler(open(os.devnull, 'w'))
-    ]
-)
+# 日志经队列由后台线程写入按大小轮转的文件，不阻塞事件循环
+log_pipeline.setup(log_file, log_level, verbose_logging)
 
 # 设置uvicorn日志级别
 if not verbose_logging:
@@ -54,8 +64,33 @@ async def lifespan(app: FastAPI):
         # 即使数据库连接失败，应用也会继续启动
         # 后续请求会通过 ensure_connected 尝试重新连接
     
+    # 启动模型驻留状态轮询，并按最近的使用情况预加载模型
+    await node_registry.start()
+    await residency_manager.start()
+    await model_preloader.start()
+    # 恢复重启前未完成的批量推理任务
+    await batch_manager.start()
+    # 在后台预先启动文档转换进程
+    await document_service.start()
+    
     yield
     
+    await batch_manager.stop()
+    await model_preloader.stop()
+    await residency_manager.stop()
+    await node_registry.stop()
+    # 取消进行中的模型导入
+    model_importer.close()
+    # 关闭共享的 Ollama 连接池
+    await ollama_transport.close()
+    # 关闭 Tavily 搜索线程池
+    tavily_pool.close()
+    # 关闭图片预处理进程池
+    vision_preprocessor.close()
+    # 取消进行中的渐进式转换并关闭文档转换进程池
+    progressive_converter.close()
+    document_service.close()
+    
     # 关闭时断开数据库连接
     try:
         await db.disconnect()
@@ -102,9 +137,42 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["GET", "POST", "PUT", "DELETE", "OPTIONS"],
     allow_headers=["Authorization", "Content-Type", "Accept"],
-    expose_headers=["Authorization"],
+    expose_headers=["Authorization", "Server-Timing"],
 )
 
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    """按路由模板记录请求耗时，避免路径参数使标签无限增长"""
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        http_request_seconds.observe(
+            time.perf_counter() - started,
+            method=request.method,
+            route=getattr(route, "path", "unmatched"),
+            status=status
+        )
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    """追踪请求各阶段的耗时，通过 Server-Timing 头返回给客户端"""
+    trace, token = start_trace(f"{request.method} {request.url.path}")
+    try:
+        response = await call_next(request)
+        if trace is not None:
+            # 流式响应在返回响应头时结束追踪，之后的阶段不再计入
+            response.headers["Server-Timing"] = trace.server_timing()
+            route = request.scope.get("route")
+            trace.attrs.update(route=getattr(route, "path", None), status=response.status_code)
+        return response
+    finally:
+        finish_trace(trace, token)
+
 # 创建静态文件目录
 avatars_dir = get_avatars_dir()
 os.makedirs(avatars_dir, exist_ok=True)
@@ -121,6 +189,7 @@ else:
 
 # 包含API路由
 app.include_router(api_router, prefix="/api")  # 添加全局 /api 前缀
+app.include_router(monitoring_router, tags=["monitoring"])  # Prometheus 抓取路径 /metrics
 
 # WebSocket连接管理器
 class ConnectionManager:
@@ -160,6 +229,8 @@ async def websocket_endpoint(websocket: WebSocket):
         manager.disconnect(websocket)
 
 if __name__ == "__main__":
+    # 打包后的应用中启动图片预处理等子进程需要
+    multiprocessing.freeze_support()
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
@@ -0,0 +1,214 @@
+import asyncio
+import bisect
+import logging
+import math
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+# 默认的延迟分桶（秒）
+DEFAULT_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+class Metric:
+    """指标基类，按标签值分别保存样本"""
+
+    type = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, Any] = {}
+
+    def _key(self, labels: Dict[str, Any]) -> Tuple:
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.type}"]
+        lines.extend(self._samples())
+        return lines
+
+    def _samples(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+class Counter(Metric):
+    """只增不减的计数器"""
+
+    type = "counter"
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, value: float, **labels) -> None:
+        """直接设置累计值，用于从已有统计中导出"""
+        self._values[self._key(labels)] = value
+
+class Gauge(Metric):
+    """可增可减的当前值"""
+
+    type = "gauge"
+
+    def set(self, value: float, **labels) -> None:
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount: float = 1, **labels) -> None:
+        self.inc(-amount, **labels)
+
+class Histogram(Metric):
+    """固定分桶的直方图，输出累计分桶计数（le 语义）"""
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Optional[Sequence[float]] = None):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = sorted(buckets or DEFAULT_BUCKETS)
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # [各分桶计数（最后一个为溢出桶）, 总和, 总数]
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        state[0][bisect.bisect_left(self.buckets, value)] += 1
+        state[1] += value
+        state[2] += 1
+
+    def load(self, counts: Sequence[int], total: float, **labels) -> None:
+        """载入已有直方图的分桶计数（非累计），用于从已有统计中导出"""
+        self._values[self._key(labels)] = [list(counts), total, sum(counts)]
+
+    def _samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + [math.inf], counts):
+                cumulative += bucket_count
+                labels = _format_labels(self.labelnames, key, f'le="{_format_value(bound)}"')
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(round(total, 6))}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+Collector = Callable[[], Union[Iterable[Metric], Awaitable[Iterable[Metric]]]]
+
+class MetricsRegistry:
+    """进程内指标注册表，以 Prometheus 文本格式输出
+
+    埋点处直接更新注册的指标；已有的统计（调度器、驻留、节点等）通过采集函数在抓取时导出，
+    不在请求路径上增加开销。
+    """
+
+    def __init__(self):
+        self._metrics: List[Metric] = []
+        self._collectors: List[Collector] = []
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Optional[Sequence[float]] = None) -> Histogram:
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def register_collector(self, collector: Collector) -> None:
+        """注册采集函数，每次抓取时调用，返回临时构造的指标"""
+        self._collectors.append(collector)
+
+    async def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        for collector in self._collectors:
+            try:
+                collected = collector()
+                if asyncio.iscoroutine(collected):
+                    collected = await collected
+                for metric in collected:
+                    lines.extend(metric.render())
+            except Exception as e:
+                logging.warning(f"采集指标失败 {getattr(collector, '__name__', collector)}: {e}")
+        return "\n".join(lines) + "\n"
+
+# 全局指标注册表
+registry = MetricsRegistry()
+
+# 埋点指标
+http_request_seconds = registry.histogram(
+    "kunlab_http_request_duration_seconds", "HTTP 请求耗时（流式响应为返回响应头的时间）",
+    ("method", "route", "status")
+)
+websocket_connections = registry.gauge(
+    "kunlab_websocket_connections", "当前的 WebSocket 连接数", ("endpoint",)
+)
+websocket_streams = registry.gauge(
+    "kunlab_websocket_streams", "当前正在推送的聊天流数", ("endpoint",)
+)
+websocket_streams_total = registry.counter(
+    "kunlab_websocket_streams_total", "累计的聊天流数", ("endpoint",)
+)
+ttft_seconds = registry.histogram(
+    "kunlab_ttft_seconds", "服务端首 token 延迟（包括排队、网页搜索和提示词评估）", ("model",),
+    [0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30, 60]
+)
+inter_token_seconds = registry.histogram(
+    "kunlab_inter_token_seconds", "相邻两个内容块之间的间隔", ("model",),
+    [0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2]
+)
+client_pool_in_use = registry.gauge(
+    "kunlab_client_pool_in_use", "按模型统计正在占用调度槽位的请求数", ("model",)
+)
+model_load_seconds = registry.histogram(
+    "kunlab_model_load_duration_seconds", "客户端池加载模型的耗时", ("model",),
+    [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300]
+)
+ollama_request_seconds = registry.histogram(
+    "kunlab_ollama_request_duration_seconds", "Ollama 请求耗时（流式请求为收到响应头的时间）",
+    ("method", "endpoint")
+)
+ollama_request_errors_total = registry.counter(
+    "kunlab_ollama_request_errors_total", "Ollama 请求失败次数", ("endpoint",)
+)
+db_query_seconds = registry.histogram(
+    "kunlab_db_query_duration_seconds", "数据库语句执行耗时", ("operation",),
+    [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1]
+)
+tavily_call_seconds = registry.histogram(
+    "kunlab_tavily_call_duration_seconds", "Tavily 请求耗时（包括排队时间）", ("method", "outcome"),
+    [0.1, 0.25, 0.5, 1, 2, 3, 5, 10, 20, 30]
+)
+model_pull_bytes_total = registry.counter(
+    "kunlab_model_pull_bytes_total", "拉取模型累计下载的字节数，rate() 即下载速度", ("model",)
+)
+model_import_bytes_total = registry.counter(
+    "kunlab_model_import_bytes_total", "导入模型时按阶段统计处理的字节数（hash 计算摘要，upload 上传）", ("stage",)
+)
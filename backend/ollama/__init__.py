@@ -1,4 +1,5 @@
 from .client import OllamaClient
+from .transport import OllamaTransport, ollama_transport
 from .types import (
     ModelInfo,
     ChatMessage,
@@ -20,6 +21,8 @@ from .types import (
 
 __all__ = [
     "OllamaClient",
+    "OllamaTransport",
+    "ollama_transport",
     "ModelInfo",
     "ChatMessage",
     "ChatRequest",
@@ -1,7 +1,11 @@
 import asyncio
 import json
-from typing import AsyncGenerator, Dict, List, Optional, Union, Any
+import time
+from contextlib import aclosing
+from typing import AsyncGenerator, AsyncIterable, Dict, List, Optional, Union, Any
 import aiohttp
+from multidict import CIMultiDict, CIMultiDictProxy
+from yarl import URL
 from .types import (
     ModelInfo, ChatMessage, ChatRequest, ChatResponse,
     EmbeddingRequest, EmbeddingResponse,
@@ -10,40 +14,51 @@ from .types import (
     ModelCreateRequest, ModelCreateResponse,
     Options
 )
+from .transport import ollama_transport
+from .ndjson import LazyChunk, iter_lines, loads
+from metrics import ollama_request_seconds, ollama_request_errors_total
+from tracing import record_span
 
 class OllamaClient:
+    """Ollama API 客户端
+
+    默认使用进程内共享的传输层（连接池），关闭客户端不会关闭共享连接。
+    """
+
     def __init__(self, base_url: str = "http://localhost:11434"):
         self.base_url = base_url.rstrip("/")
-        self._session: Optional[aiohttp.ClientSession] = None
 
     async def _ensure_session(self) -> aiohttp.ClientSession:
-        if self._session is None or self._session.closed:
-            # 设置较长的超时时间，防止长时间下载过程中断开
-            timeout = aiohttp.ClientTimeout(
-                total=None,  # 禁用总超时
-                connect=60.0,  # 连接超时为60秒
-                sock_connect=60.0,  # 套接字连接超时为60秒
-                sock_read=1800.0  # 套接字读取超时为30分钟
-            )
-            self._session = aiohttp.ClientSession(timeout=timeout)
-        return self._session
+        return await ollama_transport.get_session()
 
     async def close(self):
-        if self._session and not self._session.closed:
-            await self._session.close()
+        # 共享会话由传输层统一管理，在应用退出时关闭
+        pass
 
     async def _request(
         self,
         method: str,
         endpoint: str,
         data: Optional[Dict] = None,
-        stream: bool = False
+        stream: bool = False,
+        raw: bool = False
     ) -> Union[Dict, AsyncGenerator[Dict, None]]:
+        """发送请求
+
+        Args:
+            stream: 按 NDJSON 逐行返回
+            raw: 流式请求时返回每行的原始字节，不做解析
+        """
         session = await self._ensure_session()
         url = f"{self.base_url}/{endpoint}"
+        started = time.perf_counter()
         
         try:
             async with session.request(method, url, json=data) as response:
+                # 流式请求只统计到收到响应头为止，生成耗时由首 token 和 token 间隔指标反映
+                elapsed = time.perf_counter() - started
+                ollama_request_seconds.observe(elapsed, method=method, endpoint=endpoint)
+                record_span("ollama", elapsed, endpoint=endpoint, status=response.status)
                 if response.status != 200:
                     error_text = await response.text()
                     raise aiohttp.ClientResponseError(
@@ -54,17 +69,24 @@ class OllamaClient:
                     )
                 
                 if stream:
-                    async for line in response.content:
-                        if line:
+                    try:
+                        async for line in iter_lines(response.content.iter_any()):
+                            if raw:
+                                yield line
+                                continue
                             try:
-                                yield json.loads(line.decode())
-                            except json.JSONDecodeError as e:
+                                yield loads(line)
+                            except ValueError:
                                 raise aiohttp.ClientResponseError(
                                     response.request_info,
                                     response.history,
                                     status=response.status,
-                                    message=f"Invalid JSON response: {line.decode()}"
+                                    message=f"Invalid JSON response: {line.decode(errors='replace')}"
                                 )
+                    except (asyncio.CancelledError, GeneratorExit):
+                        # 取消或提前关闭时直接断开连接，让 Ollama 立即停止生成
+                        response.close()
+                        raise
                 else:
                     # 删除操作不需要返回 JSON
                     if method == "DELETE":
@@ -80,10 +102,15 @@ class OllamaClient:
                                 status=response.status,
                                 message=f"Invalid JSON response: {text}"
                             )
+        except aiohttp.ClientResponseError:
+            ollama_request_errors_total.inc(endpoint=endpoint)
+            raise
         except aiohttp.ClientError as e:
+            ollama_request_errors_total.inc(endpoint=endpoint)
+            # 连接失败等错误没有响应，构造请求信息以便错误信息可以正常格式化
             raise aiohttp.ClientResponseError(
-                None,
-                None,
+                aiohttp.RequestInfo(URL(url), method, CIMultiDictProxy(CIMultiDict()), URL(url)),
+                (),
                 status=getattr(e, 'status', 500),
                 message=f"Request failed: {str(e)}"
             )
@@ -97,8 +124,18 @@ class OllamaClient:
 
     # 聊天对话
     async def chat(self, request: ChatRequest) -> AsyncGenerator[ChatResponse, None]:
-        async for response in self._request("POST", "api/chat", request.dict(), stream=request.stream):
-            yield ChatResponse(**response)
+        async with aclosing(self._request("POST", "api/chat", request.dict(), stream=request.stream)) as responses:
+            async for response in responses:
+                yield ChatResponse(**response)
+
+    # 聊天对话（高吞吐），返回按需解析的响应块，不为每个 token 构造 pydantic 对象
+    # 透传时直接转发 chunk.raw，只通过 chunk.done 查看是否结束
+    async def chat_lazy(self, request: ChatRequest) -> AsyncGenerator[LazyChunk, None]:
+        data = request.dict()
+        data["stream"] = True
+        async with aclosing(self._request("POST", "api/chat", data, stream=True, raw=True)) as lines:
+            async for line in lines:
+                yield LazyChunk(line)
 
     # 生成嵌入向量
     async def embeddings(self, request: EmbeddingRequest) -> EmbeddingResponse:
@@ -117,6 +154,29 @@ class OllamaClient:
         async for response in self._request("GET", "api/tags", stream=False):
             return ModelList(**response)
 
+    # 获取 Ollama 版本，可用于健康检查
+    async def version(self) -> Dict[str, Any]:
+        async for response in self._request("GET", "api/version", stream=False):
+            return response
+
+    # 获取当前已加载到内存中的模型
+    async def list_running(self) -> Dict[str, Any]:
+        async for response in self._request("GET", "api/ps", stream=False):
+            return response
+
+    # 只加载模型而不生成内容（空提示词）
+    async def load_model(self, model: str, keep_alive: Optional[Union[str, int, float]] = None) -> Dict[str, Any]:
+        data: Dict[str, Any] = {"model": model}
+        if keep_alive is not None:
+            data["keep_alive"] = keep_alive
+        async for response in self._request("POST", "api/generate", data, stream=False):
+            return response
+
+    # 卸载模型，立即释放其占用的内存
+    async def unload_model(self, model: str) -> None:
+        async for _ in self._request("POST", "api/generate", {"model": model, "keep_alive": 0}, stream=False):
+            return
+
     # 拉取模型
     async def pull_model(self, request: ModelPullRequest) -> AsyncGenerator[ModelPullResponse, None]:
         async for response in self._request("POST", "api/pull", {"name": request.name}, stream=True):
@@ -140,6 +200,31 @@ class OllamaClient:
         # 如果没有错误发生，说明创建成功
         return ModelCreateResponse(status="success")
 
+    # 以流式响应创建模型，逐条返回创建状态
+    async def create_model_stream(self, payload: Dict[str, Any]) -> AsyncGenerator[Dict[str, Any], None]:
+        async for response in self._request("POST", "api/create", {**payload, "stream": True}, stream=True):
+            yield response
+
+    # 检查 blob 是否已在 Ollama 服务端
+    async def has_blob(self, digest: str) -> bool:
+        session = await self._ensure_session()
+        async with session.head(f"{self.base_url}/api/blobs/{digest}") as response:
+            return response.status == 200
+
+    # 上传 blob，body 为分块读取文件的异步迭代器，文件不会整体读入内存
+    async def push_blob(self, digest: str, body: AsyncIterable[bytes], size: int) -> None:
+        session = await self._ensure_session()
+        url = f"{self.base_url}/api/blobs/{digest}"
+        async with session.post(url, data=body, headers={"Content-Length": str(size)}) as response:
+            if response.status not in (200, 201):
+                error_text = await response.text()
+                raise aiohttp.ClientResponseError(
+                    response.request_info,
+                    response.history,
+                    status=response.status,
+                    message=f"HTTP {response.status}: {error_text}"
+                )
+
     # 简化的聊天方法
     async def chat_simple(
         self,
@@ -3,16 +3,6 @@ from enum import Enum
 from typing import Dict, Any, Optional, List, Union
 from datetime import datetime
 import logging
-import sys
-
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.StreamHandler(sys.stdout)
-    ]
-)
 
 logger = logging.getLogger(__name__)
 
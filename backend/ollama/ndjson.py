@@ -0,0 +1,115 @@
+"""
+NDJSON 流的高性能解码
+
+- 自行按换行符切分字节块，不依赖 aiohttp 的按行读取
+- 优先使用 orjson 或 msgspec 解析，均未安装时退回标准库 json
+- LazyChunk 在首次访问字段时才解析，透传模式下只需查看 done 和 error 标记
+"""
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Dict, Optional
+
+try:
+    import orjson
+
+    PARSER = "orjson"
+
+    def loads(data: bytes) -> Any:
+        return orjson.loads(data)
+
+    def dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    try:
+        import msgspec
+
+        PARSER = "msgspec"
+        _decoder = msgspec.json.Decoder()
+        _encoder = msgspec.json.Encoder()
+
+        def loads(data: bytes) -> Any:
+            return _decoder.decode(data)
+
+        def dumps(obj: Any) -> str:
+            return _encoder.encode(obj).decode()
+    except ImportError:
+        PARSER = "json"
+
+        def loads(data: bytes) -> Any:
+            return json.loads(data)
+
+        def dumps(obj: Any) -> str:
+            return json.dumps(obj, ensure_ascii=False)
+
+# 最后一块（done 为 true）中的统计字段
+STATS_FIELDS = (
+    "total_duration", "load_duration", "prompt_eval_count", "prompt_eval_duration",
+    "eval_count", "eval_duration"
+)
+
+async def iter_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """将任意切分的字节块重新切分为完整的行（包含结尾的换行符）"""
+    buffer = b""
+    async for chunk in chunks:
+        if not chunk:
+            continue
+        buffer = buffer + chunk if buffer else chunk
+        start = 0
+        while True:
+            end = buffer.find(b"\n", start)
+            if end < 0:
+                break
+            if end > start:
+                yield buffer[start:end + 1]
+            start = end + 1
+        buffer = buffer[start:] if start else buffer
+    if buffer.strip():
+        yield buffer
+
+def peek_done(line: bytes) -> bool:
+    """不解析整行，只判断是否为最后一块"""
+    return b'"done":true' in line or b'"done": true' in line
+
+def peek_error(line: bytes) -> bool:
+    """不解析整行，判断是否可能包含 error 字段（内容中的引号会被转义，不会误判为无错误）"""
+    return b'"error"' in line
+
+class LazyChunk:
+    """按需解析的流式响应块"""
+
+    __slots__ = ("raw", "_data")
+
+    def __init__(self, raw: bytes):
+        self.raw = raw
+        self._data: Optional[Dict[str, Any]] = None
+
+    @property
+    def data(self) -> Dict[str, Any]:
+        if self._data is None:
+            self._data = loads(self.raw)
+        return self._data
+
+    @property
+    def done(self) -> bool:
+        if self._data is None:
+            return peek_done(self.raw)
+        return bool(self._data.get("done"))
+
+    @property
+    def model(self) -> Optional[str]:
+        return self.data.get("model")
+
+    @property
+    def content(self) -> str:
+        message = self.data.get("message")
+        return (message or {}).get("content") or ""
+
+    @property
+    def error(self) -> Optional[str]:
+        if self._data is None and not peek_error(self.raw):
+            return None
+        return self.data.get("error")
+
+    @property
+    def stats(self) -> Dict[str, Any]:
+        """最后一块中的统计信息"""
+        return {key: self.data[key] for key in STATS_FIELDS if key in self.data}
@@ -0,0 +1,148 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional
+
+import aiohttp
+
+from config import OLLAMA_NODES_CONFIG, OLLAMA_TRANSPORT_CONFIG
+
+class TransportMetrics:
+    """连接复用统计"""
+
+    def __init__(self):
+        self.requests_total = 0
+        self.connections_created = 0
+        self.connections_reused = 0
+        self.dns_cache_hits = 0
+        self.dns_cache_misses = 0
+        self.request_errors = 0
+
+    def snapshot(self) -> Dict[str, Any]:
+        acquired = self.connections_created + self.connections_reused
+        return {
+            "requests_total": self.requests_total,
+            "connections_created": self.connections_created,
+            "connections_reused": self.connections_reused,
+            "reuse_ratio": round(self.connections_reused / acquired, 4) if acquired else 0.0,
+            "dns_cache_hits": self.dns_cache_hits,
+            "dns_cache_misses": self.dns_cache_misses,
+            "request_errors": self.request_errors
+        }
+
+class OllamaTransport:
+    """进程内共享的 Ollama HTTP 传输层
+
+    所有访问 Ollama 的请求共用一个 ClientSession 和连接池，避免每次请求重新建立连接。
+    配置了 UNIX_SOCKET 时通过 Unix 域套接字连接同机部署的 Ollama（URL 中的主机名被忽略），
+    因此只在单节点时生效；配置了多个节点时忽略 UNIX_SOCKET，按各节点的 URL 连接。
+    """
+
+    def __init__(self):
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._lock = asyncio.Lock()
+        self.metrics = TransportMetrics()
+
+    @property
+    def unix_socket(self) -> Optional[str]:
+        """实际使用的 Unix 域套接字路径，多节点时为 None"""
+        unix_socket = OLLAMA_TRANSPORT_CONFIG["UNIX_SOCKET"]
+        if unix_socket and len(OLLAMA_NODES_CONFIG["BASE_URLS"]) > 1:
+            return None
+        return unix_socket
+
+    def _create_connector(self) -> aiohttp.BaseConnector:
+        if OLLAMA_TRANSPORT_CONFIG["UNIX_SOCKET"] and not self.unix_socket:
+            # 所有节点的请求都会发到同一个套接字，多节点配置会失效
+            logging.error(
+                f"配置了 {len(OLLAMA_NODES_CONFIG['BASE_URLS'])} 个 Ollama 节点，"
+                f"忽略 Unix 域套接字 {OLLAMA_TRANSPORT_CONFIG['UNIX_SOCKET']}，按各节点的 URL 连接"
+            )
+        unix_socket = self.unix_socket
+        if unix_socket:
+            logging.info(f"通过 Unix 域套接字连接 Ollama: {unix_socket}")
+            return aiohttp.UnixConnector(
+                path=unix_socket,
+                limit=OLLAMA_TRANSPORT_CONFIG["LIMIT"],
+                keepalive_timeout=OLLAMA_TRANSPORT_CONFIG["KEEPALIVE_TIMEOUT"]
+            )
+        return aiohttp.TCPConnector(
+            limit=OLLAMA_TRANSPORT_CONFIG["LIMIT"],
+            limit_per_host=OLLAMA_TRANSPORT_CONFIG["LIMIT_PER_HOST"],
+            keepalive_timeout=OLLAMA_TRANSPORT_CONFIG["KEEPALIVE_TIMEOUT"],
+            ttl_dns_cache=OLLAMA_TRANSPORT_CONFIG["DNS_CACHE_TTL"],
+            use_dns_cache=True
+        )
+
+    def _create_trace_config(self) -> aiohttp.TraceConfig:
+        metrics = self.metrics
+        trace_config = aiohttp.TraceConfig()
+
+        async def on_request_start(session, context, params):
+            metrics.requests_total += 1
+
+        async def on_request_exception(session, context, params):
+            metrics.request_errors += 1
+
+        async def on_connection_create_end(session, context, params):
+            metrics.connections_created += 1
+
+        async def on_connection_reuseconn(session, context, params):
+            metrics.connections_reused += 1
+
+        async def on_dns_cache_hit(session, context, params):
+            metrics.dns_cache_hits += 1
+
+        async def on_dns_cache_miss(session, context, params):
+            metrics.dns_cache_misses += 1
+
+        trace_config.on_request_start.append(on_request_start)
+        trace_config.on_request_exception.append(on_request_exception)
+        trace_config.on_connection_create_end.append(on_connection_create_end)
+        trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+        trace_config.on_dns_cache_hit.append(on_dns_cache_hit)
+        trace_config.on_dns_cache_miss.append(on_dns_cache_miss)
+        return trace_config
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """获取共享的 ClientSession，首次调用时创建"""
+        if self._session is None or self._session.closed:
+            async with self._lock:
+                if self._session is None or self._session.closed:
+                    # 设置较长的超时时间，防止长时间下载或生成过程中断开
+                    timeout = aiohttp.ClientTimeout(
+                        total=None,  # 禁用总超时
+                        connect=OLLAMA_TRANSPORT_CONFIG["CONNECT_TIMEOUT"],
+                        sock_connect=OLLAMA_TRANSPORT_CONFIG["CONNECT_TIMEOUT"],
+                        sock_read=OLLAMA_TRANSPORT_CONFIG["SOCK_READ_TIMEOUT"]
+                    )
+                    self._session = aiohttp.ClientSession(
+                        connector=self._create_connector(),
+                        timeout=timeout,
+                        trace_configs=[self._create_trace_config()]
+                    )
+        return self._session
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[aiohttp.ClientSession]:
+        """以 `async with` 的形式使用共享会话，退出时不关闭会话"""
+        yield await self.get_session()
+
+    async def close(self) -> None:
+        """关闭共享会话，应用退出时调用"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    def snapshot(self) -> Dict[str, Any]:
+        connector = self._session.connector if self._session is not None and not self._session.closed else None
+        return {
+            "transport": "unix" if self.unix_socket else "tcp",
+            "limit": OLLAMA_TRANSPORT_CONFIG["LIMIT"],
+            "limit_per_host": OLLAMA_TRANSPORT_CONFIG["LIMIT_PER_HOST"],
+            "open": connector is not None,
+            **self.metrics.snapshot()
+        }
+
+# 全局传输层
+ollama_transport = OllamaTransport()
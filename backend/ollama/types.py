@@ -70,6 +70,7 @@ class ChatRequest(BaseModel):
     messages: List[ChatMessage]
     stream: bool = True
     options: Optional[Options] = None
+    keep_alive: Optional[Union[str, int, float]] = Field(default=None, description="How long the model stays loaded after the request, e.g. \"5m\"; 0 unloads it")
 
 class ChatResponse(BaseModel):
     model: str
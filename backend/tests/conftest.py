@@ -0,0 +1,15 @@
+"""
+测试公共配置
+
+在导入后端模块之前把数据目录指向临时目录，测试不会读写开发环境的数据库和数据文件。
+"""
+import os
+import sys
+import tempfile
+
+os.environ.setdefault("ELECTRON_USER_DATA_DIR", tempfile.mkdtemp(prefix="kunlab-tests-"))
+os.environ.setdefault("KUNLAB_PRELOAD_MODELS", "false")
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BACKEND_DIR not in sys.path:
+    sys.path.insert(0, BACKEND_DIR)
@@ -0,0 +1,65 @@
+"""
+本地的 Ollama 替身服务
+
+只实现节点路由用到的接口：/api/version、/api/ps 和流式的 /api/chat。
+可以配置已加载的模型、首个 token 前的延迟和失败状态码，用于测试健康检查、模型亲和和对冲请求。
+"""
+import asyncio
+import json
+from typing import List, Optional
+
+from aiohttp import ClientConnectionError, web
+
+class OllamaStandIn:
+    def __init__(self, name: str, models: Optional[List[str]] = None, first_token_delay: float = 0.0,
+                 chat_status: int = 200, healthy: bool = True):
+        self.name = name
+        self.models = list(models or [])
+        self.first_token_delay = first_token_delay
+        self.chat_status = chat_status
+        self.healthy = healthy
+        self.chat_requests = 0
+        self._runner: Optional[web.AppRunner] = None
+        self.base_url = ""
+
+    async def __aenter__(self) -> "OllamaStandIn":
+        app = web.Application()
+        app.router.add_get("/api/version", self._version)
+        app.router.add_get("/api/ps", self._ps)
+        app.router.add_post("/api/chat", self._chat)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = self._runner.addresses[0][:2]
+        self.base_url = f"http://{host}:{port}"
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self._runner.cleanup()
+
+    async def _version(self, request: web.Request) -> web.Response:
+        if not self.healthy:
+            return web.json_response({"error": "unavailable"}, status=503)
+        return web.json_response({"version": "0.0.0-standin"})
+
+    async def _ps(self, request: web.Request) -> web.Response:
+        return web.json_response({"models": [{"name": name, "size": 1} for name in self.models]})
+
+    async def _chat(self, request: web.Request) -> web.StreamResponse:
+        self.chat_requests += 1
+        body = await request.json()
+        if self.chat_status != 200:
+            return web.json_response({"error": f"{self.name} failed"}, status=self.chat_status)
+        response = web.StreamResponse(headers={"Content-Type": "application/x-ndjson"})
+        await response.prepare(request)
+        try:
+            await asyncio.sleep(self.first_token_delay)
+            for word in (self.name, " says", " hi"):
+                line = {"model": body["model"], "message": {"role": "assistant", "content": word}, "done": False}
+                await response.write((json.dumps(line) + "\n").encode())
+            await response.write((json.dumps({"model": body["model"], "done": True, "eval_count": 3}) + "\n").encode())
+        except (ConnectionError, ClientConnectionError):
+            # 对冲请求落后的一方被取消，客户端已断开连接
+            pass
+        return response
@@ -0,0 +1,60 @@
+import asyncio
+import json
+import uuid
+
+from api.chat.db_operations import save_message
+from api.chat.websocket_handler import load_history
+from api.tools.attachments import DONE, attachment_store, parse_attachment_ref
+from database import db
+
+ATTACHMENT_ID = "ab" * 32
+
+async def _create_conversation() -> str:
+    await db.connect()
+    await db.execute(
+        "INSERT OR IGNORE INTO users (username, hashed_password) VALUES (?, ?)",
+        ("tester", "x")
+    )
+    conversation_id = str(uuid.uuid4())
+    await db.execute(
+        "INSERT INTO conversations (id, title, user_id, model) VALUES (?, ?, ?, ?)",
+        (conversation_id, "test", "tester", "llama3")
+    )
+    await db.commit()
+    return conversation_id
+
+def test_parse_attachment_ref_with_long_preview():
+    document = {"name": "a.pdf", "content": "x" * 2000, "type": "application/pdf", "attachment_id": ATTACHMENT_ID}
+    assert parse_attachment_ref(document)["attachment_id"] == ATTACHMENT_ID
+    assert parse_attachment_ref(json.dumps(document))["attachment_id"] == ATTACHMENT_ID
+    assert parse_attachment_ref(json.dumps({"name": "a.md", "content": "# 文件: a.md\n"})) is None
+    assert parse_attachment_ref("# 普通的 Markdown 文档") is None
+
+async def _save_and_reload(conversation_id: str) -> None:
+    document = {"name": "a.pdf", "content": "预览" * 1000, "type": "application/pdf",
+                "attachment_id": ATTACHMENT_ID}
+    await save_message(db, conversation_id, "user", "总结这个文档", document=document)
+
+    row = await db.fetch_one("SELECT document FROM messages WHERE conversation_id = ?", (conversation_id,))
+    # 只保存引用，不保存预览内容
+    assert json.loads(row["document"]) == {"attachment_id": ATTACHMENT_ID, "name": "a.pdf",
+                                           "type": "application/pdf"}
+
+    history = await load_history(db, conversation_id, "llama3")
+    assert parse_attachment_ref(history[-1]["document"])["attachment_id"] == ATTACHMENT_ID
+    assert await attachment_store.read_for_prompt(ATTACHMENT_ID, 1000) == "转换后的全文"
+
+def test_saved_attachment_reference_survives_reload():
+    async def scenario():
+        await attachment_store.begin(ATTACHMENT_ID, "a.pdf", "application/pdf", 1)
+        await attachment_store.append(ATTACHMENT_ID, "转换后的全文", 1, 1)
+        await attachment_store.finish(ATTACHMENT_ID)
+        assert attachment_store.get_status(ATTACHMENT_ID)["status"] == DONE
+
+        conversation_id = await _create_conversation()
+        try:
+            await _save_and_reload(conversation_id)
+        finally:
+            await db.disconnect()
+
+    asyncio.run(scenario())
@@ -0,0 +1,29 @@
+import asyncio
+
+from api.chat.batch import BatchJobCreate, BatchManager
+from database import db
+
+def test_unexpected_error_marks_job_failed():
+    async def scenario():
+        await db.connect()
+        await db.execute(
+            "INSERT OR IGNORE INTO users (username, hashed_password) VALUES (?, ?)",
+            ("tester", "x")
+        )
+        await db.commit()
+        manager = BatchManager(db)
+
+        async def broken_worker(job, options, pending):
+            raise RuntimeError("磁盘已满")
+
+        manager._worker = broken_worker
+        job = await manager.submit("tester", BatchJobCreate(model="llama3", prompts=["a", "b"]))
+        await asyncio.gather(*manager._tasks.values())
+        job = await manager.get_job(job["id"])
+        await db.disconnect()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job["status"] == "failed"
+    assert job["error"] == "磁盘已满"
+    assert job["finished_at"] is not None
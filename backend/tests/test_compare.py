@@ -0,0 +1,150 @@
+import asyncio
+import json
+import uuid
+
+from fastapi import WebSocketDisconnect
+
+from api.chat import compare
+from api.chat.generation_registry import generation_registry
+from api.chat.websocket_handler import run_chat_turn
+from database import db
+
+class _Sender:
+    def __init__(self):
+        self.frames = []
+
+    async def send_json(self, frame):
+        self.frames.append(frame)
+
+async def _no_save(*args, **kwargs):
+    return None
+
+class _Slot:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+def test_cancelled_compare_keeps_partial_reply(monkeypatch):
+    first_chunk = asyncio.Event()
+
+    async def fake_client(model, websocket, username):
+        return object(), 0, _Slot()
+
+    async def fake_chunks(*args, **kwargs):
+        yield json.dumps({"message": {"content": "部分"}, "done": False})
+        first_chunk.set()
+        await asyncio.Event().wait()
+
+    monkeypatch.setattr(compare, "get_available_client", fake_client)
+    monkeypatch.setattr(compare, "process_chat_messages", fake_chunks)
+
+    async def scenario():
+        await db.connect()
+        await db.execute(
+            "INSERT OR IGNORE INTO users (username, hashed_password) VALUES (?, ?)",
+            ("tester", "x")
+        )
+        conversation_id = str(uuid.uuid4())
+        await db.execute(
+            "INSERT INTO conversations (id, title, user_id, model) VALUES (?, ?, ?, ?)",
+            (conversation_id, "test", "tester", "llama3")
+        )
+        await db.commit()
+
+        stream = compare.ModelStream(_Sender(), "llama3")
+        task = asyncio.create_task(
+            compare.compare_model(stream, db, conversation_id, [], "llama3", False, "tester")
+        )
+        await first_chunk.wait()
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+        rows = await db.fetch_all(
+            "SELECT role, content, model FROM messages WHERE conversation_id = ?", (conversation_id,)
+        )
+        await db.disconnect()
+        return rows
+
+    rows = asyncio.run(scenario())
+    assert [(r["role"], r["content"], r["model"]) for r in rows] == [("assistant", "部分", "llama3")]
+
+def test_compare_is_the_conversations_active_generation(monkeypatch):
+    streaming = asyncio.Event()
+
+    async def fake_client(model, websocket, username):
+        return object(), 0, _Slot()
+
+    async def fake_chunks(*args, **kwargs):
+        yield json.dumps({"message": {"content": "部分"}, "done": False})
+        streaming.set()
+        await asyncio.Event().wait()
+
+    async def fake_history(db, conversation_id, model):
+        return []
+
+    monkeypatch.setattr(compare, "get_available_client", fake_client)
+    monkeypatch.setattr(compare, "process_chat_messages", fake_chunks)
+    monkeypatch.setattr(compare, "load_history", fake_history)
+
+    async def scenario():
+        await db.connect()
+        await db.execute(
+            "INSERT OR IGNORE INTO users (username, hashed_password) VALUES (?, ?)",
+            ("tester", "x")
+        )
+        conversation_id = str(uuid.uuid4())
+        await db.execute(
+            "INSERT INTO conversations (id, title, user_id, model) VALUES (?, ?, ?, ?)",
+            (conversation_id, "test", "tester", "llama3")
+        )
+        await db.commit()
+        conversation = {"id": conversation_id, "model": "llama3"}
+        user = {"username": "tester"}
+        request = {"models": ["a", "b"], "messages": [{"role": "user", "content": "你好"}]}
+
+        sender = _Sender()
+        turn = asyncio.create_task(compare.run_compare_turn(sender, db, conversation, user, request))
+        await streaming.wait()
+
+        # 对比进行中，普通对话不能开始
+        chat_sender = _Sender()
+        started = await run_chat_turn(chat_sender, db, conversation, user, {"messages": [{"role": "user", "content": "x"}]})
+
+        # 中止接口取消对比
+        cancelled = generation_registry.cancel_conversation(conversation_id)
+        completed = await turn
+        await db.disconnect()
+        return started, chat_sender.frames, cancelled, completed, sender.frames
+
+    started, chat_frames, cancelled, completed, frames = asyncio.run(scenario())
+    assert not started
+    assert "进行中的生成" in chat_frames[0]["error"]
+    assert cancelled and not completed
+    assert frames[0]["type"] == "generation"
+    assert frames[-1]["type"] == "cancelled" and frames[-1]["reason"] == "abort"
+
+def test_dead_socket_on_final_frame_still_returns_stats(monkeypatch):
+    async def fake_client(model, websocket, username):
+        return object(), 0, _Slot()
+
+    async def fake_chunks(*args, **kwargs):
+        yield json.dumps({"message": {"content": "完整"}, "done": False})
+        yield json.dumps({"done": True, "stats": {"eval_count": 4, "eval_duration": 2_000_000_000}})
+
+    class _ClosingSender(_Sender):
+        async def send_json(self, frame):
+            if frame.get("type") == "compare_done":
+                raise WebSocketDisconnect(code=1006)
+            await super().send_json(frame)
+
+    monkeypatch.setattr(compare, "get_available_client", fake_client)
+    monkeypatch.setattr(compare, "process_chat_messages", fake_chunks)
+    monkeypatch.setattr(compare, "save_message", _no_save)
+    monkeypatch.setattr(compare.generation_stats, "record", _no_save)
+
+    result = asyncio.run(compare.compare_model(
+        compare.ModelStream(_ClosingSender(), "llama3"), None, "c1", [], "llama3", False, "tester"
+    ))
+    assert result["error"] is None
+    assert result["tokens_per_second"] == 2.0
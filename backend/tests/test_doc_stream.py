@@ -0,0 +1,61 @@
+import asyncio
+
+from api.tools.attachments import DONE, AttachmentStore
+from api.tools.doc_stream import ProgressiveConverter
+
+DIGEST = "cd" * 32
+
+class _FakeConverter:
+    """按固定摘要保存上传文件，转换时等待测试放行"""
+
+    max_workers = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.release = asyncio.Event()
+        self.conversions = 0
+        self.discarded = 0
+        self.cache_hits = self.conversions_total = self.failures_total = 0
+
+    async def spool(self, file, spool_bytes=None):
+        await asyncio.sleep(0)
+        return {"digest": DIGEST, "path": None}
+
+    def discard(self, spooled):
+        self.discarded += 1
+
+    def cache_path(self, digest):
+        return self.cache_dir / digest
+
+    async def run_in_pool(self, func, *args):
+        self.conversions += 1
+        await self.release.wait()
+        return "# 转换结果\n"
+
+    def write_cache(self, digest, text=None, source=None):
+        pass
+
+class _Upload:
+    filename = "a.docx"
+    content_type = None
+
+def test_concurrent_uploads_of_same_file_share_one_conversion(tmp_path):
+    async def scenario():
+        store = AttachmentStore(tmp_path / "attachments")
+        store.root.mkdir()
+        converter = _FakeConverter(tmp_path)
+        progressive = ProgressiveConverter(converter, store)
+
+        statuses = await asyncio.gather(*(progressive.start(_Upload()) for _ in range(3)))
+        assert len(progressive._tasks) == 1
+        converter.release.set()
+        await asyncio.gather(*progressive._tasks.values())
+        return statuses, converter, store
+
+    statuses, converter, store = asyncio.run(scenario())
+    assert all(status["attachment_id"] == DIGEST for status in statuses)
+    assert converter.conversions == 1
+    # 重复的上传文件都已删除，加上转换任务结束时删除的一份
+    assert converter.discarded == 3
+    assert store.get_status(DIGEST)["status"] == DONE
+    assert store.text_path(DIGEST).read_text(encoding="utf-8") == "# 转换结果\n"
@@ -0,0 +1,60 @@
+import asyncio
+
+from api.chat.generation_registry import Generation, GenerationMetrics, GenerationSubscriber, stream_generation
+from config import GENERATION_CONFIG
+
+class _SlowSender:
+    """每帧发送前都等待，直到测试放行"""
+
+    def __init__(self):
+        self.frames = []
+        self.gate = asyncio.Event()
+
+    async def send_json(self, frame):
+        await self.gate.wait()
+        self.frames.append(frame)
+
+def _content(frames):
+    return "".join(f["message"]["content"] for f in frames if "message" in f)
+
+def test_slow_subscriber_is_resynced_from_its_offset():
+    async def scenario():
+        generation = Generation("c1", "alice", "m", db=None, metrics=GenerationMetrics())
+        sender = _SlowSender()
+        consumer = asyncio.create_task(stream_generation(sender, generation))
+        await asyncio.sleep(0)
+        (subscriber,) = generation._subscribers
+
+        pieces = [f"{i}," for i in range(GENERATION_CONFIG["SUBSCRIBER_QUEUE_SIZE"] * 3)]
+        for piece in pieces:
+            await generation.append(piece)
+        # 积压不会超过队列上限
+        assert subscriber.queue.qsize() <= GENERATION_CONFIG["SUBSCRIBER_QUEUE_SIZE"]
+        assert subscriber.lagging
+
+        generation._finish("done", {"done": True})
+        sender.gate.set()
+        completed = await consumer
+        return completed, sender.frames, "".join(pieces)
+
+    completed, frames, expected = asyncio.run(scenario())
+    assert completed
+    assert _content(frames) == expected
+    assert frames[-1] == {"done": True}
+    assert GenerationSubscriber.RESYNC not in frames
+
+def test_late_subscriber_replays_from_offset():
+    async def scenario():
+        generation = Generation("c1", "alice", "m", db=None, metrics=GenerationMetrics())
+        await generation.append("hello ")
+        await generation.append("world")
+        generation._finish("done", {"done": True})
+        sender = _SlowSender()
+        sender.gate.set()
+        await stream_generation(sender, generation, offset=3)
+        return sender.frames
+
+    frames = asyncio.run(scenario())
+    assert frames[0]["type"] == "generation"
+    assert frames[1] == {"message": {"content": "lo world"}, "offset": 3}
+    assert frames[-1] == {"done": True}
@@ -0,0 +1,16 @@
+from api.chat.message_processor import history_window_start
+
+def test_window_keeps_at_least_max_messages():
+    for total in range(21, 60):
+        start = history_window_start(total, 20, 8)
+        assert 20 <= total - start <= 27
+        assert start % 8 == 0
+
+def test_window_start_only_moves_by_blocks():
+    starts = [history_window_start(total, 20, 8) for total in range(20, 45)]
+    assert starts[:8] == [0] * 8
+    assert starts[8:16] == [8] * 8
+
+def test_without_block_keeps_exactly_max_messages():
+    assert history_window_start(35, 20) == 15
+    assert history_window_start(10, 20, 8) == 0
@@ -0,0 +1,118 @@
+import asyncio
+import io
+import json
+from datetime import datetime, timedelta
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from PIL import Image
+from starlette.datastructures import Headers
+
+from api.tools.image_store import ImageStore, image_id_from_handle
+from database import Database
+
+def _upload(data: bytes, content_type: str) -> UploadFile:
+    return UploadFile(io.BytesIO(data), filename="upload", headers=Headers({"content-type": content_type}))
+
+def _png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (40, 30), (200, 10, 10)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+async def _connect(tmp_path) -> Database:
+    database = Database(tmp_path / "images.db")
+    await database.connect()
+    for username in ("alice", "bob"):
+        await database.execute(
+            "INSERT OR IGNORE INTO users (username, hashed_password) VALUES (?, ?)", (username, "x")
+        )
+    await database.commit()
+    return database
+
+def _save(tmp_path, data: bytes, content_type: str):
+    async def scenario():
+        database = await _connect(tmp_path)
+        try:
+            return await ImageStore(database, tmp_path / "images").save_upload(_upload(data, content_type), "alice")
+        finally:
+            await database.disconnect()
+    return asyncio.run(scenario())
+
+def test_upload_stores_detected_type(tmp_path):
+    result = _save(tmp_path, _png(), "image/gif")
+    assert result["content_type"] == "image/png"
+    assert result["image_id"].startswith("kunimg:")
+
+@pytest.mark.parametrize("data, content_type", [
+    (b'<svg xmlns="http://www.w3.org/2000/svg"><script>alert(1)</script></svg>', "image/svg+xml"),
+    (b"<html><script>alert(1)</script></html>", "image/png"),
+])
+def test_upload_rejects_non_raster_content(tmp_path, data, content_type):
+    with pytest.raises(HTTPException) as excinfo:
+        _save(tmp_path, data, content_type)
+    assert excinfo.value.status_code == 400
+    assert not any((tmp_path / "images").rglob("[0-9a-f]*"))
+
+def test_only_uploader_and_referencing_conversation_can_read(tmp_path):
+    async def scenario():
+        database = await _connect(tmp_path)
+        try:
+            store = ImageStore(database, tmp_path / "images")
+            result = await store.save_upload(_upload(_png(), "image/png"), "alice")
+            image_id = image_id_from_handle(result["image_id"])
+            assert await store.can_access(image_id, "alice")
+            assert not await store.can_access(image_id, "bob")
+
+            # 旧数据没有上传者记录，引用了图片的对话的所有者仍然可以读取
+            await database.execute(
+                "INSERT INTO conversations (id, title, user_id, model) VALUES (?, ?, ?, ?)",
+                ("conv-bob", "test", "bob", "llama3")
+            )
+            await database.execute(
+                "INSERT INTO messages (conversation_id, role, content, images) VALUES (?, ?, ?, ?)",
+                ("conv-bob", "user", "看图", json.dumps([result["image_id"]]))
+            )
+            await database.commit()
+            assert await store.can_access(image_id, "bob")
+        finally:
+            await database.disconnect()
+    asyncio.run(scenario())
+
+def test_delete_orphans_keeps_referenced_and_recent_images(tmp_path):
+    async def scenario():
+        database = await _connect(tmp_path)
+        try:
+            store = ImageStore(database, tmp_path / "images")
+            referenced = await store.save_upload(_upload(_png(), "image/png"), "alice")
+            orphan_data = io.BytesIO()
+            Image.new("RGB", (10, 10), (0, 0, 200)).save(orphan_data, "PNG")
+            orphan = await store.save_upload(_upload(orphan_data.getvalue(), "image/png"), "alice")
+            recent_data = io.BytesIO()
+            Image.new("RGB", (10, 10), (0, 200, 0)).save(recent_data, "PNG")
+            recent = await store.save_upload(_upload(recent_data.getvalue(), "image/png"), "alice")
+
+            await database.execute(
+                "INSERT INTO conversations (id, title, user_id, model) VALUES (?, ?, ?, ?)",
+                ("conv-alice", "test", "alice", "llama3")
+            )
+            await database.execute(
+                "INSERT INTO messages (conversation_id, role, content, images) VALUES (?, ?, ?, ?)",
+                ("conv-alice", "user", "看图", json.dumps([referenced["image_id"]]))
+            )
+            old = (datetime.now() - timedelta(days=2)).isoformat()
+            for handle in (referenced["image_id"], orphan["image_id"]):
+                await database.execute("UPDATE images SET created_at = ? WHERE id = ?",
+                                       (old, image_id_from_handle(handle)))
+            await database.commit()
+
+            assert await store.delete_orphans() == 1
+            orphan_id = image_id_from_handle(orphan["image_id"])
+            assert await store.get_info(orphan_id) is None
+            assert not store.original_path(orphan_id).exists()
+            assert not store.thumbnail_path(orphan_id).exists()
+            assert await database.fetch_one("SELECT 1 FROM image_owners WHERE image_id = ?", (orphan_id,)) is None
+            assert await store.get_info(image_id_from_handle(referenced["image_id"])) is not None
+            assert await store.get_info(image_id_from_handle(recent["image_id"])) is not None
+        finally:
+            await database.disconnect()
+    asyncio.run(scenario())
@@ -0,0 +1,55 @@
+import asyncio
+
+from api.models.import_model import ImportCancelled, ModelImporter, ModelImportJob
+from config import MODEL_IMPORT_CONFIG
+from ollama.transport import ollama_transport
+
+async def _run_job(importer: ModelImporter, digest) -> ModelImportJob:
+    job = ModelImportJob("test-model", "/tmp/model.gguf", 1024)
+    importer.jobs[job.name] = job
+    importer._digest = digest
+    job.task = asyncio.create_task(importer._run(job))
+    return job
+
+def test_cancelled_import_reraises_and_is_pruned(monkeypatch):
+    monkeypatch.setitem(MODEL_IMPORT_CONFIG, "RETENTION_SECONDS", 0.01)
+    started = asyncio.Event()
+
+    async def digest(job):
+        started.set()
+        await asyncio.Event().wait()
+
+    async def scenario():
+        importer = ModelImporter()
+        job = await _run_job(importer, digest)
+        await started.wait()
+        job.task.cancel()
+        await asyncio.gather(job.task, return_exceptions=True)
+        state = (job.task.cancelled(), job.state["status"], job.name in importer.jobs)
+        await asyncio.sleep(0.05)
+        await ollama_transport.close()
+        return state, importer.jobs
+
+    (task_cancelled, status, kept), jobs = asyncio.run(scenario())
+    # 任务状态先更新为已取消，CancelledError 继续向上抛出
+    assert task_cancelled
+    assert status == "cancelled"
+    assert kept
+    assert jobs == {}
+
+def test_import_cancelled_from_hashing_thread_finishes_normally(monkeypatch):
+    monkeypatch.setitem(MODEL_IMPORT_CONFIG, "RETENTION_SECONDS", 60)
+
+    async def digest(job):
+        raise ImportCancelled()
+
+    async def scenario():
+        importer = ModelImporter()
+        job = await _run_job(importer, digest)
+        await job.task
+        await ollama_transport.close()
+        return job
+
+    job = asyncio.run(scenario())
+    assert job.state["status"] == "cancelled"
+    assert not job.task.cancelled()
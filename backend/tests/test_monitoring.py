@@ -0,0 +1,24 @@
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+
+from api import monitoring
+from config import METRICS_CONFIG
+
+def _client(host: str) -> TestClient:
+    app = FastAPI()
+    app.include_router(monitoring.router)
+    return TestClient(app, client=(host, 50000))
+
+def test_ops_endpoints_default_to_loopback_only(monkeypatch):
+    monkeypatch.setitem(METRICS_CONFIG, "TOKEN", "")
+    assert _client("127.0.0.1").get("/logging").status_code == 200
+    assert _client("192.168.1.20").get("/logging").status_code == 403
+    assert _client("192.168.1.20").put("/logging/levels", json={"level": "DEBUG"}).status_code == 403
+
+def test_ops_token_is_required_from_every_host(monkeypatch):
+    monkeypatch.setitem(METRICS_CONFIG, "TOKEN", "s3cret")
+    for host in ("127.0.0.1", "192.168.1.20"):
+        client = _client(host)
+        assert client.get("/logging").status_code == 401
+        assert client.get("/logging", headers={"Authorization": "Bearer wrong"}).status_code == 401
+        assert client.get("/logging", headers={"Authorization": "Bearer s3cret"}).status_code == 200
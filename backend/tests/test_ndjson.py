@@ -0,0 +1,50 @@
+import asyncio
+import json
+
+from ollama.ndjson import LazyChunk, dumps, iter_lines, loads, peek_done, peek_error
+
+async def _collect(chunks):
+    async def source():
+        for chunk in chunks:
+            yield chunk
+    return [line async for line in iter_lines(source())]
+
+def test_iter_lines_rejoins_arbitrary_splits():
+    payload = b'{"a":1}\n{"b":"\xe4\xbd\xa0"}\n\n{"c":3}'
+    for size in (1, 2, 3, 5, len(payload)):
+        chunks = [payload[i:i + size] for i in range(0, len(payload), size)]
+        lines = asyncio.run(_collect(chunks))
+        assert lines == [b'{"a":1}\n', b'{"b":"\xe4\xbd\xa0"}\n', b'{"c":3}']
+
+def test_iter_lines_skips_empty_chunks_and_blank_tail():
+    assert asyncio.run(_collect([b"", b'{"a":1}\n', b"", b"  \n", b" "])) == [b'{"a":1}\n', b"  \n"]
+
+def test_peek_done():
+    assert peek_done(b'{"model":"m","done":true}\n')
+    assert peek_done(b'{"model": "m", "done": true}\n')
+    assert not peek_done(b'{"message":{"content":"\\"done\\":true"},"done":false}\n')
+
+def test_lazy_chunk_parses_on_demand():
+    line = (dumps({"model": "m", "message": {"role": "assistant", "content": "你好"}, "done": False}) + "\n").encode()
+    chunk = LazyChunk(line)
+    assert not chunk.done
+    assert chunk.error is None
+    # done 和 error 都只靠查看原始字节判断
+    assert chunk._data is None
+    assert chunk.content == "你好"
+    assert chunk.model == "m"
+
+def test_lazy_chunk_error_and_stats():
+    assert LazyChunk(b'{"error":"model not found"}\n').error == "model not found"
+    # 内容中带引号的 "error" 会被转义，不会被当作错误字段
+    quoted = LazyChunk(json.dumps({"message": {"content": 'say "error"'}, "done": False}).encode())
+    assert not peek_error(quoted.raw)
+    assert quoted.error is None
+
+    final = LazyChunk(b'{"done":true,"eval_count":12,"eval_duration":3000,"unknown":1}')
+    assert final.done
+    assert final.stats == {"eval_count": 12, "eval_duration": 3000}
+
+def test_loads_roundtrip():
+    data = {"message": {"content": "中文"}, "done": True}
+    assert loads(dumps(data).encode()) == data
@@ -0,0 +1,113 @@
+import asyncio
+from contextlib import aclosing
+
+import pytest
+
+from api.chat.node_registry import NodeRegistry
+from config import OLLAMA_NODES_CONFIG, OLLAMA_TRANSPORT_CONFIG
+from ollama.transport import OllamaTransport, ollama_transport
+from ollama.types import ChatMessage, ChatRequest
+from tests.ollama_standin import OllamaStandIn
+
+def _request(model: str = "llama3") -> ChatRequest:
+    return ChatRequest(model=model, messages=[ChatMessage(role="user", content="hello")])
+
+async def _collect(registry: NodeRegistry, request: ChatRequest) -> str:
+    content = ""
+    async with aclosing(registry.chat(request)) as chunks:
+        async for chunk in chunks:
+            content += chunk.content
+    return content
+
+def _run(scenario):
+    async def wrapper():
+        try:
+            return await scenario()
+        finally:
+            # 共享会话绑定在本次事件循环上
+            await ollama_transport.close()
+    return asyncio.run(wrapper())
+
+@pytest.fixture
+def hedging(monkeypatch):
+    monkeypatch.setitem(OLLAMA_NODES_CONFIG, "HEDGE_ENABLED", True)
+    monkeypatch.setitem(OLLAMA_NODES_CONFIG, "HEDGE_DELAY", 0.2)
+
+def test_health_check_marks_unreachable_nodes_and_syncs_models():
+    async def scenario():
+        async with OllamaStandIn("a", models=["llama3:latest"]) as a, OllamaStandIn("b", healthy=False) as b:
+            registry = NodeRegistry([a.base_url, b.base_url])
+            for _ in range(OLLAMA_NODES_CONFIG["FAIL_THRESHOLD"]):
+                await registry.check_all()
+            node_a, node_b = registry.nodes
+            assert node_a.healthy and node_a.version == "0.0.0-standin"
+            assert node_a.has_model("llama3")
+            assert not node_b.healthy
+            # 不可用的节点不再被选中
+            assert registry.select("mistral") is node_a
+
+            b.healthy = True
+            await registry.check(node_b)
+            assert node_b.healthy
+
+    _run(scenario)
+
+def test_select_prefers_model_affinity_then_least_in_flight():
+    async def scenario():
+        async with OllamaStandIn("a") as a, OllamaStandIn("b", models=["qwen2.5:7b"]) as b:
+            registry = NodeRegistry([a.base_url, b.base_url])
+            await registry.check_all()
+            node_a, node_b = registry.nodes
+
+            node_b.in_flight = 5
+            assert registry.select("qwen2.5:7b") is node_b
+            assert registry.select("llama3") is node_a
+
+            node_a.in_flight = 6
+            assert registry.select("llama3") is node_b
+
+    _run(scenario)
+
+def test_chat_routes_to_selected_node_and_learns_loaded_model():
+    async def scenario():
+        async with OllamaStandIn("a") as a, OllamaStandIn("b") as b:
+            registry = NodeRegistry([a.base_url, b.base_url])
+            registry.nodes[0].in_flight = 1
+            content = await _collect(registry, _request())
+            node_b = registry.nodes[1]
+            assert content == "b says hi"
+            assert node_b.has_model("llama3") and node_b.in_flight == 0
+            assert (a.chat_requests, b.chat_requests) == (0, 1)
+
+    _run(scenario)
+
+def test_hedged_request_wins_on_faster_node(hedging):
+    async def scenario():
+        async with OllamaStandIn("slow", first_token_delay=2.0) as slow, OllamaStandIn("fast") as fast:
+            registry = NodeRegistry([slow.base_url, fast.base_url])
+            content = await _collect(registry, _request())
+            return content, registry.hedges_total, registry.hedge_wins_total, registry.nodes[0].in_flight
+
+    content, hedges, wins, slow_in_flight = _run(scenario)
+    assert content == "fast says hi"
+    assert (hedges, wins) == (1, 1)
+    # 落后的请求已被取消
+    assert slow_in_flight == 0
+
+def test_failed_primary_is_retried_on_another_node(hedging):
+    async def scenario():
+        async with OllamaStandIn("broken", chat_status=500) as broken, OllamaStandIn("ok") as ok:
+            registry = NodeRegistry([broken.base_url, ok.base_url])
+            content = await _collect(registry, _request())
+            return content, registry.nodes[0].errors_total
+
+    content, errors = _run(scenario)
+    assert content == "ok says hi"
+    assert errors == 1
+
+def test_unix_socket_is_ignored_with_several_nodes(monkeypatch):
+    monkeypatch.setitem(OLLAMA_TRANSPORT_CONFIG, "UNIX_SOCKET", "/tmp/ollama.sock")
+    monkeypatch.setitem(OLLAMA_NODES_CONFIG, "BASE_URLS", ["http://a:11434", "http://b:11434"])
+    assert OllamaTransport().unix_socket is None
+    monkeypatch.setitem(OLLAMA_NODES_CONFIG, "BASE_URLS", ["http://a:11434"])
+    assert OllamaTransport().unix_socket == "/tmp/ollama.sock"
@@ -0,0 +1,46 @@
+import asyncio
+import time
+
+from api.chat.residency import GB, ResidencyManager
+
+class _FakeClient:
+    def __init__(self, failing):
+        self.failing = set(failing)
+        self.unloaded = []
+
+    async def unload_model(self, model):
+        if model in self.failing:
+            raise RuntimeError("连接被拒绝")
+        self.unloaded.append(model)
+
+    async def list_running(self):
+        raise RuntimeError("不可用")
+
+def _manager(failing) -> ResidencyManager:
+    manager = ResidencyManager("http://127.0.0.1:9", 10 * GB)
+    manager.client = _FakeClient(failing)
+    manager.resident = {
+        "old:latest": {"name": "old:latest", "size": 4 * GB},
+        "older:latest": {"name": "older:latest", "size": 4 * GB},
+    }
+    manager._estimates["new:latest"] = 4 * GB
+    manager._usage("older").last_used = 1
+    manager._usage("old").last_used = 2
+    manager._last_refresh = time.monotonic()
+    return manager
+
+def test_failed_unload_keeps_the_model_counted():
+    manager = _manager(failing={"older:latest"})
+    asyncio.run(manager.ensure_capacity("new"))
+    # 卸载失败的模型仍然计入内存占用，改为淘汰下一个候选
+    assert "older:latest" in manager.resident
+    assert manager.client.unloaded == ["old:latest"]
+    assert manager.evictions_total == 1
+    # 下一次检查时重新查询 /api/ps
+    assert manager._last_refresh == 0.0
+
+def test_all_unloads_failing_does_not_loop_forever():
+    manager = _manager(failing={"older:latest", "old:latest"})
+    asyncio.run(asyncio.wait_for(manager.ensure_capacity("new"), 1))
+    assert set(manager.resident) == {"old:latest", "older:latest"}
+    assert manager.used_bytes() == 8 * GB
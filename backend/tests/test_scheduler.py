@@ -0,0 +1,179 @@
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+from api.chat.scheduler import FairScheduler, Priority, QueueFullError
+
+def _scheduler(capacity: int = 1, max_queue_length: int = 10, max_queue_per_user: int = 5) -> FairScheduler:
+    return FairScheduler(capacity, max_queue_length, max_queue_per_user, [0.1, 1])
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+def test_users_are_served_round_robin():
+    async def scenario():
+        scheduler = _scheduler()
+        order = []
+        gate = asyncio.Event()
+
+        async def request(username: str, tag: str):
+            async with scheduler.slot(username):
+                order.append(tag)
+                await gate.wait()
+
+        holder = asyncio.create_task(request("alice", "a0"))
+        await _settle()
+        tasks = [asyncio.create_task(request("alice", f"a{i}")) for i in (1, 2, 3)]
+        await _settle()
+        tasks.append(asyncio.create_task(request("bob", "b1")))
+        await _settle()
+        gate.set()
+        await asyncio.gather(holder, *tasks)
+        return order
+
+    # bob 只排了一个请求，不必等 alice 的全部请求完成
+    assert asyncio.run(scenario()) == ["a0", "a1", "b1", "a2", "a3"]
+
+def test_interactive_requests_go_before_background():
+    async def scenario():
+        scheduler = _scheduler()
+        order = []
+        gate = asyncio.Event()
+
+        async def request(username: str, priority: Priority):
+            async with scheduler.slot(username, priority):
+                order.append(username)
+                await gate.wait()
+
+        holder = asyncio.create_task(request("holder", Priority.INTERACTIVE))
+        await _settle()
+        background = asyncio.create_task(request("batch", Priority.BACKGROUND))
+        await _settle()
+        interactive = asyncio.create_task(request("user", Priority.INTERACTIVE))
+        await _settle()
+        gate.set()
+        await asyncio.gather(holder, background, interactive)
+        return order
+
+    assert asyncio.run(scenario()) == ["holder", "user", "batch"]
+
+def test_full_queue_is_rejected_before_waiting():
+    async def scenario():
+        scheduler = _scheduler(max_queue_length=1)
+        gate = asyncio.Event()
+
+        async def request(username: str):
+            async with scheduler.slot(username):
+                await gate.wait()
+
+        holder = asyncio.create_task(request("alice"))
+        await _settle()
+        waiting = asyncio.create_task(request("bob"))
+        await _settle()
+        with pytest.raises(QueueFullError):
+            scheduler.slot("carol").check()
+        with pytest.raises(QueueFullError):
+            async with scheduler.slot("carol"):
+                pass
+        gate.set()
+        await asyncio.gather(holder, waiting)
+        # 队列空闲后可以正常进入
+        scheduler.slot("carol").check()
+        return scheduler.snapshot()
+
+    snapshot = asyncio.run(scenario())
+    assert snapshot["priorities"]["interactive"]["rejected_total"] == 2
+    assert snapshot["active"] == 0
+
+def test_prepare_runs_after_grant_and_hold_covers_the_wait():
+    async def scenario():
+        scheduler = _scheduler()
+        events = []
+        gate = asyncio.Event()
+
+        @asynccontextmanager
+        async def hold():
+            events.append("hold")
+            try:
+                yield
+            finally:
+                events.append("unhold")
+
+        async def prepare():
+            events.append("prepare")
+
+        async def holder():
+            async with scheduler.slot("alice"):
+                await gate.wait()
+
+        first = asyncio.create_task(holder())
+        await _settle()
+
+        async def queued():
+            async with scheduler.slot("bob", prepare=prepare, hold=hold):
+                events.append("run")
+
+        second = asyncio.create_task(queued())
+        await _settle()
+        # 排队期间已标记，但在获得槽位前不做准备工作（如加载模型）
+        assert events == ["hold"]
+        gate.set()
+        await asyncio.gather(first, second)
+        return events, scheduler.active
+
+    events, active = asyncio.run(scenario())
+    assert events == ["hold", "prepare", "run", "unhold"]
+    assert active == 0
+
+def test_failed_prepare_releases_the_slot():
+    async def scenario():
+        scheduler = _scheduler()
+
+        async def prepare():
+            raise RuntimeError("load failed")
+
+        with pytest.raises(RuntimeError):
+            async with scheduler.slot("alice", prepare=prepare):
+                pass
+        return scheduler.active
+
+    assert asyncio.run(scenario()) == 0
+
+def test_queue_positions_arrive_in_order_with_slow_notifier():
+    async def scenario():
+        scheduler = _scheduler()
+        gate = asyncio.Event()
+        received = []
+
+        class SlowNotifier:
+            def __init__(self):
+                self.delay = 0.05
+
+            async def send_json(self, frame):
+                # 越早的帧发送越慢，各帧各自建任务时会乱序到达
+                delay, self.delay = self.delay, self.delay / 2
+                await asyncio.sleep(delay)
+                received.append(frame["position"])
+
+        async def request(username: str, priority: Priority, notifier=None):
+            async with scheduler.slot(username, priority, notifier):
+                await gate.wait()
+
+        holder = asyncio.create_task(request("holder", Priority.INTERACTIVE))
+        await _settle()
+        first = asyncio.create_task(request("alice", Priority.INTERACTIVE))
+        await _settle()
+        background = asyncio.create_task(request("batch", Priority.BACKGROUND, SlowNotifier()))
+        await _settle()
+        second = asyncio.create_task(request("bob", Priority.INTERACTIVE))
+        await _settle()
+        gate.set()
+        await asyncio.gather(holder, first, background, second)
+        await asyncio.sleep(0.2)
+        return received, scheduler._send_tasks
+
+    received, pending = asyncio.run(scenario())
+    assert received == [2, 3, 2, 1, 0]
+    assert not pending
@@ -0,0 +1,90 @@
+import asyncio
+
+from api.chat import session_handler
+from api.chat.generation_registry import CancelReason, generation_registry
+from api.chat.session_handler import ChatSession
+from config import WEBSOCKET_CONFIG
+
+class _FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        self.closed = True
+
+async def _conversation(db, conversation_id, username):
+    return {"id": conversation_id, "model": "llama3", "user_id": username}
+
+def _start_turn(release: asyncio.Event):
+    """启动一个等待放行的生成，模拟 run_chat_turn"""
+    async def turn(sender, db, conversation, current_user, data, on_start=None):
+        async def produce(generation):
+            await release.wait()
+
+        generation = generation_registry.start(conversation["id"], current_user["username"], "llama3", db, produce)
+        if on_start is not None:
+            on_start(generation)
+        await generation.task
+    return turn
+
+def test_heartbeat_timeout_only_cancels_own_generations(monkeypatch):
+    monkeypatch.setattr(session_handler, "get_owned_conversation", _conversation)
+    monkeypatch.setitem(WEBSOCKET_CONFIG, "PING_INTERVAL", 0.02)
+    monkeypatch.setitem(WEBSOCKET_CONFIG, "PING_TIMEOUT", 0.0)
+
+    async def scenario():
+        stale = ChatSession(_FakeWebSocket(), db=None)
+        stale.current_user = {"username": "alice"}
+        first = asyncio.Event()
+        await stale._start_stream({"request_id": "r1", "conversation_id": "c-heartbeat"}, _start_turn(first))
+        await asyncio.sleep(0)
+        (own_id,) = stale.owned_generations
+        first.set()
+        await asyncio.sleep(0.01)
+        # 生成结束后不再记录
+        assert stale.owned_generations == set()
+
+        # 另一个标签页在同一对话中开始新的生成
+        other = ChatSession(_FakeWebSocket(), db=None)
+        other.current_user = {"username": "alice"}
+        second = asyncio.Event()
+        await other._start_stream({"request_id": "r2", "conversation_id": "c-heartbeat"}, _start_turn(second))
+        await asyncio.sleep(0)
+        (other_id,) = other.owned_generations
+
+        stale._last_seen -= 10
+        await stale._heartbeat()
+        running = generation_registry.get(other_id)
+        state = (running.finished, stale.websocket.closed)
+
+        # 心跳超时的会话取消自己发起的生成，原因为 heartbeat_timeout
+        other._last_seen -= 10
+        await other._heartbeat()
+        await asyncio.gather(running.task, return_exceptions=True)
+        return own_id, state, running
+
+    own_id, (finished, closed), running = asyncio.run(scenario())
+    assert own_id != running.id
+    assert closed and not finished
+    assert running.cancel_reason == CancelReason.HEARTBEAT_TIMEOUT
+
+def test_cancel_message_is_acknowledged(monkeypatch):
+    monkeypatch.setattr(session_handler, "get_owned_conversation", _conversation)
+
+    async def scenario():
+        session = ChatSession(_FakeWebSocket(), db=None)
+        session.current_user = {"username": "alice"}
+        await session._start_stream({"request_id": "r1", "conversation_id": "c-cancel"}, _start_turn(asyncio.Event()))
+        await asyncio.sleep(0)
+        await session._dispatch({"type": "cancel", "request_id": "r1"})
+        await asyncio.sleep(0.01)
+        await session._dispatch({"type": "cancel", "request_id": "missing"})
+        return session.websocket.sent
+
+    sent = asyncio.run(scenario())
+    assert {"type": "cancel_ack", "request_id": "r1"} in sent
+    assert sent[-1]["type"] == "error" and sent[-1]["request_id"] == "missing"
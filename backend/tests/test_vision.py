@@ -0,0 +1,24 @@
+import os
+
+from api.tools.vision import VisionPreprocessor
+from config import VISION_CONFIG
+
+def test_prune_cache_keeps_most_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setitem(VISION_CONFIG, "CACHE_MAX_ENTRIES", 2)
+    preprocessor = VisionPreprocessor(store=None, cache_dir=tmp_path, max_workers=1)
+    paths = []
+    for i, name in enumerate(("aa", "bb", "cc")):
+        path = tmp_path / name[:2] / f"{name * 32}-1024-q85"
+        path.parent.mkdir()
+        path.write_bytes(b"jpeg")
+        os.utime(path, (1000 + i, 1000 + i))
+        paths.append(path)
+    # 进行中的临时文件不计入也不删除
+    (tmp_path / "aa" / "partial.1.tmp").write_bytes(b"")
+    # 最早写入的结果刚被使用过
+    os.utime(paths[0], (2000, 2000))
+
+    preprocessor._prune_cache()
+
+    assert [path.exists() for path in paths] == [True, False, True]
+    assert (tmp_path / "aa" / "partial.1.tmp").exists()
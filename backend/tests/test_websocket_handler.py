@@ -0,0 +1,59 @@
+import asyncio
+
+import pytest
+
+from api.chat import websocket_handler
+from config import TRACING_CONFIG
+from tracing import current_trace
+
+class _FakeWebSocket:
+    def __init__(self):
+        self.sent = []
+        self.closed = False
+
+    async def accept(self):
+        pass
+
+    async def send_json(self, data):
+        self.sent.append(data)
+
+    async def close(self, code=1000, reason=None):
+        self.closed = True
+
+async def _user(token):
+    if token != "valid":
+        raise ValueError("无效的token")
+    return {"username": "tester"}
+
+async def _no_conversation(db, conversation_id, username):
+    return None
+
+async def _broken_lookup(db, conversation_id, username):
+    raise RuntimeError("database is locked")
+
+@pytest.mark.parametrize("token, lookup", [
+    ("invalid", _no_conversation),
+    ("valid", _no_conversation),
+    ("valid", _broken_lookup),
+])
+def test_early_returns_finish_trace(monkeypatch, token, lookup):
+    monkeypatch.setitem(TRACING_CONFIG, "ENABLED", True)
+    monkeypatch.setattr(websocket_handler, "get_current_user_from_token", _user)
+    monkeypatch.setattr(websocket_handler, "get_owned_conversation", lookup)
+    finished = []
+    finish_trace = websocket_handler.finish_trace
+
+    def record_finish(trace, trace_token=None):
+        finished.append(trace)
+        finish_trace(trace, trace_token)
+    monkeypatch.setattr(websocket_handler, "finish_trace", record_finish)
+
+    async def scenario():
+        websocket = _FakeWebSocket()
+        await websocket_handler.handle_websocket_connection(websocket, "conv-1", token, db=None)
+        return websocket, current_trace()
+
+    websocket, trace = asyncio.run(scenario())
+    assert "error" in websocket.sent[0] and websocket.closed
+    assert len(finished) == 1 and finished[0].finished
+    assert trace is None
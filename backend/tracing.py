@@ -0,0 +1,243 @@
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+from contextvars import ContextVar, Token
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+from config import TRACING_CONFIG
+
+# 当前请求的追踪，随 contextvars 传播到请求中创建的子任务
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("kunlab_trace", default=None)
+_current_span: ContextVar[Optional[str]] = ContextVar("kunlab_span", default=None)
+
+class Trace:
+    """一次请求（HTTP 请求或一轮 WebSocket 对话）的追踪，按名称汇总各阶段耗时"""
+
+    def __init__(self, name: str, sampled: bool = False, **attrs):
+        self.id = uuid.uuid4().hex[:16]
+        self.name = name
+        self.sampled = sampled
+        self.attrs = attrs
+        self.started_at = time.time()
+        self._t0 = time.perf_counter()
+        self.spans: List[Dict[str, Any]] = []
+        self.dropped = 0
+        self.duration: Optional[float] = None
+
+    @property
+    def finished(self) -> bool:
+        return self.duration is not None
+
+    def elapsed(self) -> float:
+        return self.duration if self.finished else time.perf_counter() - self._t0
+
+    def add(self, name: str, duration: float, start: Optional[float] = None,
+            parent: Optional[str] = None, **attrs) -> None:
+        """记录一个阶段
+
+        追踪结束后（如连接断开后仍在运行的生成任务）记录的阶段被忽略，
+        单个追踪的阶段数超过上限时只计数，避免长期运行的子任务占用内存。
+        """
+        if self.finished:
+            return
+        if len(self.spans) >= TRACING_CONFIG["MAX_SPANS"]:
+            self.dropped += 1
+            return
+        span = {
+            "name": name,
+            "start_ms": round((start - self._t0) * 1000, 3) if start is not None else None,
+            "duration_ms": round(duration * 1000, 3)
+        }
+        if parent:
+            span["parent"] = parent
+        if attrs:
+            span["attrs"] = attrs
+        self.spans.append(span)
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """按阶段名称汇总的耗时（毫秒）和次数，按首次出现的顺序"""
+        result: Dict[str, Dict[str, Any]] = {}
+        for span in self.spans:
+            item = result.setdefault(span["name"], {"ms": 0.0, "count": 0})
+            item["ms"] = round(item["ms"] + span["duration_ms"], 3)
+            item["count"] += 1
+        return result
+
+    def server_timing(self) -> str:
+        """Server-Timing 响应头的值"""
+        entries = []
+        for name, item in self.summary().items():
+            entry = f"{name};dur={item['ms']}"
+            if item["count"] > 1:
+                entry += f';desc="{item["count"]} calls"'
+            entries.append(entry)
+        entries.append(f"total;dur={round(self.elapsed() * 1000, 3)}")
+        return ", ".join(entries)
+
+    def timing_frame(self) -> Dict[str, Any]:
+        """WebSocket 流结束时发送的耗时汇总帧"""
+        return {
+            "type": "timing",
+            "trace_id": self.id,
+            "total_ms": round(self.elapsed() * 1000, 3),
+            "spans": self.summary()
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "trace_id": self.id,
+            "name": self.name,
+            "started_at": datetime.fromtimestamp(self.started_at).isoformat(),
+            "duration_ms": round(self.elapsed() * 1000, 3),
+            "attrs": self.attrs,
+            "spans": self.spans,
+            "dropped_spans": self.dropped
+        }
+
+class _Span:
+    """计时上下文管理器，同时支持 with 和 async with"""
+
+    __slots__ = ("trace", "name", "attrs", "_start", "_token")
+
+    def __init__(self, trace: Trace, name: str, attrs: Dict[str, Any]):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def __enter__(self) -> "_Span":
+        self._start = time.perf_counter()
+        self._token = _current_span.set(self.name)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        _current_span.reset(self._token)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        self.trace.add(self.name, time.perf_counter() - self._start, self._start,
+                       parent=_current_span.get(), **self.attrs)
+
+    async def __aenter__(self) -> "_Span":
+        return self.__enter__()
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        self.__exit__(exc_type, exc, tb)
+
+class _NoopSpan:
+    """没有进行中的追踪时使用，不做任何记录"""
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        pass
+
+    async def __aenter__(self) -> "_NoopSpan":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        pass
+
+_NOOP_SPAN = _NoopSpan()
+
+def span(name: str, **attrs):
+    """记录一个阶段的耗时：`with span("db"):` 或 `async with span("client"):`"""
+    trace = _current_trace.get()
+    if trace is None or trace.finished:
+        return _NOOP_SPAN
+    return _Span(trace, name, attrs)
+
+def record_span(name: str, duration: float, **attrs) -> None:
+    """直接记录已知耗时（秒）的阶段，如 Ollama 报告的提示词评估时间"""
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(name, duration, parent=_current_span.get(), **attrs)
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+def start_trace(name: str, **attrs) -> Tuple[Optional[Trace], Optional[Token]]:
+    """开始追踪，之后在当前上下文（及其中创建的任务）中记录的阶段都归入该追踪"""
+    if not TRACING_CONFIG["ENABLED"]:
+        return None, None
+    sampled = random.random() < TRACING_CONFIG["SAMPLE_RATE"]
+    trace = Trace(name, sampled, **attrs)
+    return trace, _current_trace.set(trace)
+
+def finish_trace(trace: Optional[Trace], token: Optional[Token] = None) -> None:
+    """结束追踪，按采样或慢请求阈值导出"""
+    if trace is None:
+        return
+    if token is not None:
+        _current_trace.reset(token)
+    if trace.finished:
+        return
+    trace.duration = time.perf_counter() - trace._t0
+    slow_ms = TRACING_CONFIG["SLOW_TRACE_MS"]
+    if trace.sampled or (slow_ms and trace.duration * 1000 >= slow_ms):
+        trace_exporter.export(trace)
+
+class TraceExporter:
+    """将追踪以 JSONL 格式写入本地文件
+
+    写入在单独的守护线程中进行，不阻塞事件循环；队列已满时丢弃追踪而不是等待。
+    文件超过大小上限时轮转为 .1 文件。
+    """
+
+    def __init__(self, path: str, max_bytes: int, queue_size: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._queue: "queue.Queue[Dict[str, Any]]" = queue.Queue(maxsize=queue_size)
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+        self.exported_total = 0
+        self.dropped_total = 0
+
+    def export(self, trace: Trace) -> None:
+        self._ensure_thread()
+        try:
+            self._queue.put_nowait(trace.to_dict())
+        except queue.Full:
+            self.dropped_total += 1
+
+    def _ensure_thread(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+                    self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            record = self._queue.get()
+            try:
+                os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+                if self.max_bytes and os.path.exists(self.path) and os.path.getsize(self.path) >= self.max_bytes:
+                    os.replace(self.path, self.path + ".1")
+                with open(self.path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                self.exported_total += 1
+            except Exception as e:
+                self.dropped_total += 1
+                logging.warning(f"写入追踪文件失败: {e}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "sample_rate": TRACING_CONFIG["SAMPLE_RATE"],
+            "slow_trace_ms": TRACING_CONFIG["SLOW_TRACE_MS"],
+            "exported_total": self.exported_total,
+            "dropped_total": self.dropped_total
+        }
+
+# 全局追踪导出器
+trace_exporter = TraceExporter(
+    TRACING_CONFIG["EXPORT_PATH"],
+    TRACING_CONFIG["MAX_FILE_BYTES"],
+    TRACING_CONFIG["EXPORT_QUEUE_SIZE"]
+)
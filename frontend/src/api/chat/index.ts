@@ -261,5 +261,51 @@ export const chatApi = {
       content: data.content || '',
       type: data.type || file.type || 'text/markdown'
     }
+  },
+
+  // 渐进式文档转换：以 SSE 接收已转换的内容和进度，onEvent 依次收到 start、chunk、progress、done 或 error 事件
+  convertDocumentStream: async (file: File, onEvent: (event: string, data: any) => void): Promise<void> => {
+    const formData = new FormData()
+    formData.append('file', file)
+
+    const headers: Record<string, string> = {}
+    const authHeaders = getAuthHeaders()
+    if ('Authorization' in authHeaders) {
+      headers['Authorization'] = authHeaders['Authorization']
+    }
+
+    const response = await fetch(`${API_BASE_URL}/api/doc/convert/stream`, {
+      method: 'POST',
+      headers,
+      body: formData
+    })
+
+    if (!response.ok || !response.body) {
+      const errorData = await response.json().catch(() => null)
+      throw new Error(errorData?.detail || '文档转换失败')
+    }
+
+    const reader = response.body.getReader()
+    const decoder = new TextDecoder()
+    let buffer = ''
+    while (true) {
+      const { done, value } = await reader.read()
+      if (done) break
+      buffer += decoder.decode(value, { stream: true })
+      // SSE 事件以空行分隔
+      let boundary = buffer.indexOf('\n\n')
+      while (boundary !== -1) {
+        const block = buffer.slice(0, boundary)
+        buffer = buffer.slice(boundary + 2)
+        boundary = buffer.indexOf('\n\n')
+        let event = 'message'
+        let data = ''
+        for (const line of block.split('\n')) {
+          if (line.startsWith('event:')) event = line.slice(6).trim()
+          else if (line.startsWith('data:')) data += line.slice(5).trim()
+        }
+        if (data) onEvent(event, JSON.parse(data))
+      }
+    }
   }
 }
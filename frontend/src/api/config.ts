@@ -109,6 +109,14 @@ export const getAuthHeaders = () => {
   return headers
 }
 
+// 图片地址附加认证token：<img> 标签无法携带认证头，图片接口也接受查询参数中的token
+export const withAuthToken = (url: string) => {
+  const authorization = getAuthHeaders()['Authorization']
+  if (!authorization) return url
+  const token = authorization.replace('Bearer ', '')
+  return `${url}${url.includes('?') ? '&' : '?'}token=${encodeURIComponent(token)}`
+}
+
 // 请求重试配置
 export const RETRY_CONFIG = {
   maxRetries: 3,         // 最大重试次数
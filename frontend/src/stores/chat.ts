@@ -86,6 +86,7 @@ export const useChatStore = defineStore('chat', () => {
       timestamp: new Date().toISOString(),
       model: currentModel.value,
       image: payload.image,
+      image_url: payload.image_url,
       images: payload.image ? [payload.image] : undefined,
       document: payload.document,
       showDocument: false
@@ -232,7 +233,8 @@ export const useChatStore = defineStore('chat', () => {
             messages: [{
               role: 'user',
               content: userMessage.content,
-              image: userMessage.image ? userMessage.image.split(',')[1] : undefined, // 只发送base64数据部分
+              // 图片句柄原样发送，data URL 只发送 base64 数据部分
+              image: userMessage.image?.startsWith('data:') ? userMessage.image.split(',')[1] : userMessage.image,
               document: userMessage.document
             }],
             model: currentModel.value,
@@ -10,6 +10,7 @@ export interface Message {
   image?: string
   images?: string | string[]
   image_path?: string
+  image_url?: string
   pdf?: PDFData
   document?: DocumentData
   showDocument?: boolean
@@ -38,6 +39,8 @@ export interface DocumentData {
   name: string
   content: string
   type: string
+  attachment_id?: string
+  status?: string
 }
 
 export interface Chat {
@@ -108,6 +111,7 @@ export interface ConversationUpdate {
 export interface SendMessagePayload {
   content: string
   image?: string
+  image_url?: string
   pdf?: PDFData
   document?: DocumentData
   web_search?: boolean